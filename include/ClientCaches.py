@@ -13,12 +13,20 @@ from . import HydrusImageHandling
 from . import HydrusPaths
 from . import HydrusSerialisable
 from . import HydrusThreading
+import array
+import bisect
+import hashlib
 import json
+import numpy
 import os
+import pickle
 import random
+import re
+import shutil
 from . import HydrusLocking
 import threading
 import time
+import unicodedata
 import wx
 from . import HydrusData
 from . import ClientData
@@ -26,8 +34,31 @@ from . import ClientConstants as CC
 from . import HydrusGlobals as HG
 import collections
 from . import HydrusTags
+import struct
 import traceback
 import weakref
+import zlib
+
+LZ4_OK = False
+
+try:
+    
+    import lz4.block
+    
+    LZ4_OK = True
+    
+except Exception: # see ClientRendering, an ImportError is not always enough
+    
+    pass
+    
+
+# no native popcount before numpy 2.0's bitwise_count, so we fall back to counting a byte at a time through this
+PHASH_BYTE_POPCOUNTS = numpy.array( [ bin( i ).count( '1' ) for i in range( 256 ) ], dtype = numpy.uint8 )
+
+# 4M uint64 distances is 32MB of scratch per search thread
+PHASH_SEARCH_MAX_MATRIX_CELLS = 4 * 1024 * 1024
+
+SUBTAG_WORD_RE = re.compile( r'\w+' )
 
 # now let's fill out grandparents
 def BuildServiceKeysToChildrenToParents( service_keys_to_simple_children_to_parents ):
@@ -192,6 +223,110 @@ def CollapseTagSiblingPairs( groups_of_pairs ):
     
     return siblings
     
+def GetPHashHammingDistances( xored ):
+    
+    if hasattr( numpy, 'bitwise_count' ):
+        
+        return numpy.bitwise_count( xored )
+        
+    
+    return PHASH_BYTE_POPCOUNTS[ xored.view( numpy.uint8 ) ].reshape( xored.shape + ( 8, ) ).sum( axis = -1 )
+    
+def GetPHashPairsWithinDistance( query_phashes, phashes, max_hamming_distance, num_threads = 1 ):
+    
+    # returns parallel arrays of query indices and phashes indices for every pair no further apart than max_hamming_distance
+    
+    if num_threads > 1 and len( query_phashes ) > 1:
+        
+        # numpy lets go of the GIL inside its loops, so plain threads get every core without forking the whole client
+        
+        groups_of_query_indices = [ query_indices for query_indices in numpy.array_split( numpy.arange( len( query_phashes ) ), num_threads ) if len( query_indices ) > 0 ]
+        
+        results = [ None ] * len( groups_of_query_indices )
+        
+        def work_on_group( i, query_indices ):
+            
+            try:
+                
+                ( group_query_indices, phash_indices ) = GetPHashPairsWithinDistance( query_phashes[ query_indices ], phashes, max_hamming_distance )
+                
+                results[ i ] = ( query_indices[ group_query_indices ], phash_indices )
+                
+            except Exception as e:
+                
+                results[ i ] = e
+                
+            
+        
+        threads = [ threading.Thread( target = work_on_group, args = ( i, query_indices ), daemon = True ) for ( i, query_indices ) in enumerate( groups_of_query_indices ) ]
+        
+        for thread in threads:
+            
+            thread.start()
+            
+        
+        for thread in threads:
+            
+            thread.join()
+            
+        
+        for result in results:
+            
+            if isinstance( result, Exception ):
+                
+                raise result
+                
+            
+        
+    else:
+        
+        results = []
+        
+        # the distance matrix for a whole block against the whole index would be huge, so we walk the index in tiles
+        
+        tile_size = max( 1, PHASH_SEARCH_MAX_MATRIX_CELLS // max( 1, len( query_phashes ) ) )
+        
+        for tile_start in range( 0, len( phashes ), tile_size ):
+            
+            tile = phashes[ tile_start : tile_start + tile_size ]
+            
+            distances = GetPHashHammingDistances( numpy.bitwise_xor( query_phashes[ :, None ], tile[ None, : ] ) )
+            
+            ( query_indices, tile_indices ) = numpy.nonzero( distances <= max_hamming_distance )
+            
+            results.append( ( query_indices, tile_indices + tile_start ) )
+            
+        
+    
+    if len( results ) == 0:
+        
+        return ( numpy.zeros( 0, dtype = numpy.int64 ), numpy.zeros( 0, dtype = numpy.int64 ) )
+        
+    
+    return ( numpy.concatenate( [ query_indices for ( query_indices, phash_indices ) in results ] ), numpy.concatenate( [ phash_indices for ( query_indices, phash_indices ) in results ] ) )
+    
+def GetSubtagTrigrams( subtag ):
+    
+    return { subtag[ i : i + 3 ] for i in range( len( subtag ) - 2 ) }
+    
+def NormaliseSubtagForIndex( subtag ):
+    
+    # the subtag columns compare with utf8mb4_0900_ai_ci, which ignores case and accents, so the in-memory index folds both away too
+    
+    subtag = unicodedata.normalize( 'NFKD', subtag.casefold() )
+    
+    return ''.join( ( c for c in subtag if not unicodedata.combining( c ) ) )
+    
+def GetSubtagWords( searchable_subtag ):
+    
+    # every point a fulltext word match could start from, so 'gun*' finds 'gundam' and 'big gun'
+    
+    words = { searchable_subtag }
+    
+    words.update( ( searchable_subtag[ match.start() : ] for match in SUBTAG_WORD_RE.finditer( searchable_subtag ) ) )
+    
+    return words
+    
 def LoopInSimpleChildrenToParents( simple_children_to_parents, child, parent ):
     
     potential_loop_paths = { parent }
@@ -582,6 +717,184 @@ class DataCache( object ):
             
         
     
+class FileSearchResultCache( object ):
+    
+    def __init__( self, max_num_ids ):
+        
+        self._max_num_ids = max_num_ids
+        
+        # search key -> ( sorted hash_id array, dependencies ), oldest first
+        self._keys_to_results = collections.OrderedDict()
+        self._dependencies_to_keys = collections.defaultdict( set )
+        
+        self._num_ids = 0
+        
+        # a search that started before an invalidation, or while one is uncommitted, may have seen old rows, so it is not allowed to store its result
+        self._generation = 0
+        self._invalidated_since_commit = False
+        
+        self._num_hits = 0
+        self._num_misses = 0
+        
+        self._lock = HydrusLocking.LogLock( 'FileSearchResultCache' )
+        
+    
+    def _Cull( self ):
+        
+        while self._num_ids > self._max_num_ids and len( self._keys_to_results ) > 0:
+            
+            ( key, ( hash_ids, dependencies ) ) = next( iter( self._keys_to_results.items() ) )
+            
+            self._DeleteResult( key )
+            
+        
+    
+    def _DeleteResult( self, key ):
+        
+        ( hash_ids, dependencies ) = self._keys_to_results.pop( key )
+        
+        self._num_ids -= len( hash_ids )
+        
+        for dependency in dependencies:
+            
+            keys = self._dependencies_to_keys[ dependency ]
+            
+            keys.discard( key )
+            
+            if len( keys ) == 0:
+                
+                del self._dependencies_to_keys[ dependency ]
+                
+            
+        
+    
+    def __len__( self ):
+        
+        with self._lock:
+            
+            return len( self._keys_to_results )
+            
+        
+    
+    def AddResult( self, key, generation, hash_ids, dependencies ):
+        
+        with self._lock:
+            
+            if generation != self._generation or self._invalidated_since_commit:
+                
+                return
+                
+            
+            if len( hash_ids ) > self._max_num_ids:
+                
+                return
+                
+            
+            if key in self._keys_to_results:
+                
+                self._DeleteResult( key )
+                
+            
+            hash_ids = array.array( 'I', sorted( hash_ids ) )
+            
+            self._keys_to_results[ key ] = ( hash_ids, dependencies )
+            
+            self._num_ids += len( hash_ids )
+            
+            for dependency in dependencies:
+                
+                self._dependencies_to_keys[ dependency ].add( key )
+                
+            
+            self._Cull()
+            
+        
+    
+    def Clear( self ):
+        
+        with self._lock:
+            
+            self._keys_to_results = collections.OrderedDict()
+            self._dependencies_to_keys = collections.defaultdict( set )
+            
+            self._num_ids = 0
+            
+            self._generation += 1
+            self._invalidated_since_commit = True
+            
+        
+    
+    def GetGeneration( self ):
+        
+        with self._lock:
+            
+            return self._generation
+            
+        
+    
+    def GetResult( self, key ):
+        
+        with self._lock:
+            
+            if key in self._keys_to_results:
+                
+                self._num_hits += 1
+                
+                self._keys_to_results.move_to_end( key )
+                
+                ( hash_ids, dependencies ) = self._keys_to_results[ key ]
+                
+                return hash_ids
+                
+            else:
+                
+                self._num_misses += 1
+                
+                return None
+                
+            
+        
+    
+    def GetStats( self ):
+        
+        with self._lock:
+            
+            return ( len( self._keys_to_results ), self._num_ids, self._max_num_ids, self._num_hits, self._num_misses )
+            
+        
+    
+    def Invalidate( self, dependencies ):
+        
+        with self._lock:
+            
+            for dependency in dependencies:
+                
+                if dependency in self._dependencies_to_keys:
+                    
+                    for key in list( self._dependencies_to_keys[ dependency ] ):
+                        
+                        self._DeleteResult( key )
+                        
+                    
+                
+            
+            self._generation += 1
+            self._invalidated_since_commit = True
+            
+        
+    
+    def NotifyCommitted( self ):
+        
+        with self._lock:
+            
+            if self._invalidated_since_commit:
+                
+                self._generation += 1
+                self._invalidated_since_commit = False
+                
+            
+        
+    
 class FileViewingStatsManager( object ):
     
     def __init__( self, controller ):
@@ -726,96 +1039,715 @@ class FileViewingStatsManager( object ):
         self._PubSubRow( hash, row )
         
 
-class LocalBooruCache( object ):
+class JSONDumpStore( object ):
     
-    def __init__( self, controller ):
+    # serialisable dumps live as content-addressed blobs under JSON_PATH, and the db rows only hold blob names
+    # this counts the rows pointing at each blob, so an unchanged object is not written again and an unreferenced blob is deleted a few at a time once that is committed
+    
+    GRACE_PERIOD = 300
+    
+    LEGACY_SUFFIX = '.json'
+    
+    def __init__( self, path ):
         
-        self._controller = controller
+        self._path = path
         
-        self._lock = HydrusLocking.LogLock('LocalBooruCache')
+        # content key ( '<sha256>.json' or '<sha256>.list' ) -> blob name on disk
+        self._keys_to_names = {}
         
-        self._RefreshShares()
+        self._rows_to_names = {}
+        self._names_to_counts = collections.Counter()
+        self._manifest_names_to_child_names = {}
         
-        self._controller.sub( self, 'RefreshShares', 'refresh_local_booru_shares' )
-        self._controller.sub( self, 'RefreshShares', 'restart_client_server_service' )
+        self._index_loaded = False
         
-    
-    def _CheckDataUsage( self ):
+        self._uncommitted_orphan_names = set()
+        self._orphan_names_to_timestamps = collections.OrderedDict()
         
-        if not self._local_booru_service.BandwidthOK():
-            
-            raise HydrusExceptions.InsufficientCredentialsException( 'This booru has used all its monthly data. Please try again next month.' )
-            
+        # a rollback only needs the index reloaded if a row moved since the last commit
+        self._rows_changed_since_commit = False
         
-    
-    def _CheckFileAuthorised( self, share_key, hash ):
+        self._lock = threading.Lock()
         
-        self._CheckShareAuthorised( share_key )
+        self._LoadExistingNames()
         
-        info = self._GetInfo( share_key )
+    
+    def _AddRef( self, name ):
         
-        if hash not in info[ 'hashes_set' ]:
+        self._names_to_counts[ name ] += 1
+        
+        if self._names_to_counts[ name ] == 1:
             
-            raise HydrusExceptions.NotFoundException( 'That file was not found in that share.' )
+            self._uncommitted_orphan_names.discard( name )
+            
+            if name in self._orphan_names_to_timestamps:
+                
+                del self._orphan_names_to_timestamps[ name ]
+                
+            
+            if self._IsManifest( name ):
+                
+                for child_name in self._GetManifestChildNames( name ):
+                    
+                    self._AddRef( child_name )
+                    
+                
             
         
     
-    def _CheckShareAuthorised( self, share_key ):
-        
-        self._CheckDataUsage()
+    def _Compress( self, data ):
         
-        info = self._GetInfo( share_key )
-        
-        timeout = info[ 'timeout' ]
-        
-        if timeout is not None and HydrusData.TimeHasPassed( timeout ):
+        if LZ4_OK:
             
-            raise HydrusExceptions.InsufficientCredentialsException( 'This share has expired.' )
+            return ( lz4.block.compress( data ), '.lz4' )
+            
+        else:
+            
+            return ( zlib.compress( data ), '.z' )
             
         
     
-    def _GetInfo( self, share_key ):
-        
-        try: info = self._keys_to_infos[ share_key ]
-        except: raise HydrusExceptions.NotFoundException( 'Did not find that share on this booru.' )
+    def _Decompress( self, name, data ):
         
-        if info is None:
-            
-            info = self._controller.Read( 'local_booru_share', share_key )
+        if name.endswith( '.lz4' ):
             
-            hashes = info[ 'hashes' ]
-            
-            info[ 'hashes_set' ] = set( hashes )
+            if not LZ4_OK:
+                
+                raise Exception( 'The json dump ' + name + ' is lz4 compressed, but lz4 is not available!' )
+                
             
-            media_results = self._controller.Read( 'media_results', hashes )
+            return lz4.block.decompress( data )
             
-            info[ 'media_results' ] = media_results
+        elif name.endswith( '.z' ):
             
-            hashes_to_media_results = { media_result.GetHash() : media_result for media_result in media_results }
+            return zlib.decompress( data )
             
-            info[ 'hashes_to_media_results' ] = hashes_to_media_results
+        else:
             
-            self._keys_to_infos[ share_key ] = info
+            return data
             
         
-        return info
-        
     
-    def _RefreshShares( self ):
+    def _GetKey( self, name ):
         
-        self._local_booru_service = self._controller.services_manager.GetService( CC.LOCAL_BOORU_SERVICE_KEY )
+        if name.endswith( self.LEGACY_SUFFIX ):
+            
+            return name
+            
         
-        self._keys_to_infos = {}
+        return os.path.splitext( name )[0]
         
-        share_keys = self._controller.Read( 'local_booru_share_keys' )
+    
+    def _GetManifestChildNames( self, name ):
         
-        for share_key in share_keys:
+        if name not in self._manifest_names_to_child_names:
             
-            self._keys_to_infos[ share_key ] = None
+            self._manifest_names_to_child_names[ name ] = json.loads( self._ReadText( name ) )
             
         
+        return self._manifest_names_to_child_names[ name ]
+        
     
-    def CheckShareAuthorised( self, share_key ):
+    def _IsManifest( self, name ):
+        
+        return self._GetKey( name ).endswith( '.list' )
+        
+    
+    def _LoadExistingNames( self ):
+        
+        if not os.path.exists( self._path ):
+            
+            return
+            
+        
+        for entry in os.scandir( self._path ):
+            
+            name = entry.name
+            
+            if name.endswith( self.LEGACY_SUFFIX ) or name.endswith( '.lz4' ) or name.endswith( '.z' ):
+                
+                self._keys_to_names[ self._GetKey( name ) ] = name
+                
+            
+        
+    
+    def _ReadText( self, name ):
+        
+        with open( os.path.join( self._path, name ), 'rb' ) as f:
+            
+            data = f.read()
+            
+        
+        return str( self._Decompress( name, data ), 'utf-8' )
+        
+    
+    def _RemoveRef( self, name ):
+        
+        self._names_to_counts[ name ] -= 1
+        
+        if self._names_to_counts[ name ] <= 0:
+            
+            del self._names_to_counts[ name ]
+            
+            self._uncommitted_orphan_names.add( name )
+            
+            if self._IsManifest( name ):
+                
+                for child_name in self._GetManifestChildNames( name ):
+                    
+                    self._RemoveRef( child_name )
+                    
+                
+            
+        
+    
+    def _WriteBlob( self, text, kind ):
+        
+        data = text.encode( 'utf-8' )
+        
+        key = hashlib.sha256( data ).hexdigest() + '.' + kind
+        
+        with self._lock:
+            
+            if key in self._keys_to_names:
+                
+                return self._keys_to_names[ key ]
+                
+            
+            ( compressed_data, suffix ) = self._Compress( data )
+            
+            name = key + suffix
+            
+            path = os.path.join( self._path, name )
+            temp_path = path + '.' + str( os.getpid() ) + '.tmp'
+            
+            # a blob is never rewritten once it exists, so it must never exist half-written
+            
+            with open( temp_path, 'wb' ) as f:
+                
+                f.write( compressed_data )
+                
+            
+            os.replace( temp_path, path )
+            
+            self._keys_to_names[ key ] = name
+            
+            return name
+            
+        
+    
+    def CollectGarbage( self, max_num_to_delete = 20 ):
+        
+        with self._lock:
+            
+            if not self._index_loaded:
+                
+                return 0
+                
+            
+            num_deleted = 0
+            
+            # oldest first, so we can stop at the first one still in its grace period. a reader may be on an older snapshot that still points at it
+            
+            while len( self._orphan_names_to_timestamps ) > 0 and num_deleted < max_num_to_delete:
+                
+                ( name, timestamp ) = next( iter( self._orphan_names_to_timestamps.items() ) )
+                
+                if not HydrusData.TimeHasPassed( timestamp + self.GRACE_PERIOD ):
+                    
+                    break
+                    
+                
+                del self._orphan_names_to_timestamps[ name ]
+                
+                if name in self._names_to_counts:
+                    
+                    continue
+                    
+                
+                try:
+                    
+                    os.remove( os.path.join( self._path, name ) )
+                    
+                except FileNotFoundError:
+                    
+                    pass
+                    
+                except Exception as e:
+                    
+                    HydrusData.Print( 'Could not delete the unused json dump ' + name + ':' )
+                    
+                    HydrusData.PrintException( e )
+                    
+                
+                key = self._GetKey( name )
+                
+                if self._keys_to_names.get( key ) == name:
+                    
+                    del self._keys_to_names[ key ]
+                    
+                
+                if name in self._manifest_names_to_child_names:
+                    
+                    del self._manifest_names_to_child_names[ name ]
+                    
+                
+                num_deleted += 1
+                
+            
+            return num_deleted
+            
+        
+    
+    def DeleteRows( self, row_key_prefix ):
+        
+        with self._lock:
+            
+            row_keys = [ row_key for row_key in self._rows_to_names if row_key[ : len( row_key_prefix ) ] == row_key_prefix ]
+            
+            for row_key in row_keys:
+                
+                self._RemoveRef( self._rows_to_names.pop( row_key ) )
+                
+            
+            if len( row_keys ) > 0:
+                
+                self._rows_changed_since_commit = True
+                
+            
+        
+    
+    def GetNumOrphans( self ):
+        
+        with self._lock:
+            
+            return len( self._uncommitted_orphan_names ) + len( self._orphan_names_to_timestamps )
+            
+        
+    
+    def LoadIndex( self, rows ):
+        
+        with self._lock:
+            
+            self._rows_to_names = {}
+            self._names_to_counts = collections.Counter()
+            
+            for ( row_key, name ) in rows:
+                
+                if name is None:
+                    
+                    continue
+                    
+                
+                self._rows_to_names[ row_key ] = name
+                
+                try:
+                    
+                    self._AddRef( name )
+                    
+                except Exception as e:
+                    
+                    HydrusData.Print( 'The json dump ' + name + ' could not be read when indexing the dump store:' )
+                    
+                    HydrusData.PrintException( e )
+                    
+                
+            
+            # whatever is on disk and not pointed at is left over from a crash, a rollback or the old uuid store
+            
+            now = HydrusData.GetNow()
+            
+            self._rows_changed_since_commit = False
+            
+            self._uncommitted_orphan_names = set()
+            self._orphan_names_to_timestamps = collections.OrderedDict()
+            
+            for name in self._keys_to_names.values():
+                
+                if name not in self._names_to_counts:
+                    
+                    self._orphan_names_to_timestamps[ name ] = now
+                    
+                
+            
+            self._index_loaded = True
+            
+        
+    
+    def MirrorLiveBlobs( self, dest_dir ):
+        
+        # blobs never change, so one already in dest under the same name is skipped
+        # nothing is removed from dest here, as an older copy of the db may still point at what is there. PruneMirroredBlobs does that once it is replaced
+        
+        HydrusPaths.MakeSureDirectoryExists( dest_dir )
+        
+        with self._lock:
+            
+            live_names = set( self._names_to_counts.keys() )
+            
+            existing_names = { name for name in os.listdir( dest_dir ) if not name.endswith( '.tmp' ) }
+            
+            for name in live_names.difference( existing_names ):
+                
+                dest_path = os.path.join( dest_dir, name )
+                temp_path = dest_path + '.tmp'
+                
+                shutil.copy2( os.path.join( self._path, name ), temp_path )
+                
+                os.replace( temp_path, dest_path )
+                
+            
+        
+        return live_names
+        
+    
+    @staticmethod
+    def PruneMirroredBlobs( dest_dir, live_names ):
+        
+        for name in os.listdir( dest_dir ):
+            
+            if name not in live_names:
+                
+                os.remove( os.path.join( dest_dir, name ) )
+                
+            
+        
+    
+    def NotifyCommitted( self ):
+        
+        with self._lock:
+            
+            self._rows_changed_since_commit = False
+            
+            if len( self._uncommitted_orphan_names ) > 0:
+                
+                now = HydrusData.GetNow()
+                
+                for name in self._uncommitted_orphan_names:
+                    
+                    self._orphan_names_to_timestamps[ name ] = now
+                    
+                
+                self._uncommitted_orphan_names = set()
+                
+            
+        
+    
+    def Read( self, name, json_load = True ):
+        
+        if self._IsManifest( name ):
+            
+            with self._lock:
+                
+                child_names = self._GetManifestChildNames( name )
+                
+            
+            value = [ self.Read( child_name ) for child_name in child_names ]
+            
+            return value if json_load else json.dumps( value )
+            
+        
+        text = self._ReadText( name )
+        
+        return json.loads( text ) if json_load else text
+        
+    
+    def RowsChangedSinceCommit( self ):
+        
+        with self._lock:
+            
+            return self._rows_changed_since_commit
+            
+        
+    
+    def SetRow( self, row_key, name ):
+        
+        with self._lock:
+            
+            old_name = self._rows_to_names.get( row_key, None )
+            
+            self._rows_to_names[ row_key ] = name
+            
+            self._rows_changed_since_commit = True
+            
+            self._AddRef( name )
+            
+            if old_name is not None:
+                
+                self._RemoveRef( old_name )
+                
+            
+        
+    
+    def Write( self, dump, json_dump = True, split = False ):
+        
+        if json_dump and split and isinstance( dump, ( list, tuple ) ):
+            
+            # each item is its own blob, so saving a big list where only a few items changed only writes those and a small manifest
+            
+            child_names = [ self.Write( item ) for item in dump ]
+            
+            name = self._WriteBlob( json.dumps( child_names ), 'list' )
+            
+            with self._lock:
+                
+                self._manifest_names_to_child_names[ name ] = child_names
+                
+            
+            return name
+            
+        
+        text = json.dumps( dump ) if json_dump else dump
+        
+        return self._WriteBlob( text, 'json' )
+        
+    
+class LRUCache( object ):
+    
+    def __init__( self, max_size, name = 'LRUCache' ):
+        
+        self._name = name
+        self._max_size = max_size
+        
+        # an OrderedDict keeps recency order in its own linked list, so touching and evicting are both O(1)
+        self._keys_to_values = collections.OrderedDict()
+        
+        self._num_hits = 0
+        self._num_misses = 0
+        
+        self._lock = HydrusLocking.LogLock( name )
+        
+    
+    def _Cull( self ):
+        
+        while len( self._keys_to_values ) > self._max_size:
+            
+            self._keys_to_values.popitem( last = False )
+            
+        
+    
+    def __contains__( self, key ):
+        
+        with self._lock:
+            
+            return key in self._keys_to_values
+            
+        
+    
+    def __len__( self ):
+        
+        with self._lock:
+            
+            return len( self._keys_to_values )
+            
+        
+    
+    def AddData( self, key, value ):
+        
+        with self._lock:
+            
+            self._keys_to_values[ key ] = value
+            
+            self._keys_to_values.move_to_end( key )
+            
+            self._Cull()
+            
+        
+    
+    def AddManyData( self, keys_to_values ):
+        
+        with self._lock:
+            
+            for ( key, value ) in keys_to_values.items():
+                
+                self._keys_to_values[ key ] = value
+                
+                self._keys_to_values.move_to_end( key )
+                
+            
+            self._Cull()
+            
+        
+    
+    def Clear( self ):
+        
+        with self._lock:
+            
+            self._keys_to_values = collections.OrderedDict()
+            
+        
+    
+    def DeleteData( self, key ):
+        
+        with self._lock:
+            
+            if key in self._keys_to_values:
+                
+                del self._keys_to_values[ key ]
+                
+            
+        
+    
+    def GetAllData( self ):
+        
+        with self._lock:
+            
+            return list( self._keys_to_values.items() )
+            
+        
+    
+    def GetIfHasData( self, key ):
+        
+        with self._lock:
+            
+            if key in self._keys_to_values:
+                
+                self._num_hits += 1
+                
+                self._keys_to_values.move_to_end( key )
+                
+                return self._keys_to_values[ key ]
+                
+            else:
+                
+                self._num_misses += 1
+                
+                return None
+                
+            
+        
+    
+    def GetManyDataAndMissing( self, keys ):
+        
+        with self._lock:
+            
+            keys_to_values = {}
+            missing_keys = []
+            
+            for key in keys:
+                
+                if key in self._keys_to_values:
+                    
+                    self._keys_to_values.move_to_end( key )
+                    
+                    keys_to_values[ key ] = self._keys_to_values[ key ]
+                    
+                else:
+                    
+                    missing_keys.append( key )
+                    
+                
+            
+            self._num_hits += len( keys_to_values )
+            self._num_misses += len( missing_keys )
+            
+            return ( keys_to_values, missing_keys )
+            
+        
+    
+    def GetName( self ):
+        
+        return self._name
+        
+    
+    def GetStats( self ):
+        
+        with self._lock:
+            
+            return ( len( self._keys_to_values ), self._max_size, self._num_hits, self._num_misses )
+            
+        
+    
+class LocalBooruCache( object ):
+    
+    def __init__( self, controller ):
+        
+        self._controller = controller
+        
+        self._lock = HydrusLocking.LogLock('LocalBooruCache')
+        
+        self._RefreshShares()
+        
+        self._controller.sub( self, 'RefreshShares', 'refresh_local_booru_shares' )
+        self._controller.sub( self, 'RefreshShares', 'restart_client_server_service' )
+        
+    
+    def _CheckDataUsage( self ):
+        
+        if not self._local_booru_service.BandwidthOK():
+            
+            raise HydrusExceptions.InsufficientCredentialsException( 'This booru has used all its monthly data. Please try again next month.' )
+            
+        
+    
+    def _CheckFileAuthorised( self, share_key, hash ):
+        
+        self._CheckShareAuthorised( share_key )
+        
+        info = self._GetInfo( share_key )
+        
+        if hash not in info[ 'hashes_set' ]:
+            
+            raise HydrusExceptions.NotFoundException( 'That file was not found in that share.' )
+            
+        
+    
+    def _CheckShareAuthorised( self, share_key ):
+        
+        self._CheckDataUsage()
+        
+        info = self._GetInfo( share_key )
+        
+        timeout = info[ 'timeout' ]
+        
+        if timeout is not None and HydrusData.TimeHasPassed( timeout ):
+            
+            raise HydrusExceptions.InsufficientCredentialsException( 'This share has expired.' )
+            
+        
+    
+    def _GetInfo( self, share_key ):
+        
+        try: info = self._keys_to_infos[ share_key ]
+        except: raise HydrusExceptions.NotFoundException( 'Did not find that share on this booru.' )
+        
+        if info is None:
+            
+            info = self._controller.Read( 'local_booru_share', share_key )
+            
+            hashes = info[ 'hashes' ]
+            
+            info[ 'hashes_set' ] = set( hashes )
+            
+            media_results = self._controller.Read( 'media_results', hashes )
+            
+            info[ 'media_results' ] = media_results
+            
+            hashes_to_media_results = { media_result.GetHash() : media_result for media_result in media_results }
+            
+            info[ 'hashes_to_media_results' ] = hashes_to_media_results
+            
+            self._keys_to_infos[ share_key ] = info
+            
+        
+        return info
+        
+    
+    def _RefreshShares( self ):
+        
+        self._local_booru_service = self._controller.services_manager.GetService( CC.LOCAL_BOORU_SERVICE_KEY )
+        
+        self._keys_to_infos = {}
+        
+        share_keys = self._controller.Read( 'local_booru_share_keys' )
+        
+        for share_key in share_keys:
+            
+            self._keys_to_infos[ share_key ] = None
+            
+        
+    
+    def CheckShareAuthorised( self, share_key ):
         
         with self._lock: self._CheckShareAuthorised( share_key )
         
@@ -881,31 +1813,57 @@ class LocalBooruCache( object ):
     
 class MediaResultCache( object ):
     
-    def __init__( self ):
+    def __init__( self, strong_cache_size = 0, snapshot_path = None ):
         
         self._lock = HydrusLocking.LogLock('MediaResultCache')
         
         self._hash_ids_to_media_results = weakref.WeakValueDictionary()
         self._hashes_to_media_results = weakref.WeakValueDictionary()
         
+        # the weak dicts forget a result as soon as its page closes, so an optional strong lru keeps the most recent ones alive, and they are saved to disk on shutdown
+        
+        self._strong_media_results = None
+        self._snapshot = None
+        self._snapshot_path = snapshot_path
+        
+        if strong_cache_size > 0:
+            
+            self._strong_media_results = LRUCache( strong_cache_size, 'media_results' )
+            
+            if snapshot_path is not None:
+                
+                self._snapshot = MediaResultSnapshot( snapshot_path )
+                
+            
+        
         HG.client_controller.sub( self, 'ProcessContentUpdates', 'content_updates_data' )
         HG.client_controller.sub( self, 'ProcessServiceUpdates', 'service_updates_data' )
         HG.client_controller.sub( self, 'NewForceRefreshTags', 'notify_new_force_refresh_tags_data' )
         HG.client_controller.sub( self, 'NewSiblings', 'notify_new_siblings_data' )
         
     
+    def _AddMediaResults( self, media_results ):
+        
+        for media_result in media_results:
+            
+            hash_id = media_result.GetHashId()
+            hash = media_result.GetHash()
+            
+            self._hash_ids_to_media_results[ hash_id ] = media_result
+            self._hashes_to_media_results[ hash ] = media_result
+            
+        
+        if self._strong_media_results is not None:
+            
+            self._strong_media_results.AddManyData( { media_result.GetHashId() : media_result for media_result in media_results } )
+            
+        
+    
     def AddMediaResults( self, media_results ):
         
         with self._lock:
             
-            for media_result in media_results:
-                
-                hash_id = media_result.GetHashId()
-                hash = media_result.GetHash()
-                
-                self._hash_ids_to_media_results[ hash_id ] = media_result
-                self._hashes_to_media_results[ hash ] = media_result
-                
+            self._AddMediaResults( media_results )
             
         
     
@@ -923,6 +1881,16 @@ class MediaResultCache( object ):
                 del self._hashes_to_media_results[ hash ]
                 
             
+            if self._strong_media_results is not None:
+                
+                self._strong_media_results.DeleteData( hash_id )
+                
+            
+            if self._snapshot is not None:
+                
+                self._snapshot.DropHashes( ( hash, ) )
+                
+            
         
     
     def GetMediaResultsAndMissing( self, hash_ids ):
@@ -944,6 +1912,27 @@ class MediaResultCache( object ):
                     
                 
             
+            if self._snapshot is not None and len( missing_hash_ids ) > 0:
+                
+                restored_media_results = self._snapshot.PopMediaResults( missing_hash_ids )
+                
+                if len( restored_media_results ) > 0:
+                    
+                    self._AddMediaResults( restored_media_results )
+                    
+                    media_results.extend( restored_media_results )
+                    
+                    missing_hash_ids = [ hash_id for hash_id in missing_hash_ids if hash_id not in self._hash_ids_to_media_results ]
+                    
+                
+            
+            if self._strong_media_results is not None:
+                
+                # touch them so the lru knows what is in use
+                
+                self._strong_media_results.AddManyData( { media_result.GetHashId() : media_result for media_result in media_results } )
+                
+            
             return ( media_results, missing_hash_ids )
             
         
@@ -954,6 +1943,18 @@ class MediaResultCache( object ):
         
         with self._lock:
             
+            if self._snapshot is not None:
+                
+                self._snapshot.Clear()
+                
+            
+            if self._strong_media_results is not None:
+                
+                # no point refreshing what no page is looking at, and it would push us over the limit below
+                
+                self._strong_media_results.Clear()
+                
+            
             if len( self._hash_ids_to_media_results ) < 10000:
                 
                 hash_ids = list( self._hash_ids_to_media_results.keys() )
@@ -980,6 +1981,11 @@ class MediaResultCache( object ):
         
         with self._lock:
             
+            if self._snapshot is not None:
+                
+                self._snapshot.Clear()
+                
+            
             for media_result in list(self._hash_ids_to_media_results.values()):
                 
                 media_result.GetTagsManager().NewSiblings()
@@ -1005,6 +2011,11 @@ class MediaResultCache( object ):
                             
                         
                     
+                    if self._snapshot is not None:
+                        
+                        self._snapshot.DropHashes( hashes )
+                        
+                    
                 
             
         
@@ -1021,6 +2032,11 @@ class MediaResultCache( object ):
                     
                     if action in ( HC.SERVICE_UPDATE_DELETE_PENDING, HC.SERVICE_UPDATE_RESET ):
                         
+                        if self._snapshot is not None:
+                            
+                            self._snapshot.Clear()
+                            
+                        
                         for media_result in list(self._hash_ids_to_media_results.values()):
                             
                             if action == HC.SERVICE_UPDATE_DELETE_PENDING:
@@ -1037,8 +2053,201 @@ class MediaResultCache( object ):
                 
             
         
+    def SaveSnapshot( self ):
+        
+        if self._snapshot is None:
+            
+            return
+            
+        
+        with self._lock:
+            
+            media_results = [ media_result for ( hash_id, media_result ) in self._strong_media_results.GetAllData() ]
+            
+            self._snapshot.Close()
+            
+            MediaResultSnapshot.STATICWrite( self._snapshot_path, media_results )
+            
+            # the file is for the next session. opening it here would read it straight back in and delete it
+            
+            self._snapshot = None
+            
+        
+    
+MEDIA_RESULT_SNAPSHOT_FILENAME = 'client.media_results.cache'
+
+class MediaResultSnapshot( object ):
+    
+    # a one-shot store of the last session's media results. rows are only deserialised when asked for, and each is handed out once, since the live object takes over from then on
+    # the file is deleted as soon as it is read, so a crash, a restore or any other change to the db before the next clean shutdown leaves nothing stale to load
+    
+    MAGIC = b'hydrus media results 1\n'
+    
+    def __init__( self, path ):
+        
+        self._path = path
+        
+        self._data = None
+        self._data_start = 0
+        
+        self._hash_ids_to_rows = {}
+        self._hashes_to_hash_ids = {}
+        
+        if os.path.exists( path ):
+            
+            try:
+                
+                self._Load()
+                
+            except Exception as e:
+                
+                HydrusData.Print( 'Could not load the media result snapshot, so it will be discarded:' )
+                
+                HydrusData.PrintException( e )
+                
+                self.Close()
+                
+                self._hash_ids_to_rows = {}
+                self._hashes_to_hash_ids = {}
+                
+            
+        
+    
+    def _Load( self ):
+        
+        try:
+            
+            with open( self._path, 'rb' ) as f:
+                
+                data = f.read()
+                
+            
+        finally:
+            
+            MediaResultSnapshot.STATICDelete( self._path )
+            
+        
+        if len( data ) == 0:
+            
+            return
+            
+        
+        self._data = memoryview( data )
+        
+        if self._data[ : len( self.MAGIC ) ] != self.MAGIC:
+            
+            raise Exception( 'Snapshot had the wrong header!' )
+            
+        
+        index_start = len( self.MAGIC ) + 8
+        
+        ( index_length, ) = struct.unpack( '>Q', self._data[ len( self.MAGIC ) : index_start ] )
+        
+        self._data_start = index_start + index_length
+        
+        self._hash_ids_to_rows = pickle.loads( zlib.decompress( self._data[ index_start : self._data_start ] ) )
+        
+        self._hashes_to_hash_ids = { hash : hash_id for ( hash_id, ( hash, offset, length ) ) in self._hash_ids_to_rows.items() }
+        
+    
+    def Clear( self ):
+        
+        self._hash_ids_to_rows = {}
+        self._hashes_to_hash_ids = {}
+        
+    
+    def Close( self ):
+        
+        self._data = None
+        
+    
+    def DropHashes( self, hashes ):
+        
+        for hash in hashes:
+            
+            if hash in self._hashes_to_hash_ids:
+                
+                hash_id = self._hashes_to_hash_ids.pop( hash )
+                
+                del self._hash_ids_to_rows[ hash_id ]
+                
+            
+        
+    
+    
+    def PopMediaResults( self, hash_ids ):
+        
+        media_results = []
+        
+        for hash_id in hash_ids:
+            
+            if hash_id not in self._hash_ids_to_rows:
+                
+                continue
+                
+            
+            ( hash, offset, length ) = self._hash_ids_to_rows.pop( hash_id )
+            
+            del self._hashes_to_hash_ids[ hash ]
+            
+            start = self._data_start + offset
+            
+            media_results.append( pickle.loads( zlib.decompress( self._data[ start : start + length ] ) ) )
+            
+        
+        return media_results
+        
+    
+    @staticmethod
+    def STATICDelete( path ):
+        
+        if os.path.exists( path ):
+            
+            os.remove( path )
+            
+        
     
+    @staticmethod
+    def STATICWrite( path, media_results ):
+        
+        hash_ids_to_rows = {}
+        blocks = []
+        
+        offset = 0
+        
+        for media_result in media_results:
+            
+            block = zlib.compress( pickle.dumps( media_result, protocol = pickle.HIGHEST_PROTOCOL ) )
+            
+            hash_ids_to_rows[ media_result.GetHashId() ] = ( media_result.GetHash(), offset, len( block ) )
+            
+            blocks.append( block )
+            
+            offset += len( block )
+            
+        
+        index = zlib.compress( pickle.dumps( hash_ids_to_rows, protocol = pickle.HIGHEST_PROTOCOL ) )
+        
+        temp_path = path + '.tmp'
+        
+        with open( temp_path, 'wb' ) as f:
+            
+            f.write( MediaResultSnapshot.MAGIC )
+            f.write( struct.pack( '>Q', len( index ) ) )
+            f.write( index )
+            
+            for block in blocks:
+                
+                f.write( block )
+                
+            
+        
+        os.replace( temp_path, path )
+        
     
+
+
+
 class MenuEventIdToActionCache( object ):
     
     def __init__( self ):
@@ -1230,12 +2439,136 @@ class ParsingCache( object ):
                 self._html_to_soups[ html ] = ( now, soup )
                 
             
-            if len( self._html_to_soups ) > 10:
-                
-                self._CleanCache()
-                
+            if len( self._html_to_soups ) > 10:
+                
+                self._CleanCache()
+                
+            
+            return soup
+            
+        
+    
+class PHashIndex( object ):
+    
+    def __init__( self, phash_ids_and_phashes = None ):
+        
+        self._lock = threading.Lock()
+        
+        self._phash_ids = numpy.zeros( 1024, dtype = numpy.int64 )
+        self._phashes = numpy.zeros( 1024, dtype = numpy.uint64 )
+        self._num_phashes = 0
+        
+        self._phash_ids_to_indices = {}
+        
+        if phash_ids_and_phashes is not None:
+            
+            self.AddPHashes( phash_ids_and_phashes )
+            
+        
+    
+    def __len__( self ):
+        
+        with self._lock:
+            
+            return self._num_phashes
+            
+        
+    
+    def _Grow( self, num_needed ):
+        
+        capacity = len( self._phashes )
+        
+        if num_needed <= capacity:
+            
+            return
+            
+        
+        while capacity < num_needed:
+            
+            capacity *= 2
+            
+        
+        self._phash_ids = numpy.resize( self._phash_ids, capacity )
+        self._phashes = numpy.resize( self._phashes, capacity )
+        
+    
+    def AddPHashes( self, phash_ids_and_phashes ):
+        
+        with self._lock:
+            
+            new_rows = [ ( phash_id, phash ) for ( phash_id, phash ) in phash_ids_and_phashes if phash_id not in self._phash_ids_to_indices ]
+            
+            if len( new_rows ) == 0:
+                
+                return
+                
+            
+            start = self._num_phashes
+            end = start + len( new_rows )
+            
+            self._Grow( end )
+            
+            self._phash_ids[ start : end ] = [ phash_id for ( phash_id, phash ) in new_rows ]
+            self._phashes[ start : end ] = numpy.frombuffer( b''.join( phash for ( phash_id, phash ) in new_rows ), dtype = numpy.uint64 )
+            
+            for ( index, ( phash_id, phash ) ) in enumerate( new_rows, start ):
+                
+                self._phash_ids_to_indices[ phash_id ] = index
+                
+            
+            self._num_phashes = end
+            
+        
+    
+    def DeletePHashIds( self, phash_ids ):
+        
+        with self._lock:
+            
+            for phash_id in phash_ids:
+                
+                if phash_id not in self._phash_ids_to_indices:
+                    
+                    continue
+                    
+                
+                # fill the hole with the last entry so the live region stays contiguous
+                
+                index = self._phash_ids_to_indices.pop( phash_id )
+                
+                last_index = self._num_phashes - 1
+                
+                if index != last_index:
+                    
+                    last_phash_id = int( self._phash_ids[ last_index ] )
+                    
+                    self._phash_ids[ index ] = last_phash_id
+                    self._phashes[ index ] = self._phashes[ last_index ]
+                    
+                    self._phash_ids_to_indices[ last_phash_id ] = index
+                    
+                
+                self._num_phashes = last_index
+                
+            
+        
+    
+    def GetSnapshot( self ):
+        
+        with self._lock:
+            
+            return ( self._phash_ids[ : self._num_phashes ].copy(), self._phashes[ : self._num_phashes ].copy() )
             
-            return soup
+        
+    
+    def Search( self, phash, max_hamming_distance ):
+        
+        search_phash_value = numpy.frombuffer( phash, dtype = numpy.uint64 )[0]
+        
+        with self._lock:
+            
+            distances = GetPHashHammingDistances( numpy.bitwise_xor( self._phashes[ : self._num_phashes ], search_phash_value ) )
+            
+            return self._phash_ids[ : self._num_phashes ][ distances <= max_hamming_distance ].tolist()
             
         
     
@@ -1444,6 +2777,293 @@ class ServicesManager( object ):
             
         
     
+class SubtagAutocompleteIndex( object ):
+    
+    MAX_RECENT_SUBTAGS = 100000
+    
+    def __init__( self ):
+        
+        self._lock = threading.Lock()
+        
+        self._loading = False
+        self._generation = 0
+        
+        self._ClearRecent()
+        
+        self._Clear()
+        
+    
+    def _AddRecentToIndex( self, subtag_id, subtag ):
+        
+        # subtags added since the load get the same kind of index, kept small and sorted as they come in
+        
+        for word in GetSubtagWords( NormaliseSubtagForIndex( ClientSearch.ConvertTagToSearchable( subtag ) ) ):
+            
+            i = bisect.bisect_left( self._recent_words, word )
+            
+            self._recent_words.insert( i, word )
+            self._recent_word_subtag_ids.insert( i, subtag_id )
+            
+        
+        for trigram in GetSubtagTrigrams( NormaliseSubtagForIndex( subtag ) ):
+            
+            self._recent_trigrams_to_subtag_ids[ trigram ].add( subtag_id )
+            
+        
+    
+    def _Clear( self ):
+        
+        self._ready = False
+        
+        self._words = []
+        self._word_subtag_ids = array.array( 'I' )
+        self._trigrams_to_subtag_ids = {}
+        
+    
+    def _ClearRecent( self ):
+        
+        self._recent_subtags = []
+        
+        self._recent_words = []
+        self._recent_word_subtag_ids = []
+        self._recent_trigrams_to_subtag_ids = collections.defaultdict( set )
+        
+    
+    def _StartLoad( self ):
+        
+        if self._loading:
+            
+            return
+            
+        
+        self._loading = True
+        
+        HG.client_controller.CallToThreadLongRunning( self.THREADLoad, self._generation )
+        
+    
+    def AddSubtag( self, subtag_id, subtag ):
+        
+        with self._lock:
+            
+            # kept even when not ready, since a load in flight may have read its rows before this was committed
+            
+            self._recent_subtags.append( ( subtag_id, subtag ) )
+            
+            if len( self._recent_subtags ) > self.MAX_RECENT_SUBTAGS:
+                
+                # a big import has got ahead of us, so a fresh load is cheaper than growing this further
+                
+                self._ClearRecent()
+                
+                self._generation += 1
+                
+                self._Clear()
+                
+            else:
+                
+                self._AddRecentToIndex( subtag_id, subtag )
+                
+            
+        
+    
+    def BuildIndex( self, subtag_ids_and_subtags ):
+        
+        words_and_subtag_ids = []
+        trigrams_to_subtag_ids = collections.defaultdict( lambda: array.array( 'I' ) )
+        max_subtag_id = 0
+        
+        for ( subtag_id, subtag ) in subtag_ids_and_subtags:
+            
+            words_and_subtag_ids.extend( ( ( word, subtag_id ) for word in GetSubtagWords( NormaliseSubtagForIndex( ClientSearch.ConvertTagToSearchable( subtag ) ) ) ) )
+            
+            for trigram in GetSubtagTrigrams( NormaliseSubtagForIndex( subtag ) ):
+                
+                trigrams_to_subtag_ids[ trigram ].append( subtag_id )
+                
+            
+            max_subtag_id = max( max_subtag_id, subtag_id )
+            
+        
+        words_and_subtag_ids.sort()
+        
+        words = [ word for ( word, subtag_id ) in words_and_subtag_ids ]
+        word_subtag_ids = array.array( 'I', ( subtag_id for ( word, subtag_id ) in words_and_subtag_ids ) )
+        
+        return ( words, word_subtag_ids, dict( trigrams_to_subtag_ids ), max_subtag_id )
+        
+    
+    def GetSubtagIdCandidatesFromWildcard( self, wildcard ):
+        
+        # a superset of the matches, for the db to check with LIKE. None means we cannot narrow it down
+        
+        trigrams = set()
+        
+        # LIKE also treats _ and % as wildcards, so only the runs between them are literal
+        
+        for segment in re.split( '[*_%]', wildcard ):
+            
+            trigrams.update( GetSubtagTrigrams( NormaliseSubtagForIndex( segment ) ) )
+            
+        
+        if len( trigrams ) == 0:
+            
+            return None
+            
+        
+        with self._lock:
+            
+            if not self._ready:
+                
+                self._StartLoad()
+                
+                return None
+                
+            
+            postings = sorted( ( self._trigrams_to_subtag_ids.get( trigram, () ) for trigram in trigrams ), key = len )
+            
+            candidates = set( postings[0] )
+            
+            for posting in postings[1:]:
+                
+                if len( candidates ) == 0:
+                    
+                    break
+                    
+                
+                candidates.intersection_update( posting )
+                
+            
+            recent_postings = sorted( ( self._recent_trigrams_to_subtag_ids.get( trigram, set() ) for trigram in trigrams ), key = len )
+            
+            candidates.update( recent_postings[0].intersection( *recent_postings[1:] ) )
+            
+            return candidates
+            
+        
+    
+    def GetSubtagIdsFromPrefix( self, prefix, whole_word = False ):
+        
+        # prefix is in searchable form. whole_word means the match has to end at a word boundary, like a fulltext 'gun' without the '*'
+        
+        prefix = NormaliseSubtagForIndex( prefix )
+        
+        def word_matches( word ):
+            
+            if not word.startswith( prefix ):
+                
+                return False
+                
+            
+            return not whole_word or SUBTAG_WORD_RE.match( word, len( prefix ) ) is None
+            
+        
+        with self._lock:
+            
+            if not self._ready:
+                
+                self._StartLoad()
+                
+                return None
+                
+            
+            subtag_ids = set()
+            
+            for ( words, word_subtag_ids ) in ( ( self._words, self._word_subtag_ids ), ( self._recent_words, self._recent_word_subtag_ids ) ):
+                
+                start = bisect.bisect_left( words, prefix )
+                end = bisect.bisect_left( words, prefix + '\U0010ffff', start )
+                
+                if whole_word:
+                    
+                    subtag_ids.update( ( word_subtag_ids[ i ] for i in range( start, end ) if word_matches( words[ i ] ) ) )
+                    
+                else:
+                    
+                    subtag_ids.update( word_subtag_ids[ start : end ] )
+                    
+                
+            
+            return subtag_ids
+            
+        
+    
+    def IsReady( self ):
+        
+        with self._lock:
+            
+            return self._ready
+            
+        
+    
+    def Reset( self ):
+        
+        with self._lock:
+            
+            self._ClearRecent()
+            
+            self._generation += 1
+            
+            self._Clear()
+            
+        
+    
+    def StartLoad( self ):
+        
+        with self._lock:
+            
+            if not self._ready:
+                
+                self._StartLoad()
+                
+            
+        
+    
+    def THREADLoad( self, generation ):
+        
+        try:
+            
+            subtag_ids_and_subtags = HG.client_controller.Read( 'autocomplete_subtags' )
+            
+            ( words, word_subtag_ids, trigrams_to_subtag_ids, max_subtag_id ) = self.BuildIndex( subtag_ids_and_subtags )
+            
+            with self._lock:
+                
+                if generation == self._generation:
+                    
+                    self._words = words
+                    self._word_subtag_ids = word_subtag_ids
+                    self._trigrams_to_subtag_ids = trigrams_to_subtag_ids
+                    
+                    still_recent_subtags = [ ( subtag_id, subtag ) for ( subtag_id, subtag ) in self._recent_subtags if subtag_id > max_subtag_id ]
+                    
+                    self._ClearRecent()
+                    
+                    for ( subtag_id, subtag ) in still_recent_subtags:
+                        
+                        self._recent_subtags.append( ( subtag_id, subtag ) )
+                        
+                        self._AddRecentToIndex( subtag_id, subtag )
+                        
+                    
+                    self._ready = True
+                    
+                
+            
+        except Exception as e:
+            
+            HydrusData.ShowText( 'The tag autocomplete index failed to load! Autocomplete will fall back to the database for now.' )
+            
+            HydrusData.ShowException( e )
+            
+        finally:
+            
+            with self._lock:
+                
+                self._loading = False
+                
+            
+        
+    
 class TagCensorshipManager( object ):
     
     def __init__( self, controller ):
@@ -1591,15 +3211,110 @@ class TagParentsManager( object ):
         
         self._service_keys_to_children_to_parents = collections.defaultdict( HydrusData.default_dict_list )
         
+        # with a cache size set, nothing is loaded up front and parents are looked up in the db as tags are seen
+        self._lazy_cache_size = HC.TAG_RELATIONSHIP_CACHE_SIZE
+        self._service_keys_to_lazy_children_to_parents = {}
+        self._lazy_tags_being_fetched = set()
+        
         self._RefreshParents()
         
         self._lock = HydrusLocking.LogLock('TagParentsManager')
         
         self._controller.sub( self, 'NotifyNewParents', 'notify_new_parents' )
         
+        if self._lazy_cache_size > 0:
+            
+            # lazy parents are collapsed through the siblings when they are looked up, so a sibling change makes them stale too
+            self._controller.sub( self, 'NotifyNewParents', 'notify_new_siblings_data' )
+            
+        
+    
+    def _FetchLazyChildrenToParents( self, lazy_children_to_parents, service_key, tags ):
+        
+        # the full maps collapse every service's pairs through the siblings before building, so do the same here
+        if service_key == CC.COMBINED_TAG_SERVICE_KEY or self._controller.new_options.GetBoolean( 'apply_all_siblings_to_all_services' ):
+            
+            sibling_service_key = CC.COMBINED_TAG_SERVICE_KEY
+            
+        else:
+            
+            sibling_service_key = service_key
+            
+        
+        tags_to_parents = self._controller.Read( 'tag_parents_lookup', service_key, tags, sibling_service_key )
+        
+        fetched_children_to_parents = { tag : tags_to_parents.get( tag, [] ) for tag in tags }
+        
+        lazy_children_to_parents.AddManyData( fetched_children_to_parents )
+        
+        return fetched_children_to_parents
+        
+    
+    def _GetChildrenToParents( self, service_key, tags ):
+        
+        if self._lazy_cache_size == 0:
+            
+            # the full map is a defaultdict, so the lookups are done here, under the lock, rather than by the caller
+            
+            with self._lock:
+                
+                children_to_parents = self._service_keys_to_children_to_parents.get( service_key, {} )
+                
+                return { tag : list( children_to_parents[ tag ] ) if tag in children_to_parents else [] for tag in tags }
+                
+            
+        
+        with self._lock:
+            
+            if service_key not in self._service_keys_to_lazy_children_to_parents:
+                
+                self._service_keys_to_lazy_children_to_parents[ service_key ] = LRUCache( self._lazy_cache_size, 'tag_parents' )
+                
+            
+            lazy_children_to_parents = self._service_keys_to_lazy_children_to_parents[ service_key ]
+            
+        
+        ( children_to_parents, missing_tags ) = lazy_children_to_parents.GetManyDataAndMissing( set( tags ) )
+        
+        if len( missing_tags ) > 0:
+            
+            if wx.IsMainThread():
+                
+                # the gui does not wait on the db. the tags have no parents until the lookup lands in the cache
+                
+                children_to_parents.update( { tag : [] for tag in missing_tags } )
+                
+                with self._lock:
+                    
+                    missing_tags = { tag for tag in missing_tags if ( service_key, tag ) not in self._lazy_tags_being_fetched }
+                    
+                    self._lazy_tags_being_fetched.update( ( ( service_key, tag ) for tag in missing_tags ) )
+                    
+                
+                if len( missing_tags ) > 0:
+                    
+                    self._controller.CallToThread( self.THREADFetchLazyChildrenToParents, lazy_children_to_parents, service_key, missing_tags )
+                    
+                
+            else:
+                
+                # this is done outside the lock, as the db may itself be waiting on us from the middle of a search
+                children_to_parents.update( self._FetchLazyChildrenToParents( lazy_children_to_parents, service_key, missing_tags ) )
+                
+            
+        
+        return children_to_parents
+        
     
     def _RefreshParents( self ):
         
+        if self._lazy_cache_size > 0:
+            
+            self._service_keys_to_lazy_children_to_parents = {}
+            
+            return
+            
+        
         service_keys_to_statuses_to_pairs = self._controller.Read( 'tag_parents' )
         
         # first collapse siblings
@@ -1659,31 +3374,30 @@ class TagParentsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
+        children_to_parents = self._GetChildrenToParents( service_key, [ predicate.GetValue() for predicate in predicates if predicate.GetType() == HC.PREDICATE_TYPE_TAG ] )
+        
         results = []
         
-        with self._lock:
+        for predicate in predicates:
             
-            for predicate in predicates:
+            results.append( predicate )
+            
+            if predicate.GetType() == HC.PREDICATE_TYPE_TAG:
                 
-                results.append( predicate )
+                tag = predicate.GetValue()
                 
-                if predicate.GetType() == HC.PREDICATE_TYPE_TAG:
-                    
-                    tag = predicate.GetValue()
-                    
-                    parents = self._service_keys_to_children_to_parents[ service_key ][ tag ]
-                    
-                    for parent in parents:
-                        
-                        parent_predicate = ClientSearch.Predicate( HC.PREDICATE_TYPE_PARENT, parent )
-                        
-                        results.append( parent_predicate )
-                        
+                parents = children_to_parents[ tag ]
+                
+                for parent in parents:
+                    
+                    parent_predicate = ClientSearch.Predicate( HC.PREDICATE_TYPE_PARENT, parent )
+                    
+                    results.append( parent_predicate )
                     
                 
             
-            return results
-            
+        
+        return results
         
     
     def ExpandTags( self, service_key, tags, service_strict = False ):
@@ -1693,18 +3407,17 @@ class TagParentsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            tags_results = set( tags )
-            
-            for tag in tags:
-                
-                tags_results.update( self._service_keys_to_children_to_parents[ service_key ][ tag ] )
-                
+        children_to_parents = self._GetChildrenToParents( service_key, tags )
+        
+        tags_results = set( tags )
+        
+        for tag in tags:
             
-            return tags_results
+            tags_results.update( children_to_parents[ tag ] )
             
         
+        return tags_results
+        
     
     def GetParents( self, service_key, tag, service_strict = False ):
         
@@ -1713,10 +3426,9 @@ class TagParentsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            return self._service_keys_to_children_to_parents[ service_key ][ tag ]
-            
+        children_to_parents = self._GetChildrenToParents( service_key, ( tag, ) )
+        
+        return children_to_parents[ tag ]
         
     
     def NotifyNewParents( self ):
@@ -1734,6 +3446,24 @@ class TagParentsManager( object ):
             
         
     
+    def Prefetch( self, service_keys_to_tags ):
+        
+        if self._lazy_cache_size == 0:
+            
+            return
+            
+        
+        if self._controller.new_options.GetBoolean( 'apply_all_parents_to_all_services' ):
+            
+            service_keys_to_tags = { CC.COMBINED_TAG_SERVICE_KEY : { tag for tags in service_keys_to_tags.values() for tag in tags } }
+            
+        
+        for ( service_key, tags ) in service_keys_to_tags.items():
+            
+            self._GetChildrenToParents( service_key, tags )
+            
+        
+    
     def RefreshParentsIfDirty( self ):
         
         with self._lock:
@@ -1747,6 +3477,21 @@ class TagParentsManager( object ):
             
         
     
+    def THREADFetchLazyChildrenToParents( self, lazy_children_to_parents, service_key, tags ):
+        
+        try:
+            
+            self._FetchLazyChildrenToParents( lazy_children_to_parents, service_key, tags )
+            
+        finally:
+            
+            with self._lock:
+                
+                self._lazy_tags_being_fetched.difference_update( ( ( service_key, tag ) for tag in tags ) )
+                
+            
+        
+    
 class TagSiblingsManager( object ):
     
     def __init__( self, controller ):
@@ -1759,6 +3504,12 @@ class TagSiblingsManager( object ):
         self._service_keys_to_siblings = collections.defaultdict( dict )
         self._service_keys_to_reverse_lookup = collections.defaultdict( dict )
         
+        # with a cache size set, nothing is loaded up front and siblings are looked up in the db as tags are seen
+        self._lazy_cache_size = HC.TAG_RELATIONSHIP_CACHE_SIZE
+        self._service_keys_to_lazy_siblings = {}
+        self._service_keys_to_lazy_reverse_lookup = {}
+        self._lazy_tags_being_fetched = set()
+        
         self._RefreshSiblings()
         
         self._lock = HydrusLocking.LogLock('TagSiblingsManager')
@@ -1766,15 +3517,124 @@ class TagSiblingsManager( object ):
         self._controller.sub( self, 'NotifyNewSiblings', 'notify_new_siblings_data' )
         
     
-    def _CollapseTags( self, service_key, tags ):
-    
-        siblings = self._service_keys_to_siblings[ service_key ]
+    def _CollapseTags( self, siblings, tags ):
         
         return { siblings[ tag ] if tag in siblings else tag for tag in tags }
         
     
+    def _FetchIntoLazyCache( self, lazy_cache, action, service_key, tags, default ):
+        
+        fetched_tags_to_values = self._controller.Read( action, service_key, tags )
+        
+        tags_to_values = { tag : fetched_tags_to_values.get( tag, default( tag ) ) for tag in tags }
+        
+        lazy_cache.AddManyData( tags_to_values )
+        
+        return tags_to_values
+        
+    
+    def _GetFromLazyCache( self, lazy_cache, action, service_key, tags, default ):
+        
+        ( tags_to_values, missing_tags ) = lazy_cache.GetManyDataAndMissing( set( tags ) )
+        
+        if len( missing_tags ) > 0:
+            
+            if wx.IsMainThread():
+                
+                # the gui does not wait on the db. the tags have no siblings until the lookup lands in the cache, and the tag lists redraw then
+                
+                tags_to_values.update( { tag : default( tag ) for tag in missing_tags } )
+                
+                with self._lock:
+                    
+                    missing_tags = { tag for tag in missing_tags if ( action, service_key, tag ) not in self._lazy_tags_being_fetched }
+                    
+                    self._lazy_tags_being_fetched.update( ( ( action, service_key, tag ) for tag in missing_tags ) )
+                    
+                
+                if len( missing_tags ) > 0:
+                    
+                    self._controller.CallToThread( self.THREADFetchIntoLazyCache, lazy_cache, action, service_key, missing_tags, default )
+                    
+                
+            else:
+                
+                # this is done outside the lock, as the db may itself be waiting on us from the middle of a search
+                tags_to_values.update( self._FetchIntoLazyCache( lazy_cache, action, service_key, missing_tags, default ) )
+                
+            
+        
+        return tags_to_values
+        
+    
+    def _GetLazyCache( self, service_keys_to_lazy_caches, service_key, name ):
+        
+        with self._lock:
+            
+            if service_key not in service_keys_to_lazy_caches:
+                
+                service_keys_to_lazy_caches[ service_key ] = LRUCache( self._lazy_cache_size, name )
+                
+            
+            return service_keys_to_lazy_caches[ service_key ]
+            
+        
+    
+    def _GetReverseLookup( self, service_key, ideals ):
+        
+        if self._lazy_cache_size == 0:
+            
+            # the full map is a defaultdict, so the lookups are done here, under the lock, rather than by the caller
+            
+            with self._lock:
+                
+                reverse_lookup = self._service_keys_to_reverse_lookup.get( service_key, {} )
+                
+                return { ideal : list( reverse_lookup[ ideal ] ) for ideal in ideals if ideal in reverse_lookup }
+                
+            
+        
+        lazy_reverse_lookup = self._GetLazyCache( self._service_keys_to_lazy_reverse_lookup, service_key, 'tag_siblings_reverse_lookup' )
+        
+        reverse_lookup = self._GetFromLazyCache( lazy_reverse_lookup, 'tag_siblings_reverse_lookup', service_key, ideals, lambda ideal: [] )
+        
+        return { ideal : bads for ( ideal, bads ) in reverse_lookup.items() if len( bads ) > 0 }
+        
+    
+    def _GetSiblings( self, service_key, tags ):
+        
+        if self._lazy_cache_size == 0:
+            
+            # the full map is a defaultdict, so the lookups are done here, under the lock, rather than by the caller
+            
+            with self._lock:
+                
+                siblings = self._service_keys_to_siblings.get( service_key, {} )
+                
+                return { tag : siblings[ tag ] for tag in tags if tag in siblings }
+                
+            
+        
+        lazy_siblings = self._GetLazyCache( self._service_keys_to_lazy_siblings, service_key, 'tag_siblings' )
+        
+        # tags with no sibling are stored as their own ideal, so they do not go back to the db every time
+        tags_to_ideals = self._GetFromLazyCache( lazy_siblings, 'tag_siblings_lookup', service_key, tags, lambda tag: tag )
+        
+        return { tag : ideal for ( tag, ideal ) in tags_to_ideals.items() if ideal != tag }
+        
+    
     def _RefreshSiblings( self ):
         
+        if self._lazy_cache_size > 0:
+            
+            self._service_keys_to_lazy_siblings = {}
+            self._service_keys_to_lazy_reverse_lookup = {}
+            
+            self._controller.pub( 'new_siblings_gui' )
+            
+            return
+            
+        
         self._service_keys_to_siblings = collections.defaultdict( dict )
         self._service_keys_to_reverse_lookup = collections.defaultdict( dict )
         
@@ -1834,54 +3694,51 @@ class TagSiblingsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            siblings = self._service_keys_to_siblings[ service_key ]
-            
-            results = [ predicate for predicate in predicates if predicate.GetType() != HC.PREDICATE_TYPE_TAG ]
-            
-            tag_predicates = [ predicate for predicate in predicates if predicate.GetType() == HC.PREDICATE_TYPE_TAG ]
-            
-            tags_to_predicates = { predicate.GetValue() : predicate for predicate in predicates if predicate.GetType() == HC.PREDICATE_TYPE_TAG }
-            
-            tags = list(tags_to_predicates.keys())
-            
-            tags_to_include_in_results = set()
+        results = [ predicate for predicate in predicates if predicate.GetType() != HC.PREDICATE_TYPE_TAG ]
+        
+        tag_predicates = [ predicate for predicate in predicates if predicate.GetType() == HC.PREDICATE_TYPE_TAG ]
+        
+        tags_to_predicates = { predicate.GetValue() : predicate for predicate in predicates if predicate.GetType() == HC.PREDICATE_TYPE_TAG }
+        
+        tags = list(tags_to_predicates.keys())
+        
+        siblings = self._GetSiblings( service_key, tags )
+        
+        tags_to_include_in_results = set()
+        
+        for tag in tags:
             
-            for tag in tags:
+            if tag in siblings:
                 
-                if tag in siblings:
-                    
-                    old_tag = tag
-                    old_predicate = tags_to_predicates[ old_tag ]
-                    
-                    new_tag = siblings[ old_tag ]
-                    
-                    if new_tag not in tags_to_predicates:
-                        
-                        ( old_pred_type, old_value, old_inclusive ) = old_predicate.GetInfo()
-                        
-                        new_predicate = ClientSearch.Predicate( old_pred_type, new_tag, old_inclusive )
-                        
-                        tags_to_predicates[ new_tag ] = new_predicate
-                        
-                        tags_to_include_in_results.add( new_tag )
-                        
+                old_tag = tag
+                old_predicate = tags_to_predicates[ old_tag ]
+                
+                new_tag = siblings[ old_tag ]
+                
+                if new_tag not in tags_to_predicates:
                     
-                    new_predicate = tags_to_predicates[ new_tag ]
+                    ( old_pred_type, old_value, old_inclusive ) = old_predicate.GetInfo()
                     
-                    new_predicate.AddCounts( old_predicate )
+                    new_predicate = ClientSearch.Predicate( old_pred_type, new_tag, old_inclusive )
                     
-                else:
+                    tags_to_predicates[ new_tag ] = new_predicate
                     
-                    tags_to_include_in_results.add( tag )
+                    tags_to_include_in_results.add( new_tag )
                     
                 
+                new_predicate = tags_to_predicates[ new_tag ]
+                
+                new_predicate.AddCounts( old_predicate )
+                
+            else:
+                
+                tags_to_include_in_results.add( tag )
+                
             
-            results.extend( [ tags_to_predicates[ tag ] for tag in tags_to_include_in_results ] )
-            
-            return results
-            
+        
+        results.extend( [ tags_to_predicates[ tag ] for tag in tags_to_include_in_results ] )
+        
+        return results
         
     
     def CollapsePairs( self, service_key, pairs, service_strict = False ):
@@ -1891,30 +3748,27 @@ class TagSiblingsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            siblings = self._service_keys_to_siblings[ service_key ]
-            
-            result = set()
+        siblings = self._GetSiblings( service_key, { tag for pair in pairs for tag in pair } )
+        
+        result = set()
+        
+        for ( a, b ) in pairs:
             
-            for ( a, b ) in pairs:
+            if a in siblings:
                 
-                if a in siblings:
-                    
-                    a = siblings[ a ]
-                    
+                a = siblings[ a ]
                 
-                if b in siblings:
-                    
-                    b = siblings[ b ]
-                    
+            
+            if b in siblings:
                 
-                result.add( ( a, b ) )
+                b = siblings[ b ]
                 
             
-            return result
+            result.add( ( a, b ) )
             
         
+        return result
+        
     
     def CollapseStatusesToTags( self, service_key, statuses_to_tags, service_strict = False ):
         
@@ -1923,20 +3777,19 @@ class TagSiblingsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            statuses = list(statuses_to_tags.keys())
-            
-            new_statuses_to_tags = HydrusData.default_dict_set()
-            
-            for status in statuses:
-                
-                new_statuses_to_tags[ status ] = self._CollapseTags( service_key, statuses_to_tags[ status ] )
-                
+        statuses = list(statuses_to_tags.keys())
+        
+        siblings = self._GetSiblings( service_key, { tag for status in statuses for tag in statuses_to_tags[ status ] } )
+        
+        new_statuses_to_tags = HydrusData.default_dict_set()
+        
+        for status in statuses:
             
-            return new_statuses_to_tags
+            new_statuses_to_tags[ status ] = self._CollapseTags( siblings, statuses_to_tags[ status ] )
             
         
+        return new_statuses_to_tags
+        
     
     def CollapseTag( self, service_key, tag, service_strict = False ):
         
@@ -1945,18 +3798,15 @@ class TagSiblingsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
+        siblings = self._GetSiblings( service_key, ( tag, ) )
+        
+        if tag in siblings:
             
-            siblings = self._service_keys_to_siblings[ service_key ]
+            return siblings[ tag ]
             
-            if tag in siblings:
-                
-                return siblings[ tag ]
-                
-            else:
-                
-                return tag
-                
+        else:
+            
+            return tag
             
         
     
@@ -1967,10 +3817,9 @@ class TagSiblingsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            return self._CollapseTags( service_key, tags )
-            
+        siblings = self._GetSiblings( service_key, tags )
+        
+        return self._CollapseTags( siblings, tags )
         
     
     def CollapseTagsToCount( self, service_key, tags_to_count, service_strict = False ):
@@ -1980,47 +3829,74 @@ class TagSiblingsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            siblings = self._service_keys_to_siblings[ service_key ]
-            
-            results = collections.Counter()
+        siblings = self._GetSiblings( service_key, list(tags_to_count.keys()) )
+        
+        results = collections.Counter()
+        
+        for ( tag, count ) in list(tags_to_count.items()):
             
-            for ( tag, count ) in list(tags_to_count.items()):
-                
-                if tag in siblings:
-                    
-                    tag = siblings[ tag ]
-                    
+            if tag in siblings:
                 
-                results[ tag ] += count
+                tag = siblings[ tag ]
                 
             
-            return results
+            results[ tag ] += count
             
         
+        return results
+        
     
-    def GetSibling( self, service_key, tag, service_strict = False ):
+    def CollapseTagsToAllCounts( self, service_key, tags_to_counts, service_strict = False ):
+        
+        # as CollapseTagsToCount, for the ( min_current_count, max_current_count, min_pending_count, max_pending_count ) a predicate carries
         
         if not service_strict and self._controller.new_options.GetBoolean( 'apply_all_siblings_to_all_services' ):
             
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
-            
-            siblings = self._service_keys_to_siblings[ service_key ]
+        siblings = self._GetSiblings( service_key, list( tags_to_counts.keys() ) )
+        
+        results = {}
+        
+        for ( tag, counts ) in tags_to_counts.items():
             
             if tag in siblings:
                 
-                return siblings[ tag ]
+                tag = siblings[ tag ]
+                
+            
+            if tag in results:
+                
+                results[ tag ] = ClientData.MergeAllCounts( results[ tag ], counts )
                 
             else:
                 
-                return None
+                results[ tag ] = counts
                 
             
         
+        return results
+        
+    
+    def GetSibling( self, service_key, tag, service_strict = False ):
+        
+        if not service_strict and self._controller.new_options.GetBoolean( 'apply_all_siblings_to_all_services' ):
+            
+            service_key = CC.COMBINED_TAG_SERVICE_KEY
+            
+        
+        siblings = self._GetSiblings( service_key, ( tag, ) )
+        
+        if tag in siblings:
+            
+            return siblings[ tag ]
+            
+        else:
+            
+            return None
+            
+        
     
     def GetAllSiblings( self, service_key, tag, service_strict = False ):
         
@@ -2029,31 +3905,30 @@ class TagSiblingsManager( object ):
             service_key = CC.COMBINED_TAG_SERVICE_KEY
             
         
-        with self._lock:
+        siblings = self._GetSiblings( service_key, ( tag, ) )
+        
+        if tag in siblings:
             
-            siblings = self._service_keys_to_siblings[ service_key ]
-            reverse_lookup = self._service_keys_to_reverse_lookup[ service_key ]
+            best_tag = siblings[ tag ]
             
-            if tag in siblings:
-                
-                best_tag = siblings[ tag ]
-                
-            elif tag in reverse_lookup:
-                
-                best_tag = tag
-                
-            else:
-                
-                return [ tag ]
-                
+        else:
             
-            all_siblings = list( reverse_lookup[ best_tag ] )
+            best_tag = tag
             
-            all_siblings.append( best_tag )
+        
+        reverse_lookup = self._GetReverseLookup( service_key, ( best_tag, ) )
+        
+        if best_tag not in reverse_lookup:
             
-            return all_siblings
+            return [ tag ]
             
         
+        all_siblings = list( reverse_lookup[ best_tag ] )
+        
+        all_siblings.append( best_tag )
+        
+        return all_siblings
+        
     
     def NotifyNewSiblings( self ):
         
@@ -2070,6 +3945,24 @@ class TagSiblingsManager( object ):
             
         
     
+    def Prefetch( self, service_keys_to_tags ):
+        
+        if self._lazy_cache_size == 0:
+            
+            return
+            
+        
+        if self._controller.new_options.GetBoolean( 'apply_all_siblings_to_all_services' ):
+            
+            service_keys_to_tags = { CC.COMBINED_TAG_SERVICE_KEY : { tag for tags in service_keys_to_tags.values() for tag in tags } }
+            
+        
+        for ( service_key, tags ) in service_keys_to_tags.items():
+            
+            self._GetSiblings( service_key, tags )
+            
+        
+    
     def RefreshSiblingsIfDirty( self ):
         
         with self._lock:
@@ -2085,6 +3978,23 @@ class TagSiblingsManager( object ):
             
         
     
+    def THREADFetchIntoLazyCache( self, lazy_cache, action, service_key, tags, default ):
+        
+        try:
+            
+            self._FetchIntoLazyCache( lazy_cache, action, service_key, tags, default )
+            
+        finally:
+            
+            with self._lock:
+                
+                self._lazy_tags_being_fetched.difference_update( ( ( action, service_key, tag ) for tag in tags ) )
+                
+            
+        
+        self._controller.pub( 'notify_new_siblings_gui' )
+        
+    
 class ThumbnailCache( object ):
     
     def __init__( self, controller ):
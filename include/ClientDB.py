@@ -17,14 +17,16 @@ from . import ClientSearch
 from . import ClientServices
 from . import ClientThreading
 import collections
+import concurrent.futures
 import gc
+import gzip
 import hashlib
+import heapq
 import itertools
 import json
 import yaml
 import binascii
 import uuid
-import glob
 from . import HydrusConstants as HC
 from . import HydrusData
 from . import HydrusDB
@@ -42,9 +44,12 @@ from . import HydrusVideoHandling
 from . import ClientConstants as CC
 import os
 import psutil
+import queue
 import random
 import re
+import shutil
 import stat
+import threading
 import time
 import traceback
 import wx
@@ -63,6 +68,124 @@ YAML_DUMP_ID_LOCAL_BOORU = 8
 MIN_CACHED_INTEGER = -99999999
 MAX_CACHED_INTEGER = 99999999
 
+# how many master rows (hashes and so on) to look up or insert in one statement
+MASTER_BULK_CHUNK_SIZE = 10000
+MASTER_ID_CACHE_SIZE = 100000
+PHASH_SEARCH_BLOCK_SIZE = 1024
+MEDIA_RESULTS_PAGE_SIZE = 10000
+
+# a table is reanalyzed once its row count has moved by HC.ANALYZE_ROW_DRIFT_PERCENT, by at least this many rows, or once this long has passed anyway
+ANALYZE_MIN_ROW_DRIFT = 1000
+ANALYZE_MAX_PERIOD = 30 * 86400
+
+# tables bigger than this are only analyzed and optimized while the client is idle, unless forced
+MAINTENANCE_BIG_TABLE_ROWS = 10000000
+
+# a mappings table moving to the current schema is copied into a table with this suffix, then swapped in
+MAPPINGS_SCHEMA_MIGRATION_SUFFIX = '_schema_migration'
+MAPPINGS_SCHEMA_MIGRATION_OLD_SUFFIX = '_schema_old'
+MAPPINGS_SCHEMA_MIGRATION_CHUNK_ROWS = 50000
+
+CLIENT_FILES_MANIFEST_FILENAME = 'client_files.manifest.gz'
+
+def BackupClientFiles( prefixes_to_locations, dest, is_cancelled_hook = None, text_update_hook = None ):
+
+    # client files are named for their hash and never change, so one whose name is in the manifest of the last backup is skipped without being looked at
+    # the manifest always describes what is in dest, so a cancelled or crashed backup picks up where it stopped
+
+    manifest_path = os.path.join( dest, CLIENT_FILES_MANIFEST_FILENAME )
+
+    prefixes_to_backed_up_filenames = collections.defaultdict( set )
+
+    if os.path.exists( manifest_path ):
+
+        with gzip.open( manifest_path, 'rt', encoding = 'utf-8' ) as f:
+
+            for line in f:
+
+                ( prefix, filename ) = line.rstrip( '\n' ).split( '/', 1 )
+
+                prefixes_to_backed_up_filenames[ prefix ].add( filename )
+
+
+
+
+    num_copied = 0
+    num_deleted = 0
+
+    try:
+
+        for ( prefix, location ) in sorted( prefixes_to_locations.items() ):
+
+            if is_cancelled_hook is not None and is_cancelled_hook():
+
+                break
+
+
+            if text_update_hook is not None:
+
+                text_update_hook( 'backing up client files: ' + prefix + ', ' + HydrusData.ToHumanInt( num_copied ) + ' copied' )
+
+
+            source_dir = os.path.join( location, prefix )
+            dest_dir = os.path.join( dest, 'client_files', prefix )
+
+            HydrusPaths.MakeSureDirectoryExists( dest_dir )
+
+            try:
+
+                source_filenames = { entry.name for entry in os.scandir( source_dir ) if entry.is_file() }
+
+            except FileNotFoundError:
+
+                source_filenames = set()
+
+
+            backed_up_filenames = prefixes_to_backed_up_filenames[ prefix ]
+
+            for filename in source_filenames.difference( backed_up_filenames ):
+
+                try:
+
+                    shutil.copy2( os.path.join( source_dir, filename ), os.path.join( dest_dir, filename ) )
+
+                except FileNotFoundError:
+
+                    continue # deleted since we listed it
+
+
+                backed_up_filenames.add( filename )
+
+                num_copied += 1
+
+
+            for filename in backed_up_filenames.difference( source_filenames ):
+
+                HydrusPaths.DeletePath( os.path.join( dest_dir, filename ) )
+
+                backed_up_filenames.discard( filename )
+
+                num_deleted += 1
+
+
+
+    finally:
+
+        temp_manifest_path = manifest_path + '.tmp'
+
+        with gzip.open( temp_manifest_path, 'wt', encoding = 'utf-8' ) as f:
+
+            for ( prefix, filenames ) in prefixes_to_backed_up_filenames.items():
+
+                f.writelines( ( prefix + '/' + filename + '\n' for filename in filenames ) )
+
+
+
+        os.replace( temp_manifest_path, manifest_path )
+
+
+    return ( num_copied, num_deleted )
+
 def CanCacheInteger( num ):
 
     return MIN_CACHED_INTEGER <= num and num <= MAX_CACHED_INTEGER
@@ -108,6 +231,42 @@ def GenerateCombinedFilesMappingsCacheTableName( service_id ):
 
     return 'combined_files_ac_cache_' + str( service_id )
 
+def GenerateMappingsTableCreateStatement( table_name, primary_key_columns, has_reason_id = False, create_as = None, num_partitions = None ):
+
+    # mappings are fetched both by tag and by file, so the clustering key is backed by a unique index in the other order, which covers the other lookup by itself
+    # with mappings_partitions set, rows are also split by hash_id, so fetching one file's tags only looks in one partition
+
+    if create_as is None:
+
+        create_as = table_name
+
+
+    if num_partitions is None:
+
+        num_partitions = HC.MAPPINGS_PARTITIONS
+
+
+    reverse_columns = list( reversed( primary_key_columns ) )
+
+    column_definitions = [ 'tag_id INTEGER', 'hash_id INTEGER' ]
+
+    if has_reason_id:
+
+        column_definitions.append( 'reason_id INTEGER' )
+
+
+    column_definitions.append( 'PRIMARY KEY ( ' + ', '.join( primary_key_columns ) + ' )' )
+    column_definitions.append( 'UNIQUE INDEX ' + HydrusDB.GenerateIndexName( table_name, reverse_columns ) + ' ( ' + ', '.join( reverse_columns ) + ' )' )
+
+    statement = 'CREATE TABLE IF NOT EXISTS ' + create_as + ' ( ' + ', '.join( column_definitions ) + ' ) ENGINE=RocksDB'
+
+    if num_partitions > 0:
+
+        statement += ' PARTITION BY HASH ( hash_id ) PARTITIONS ' + str( num_partitions )
+
+
+    return statement + ';'
+
 def GenerateMappingsTableNames( service_id ):
 
     suffix = str( service_id )
@@ -153,6 +312,144 @@ def GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id ):
 
     return ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name )
 
+def GenerateTagParentClosureTableName( service_id ):
+
+    tag_parent_closure_table_name = 'tag_parent_closure_' + str( service_id )
+
+    return tag_parent_closure_table_name
+
+def GenerateTagSiblingClosureTableName( service_id ):
+
+    tag_sibling_closure_table_name = 'tag_sibling_closure_' + str( service_id )
+
+    return tag_sibling_closure_table_name
+
+def LoadRepositoryUpdates( paths, num_threads, streamed = False, max_bytes = HC.REPOSITORY_UPDATE_PREFETCH_BYTES ):
+
+    # reading and decompressing update files needs nothing from the db, so worker threads keep some loaded ahead while the db thread applies the current one
+    # how far ahead is bounded by bytes rather than by files, since a single big update can be hundreds of megabytes
+
+    # a fully decoded update is python objects several times the size of its file. a streamed one only keeps the compressed bytes
+
+    DECODED_BYTES_PER_FILE_BYTE = 8
+
+    def load( path ):
+
+        with open( path, 'rb' ) as f:
+
+            update_network_bytes = f.read()
+
+
+        if streamed:
+
+            # content rows stay compressed until the db thread iterates them. counting them is a full pass, so we do that here
+
+            update = HydrusNetwork.CreateStreamedContentUpdate( update_network_bytes )
+
+            update.GetNumRows()
+
+            return update
+
+
+        return HydrusSerialisable.CreateFromNetworkBytes( update_network_bytes )
+
+
+    def get_num_bytes_held( path ):
+
+        num_bytes = os.path.getsize( path )
+
+        if not streamed:
+
+            num_bytes *= DECODED_BYTES_PER_FILE_BYTE
+
+
+        return num_bytes
+
+
+    paths = iter( paths )
+
+    with concurrent.futures.ThreadPoolExecutor( max_workers = num_threads ) as executor:
+
+        # ( future, num_bytes ), for the loads ahead of the db. the update the db is working on still counts against the budget until it asks for the next
+
+        loading = collections.deque()
+        num_bytes_held = 0
+
+        next_path = next( paths, None )
+
+        try:
+
+            while True:
+
+                while next_path is not None and len( loading ) < num_threads + 1:
+
+                    num_bytes = get_num_bytes_held( next_path )
+
+                    # the next update is always loaded, however big it is
+
+                    if len( loading ) > 0 and num_bytes_held + num_bytes > max_bytes:
+
+                        break
+
+
+                    loading.append( ( executor.submit( load, next_path ), num_bytes ) )
+
+                    num_bytes_held += num_bytes
+
+                    next_path = next( paths, None )
+
+
+                if len( loading ) == 0:
+
+                    break
+
+
+                ( future, num_bytes ) = loading.popleft()
+
+                yield future.result()
+
+                num_bytes_held -= num_bytes
+
+
+        finally:
+
+            for ( future, num_bytes ) in loading:
+
+                future.cancel()
+
+
+
+
+
+def RestoreClientFiles( source, prefixes_to_locations, text_update_hook = None ):
+
+    for ( prefix, location ) in sorted( prefixes_to_locations.items() ):
+
+        if text_update_hook is not None:
+
+            text_update_hook( 'restoring client files: ' + prefix )
+
+
+        source_dir = os.path.join( source, 'client_files', prefix )
+        dest_dir = os.path.join( location, prefix )
+
+        HydrusPaths.MakeSureDirectoryExists( dest_dir )
+
+        source_filenames = { entry.name for entry in os.scandir( source_dir ) if entry.is_file() } if os.path.exists( source_dir ) else set()
+        dest_filenames = { entry.name for entry in os.scandir( dest_dir ) if entry.is_file() }
+
+        for filename in source_filenames.difference( dest_filenames ):
+
+            shutil.copy2( os.path.join( source_dir, filename ), os.path.join( dest_dir, filename ) )
+
+
+        for filename in dest_filenames.difference( source_filenames ):
+
+            HydrusPaths.DeletePath( os.path.join( dest_dir, filename ) )
+
+
+
+
 def report_content_speed_to_job_key( job_key, rows_done, total_rows, precise_timestamp, num_rows, row_name ):
 
     it_took = HydrusData.GetNowPrecise() - precise_timestamp
@@ -192,16 +489,48 @@ def report_speed_to_log( precise_timestamp, num_rows, row_name ):
 class DB( HydrusDB.HydrusDB ):
 
     READ_WRITE_ACTIONS = [ 'service_info', 'system_predicates', 'missing_thumbnail_hashes' ]
+    SERIAL_READ_ACTIONS = [ 'file_maintenance_get_job', 'last_shutdown_work_time', 'load_into_disk_cache', 'maintenance_due' ]
 
     def __init__( self, controller, db_dir, db_name ):
 
         self._initial_messages = []
 
+        # made before the base init, since creating or updating the db already commits and touches mappings
+        self._file_search_result_cache = ClientCaches.FileSearchResultCache( HC.FILE_SEARCH_RESULT_CACHE_SIZE )
+
+        self._json_dump_store = ClientCaches.JSONDumpStore( HC.JSON_PATH )
+
+        self._backup_in_progress = False
+        self._mappings_schema_migration_in_progress = False
+
+        if HC.TAG_AUTOCOMPLETE_INDEX:
+
+            self._subtag_autocomplete_index = ClientCaches.SubtagAutocompleteIndex()
+
+        else:
+
+            self._subtag_autocomplete_index = None
+
+
         HydrusDB.HydrusDB.__init__( self, controller, db_dir, db_name )
 
         self._controller.pub( 'splash_set_title_text', 'booting db\u2026' )
 
 
+    def _AbandonMappingsSchemaMigrationTable( self, table_name ):
+
+        self._Commit()
+
+        try:
+
+            self._DropMappingsSchemaMigrationTable( table_name )
+
+        finally:
+
+            self._BeginImmediate()
+
+
+
     def _AddFilesInfo( self, rows, overwrite = False ):
 
         if overwrite:
@@ -227,6 +556,8 @@ class DB( HydrusDB.HydrusDB ):
 
         if len( valid_hash_ids ) > 0:
 
+            self._InvalidateFileSearchResultsForFileService( service_id )
+
             valid_rows = [ ( hash_id, timestamp ) for ( hash_id, timestamp ) in rows if hash_id in valid_hash_ids ]
 
             splayed_valid_hash_ids = HydrusData.SplayListForDB( valid_hash_ids )
@@ -316,11 +647,15 @@ class DB( HydrusDB.HydrusDB ):
 
         service_id = self._c.lastrowid
 
+        self._json_dump_store.SetRow( ( 'services', service_id ), dictionary_string )
+
+        self._service_ids_to_service_keys_cache = None
+
         if service_type in HC.REPOSITORIES:
 
             repository_updates_table_name = GenerateRepositoryRepositoryUpdatesTableName( service_id )
 
-            self._c.execute( 'CREATE TABLE ' + repository_updates_table_name + ' ( update_index INTEGER, hash_id INTEGER, processed BOOL, PRIMARY KEY ( update_index, hash_id ) );' )
+            self._c.execute( 'CREATE TABLE ' + repository_updates_table_name + ' ( update_index INTEGER, hash_id INTEGER, processed BOOL, processed_rows INTEGER DEFAULT 0, PRIMARY KEY ( update_index, hash_id ) );' )
             self._CreateIndex( repository_updates_table_name, [ 'hash_id' ] )
 
             ( hash_id_map_table_name, tag_id_map_table_name ) = GenerateRepositoryMasterCacheTableNames( service_id )
@@ -355,6 +690,11 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+        if service_type in HC.TAG_SERVICES or service_type == HC.COMBINED_TAG:
+
+            self._CacheTagClosuresGenerate( service_id )
+
+
 
     def _AddTagParents( self, service_id, pairs, make_content_updates = False ):
 
@@ -370,6 +710,8 @@ class DB( HydrusDB.HydrusDB ):
             tag_ids.add( child_tag_id )
 
 
+        self._CacheTagParentsClosureUpdate( service_id, tag_ids )
+
         for tag_id in tag_ids:
 
             self._FillInParents( service_id, tag_id, make_content_updates = make_content_updates )
@@ -383,6 +725,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.executemany( 'INSERT IGNORE INTO tag_siblings ( service_id, bad_tag_id, good_tag_id, status ) VALUES ( %s, %s, %s, %s );', list( ( service_id, bad_tag_id, good_tag_id, HC.CONTENT_STATUS_CURRENT ) for ( bad_tag_id, good_tag_id ) in pairs ) )
 
+        self._CacheTagSiblingsClosureUpdate( service_id, { tag_id for pair in pairs for tag_id in pair } )
+
         tag_ids = set()
 
         for ( bad_tag_id, good_tag_id ) in pairs:
@@ -396,13 +740,24 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-    def _AnalyzeStaleBigTables( self, stop_time = None, only_when_idle = False, force_reanalyze = False ):
-        pass
+    def _AnalyzeStaleBigTables( self, maintenance_mode = HC.MAINTENANCE_FORCED, stop_time = None, force_reanalyze = False ):
+
+        names_to_analyze = self._GetBigTableNamesToAnalyze( force_reanalyze = force_reanalyze )
+
+        if len( names_to_analyze ) > 0:
+
+            done_names = self._RunTableMaintenance( 'ANALYZE TABLE', 'analyzing', names_to_analyze, maintenance_mode, stop_time )
+
+            self._SaveTableMaintenanceTimestamps( 'analyze_timestamps', done_names )
 
 
 
     def _AnalyzeTable( self, name ):
-        pass
+
+        self._RunTableMaintenance( 'ANALYZE TABLE', 'analyzing', [ name ], HC.MAINTENANCE_FORCED, None )
+
+        self._SaveTableMaintenanceTimestamps( 'analyze_timestamps', [ name ] )
+
 
     def _ArchiveFiles( self, hash_ids ):
 
@@ -420,6 +775,10 @@ class DB( HydrusDB.HydrusDB ):
 
             self._inbox_hash_ids.difference_update( valid_hash_ids )
 
+            self._TouchCache( 'inbox' )
+
+            self._InvalidateFileSearchResults( [ ( 'inbox', ) ] )
+
 
 
     def _AssociateRepositoryUpdateHashes( self, service_key, metadata_slice ):
@@ -447,63 +806,118 @@ class DB( HydrusDB.HydrusDB ):
 
     def _Backup( self, path ):
 
-        self._CloseDBCursor()
+        if self._backup_in_progress:
 
-        try:
+            HydrusData.ShowText( 'A backup is already running, so another will not be started until it is done.' )
 
-            job_key = ClientThreading.JobKey( cancellable = True )
+            return
 
-            job_key.SetVariable( 'popup_title', 'backing up db' )
 
-            self._controller.pub( 'modal_message', job_key )
+        job_key = ClientThreading.JobKey( cancellable = True )
+
+        job_key.SetVariable( 'popup_title', 'backing up db' )
+
+        self._controller.pub( 'modal_message', job_key )
 
-            job_key.SetVariable( 'popup_text_1', 'closing db' )
+        job_key.SetVariable( 'popup_text_1', 'taking a snapshot' )
+
+        connections = []
+
+        try:
+
+            # anything the writer has batched goes in the snapshot
+
+            self._Commit()
 
             HydrusPaths.MakeSureDirectoryExists( path )
 
-            for filename in list(self._db_filenames.values()):
+            self._c.execute( 'SHOW FULL TABLES WHERE Table_type = %s;', ( 'BASE TABLE', ) )
 
-                if job_key.IsCancelled():
+            table_names = [ table_name for ( table_name, table_type ) in self._c.fetchall() ]
 
-                    break
+            # biggest first, so the tables left at the end are small ones
 
+            self._c.execute( 'SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s;', ( HC.MYSQL_DB, ) )
 
-                job_key.SetVariable( 'popup_text_1', 'copying ' + filename )
+            table_names_to_estimated_num_rows = { table_name : num_rows or 0 for ( table_name, num_rows ) in self._c.fetchall() }
 
-                source = os.path.join( self._db_dir, filename )
-                dest = os.path.join( path, filename )
+            table_names.sort( key = lambda table_name: table_names_to_estimated_num_rows.get( table_name, 0 ), reverse = True )
 
-                HydrusPaths.MirrorFile( source, dest )
+            table_names_to_create_statements = {}
 
+            for table_name in table_names:
 
-            def is_cancelled_hook():
+                self._c.execute( 'SHOW CREATE TABLE ' + table_name + ';' ); ( gumpf, create_statement ) = self._c.fetchone()
 
-                return job_key.IsCancelled()
+                table_names_to_create_statements[ table_name ] = create_statement
 
 
-            def text_update_hook( text ):
+            # the global read lock holds back every commit, from this process or any other, while the snapshots open, so they all see the same rows
+            # it is only held for as long as that takes, and once they are open the writer can go back to work while the dump reads from them
 
-                job_key.SetVariable( 'popup_text_1', text )
+            lock_connection = HydrusDB.GetStandaloneConnection()
 
+            try:
 
-            client_files_default = os.path.join( self._db_dir, 'client_files' )
+                lock_cursor = lock_connection.cursor()
 
-            if os.path.exists( client_files_default ):
+                lock_cursor.execute( 'FLUSH TABLES WITH READ LOCK;' )
 
-                HydrusPaths.MirrorTree( client_files_default, os.path.join( path, 'client_files' ), text_update_hook = text_update_hook, is_cancelled_hook = is_cancelled_hook )
+                try:
 
+                    for i in range( HC.BACKUP_CONNECTIONS ):
 
-        finally:
+                        connection = HydrusDB.GetStandaloneConnection()
 
-            self._InitDBCursor(started=True)
+                        cursor = connection.cursor()
+
+                        cursor.execute( 'SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;' )
+                        cursor.execute( 'START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY;' )
+
+                        cursor.close()
+
+                        connections.append( connection )
 
-            job_key.SetVariable( 'popup_text_1', 'done!' )
+
+                finally:
+
+                    lock_cursor.execute( 'UNLOCK TABLES;' )
+
+                    lock_cursor.close()
+
+
+            finally:
+
+                lock_connection.close()
+
+
+            # blobs are only deleted on this thread, so the ones these rows point at are all still there
+            # the previous dump's blobs stay until this one has replaced it
+
+            job_key.SetVariable( 'popup_text_1', 'backing up json dumps' )
+
+            live_json_names = self._json_dump_store.MirrorLiveBlobs( os.path.join( path, 'json' ) )
+
+            prefixes_to_locations = self._GetClientFilesLocations()
+
+        except:
+
+            for connection in connections:
+
+                connection.close()
+
+
+            job_key.Cancel()
 
             job_key.Finish()
 
-            job_key.Delete( 5 )
+            raise
 
 
+        self._backup_in_progress = True
+
+        self._controller.CallToThreadLongRunning( self.THREADBackup, job_key, path, connections, table_names, table_names_to_create_statements, live_json_names, prefixes_to_locations )
+
 
     def _CacheCombinedFilesMappingsDrop( self, service_id ):
 
@@ -580,6 +994,15 @@ class DB( HydrusDB.HydrusDB ):
         return self._SelectFromListFetchAll( select_statement, tag_ids )
 
 
+    def _CacheCombinedFilesMappingsGetTopAutocompleteCounts( self, service_id, tag_ids_table_name, order_by, limit ):
+
+        ac_cache_table_name = GenerateCombinedFilesMappingsCacheTableName( service_id )
+
+        self._c.execute( 'SELECT tag_id, current_count, pending_count FROM ' + tag_ids_table_name + ' NATURAL JOIN ' + ac_cache_table_name + ' ORDER BY ' + order_by + ' DESC LIMIT %s;', ( limit, ) )
+
+        return self._c.fetchall()
+
+
     def _CacheCombinedFilesMappingsUpdate( self, service_id, count_ids ):
 
         ac_cache_table_name = GenerateCombinedFilesMappingsCacheTableName( service_id )
@@ -604,7 +1027,7 @@ class DB( HydrusDB.HydrusDB ):
 
                 ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( self._combined_local_file_service_id, tag_service_id )
 
-                service_tag_ids = self._STL( self._c.execute( 'SELECT tag_id FROM ' + ac_cache_table_name + ' WHERE current_count > 0;' ) )
+                service_tag_ids = self._STL( self._StreamSelect( 'SELECT tag_id FROM ' + ac_cache_table_name + ' WHERE current_count > 0;' ) )
 
                 tag_ids.update( service_tag_ids )
 
@@ -617,9 +1040,9 @@ class DB( HydrusDB.HydrusDB ):
 
     def _CacheLocalTagIdsPotentialAdd( self, tag_ids ):
 
-        self._PopulateTagIdsToTagsCache( tag_ids )
+        tag_ids_to_tags = self._PopulateTagIdsToTagsCache( tag_ids )
 
-        self._c.executemany( 'INSERT IGNORE INTO local_tags_cache ( tag_id, tag ) VALUES ( %s,%s );', ( ( tag_id, self._tag_ids_to_tags_cache[ tag_id ] ) for tag_id in tag_ids ) )
+        self._c.executemany( 'INSERT IGNORE INTO local_tags_cache ( tag_id, tag ) VALUES ( %s,%s );', ( ( tag_id, tag_ids_to_tags[ tag_id ] ) for tag_id in tag_ids ) )
 
 
     def _CacheLocalTagIdsPotentialDelete( self, tag_ids ):
@@ -870,15 +1293,52 @@ class DB( HydrusDB.HydrusDB ):
             
         
     
-    def _CacheSpecificMappingsDrop( self, file_service_id, tag_service_id ):
+    def _CacheSpecificMappingsAddMappingsStaged( self, file_service_id, tag_service_id, staged_mappings_table_name ):
 
         ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id )
 
-        self._c.execute( 'DROP TABLE IF EXISTS ' + cache_files_table_name + ';' )
+        # the count changes are worked out before the rows move, one GROUP BY each
 
-        self._c.execute( 'DROP TABLE IF EXISTS ' + cache_current_mappings_table_name + ';' )
+        self._c.execute( 'SELECT tag_id, COUNT( * ) FROM ' + staged_mappings_table_name + ' NATURAL JOIN ' + cache_pending_mappings_table_name + ' GROUP BY tag_id;' )
 
-        self._c.execute( 'DROP TABLE IF EXISTS ' + cache_deleted_mappings_table_name + ';' )
+        tag_ids_to_num_pending_rescinded = dict( self._c.fetchall() )
+
+        self._c.execute( 'SELECT tag_id, COUNT( * ) FROM ' + staged_mappings_table_name + ' AS staged NATURAL JOIN ' + cache_files_table_name + ' WHERE NOT EXISTS ( SELECT 1 FROM ' + cache_current_mappings_table_name + ' AS cache WHERE cache.hash_id = staged.hash_id AND cache.tag_id = staged.tag_id ) GROUP BY tag_id;' )
+
+        tag_ids_to_num_added = dict( self._c.fetchall() )
+
+        self._c.execute( 'DELETE cache FROM ' + cache_pending_mappings_table_name + ' AS cache NATURAL JOIN ' + staged_mappings_table_name + ';' )
+
+        self._c.execute( 'INSERT IGNORE INTO ' + cache_current_mappings_table_name + ' ( hash_id, tag_id ) SELECT hash_id, tag_id FROM ' + staged_mappings_table_name + ' NATURAL JOIN ' + cache_files_table_name + ';' )
+
+        self._c.execute( 'DELETE cache FROM ' + cache_deleted_mappings_table_name + ' AS cache NATURAL JOIN ' + staged_mappings_table_name + ';' )
+
+        #
+
+        changed_tag_ids = set( tag_ids_to_num_added.keys() ).union( tag_ids_to_num_pending_rescinded.keys() )
+
+        if len( changed_tag_ids ) > 0:
+
+            self._c.executemany( 'INSERT IGNORE INTO ' + ac_cache_table_name + ' ( tag_id, current_count, pending_count ) VALUES ( %s, %s, %s );', [ ( tag_id, 0, 0 ) for tag_id in changed_tag_ids ] )
+
+            self._c.executemany( 'UPDATE ' + ac_cache_table_name + ' SET current_count = current_count + %s, pending_count = pending_count - %s WHERE tag_id = %s;', [ ( tag_ids_to_num_added.get( tag_id, 0 ), tag_ids_to_num_pending_rescinded.get( tag_id, 0 ), tag_id ) for tag_id in changed_tag_ids ] )
+
+            if file_service_id == self._combined_local_file_service_id:
+
+                self._CacheLocalTagIdsPotentialAdd( list( changed_tag_ids ) )
+
+
+
+
+    def _CacheSpecificMappingsDrop( self, file_service_id, tag_service_id ):
+
+        ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id )
+
+        self._c.execute( 'DROP TABLE IF EXISTS ' + cache_files_table_name + ';' )
+
+        self._c.execute( 'DROP TABLE IF EXISTS ' + cache_current_mappings_table_name + ';' )
+
+        self._c.execute( 'DROP TABLE IF EXISTS ' + cache_deleted_mappings_table_name + ';' )
 
         self._c.execute( 'DROP TABLE IF EXISTS ' + cache_pending_mappings_table_name + ';' )
 
@@ -998,6 +1458,40 @@ class DB( HydrusDB.HydrusDB ):
             
         
     
+    def _CacheSpecificMappingsDeleteMappingsStaged( self, file_service_id, tag_service_id, staged_mappings_table_name ):
+
+        ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id )
+
+        self._c.execute( 'SELECT tag_id, COUNT( * ) FROM ' + staged_mappings_table_name + ' NATURAL JOIN ' + cache_current_mappings_table_name + ' GROUP BY tag_id;' )
+
+        tag_ids_to_num_deleted = dict( self._c.fetchall() )
+
+        self._c.execute( 'DELETE cache FROM ' + cache_current_mappings_table_name + ' AS cache NATURAL JOIN ' + staged_mappings_table_name + ';' )
+
+        self._c.execute( 'INSERT IGNORE INTO ' + cache_deleted_mappings_table_name + ' ( hash_id, tag_id ) SELECT hash_id, tag_id FROM ' + staged_mappings_table_name + ' NATURAL JOIN ' + cache_files_table_name + ';' )
+
+        #
+
+        if len( tag_ids_to_num_deleted ) > 0:
+
+            self._c.executemany( 'UPDATE ' + ac_cache_table_name + ' SET current_count = current_count - %s WHERE tag_id = %s;', [ ( num_deleted, tag_id ) for ( tag_id, num_deleted ) in tag_ids_to_num_deleted.items() ] )
+
+            select_statement = 'SELECT tag_id FROM ' + ac_cache_table_name + ' WHERE current_count = 0 AND pending_count = 0 AND tag_id IN {};'
+
+            deleted_tag_ids = self._STL( raw_data = self._SelectFromList( select_statement, list( tag_ids_to_num_deleted.keys() ) ) )
+
+            if len( deleted_tag_ids ) > 0:
+
+                self._c.executemany( 'DELETE FROM ' + ac_cache_table_name + ' WHERE tag_id = %s;', ( ( tag_id, ) for tag_id in deleted_tag_ids ) )
+
+                if file_service_id == self._combined_local_file_service_id:
+
+                    self._CacheLocalTagIdsPotentialDelete( deleted_tag_ids )
+
+
+
+
+
     def _CacheSpecificMappingsFilterHashIds( self, file_service_id, tag_service_id, hash_ids ):
 
         ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id )
@@ -1012,16 +1506,21 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.execute( 'CREATE TABLE ' + cache_files_table_name + ' ( hash_id INTEGER PRIMARY KEY ) ENGINE=RocksDB;' )
 
-        self._c.execute( 'CREATE TABLE ' + cache_current_mappings_table_name + ' ( hash_id INTEGER, tag_id INTEGER, PRIMARY KEY ( hash_id, tag_id ) ) ENGINE=RocksDB;' )
+        cache_mappings_table_names = [ cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name ]
 
-        self._c.execute( 'CREATE TABLE ' + cache_deleted_mappings_table_name + ' ( hash_id INTEGER, tag_id INTEGER, PRIMARY KEY ( hash_id, tag_id ) ) ENGINE=RocksDB;' )
+        for cache_mappings_table_name in cache_mappings_table_names:
+
+            self._c.execute( GenerateMappingsTableCreateStatement( cache_mappings_table_name, [ 'hash_id', 'tag_id' ] ) )
 
-        self._c.execute( 'CREATE TABLE ' + cache_pending_mappings_table_name + ' ( hash_id INTEGER, tag_id INTEGER, PRIMARY KEY ( hash_id, tag_id ) ) ENGINE=RocksDB;' )
 
         self._c.execute( 'CREATE TABLE ' + ac_cache_table_name + ' ( tag_id INTEGER PRIMARY KEY, current_count INTEGER, pending_count INTEGER ) ENGINE=RocksDB;' )
 
         #
 
+        # the ( tag_id, hash_id ) indexes are built once the tables are full
+
+        self._DeferSecondaryIndexes( cache_mappings_table_names )
+
         select_statement = 'SELECT hash_id FROM current_files WHERE service_id = {};'.format( file_service_id )
 
         for group_of_hash_ids in HydrusDB.ReadLargeIdQueryInSeparateChunks( self._c, select_statement, 10000 ):
@@ -1029,15 +1528,7 @@ class DB( HydrusDB.HydrusDB ):
             self._CacheSpecificMappingsAddFiles( file_service_id, tag_service_id, group_of_hash_ids )
 
 
-        self._CreateIndex( cache_current_mappings_table_name, [ 'tag_id', 'hash_id' ], unique = True )
-        self._CreateIndex( cache_deleted_mappings_table_name, [ 'tag_id', 'hash_id' ], unique = True )
-        self._CreateIndex( cache_pending_mappings_table_name, [ 'tag_id', 'hash_id' ], unique = True )
-        self._CreateIndex( cache_current_mappings_table_name, [ 'tag_id' ], unique = False )
-        self._CreateIndex( cache_deleted_mappings_table_name, [ 'tag_id' ], unique = False )
-        self._CreateIndex( cache_pending_mappings_table_name, [ 'tag_id' ], unique = False )
-        self._CreateIndex( cache_current_mappings_table_name, [ 'hash_id' ], unique = False )
-        self._CreateIndex( cache_deleted_mappings_table_name, [ 'hash_id' ], unique = False )
-        self._CreateIndex( cache_pending_mappings_table_name, [ 'hash_id' ], unique = False )
+        self._RestoreDeferredIndexes( cache_mappings_table_names )
 
 
     def _CacheSpecificMappingsGetAutocompleteCounts( self, file_service_id, tag_service_id, tag_ids ):
@@ -1048,6 +1539,15 @@ class DB( HydrusDB.HydrusDB ):
         return self._SelectFromListFetchAll( select_statement, tag_ids )
 
 
+    def _CacheSpecificMappingsGetTopAutocompleteCounts( self, file_service_id, tag_service_id, tag_ids_table_name, order_by, limit ):
+
+        ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id )
+
+        self._c.execute( 'SELECT tag_id, current_count, pending_count FROM ' + tag_ids_table_name + ' NATURAL JOIN ' + ac_cache_table_name + ' ORDER BY ' + order_by + ' DESC LIMIT %s;', ( limit, ) )
+
+        return self._c.fetchall()
+
+
     def _CacheSpecificMappingsPendMappings( self, file_service_id, tag_service_id, mappings_ids ):
 
         ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id )
@@ -1097,6 +1597,247 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+    def _CacheTagClosuresDrop( self, service_id ):
+
+        tag_parent_closure_table_name = GenerateTagParentClosureTableName( service_id )
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( service_id )
+
+        self._c.execute( 'DROP TABLE IF EXISTS ' + tag_parent_closure_table_name + ';' )
+        self._c.execute( 'DROP TABLE IF EXISTS ' + tag_sibling_closure_table_name + ';' )
+
+
+    def _CacheTagClosuresGenerate( self, service_id ):
+
+        # status is either current, for rows built from current pairs only, or pending, for rows built from current and pending pairs together
+
+        tag_parent_closure_table_name = GenerateTagParentClosureTableName( service_id )
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( service_id )
+
+        self._c.execute( 'CREATE TABLE ' + tag_parent_closure_table_name + ' ( child_tag_id INTEGER, ancestor_tag_id INTEGER, status INTEGER, PRIMARY KEY ( child_tag_id, ancestor_tag_id, status ) ) ENGINE=RocksDB;' )
+        self._CreateIndex( tag_parent_closure_table_name, [ 'ancestor_tag_id' ] )
+
+        self._c.execute( 'CREATE TABLE ' + tag_sibling_closure_table_name + ' ( bad_tag_id INTEGER, status INTEGER, ideal_tag_id INTEGER, PRIMARY KEY ( bad_tag_id, status ) ) ENGINE=RocksDB;' )
+        self._CreateIndex( tag_sibling_closure_table_name, [ 'ideal_tag_id' ] )
+
+
+    def _CacheTagClosuresGetPairs( self, service_id, content_type, tag_ids = None ):
+
+        # returns a ( current_pairs, pending_pairs ) group for each tag service the closure draws from, in descending precedence
+        # given tag_ids, we only fetch the pairs reachable from them. siblings are walked both ways, parents only upwards
+
+        if content_type == HC.CONTENT_TYPE_TAG_SIBLINGS:
+
+            ( pairs_table_name, petitions_table_name, column_a, column_b ) = ( 'tag_siblings', 'tag_sibling_petitions', 'bad_tag_id', 'good_tag_id' )
+
+            search_columns = ( column_a, column_b )
+
+        else:
+
+            ( pairs_table_name, petitions_table_name, column_a, column_b ) = ( 'tag_parents', 'tag_parent_petitions', 'child_tag_id', 'parent_tag_id' )
+
+            search_columns = ( column_a, )
+
+
+        if service_id == self._combined_tag_service_id:
+
+            # local tags take precedence
+
+            source_service_ids = [ self._local_tag_service_id ]
+
+            source_service_ids.extend( ( tag_service_id for tag_service_id in self._GetServiceIds( HC.TAG_SERVICES ) if tag_service_id != self._local_tag_service_id ) )
+
+        else:
+
+            source_service_ids = [ service_id ]
+
+
+        groups = []
+        selects_and_pairs = []
+
+        for source_service_id in source_service_ids:
+
+            current_pairs = set()
+            pending_pairs = set()
+
+            current_select = 'SELECT ' + column_a + ', ' + column_b + ' FROM ' + pairs_table_name + ' WHERE service_id = ' + str( source_service_id ) + ' AND status = ' + str( HC.CONTENT_STATUS_CURRENT )
+            pending_select = 'SELECT ' + column_a + ', ' + column_b + ' FROM ' + petitions_table_name + ' WHERE service_id = ' + str( source_service_id ) + ' AND status = ' + str( HC.CONTENT_STATUS_PENDING )
+
+            selects_and_pairs.append( ( current_select, current_pairs ) )
+            selects_and_pairs.append( ( pending_select, pending_pairs ) )
+
+            groups.append( ( current_pairs, pending_pairs ) )
+
+
+        if tag_ids is None:
+
+            for ( select, pairs ) in selects_and_pairs:
+
+                self._c.execute( select + ';' )
+
+                pairs.update( self._c.fetchall() )
+
+
+        else:
+
+            searched_tag_ids = set()
+            search_tag_ids = set( tag_ids )
+
+            while len( search_tag_ids ) > 0:
+
+                found_tag_ids = set()
+
+                for ( select, pairs ) in selects_and_pairs:
+
+                    for search_column in search_columns:
+
+                        for ( tag_id_a, tag_id_b ) in self._SelectFromListFetchAll( select + ' AND ' + search_column + ' IN {};', search_tag_ids ):
+
+                            pairs.add( ( tag_id_a, tag_id_b ) )
+
+                            found_tag_ids.add( tag_id_a )
+                            found_tag_ids.add( tag_id_b )
+
+
+
+
+                searched_tag_ids.update( search_tag_ids )
+
+                search_tag_ids = found_tag_ids.difference( searched_tag_ids )
+
+
+
+        return groups
+
+
+    def _CacheTagParentsClosureRegenerate( self, service_id, tag_ids = None ):
+
+        tag_parent_closure_table_name = GenerateTagParentClosureTableName( service_id )
+
+        if tag_ids is None:
+
+            self._c.execute( 'DELETE FROM ' + tag_parent_closure_table_name + ';' )
+
+            child_tag_ids = None
+
+        else:
+
+            # a changed pair changes the ancestors of its child and of everything below it
+
+            child_tag_ids = set( tag_ids )
+
+            child_tag_ids.update( self._STS( raw_data = self._SelectFromList( 'SELECT child_tag_id FROM ' + tag_parent_closure_table_name + ' WHERE ancestor_tag_id IN {};', tag_ids ) ) )
+
+            self._c.executemany( 'DELETE FROM ' + tag_parent_closure_table_name + ' WHERE child_tag_id = %s;', [ ( child_tag_id, ) for child_tag_id in child_tag_ids ] )
+
+
+        groups = self._CacheTagClosuresGetPairs( service_id, HC.CONTENT_TYPE_TAG_PARENTS, tag_ids = child_tag_ids )
+
+        for status in ( HC.CONTENT_STATUS_CURRENT, HC.CONTENT_STATUS_PENDING ):
+
+            children_to_parents = collections.defaultdict( set )
+
+            for ( current_pairs, pending_pairs ) in groups:
+
+                pairs = current_pairs if status == HC.CONTENT_STATUS_CURRENT else current_pairs.union( pending_pairs )
+
+                for ( child_tag_id, parent_tag_id ) in pairs:
+
+                    children_to_parents[ child_tag_id ].add( parent_tag_id )
+
+
+
+            rows = []
+
+            for child_tag_id in ( list( children_to_parents.keys() ) if child_tag_ids is None else child_tag_ids ):
+
+                ancestor_tag_ids = set()
+
+                search_tag_ids = list( children_to_parents.get( child_tag_id, () ) )
+
+                while len( search_tag_ids ) > 0:
+
+                    tag_id = search_tag_ids.pop()
+
+                    if tag_id not in ancestor_tag_ids:
+
+                        ancestor_tag_ids.add( tag_id )
+
+                        search_tag_ids.extend( children_to_parents.get( tag_id, () ) )
+
+
+
+                # loops are harmless here, but a tag is not its own parent
+
+                ancestor_tag_ids.discard( child_tag_id )
+
+                rows.extend( ( ( child_tag_id, ancestor_tag_id, status ) for ancestor_tag_id in ancestor_tag_ids ) )
+
+
+            self._c.executemany( 'INSERT IGNORE INTO ' + tag_parent_closure_table_name + ' ( child_tag_id, ancestor_tag_id, status ) VALUES ( %s, %s, %s );', rows )
+
+
+
+    def _CacheTagParentsClosureUpdate( self, service_id, tag_ids = None ):
+
+        # the combined service's closure draws on every tag service, so it changes too
+
+        for closure_service_id in ( service_id, self._combined_tag_service_id ):
+
+            self._CacheTagParentsClosureRegenerate( closure_service_id, tag_ids = tag_ids )
+
+
+
+    def _CacheTagSiblingsClosureRegenerate( self, service_id, tag_ids = None ):
+
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( service_id )
+
+        groups = self._CacheTagClosuresGetPairs( service_id, HC.CONTENT_TYPE_TAG_SIBLINGS, tag_ids = tag_ids )
+
+        if tag_ids is None:
+
+            self._c.execute( 'DELETE FROM ' + tag_sibling_closure_table_name + ';' )
+
+        else:
+
+            # the walk found every tag whose ideal could have changed. the ideal of a chain depends only on the pairs in it, so we can collapse just these
+
+            affected_tag_ids = set( tag_ids )
+
+            for ( current_pairs, pending_pairs ) in groups:
+
+                for ( bad_tag_id, good_tag_id ) in current_pairs.union( pending_pairs ):
+
+                    affected_tag_ids.add( bad_tag_id )
+                    affected_tag_ids.add( good_tag_id )
+
+
+
+            self._c.executemany( 'DELETE FROM ' + tag_sibling_closure_table_name + ' WHERE bad_tag_id = %s;', [ ( tag_id, ) for tag_id in affected_tag_ids ] )
+
+
+        statuses_to_groups_of_pairs = {}
+
+        statuses_to_groups_of_pairs[ HC.CONTENT_STATUS_CURRENT ] = [ current_pairs for ( current_pairs, pending_pairs ) in groups ]
+        statuses_to_groups_of_pairs[ HC.CONTENT_STATUS_PENDING ] = [ current_pairs.union( pending_pairs ) for ( current_pairs, pending_pairs ) in groups ]
+
+        for ( status, groups_of_pairs ) in statuses_to_groups_of_pairs.items():
+
+            siblings = ClientCaches.CollapseTagSiblingPairs( groups_of_pairs )
+
+            self._c.executemany( 'INSERT IGNORE INTO ' + tag_sibling_closure_table_name + ' ( bad_tag_id, status, ideal_tag_id ) VALUES ( %s, %s, %s );', [ ( bad_tag_id, status, ideal_tag_id ) for ( bad_tag_id, ideal_tag_id ) in siblings.items() ] )
+
+
+
+    def _CacheTagSiblingsClosureUpdate( self, service_id, tag_ids = None ):
+
+        # the combined service's closure draws on every tag service, so it changes too
+
+        for closure_service_id in ( service_id, self._combined_tag_service_id ):
+
+            self._CacheTagSiblingsClosureRegenerate( closure_service_id, tag_ids = tag_ids )
+
+
+
     def _CheckDBIntegrity( self ):
         pass
 
@@ -1242,8 +1983,11 @@ class DB( HydrusDB.HydrusDB ):
 
     def _CleanUpCaches( self ):
 
+        self._weakref_media_result_cache.SaveSnapshot()
+
         self._subscriptions_cache = {}
         self._service_cache = {}
+        self._service_ids_to_service_keys_cache = None
 
 
     def _ClearOrphanFileRecords( self ):
@@ -1260,11 +2004,11 @@ class DB( HydrusDB.HydrusDB ):
 
             local_file_service_ids = self._GetServiceIds( ( HC.LOCAL_FILE_DOMAIN, HC.LOCAL_FILE_TRASH_DOMAIN ) )
 
-            local_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM current_files WHERE service_id IN ' + HydrusData.SplayListForDB( local_file_service_ids ) + ';' ) )
+            local_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM current_files WHERE service_id IN ' + HydrusData.SplayListForDB( local_file_service_ids ) + ';' ) )
 
             combined_local_file_service_id = self._GetServiceId( CC.COMBINED_LOCAL_FILE_SERVICE_KEY )
 
-            combined_local_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM current_files WHERE service_id = %s;', ( combined_local_file_service_id, ) ) )
+            combined_local_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM current_files WHERE service_id = %s;', ( combined_local_file_service_id, ) ) )
 
             in_local_not_in_combined = local_hash_ids.difference( combined_local_hash_ids )
             in_combined_not_in_local = combined_local_hash_ids.difference( local_hash_ids )
@@ -1364,43 +2108,47 @@ class DB( HydrusDB.HydrusDB ):
 
             self._c.execute( 'DROP table ' + table_name + ';' )
 
-    def _SaveNamedDump(self, dump, json_dump=True):
-        self._PurgeNamedDumps()
-        gen_uuid = str(uuid.uuid4())
-        path = os.path.join(HC.JSON_PATH , gen_uuid + '.json')
+    def _SaveNamedDump( self, dump, json_dump = True, split = False ):
 
-        with open(path, mode='w') as f:
-            if json_dump:
-                f.write(json.dumps(dump))
-            else:
-                f.write(dump)
+        return self._json_dump_store.Write( dump, json_dump = json_dump, split = split )
 
-        return gen_uuid + '.json'
 
-    def _LoadNamedDump(self, dump, json_load=True):
-        dump_loaded = None
+    def _LoadNamedDump( self, dump, json_load = True ):
 
-        with open(os.path.join(HC.JSON_PATH , dump), mode='r') as f:
-            if json_load:
-                dump_loaded = json.loads(f.read())
-            else:
-                dump_loaded = f.read()
+        return self._json_dump_store.Read( dump, json_load = json_load )
+
+
+    def _LoadJSONDumpStoreIndex( self ):
+
+        # the store counts the rows that point at each blob, so it can tell when one is no longer needed
+
+        rows = []
+
+        self._c.execute( 'SELECT dump_type, dump FROM json_dumps;' )
+
+        rows.extend( ( ( 'json_dumps', dump_type ), dump ) for ( dump_type, dump ) in self._c.fetchall() )
+
+        self._c.execute( 'SELECT dump_type, dump_name, timestamp, dump FROM json_dumps_named;' )
+
+        rows.extend( ( ( 'json_dumps_named', dump_type, dump_name, timestamp ), dump ) for ( dump_type, dump_name, timestamp, dump ) in self._c.fetchall() )
+
+        self._c.execute( 'SELECT service_id, dictionary_string FROM services;' )
+
+        rows.extend( ( ( 'services', service_id ), dictionary_string ) for ( service_id, dictionary_string ) in self._c.fetchall() )
+
+        self._json_dump_store.LoadIndex( rows )
+
+
+    def _Commit( self ):
+
+        HydrusDB.HydrusDB._Commit( self )
+
+        self._file_search_result_cache.NotifyCommitted()
 
-        return dump_loaded
+        self._json_dump_store.NotifyCommitted()
 
-    def _PurgeNamedDumps(self):
-        dump_names = []
-        self._c.execute('SELECT dump FROM json_dumps;'); result = self._c.fetchall()
-        dump_names.extend([x[0] for x in result])
-        self._c.execute('SELECT dump FROM json_dumps_named;'); result =self._c.fetchall()
-        dump_names.extend([x[0] for x in result])
-        self._c.execute('SELECT dictionary_string FROM services;'); result =self._c.fetchall()
-        dump_names.extend([x[0] for x in result])
+        self._json_dump_store.CollectGarbage()
 
-        for file in glob.iglob(os.path.join(HC.JSON_PATH, '*')):
-            if file.endswith('.json'):
-                if os.path.split(file)[1] not in dump_names:
-                    os.rename(file, file.replace('.json', '.json')) #TODO
 
     def _CreateDB( self ):
         self._c.execute( 'CREATE DATABASE %s;' % HC.MYSQL_DB)
@@ -1417,6 +2165,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.execute( 'CREATE TABLE client_files_locations ( prefix TEXT, location TEXT );' )
 
+        self._c.execute( 'CREATE TABLE deferred_indexes ( table_name VARCHAR(255), index_name VARCHAR(255), columns TEXT, is_unique BOOL, PRIMARY KEY ( table_name, index_name ) );' )
+
         self._c.execute( 'CREATE TABLE IF NOT EXISTS ideal_client_files_locations ( location TEXT, weight INTEGER );' )
         self._c.execute( 'CREATE TABLE IF NOT EXISTS ideal_thumbnail_override_location ( location TEXT );' )
 
@@ -1488,8 +2238,10 @@ class DB( HydrusDB.HydrusDB ):
         self._c.execute( 'CREATE TABLE tag_parent_petitions ( service_id INTEGER REFERENCES services ON DELETE CASCADE, child_tag_id INTEGER, parent_tag_id INTEGER, status INTEGER, reason_id INTEGER, PRIMARY KEY ( service_id, child_tag_id, parent_tag_id, status ) );' )
 
         self._c.execute( 'CREATE TABLE tag_siblings ( service_id INTEGER REFERENCES services ON DELETE CASCADE, bad_tag_id INTEGER, good_tag_id INTEGER, status INTEGER, PRIMARY KEY ( service_id, bad_tag_id, status ) );' )
+        self._CreateIndex( 'tag_siblings', [ 'good_tag_id' ] )
 
         self._c.execute( 'CREATE TABLE tag_sibling_petitions ( service_id INTEGER REFERENCES services ON DELETE CASCADE, bad_tag_id INTEGER, good_tag_id INTEGER, status INTEGER, reason_id INTEGER, PRIMARY KEY ( service_id, bad_tag_id, status ) );' )
+        self._CreateIndex( 'tag_sibling_petitions', [ 'good_tag_id' ] )
 
         self._c.execute( 'CREATE TABLE url_map ( hash_id INTEGER, url_id INTEGER, PRIMARY KEY ( hash_id, url_id ) );' )
         self._CreateIndex( 'url_map', [ 'url_id' ] )
@@ -1512,9 +2264,9 @@ class DB( HydrusDB.HydrusDB ):
 
         # master
 
-        self._c.execute( 'CREATE TABLE IF NOT EXISTS hashes ( hash_id INTEGER PRIMARY KEY AUTO_INCREMENT, hash varchar(255) UNIQUE );' )
+        self._c.execute( 'CREATE TABLE IF NOT EXISTS hashes ( hash_id INTEGER PRIMARY KEY AUTO_INCREMENT, hash BINARY(32) UNIQUE );' )
 
-        self._c.execute( 'CREATE TABLE local_hashes ( hash_id INTEGER PRIMARY KEY, md5 varchar(255), sha1 varchar(255), sha512 varchar(255) );' )
+        self._c.execute( 'CREATE TABLE local_hashes ( hash_id INTEGER PRIMARY KEY, md5 BINARY(16), sha1 BINARY(20), sha512 BINARY(64) );' )
         self._CreateIndex( 'local_hashes', [ 'md5' ] )
         self._CreateIndex( 'local_hashes', [ 'sha1' ] )
         self._CreateIndex( 'local_hashes', [ 'sha512' ] )
@@ -1618,7 +2370,7 @@ class DB( HydrusDB.HydrusDB ):
     def _CreateDBCaches( self ):
         self._c.execute( 'CREATE TABLE IF NOT EXISTS file_maintenance_jobs ( hash_id INTEGER, job_type INTEGER, time_can_start INTEGER, PRIMARY KEY ( hash_id, job_type ) );' )
 
-        self._c.execute( 'CREATE TABLE IF NOT EXISTS shape_perceptual_hashes ( phash_id INTEGER PRIMARY KEY AUTO_INCREMENT, phash varchar(255) UNIQUE ) ENGINE=RocksDB;' )
+        self._c.execute( 'CREATE TABLE IF NOT EXISTS shape_perceptual_hashes ( phash_id INTEGER PRIMARY KEY AUTO_INCREMENT, phash BINARY(8) UNIQUE ) ENGINE=RocksDB;' )
 
         self._c.execute( 'CREATE TABLE IF NOT EXISTS shape_perceptual_hash_map ( phash_id INTEGER, hash_id INTEGER, PRIMARY KEY ( phash_id, hash_id ) ) ENGINE=RocksDB;' )
         self._CreateIndex( 'shape_perceptual_hash_map', [ 'hash_id' ] )
@@ -1678,6 +2430,54 @@ class DB( HydrusDB.HydrusDB ):
 
         
     
+    def _DeferSecondaryIndexes( self, table_names ):
+
+        # a bulk load into a big table is much faster with only its primary key to keep up, and one index build at the end is cheaper than maintaining them row by row
+        # what is dropped is recorded first, so _RepairDB or the resumed job can put it back if the client stops before _RestoreDeferredIndexes
+
+        self._Commit()
+
+        try:
+
+            for table_name in table_names:
+
+                self._c.execute( 'SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME != %s AND INDEX_TYPE NOT IN ( %s, %s ) ORDER BY INDEX_NAME, SEQ_IN_INDEX;', ( HC.MYSQL_DB, table_name, 'PRIMARY', 'FULLTEXT', 'SPATIAL' ) )
+
+                index_names_to_column_names = HydrusData.BuildKeyToListDict( ( ( index_name, non_unique ), column_name ) for ( index_name, non_unique, column_name ) in self._c.fetchall() )
+
+                if len( index_names_to_column_names ) == 0:
+
+                    continue
+
+
+                self._c.executemany( 'REPLACE INTO deferred_indexes ( table_name, index_name, columns, is_unique ) VALUES ( %s, %s, %s, %s );', [ ( table_name, index_name, ', '.join( column_names ), not non_unique ) for ( ( index_name, non_unique ), column_names ) in index_names_to_column_names.items() ] )
+
+                self._Commit()
+
+                self._c.execute( 'ALTER TABLE ' + table_name + ' ' + ', '.join( 'DROP INDEX ' + index_name for ( index_name, non_unique ) in index_names_to_column_names.keys() ) + ';' )
+
+
+        finally:
+
+            self._BeginImmediate()
+
+
+
+    def _DropMappingsSchemaMigrationTable( self, table_name ):
+
+        self._DropMappingsSchemaMigrationTriggers( table_name )
+
+        self._c.execute( 'DROP TABLE IF EXISTS ' + table_name + MAPPINGS_SCHEMA_MIGRATION_SUFFIX + ';' )
+
+
+    def _DropMappingsSchemaMigrationTriggers( self, table_name ):
+
+        for event in ( 'insert', 'update', 'delete' ):
+
+            self._c.execute( 'DROP TRIGGER IF EXISTS ' + table_name + '_migration_' + event + ';' )
+
+
+
     def _DeleteFiles( self, service_id, hash_ids ):
 
         # the gui sometimes gets out of sync and sends a DELETE FROM TRASH call before the SEND TO TRASH call
@@ -1704,6 +2504,8 @@ class DB( HydrusDB.HydrusDB ):
 
         if len( existing_hash_ids ) > 0:
 
+            self._InvalidateFileSearchResultsForFileService( service_id )
+
             splayed_existing_hash_ids = HydrusData.SplayListForDB( existing_hash_ids )
 
             # remove them from the service
@@ -1795,6 +2597,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.execute( 'DELETE FROM json_dumps WHERE dump_type = %s;', ( dump_type, ) )
 
+        self._json_dump_store.DeleteRows( ( 'json_dumps', dump_type ) )
+
 
     def _DeleteJSONDumpNamed( self, dump_type, dump_name = None, timestamp = None ):
 
@@ -1802,18 +2606,26 @@ class DB( HydrusDB.HydrusDB ):
 
             self._c.execute( 'DELETE FROM json_dumps_named WHERE dump_type = %s;', ( dump_type, ) )
 
+            self._json_dump_store.DeleteRows( ( 'json_dumps_named', dump_type ) )
+
         elif timestamp is None:
 
             self._c.execute( 'DELETE FROM json_dumps_named WHERE dump_type = %s AND dump_name = %s;', ( dump_type, dump_name ) )
 
+            self._json_dump_store.DeleteRows( ( 'json_dumps_named', dump_type, dump_name ) )
+
         else:
 
             self._c.execute( 'DELETE FROM json_dumps_named WHERE dump_type = %s AND dump_name = %s AND timestamp = %s;', ( dump_type, dump_name, timestamp ) )
 
+            self._json_dump_store.DeleteRows( ( 'json_dumps_named', dump_type, dump_name, timestamp ) )
+
 
 
     def _DeletePending( self, service_key ):
 
+        self._file_search_result_cache.Clear()
+
         service_id = self._GetServiceId( service_key )
 
         service = self._GetService( service_id )
@@ -1831,6 +2643,9 @@ class DB( HydrusDB.HydrusDB ):
             self._c.execute( 'DELETE FROM tag_sibling_petitions WHERE service_id = %s;', ( service_id, ) )
             self._c.execute( 'DELETE FROM tag_parent_petitions WHERE service_id = %s;', ( service_id, ) )
 
+            self._CacheTagSiblingsClosureUpdate( service_id )
+            self._CacheTagParentsClosureUpdate( service_id )
+
         elif service.GetServiceType() in ( HC.FILE_REPOSITORY, HC.IPFS ):
 
             self._c.execute( 'DELETE FROM file_transfers WHERE service_id = %s;', ( service_id, ) )
@@ -1855,7 +2670,7 @@ class DB( HydrusDB.HydrusDB ):
 
 
         self._c.executemany( 'DELETE FROM file_maintenance_jobs WHERE hash_id = %s;', ( ( hash_id, ) for hash_id in hash_ids ) )
-        potentially_pending_upload_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM file_transfers;', ) )
+        potentially_pending_upload_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM file_transfers;', ) )
 
         deletable_file_hash_ids = hash_ids.difference( potentially_pending_upload_hash_ids )
 
@@ -1884,6 +2699,8 @@ class DB( HydrusDB.HydrusDB ):
 
     def _DeleteService( self, service_id ):
 
+        self._file_search_result_cache.Clear()
+
         service = self._GetService( service_id )
 
         service_key = service.GetServiceKey()
@@ -1891,6 +2708,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.execute( 'DELETE FROM services WHERE service_id = %s;', ( service_id, ) )
 
+        self._json_dump_store.DeleteRows( ( 'services', service_id ) )
+
         self._c.execute( 'DELETE FROM remote_thumbnails WHERE service_id = %s;', ( service_id, ) )
 
         if service_type in HC.REPOSITORIES:
@@ -1925,6 +2744,18 @@ class DB( HydrusDB.HydrusDB ):
                 self._CacheSpecificMappingsDrop( file_service_id, service_id )
 
 
+            #
+
+            self._c.execute( 'DELETE FROM tag_siblings WHERE service_id = %s;', ( service_id, ) )
+            self._c.execute( 'DELETE FROM tag_sibling_petitions WHERE service_id = %s;', ( service_id, ) )
+            self._c.execute( 'DELETE FROM tag_parents WHERE service_id = %s;', ( service_id, ) )
+            self._c.execute( 'DELETE FROM tag_parent_petitions WHERE service_id = %s;', ( service_id, ) )
+
+            self._CacheTagClosuresDrop( service_id )
+
+            self._CacheTagSiblingsClosureRegenerate( self._combined_tag_service_id )
+            self._CacheTagParentsClosureRegenerate( self._combined_tag_service_id )
+
 
         if service_type in HC.AUTOCOMPLETE_CACHE_SPECIFIC_FILE_SERVICES:
 
@@ -1970,6 +2801,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.executemany( 'INSERT IGNORE INTO tag_parents ( service_id, child_tag_id, parent_tag_id, status ) VALUES ( %s, %s, %s, %s );', list( ( service_id, child_tag_id, parent_tag_id, HC.CONTENT_STATUS_DELETED ) for ( child_tag_id, parent_tag_id ) in pairs ) )
 
+        self._CacheTagParentsClosureUpdate( service_id, { child_tag_id for ( child_tag_id, parent_tag_id ) in pairs } )
+
 
     def _DeleteTagSiblings( self, service_id, pairs ):
 
@@ -1978,6 +2811,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.executemany( 'INSERT IGNORE INTO tag_siblings ( service_id, bad_tag_id, good_tag_id, status ) VALUES ( %s, %s, %s, %s );', list( ( service_id, bad_tag_id, good_tag_id, HC.CONTENT_STATUS_DELETED ) for ( bad_tag_id, good_tag_id ) in pairs ) )
 
+        self._CacheTagSiblingsClosureUpdate( service_id, { tag_id for pair in pairs for tag_id in pair } )
+
 
     def _DeleteYAMLDump( self, dump_type, dump_name = None ):
 
@@ -2012,8 +2847,61 @@ class DB( HydrusDB.HydrusDB ):
 
         wx.SafeShowMessage( 'hydrus db failed', message )
 
+    def _DuplicatesAddPotentialDuplicatePairs( self, pairs ):
+
+        # the same checks as _DuplicatesAddPotentialDuplicates, but with the media and alternates lookups done for the whole batch at once
+
+        if len( pairs ) == 0:
+
+            return
+
+
+        self._InvalidateFileSearchResults( [ ( 'duplicates', ) ] )
+
+        all_hash_ids = set( itertools.chain.from_iterable( pairs ) )
+
+        hash_ids_to_media_ids = dict( self._SelectFromList( 'SELECT hash_id, media_id FROM duplicate_file_members WHERE hash_id IN {};', all_hash_ids ) )
+
+        for hash_id in all_hash_ids.difference( hash_ids_to_media_ids.keys() ):
+
+            hash_ids_to_media_ids[ hash_id ] = self._DuplicatesGetMediaId( hash_id )
+
+
+        media_ids_to_alternates_group_ids = dict( self._SelectFromList( 'SELECT media_id, alternates_group_id FROM alternate_file_group_members WHERE media_id IN {};', set( hash_ids_to_media_ids.values() ) ) )
+
+        inserts = []
+
+        for ( smaller_hash_id, larger_hash_id ) in pairs:
+
+            media_id = hash_ids_to_media_ids[ smaller_hash_id ]
+            potential_media_id = hash_ids_to_media_ids[ larger_hash_id ]
+
+            if potential_media_id == media_id: # already duplicates!
+
+                continue
+
+
+            if media_id in media_ids_to_alternates_group_ids and potential_media_id in media_ids_to_alternates_group_ids:
+
+                if self._DuplicatesAlternatesGroupsAreFalsePositive( media_ids_to_alternates_group_ids[ media_id ], media_ids_to_alternates_group_ids[ potential_media_id ] ):
+
+                    continue
+
+
+
+            inserts.append( ( smaller_hash_id, larger_hash_id, HC.DUPLICATE_POTENTIAL ) )
+
+
+        for chunk in HydrusData.SplitListIntoChunks( inserts, MASTER_BULK_CHUNK_SIZE ):
+
+            self._c.execute( 'INSERT IGNORE INTO duplicate_pairs ( smaller_hash_id, larger_hash_id, duplicate_type ) VALUES ' + ','.join( [ '( %s,%s,%s )' ] * len( chunk ) ) + ';', list( itertools.chain.from_iterable( chunk ) ) )
+
+
+
     def _DuplicatesAddPotentialDuplicates( self, hash_id, potential_duplicate_hash_ids ):
 
+        self._InvalidateFileSearchResults( [ ( 'duplicates', ) ] )
+
         inserts = []
 
         media_id = self._DuplicatesGetMediaId( hash_id )
@@ -2132,6 +3020,8 @@ class DB( HydrusDB.HydrusDB ):
 
     def _DuplicatesDeletePotentialDuplicatePairs( self ):
 
+        self._InvalidateFileSearchResults( [ ( 'duplicates', ) ] )
+
         hash_ids = set()
         self._c.execute('SELECT smaller_hash_id, larger_hash_id FROM duplicate_pairs WHERE duplicate_type = %s;',
                         (HC.DUPLICATE_POTENTIAL,))
@@ -2920,9 +3810,9 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-        self._PopulateHashIdsToHashesCache( seen_hash_ids )
+        hash_ids_to_hashes = self._PopulateHashIdsToHashesCache( seen_hash_ids )
 
-        pairs_of_hashes = [ ( self._hash_ids_to_hashes_cache[ smaller_hash_id ], self._hash_ids_to_hashes_cache[ larger_hash_id ] ) for ( smaller_hash_id, larger_hash_id ) in pairs_of_hash_ids ]
+        pairs_of_hashes = [ ( hash_ids_to_hashes[ smaller_hash_id ], hash_ids_to_hashes[ larger_hash_id ] ) for ( smaller_hash_id, larger_hash_id ) in pairs_of_hash_ids ]
 
         return pairs_of_hashes
 
@@ -3104,6 +3994,8 @@ class DB( HydrusDB.HydrusDB ):
 
     def _DuplicatesSetDuplicatePairStatus( self, pair_info ):
 
+        self._InvalidateFileSearchResults( [ ( 'duplicates', ) ] )
+
         for ( duplicate_type, hash_a, hash_b, service_keys_to_content_updates ) in pair_info:
 
             if len( service_keys_to_content_updates ) > 0:
@@ -3350,14 +4242,14 @@ class DB( HydrusDB.HydrusDB ):
 
                             continue
 
-                        archive_hash = binascii.a2b_hex(result[0])
+                        archive_hash = bytes( result[0] )
 
 
                     tag_ids = self._STL( self._c.execute( 'SELECT tag_id FROM ' + current_mappings_table_name + ' WHERE hash_id = %s;', ( hash_id, ) ) )
 
-                    self._PopulateTagIdsToTagsCache( tag_ids )
+                    tag_ids_to_tags = self._PopulateTagIdsToTagsCache( tag_ids )
 
-                    tags = [ self._tag_ids_to_tags_cache[ tag_id ] for tag_id in tag_ids ]
+                    tags = [ tag_ids_to_tags[ tag_id ] for tag_id in tag_ids ]
 
                     hta.AddMappings( archive_hash, tags )
 
@@ -3424,7 +4316,7 @@ class DB( HydrusDB.HydrusDB ):
 
                     ( md5, sha1, sha512 ) = additional_data
 
-                    self._c.execute( 'INSERT IGNORE INTO local_hashes ( hash_id, md5, sha1, sha512 ) VALUES ( %s,%s,%s,%s );', ( hash_id, binascii.b2a_hex(md5) , binascii.b2a_hex(sha1) , binascii.b2a_hex(sha512)  ) )
+                    self._c.execute( 'INSERT IGNORE INTO local_hashes ( hash_id, md5, sha1, sha512 ) VALUES ( %s, %s, %s, %s );', ( hash_id, md5, sha1, sha512 ) )
 
 
 
@@ -3484,55 +4376,28 @@ class DB( HydrusDB.HydrusDB ):
     
     def _FillInParents( self, service_id, fill_in_tag_id, make_content_updates = False ):
 
-        sibling_tag_ids = set()
-
-        search_tag_ids = [ fill_in_tag_id ]
-
-        while len( search_tag_ids ) > 0:
-
-            tag_id = search_tag_ids.pop()
-
-            sibling_tag_ids.add( tag_id )
-            self._c.execute(
-                'SELECT bad_tag_id, good_tag_id FROM tag_siblings WHERE ( bad_tag_id = %s OR good_tag_id = %s ) AND status = %s;',
-                (tag_id, tag_id, HC.CONTENT_STATUS_CURRENT))
-            for ( tag_id_a, tag_id_b ) in self._c.fetchall():
-
-                if tag_id_a not in sibling_tag_ids:
-
-                    search_tag_ids.append( tag_id_a )
-
+        tag_parent_closure_table_name = GenerateTagParentClosureTableName( service_id )
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( service_id )
 
-                if tag_id_b not in sibling_tag_ids:
+        # every sibling, worse or better, of fill_in_tag_id shares its ideal
 
-                    search_tag_ids.append( tag_id_b )
+        self._c.execute( 'SELECT ideal_tag_id FROM ' + tag_sibling_closure_table_name + ' WHERE bad_tag_id = %s AND status = %s;', ( fill_in_tag_id, HC.CONTENT_STATUS_CURRENT ) ); result = self._c.fetchone()
 
+        if result is None:
 
-                sibling_tag_ids.add( tag_id_a )
-                sibling_tag_ids.add( tag_id_b )
-
-
-
-        # we now have all the siblings, worse or better, of fill_in_tag_id
-
-        parent_tag_ids = set()
-
-        search_tag_ids = list( sibling_tag_ids )
-
-        while len( search_tag_ids ) > 0:
-
-            tag_id = search_tag_ids.pop()
-
-            for parent_tag_id in self._STI( self._c.execute( 'SELECT parent_tag_id FROM tag_parents WHERE child_tag_id = %s AND status = %s;', ( tag_id, HC.CONTENT_STATUS_CURRENT ) ) ):
+            ideal_tag_id = fill_in_tag_id
 
-                if parent_tag_id not in parent_tag_ids:
+        else:
 
-                    search_tag_ids.append( parent_tag_id )
+            ( ideal_tag_id, ) = result
 
 
-                parent_tag_ids.add( parent_tag_id )
+        sibling_tag_ids = self._STS( self._c.execute( 'SELECT bad_tag_id FROM ' + tag_sibling_closure_table_name + ' WHERE ideal_tag_id = %s AND status = %s;', ( ideal_tag_id, HC.CONTENT_STATUS_CURRENT ) ) )
 
+        sibling_tag_ids.add( ideal_tag_id )
+        sibling_tag_ids.add( fill_in_tag_id )
 
+        parent_tag_ids = self._STS( raw_data = self._SelectFromList( 'SELECT DISTINCT ancestor_tag_id FROM ' + tag_parent_closure_table_name + ' WHERE status = ' + str( HC.CONTENT_STATUS_CURRENT ) + ' AND child_tag_id IN {};', sibling_tag_ids ) )
 
         # we now have all parents and grandparents of all siblings
         # all parents should apply to all siblings
@@ -3545,7 +4410,7 @@ class DB( HydrusDB.HydrusDB ):
         child_hash_ids = self._STS( raw_data = self._SelectFromList( 'SELECT hash_id FROM ' + current_mappings_table_name + ' WHERE tag_id IN {};', sibling_tag_ids ) )
         for parent_tag_id in parent_tag_ids:
 
-            parent_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM ' + current_mappings_table_name + ' WHERE tag_id = %s;', ( parent_tag_id, ) ) )
+            parent_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM ' + current_mappings_table_name + ' WHERE tag_id = %s;', ( parent_tag_id, ) ) )
 
             needed_hash_ids = child_hash_ids.difference( parent_hash_ids )
 
@@ -3619,32 +4484,182 @@ class DB( HydrusDB.HydrusDB ):
         return hashes_result
 
 
+    def _FinishMappingsSchemaMigrationTable( self, table_name ):
+
+        migration_table_name = table_name + MAPPINGS_SCHEMA_MIGRATION_SUFFIX
+        old_table_name = table_name + MAPPINGS_SCHEMA_MIGRATION_OLD_SUFFIX
+
+        self._Commit()
+
+        try:
+
+            existing_table_names = self._STS( self._c.execute( 'SHOW TABLES;' ) )
+
+            if table_name in existing_table_names and migration_table_name in existing_table_names:
+
+                # both tables are write locked from before the triggers go until after the swap, so no connection can write a row the copy would miss
+                # the swap is one RENAME, so readers see either the old table or the new one
+
+                self._c.execute( 'LOCK TABLES ' + table_name + ' WRITE, ' + migration_table_name + ' WRITE;' )
+
+                try:
+
+                    self._DropMappingsSchemaMigrationTriggers( table_name )
+
+                    self._c.execute( 'RENAME TABLE ' + table_name + ' TO ' + old_table_name + ', ' + migration_table_name + ' TO ' + table_name + ';' )
+
+                    self._c.execute( 'DROP TABLE ' + old_table_name + ';' )
+
+                finally:
+
+                    self._c.execute( 'UNLOCK TABLES;' )
+
+
+            else:
+
+                self._DropMappingsSchemaMigrationTable( table_name )
+
+
+        finally:
+
+            self._BeginImmediate()
+
+
+
     def _GenerateMappingsTables( self, service_id ):
 
         ( current_mappings_table_name, deleted_mappings_table_name, pending_mappings_table_name, petitioned_mappings_table_name ) = GenerateMappingsTableNames( service_id )
 
-        self._c.execute( 'CREATE TABLE IF NOT EXISTS ' + current_mappings_table_name + ' ( tag_id INTEGER, hash_id INTEGER, PRIMARY KEY ( tag_id, hash_id ) ) ENGINE=RocksDB;' )
-        self._CreateIndex( current_mappings_table_name, [ 'hash_id', 'tag_id' ], unique = True )
-        self._CreateIndex(current_mappings_table_name, ['tag_id'], unique=False)
-        self._CreateIndex(current_mappings_table_name, ['hash_id'], unique=False)
+        self._c.execute( GenerateMappingsTableCreateStatement( current_mappings_table_name, [ 'tag_id', 'hash_id' ] ) )
+        self._c.execute( GenerateMappingsTableCreateStatement( deleted_mappings_table_name, [ 'tag_id', 'hash_id' ] ) )
+        self._c.execute( GenerateMappingsTableCreateStatement( pending_mappings_table_name, [ 'tag_id', 'hash_id' ] ) )
+        self._c.execute( GenerateMappingsTableCreateStatement( petitioned_mappings_table_name, [ 'tag_id', 'hash_id' ], has_reason_id = True ) )
+
+
+    def _GenerateMediaResults( self, hash_ids ):
+
+        # the ids are staged once and every side table is joined against them, so this is one query per table no matter how many files there are
+
+        hash_ids_to_hashes = self._PopulateHashIdsToHashesCache( hash_ids )
+
+        with HydrusDB.TemporaryIntegerTable( self._c, set( hash_ids ), 'hash_id' ) as temp_table_name:
+
+            # get first detailed results
+
+            self._c.execute( 'SELECT hash_id, size, mime, width, height, duration, num_frames, num_words FROM files_info NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_info = { hash_id : ClientMedia.FileInfoManager( hash_id, hash_ids_to_hashes[ hash_id ], size, mime, width, height, duration, num_frames, num_words ) for ( hash_id, size, mime, width, height, duration, num_frames, num_words ) in self._c.fetchall() }
+
+            self._c.execute( 'SELECT hash_id, service_id, timestamp FROM current_files NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_current_file_service_ids_and_timestamps = HydrusData.BuildKeyToListDict( ( ( hash_id, ( service_id, timestamp ) ) for ( hash_id, service_id, timestamp ) in self._c.fetchall() ) )
+
+            self._c.execute( 'SELECT hash_id, service_id FROM deleted_files NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_deleted_file_service_ids = HydrusData.BuildKeyToListDict( self._c.fetchall() )
+
+            self._c.execute( 'SELECT hash_id, service_id FROM file_transfers NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_pending_file_service_ids = HydrusData.BuildKeyToListDict( self._c.fetchall() )
+
+            self._c.execute( 'SELECT hash_id, service_id FROM file_petitions NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_petitioned_file_service_ids = HydrusData.BuildKeyToListDict( self._c.fetchall() )
+
+            self._c.execute( 'SELECT hash_id, url FROM url_map NATURAL JOIN urls NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_urls = HydrusData.BuildKeyToSetDict( self._c.fetchall() )
+
+            self._c.execute( 'SELECT hash_id, service_id, filename FROM service_filenames NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_service_ids_and_filenames = HydrusData.BuildKeyToListDict( ( ( hash_id, ( service_id, filename ) ) for ( hash_id, service_id, filename ) in self._c.fetchall() ) )
+
+            self._c.execute( 'SELECT hash_id, service_id, rating FROM local_ratings NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_local_ratings = HydrusData.BuildKeyToListDict( ( ( hash_id, ( service_id, rating ) ) for ( hash_id, service_id, rating ) in self._c.fetchall() ) )
+
+            self._c.execute( 'SELECT hash_id, preview_views, preview_viewtime, media_views, media_viewtime FROM file_viewing_stats NATURAL JOIN ' + temp_table_name + ';' )
+
+            hash_ids_to_file_viewing_stats_managers = { hash_id : ClientMedia.FileViewingStatsManager( preview_views, preview_viewtime, media_views, media_viewtime ) for ( hash_id, preview_views, preview_viewtime, media_views, media_viewtime ) in self._c.fetchall() }
+
+            #
+
+            hash_ids_to_current_file_service_ids = { hash_id : [ file_service_id for ( file_service_id, timestamp ) in file_service_ids_and_timestamps ] for ( hash_id, file_service_ids_and_timestamps ) in list(hash_ids_to_current_file_service_ids_and_timestamps.items()) }
+
+            hash_ids_to_tags_managers = self._GetForceRefreshTagsManagers( hash_ids, hash_ids_to_current_file_service_ids = hash_ids_to_current_file_service_ids, hash_ids_table_name = temp_table_name )
+
+            inbox_hash_ids = self._GetInboxHashIds( hash_ids, hash_ids_table_name = temp_table_name )
+
+
+        # build it
+
+        service_ids_to_service_keys = self._GetServiceIdsToServiceKeys()
+
+        media_results = []
+
+        for hash_id in hash_ids:
+
+            tags_manager = hash_ids_to_tags_managers[ hash_id ]
+
+            #
+
+            current_file_service_keys = { service_ids_to_service_keys[ service_id ] for ( service_id, timestamp ) in hash_ids_to_current_file_service_ids_and_timestamps[ hash_id ] }
+
+            deleted_file_service_keys = { service_ids_to_service_keys[ service_id ] for service_id in hash_ids_to_deleted_file_service_ids[ hash_id ] }
+
+            pending_file_service_keys = { service_ids_to_service_keys[ service_id ] for service_id in hash_ids_to_pending_file_service_ids[ hash_id ] }
 
-        self._c.execute( 'CREATE TABLE IF NOT EXISTS ' + deleted_mappings_table_name + ' ( tag_id INTEGER, hash_id INTEGER, PRIMARY KEY ( tag_id, hash_id ) ) ENGINE=RocksDB;' )
-        self._CreateIndex( deleted_mappings_table_name, [ 'hash_id', 'tag_id' ], unique = True )
-        self._CreateIndex(deleted_mappings_table_name, ['tag_id'], unique=False)
-        self._CreateIndex(deleted_mappings_table_name, ['hash_id'], unique=False)
+            petitioned_file_service_keys = { service_ids_to_service_keys[ service_id ] for service_id in hash_ids_to_petitioned_file_service_ids[ hash_id ] }
 
-        self._c.execute( 'CREATE TABLE IF NOT EXISTS ' + pending_mappings_table_name + ' ( tag_id INTEGER, hash_id INTEGER, PRIMARY KEY ( tag_id, hash_id ) ) ENGINE=RocksDB;' )
-        self._CreateIndex( pending_mappings_table_name, [ 'hash_id', 'tag_id' ], unique = True )
-        self._CreateIndex(pending_mappings_table_name, ['tag_id'], unique=False)
-        self._CreateIndex(pending_mappings_table_name, ['hash_id'], unique=False)
+            inbox = hash_id in inbox_hash_ids
 
-        self._c.execute( 'CREATE TABLE IF NOT EXISTS ' + petitioned_mappings_table_name + ' ( tag_id INTEGER, hash_id INTEGER, reason_id INTEGER, PRIMARY KEY ( tag_id, hash_id ) ) ENGINE=RocksDB;' )
-        self._CreateIndex( petitioned_mappings_table_name, [ 'hash_id', 'tag_id' ], unique = True )
-        self._CreateIndex(petitioned_mappings_table_name, ['tag_id'], unique=False)
-        self._CreateIndex(petitioned_mappings_table_name, ['hash_id'], unique=False)
+            urls = hash_ids_to_urls[ hash_id ]
 
+            service_ids_to_filenames = HydrusData.BuildKeyToListDict( hash_ids_to_service_ids_and_filenames[ hash_id ] )
 
-    def _GetAutocompleteCounts( self, tag_service_id, file_service_id, tag_ids, include_current, include_pending ):
+            service_keys_to_filenames = { service_ids_to_service_keys[ service_id ] : filenames for ( service_id, filenames ) in list(service_ids_to_filenames.items()) }
+
+            current_file_service_keys_to_timestamps = { service_ids_to_service_keys[ service_id ] : timestamp for ( service_id, timestamp ) in hash_ids_to_current_file_service_ids_and_timestamps[ hash_id ] }
+
+            locations_manager = ClientMedia.LocationsManager( current_file_service_keys, deleted_file_service_keys, pending_file_service_keys, petitioned_file_service_keys, inbox, urls, service_keys_to_filenames, current_to_timestamps = current_file_service_keys_to_timestamps )
+
+            #
+
+            local_ratings = { service_ids_to_service_keys[ service_id ] : rating for ( service_id, rating ) in hash_ids_to_local_ratings[ hash_id ] }
+
+            ratings_manager = ClientRatings.RatingsManager( local_ratings )
+
+            #
+
+            if hash_id in hash_ids_to_file_viewing_stats_managers:
+
+                file_viewing_stats_manager = hash_ids_to_file_viewing_stats_managers[ hash_id ]
+
+            else:
+
+                file_viewing_stats_manager = ClientMedia.FileViewingStatsManager.STATICGenerateEmptyManager()
+
+
+            #
+
+            if hash_id in hash_ids_to_info:
+
+                file_info_manager = hash_ids_to_info[ hash_id ]
+
+            else:
+
+                hash = hash_ids_to_hashes[ hash_id ]
+
+                file_info_manager = ClientMedia.FileInfoManager( hash_id, hash )
+
+
+            media_results.append( ClientMedia.MediaResult( file_info_manager, tags_manager, locations_manager, ratings_manager, file_viewing_stats_manager ) )
+
+
+        return media_results
+
+
+    def _GetAutocompleteCounts( self, tag_service_id, file_service_id, tag_ids, include_current, include_pending, limit = None ):
 
         if tag_service_id == self._combined_tag_service_id:
 
@@ -3655,17 +4670,53 @@ class DB( HydrusDB.HydrusDB ):
             search_tag_service_ids = [ tag_service_id ]
 
 
-        if file_service_id == self._combined_file_service_id:
+        if limit is None:
+
+            if file_service_id == self._combined_file_service_id:
+
+                cache_results = self._CacheCombinedFilesMappingsGetAutocompleteCounts( tag_service_id, tag_ids )
+
+            else:
+
+                cache_results = []
+
+                for search_tag_service_id in search_tag_service_ids:
+
+                    cache_results.extend( self._CacheSpecificMappingsGetAutocompleteCounts( file_service_id, search_tag_service_id, tag_ids ) )
+
 
-            cache_results = self._CacheCombinedFilesMappingsGetAutocompleteCounts( tag_service_id, tag_ids )
 
         else:
 
-            cache_results = []
+            # each ac cache ranks its own rows, so only its top few ever leave the db
 
-            for search_tag_service_id in search_tag_service_ids:
+            if include_current and not include_pending:
+
+                order_by = 'current_count'
+
+            elif include_pending and not include_current:
+
+                order_by = 'pending_count'
+
+            else:
+
+                order_by = 'current_count + pending_count'
+
+
+            with HydrusDB.TemporaryIntegerTable( self._c, tag_ids, 'tag_id' ) as temp_tag_ids_table_name:
+
+                if file_service_id == self._combined_file_service_id:
+
+                    cache_results = self._CacheCombinedFilesMappingsGetTopAutocompleteCounts( tag_service_id, temp_tag_ids_table_name, order_by, limit )
+
+                else:
+
+                    cache_results = []
+
+                    for search_tag_service_id in search_tag_service_ids:
+
+                        cache_results.extend( self._CacheSpecificMappingsGetTopAutocompleteCounts( file_service_id, search_tag_service_id, temp_tag_ids_table_name, order_by, limit ) )
 
-                cache_results.extend( self._CacheSpecificMappingsGetAutocompleteCounts( file_service_id, search_tag_service_id, tag_ids ) )
 
 
 
@@ -3734,6 +4785,16 @@ class DB( HydrusDB.HydrusDB ):
 
             def GetPossibleSubtagIds( half_complete_subtag ):
 
+                if self._subtag_autocomplete_index is not None:
+
+                    possible_subtag_ids = self._GetPossibleSubtagIdsFromAutocompleteIndex( half_complete_subtag )
+
+                    if possible_subtag_ids is not None:
+
+                        return possible_subtag_ids
+
+
+
                 # complicated queries are passed to LIKE, because MATCH only supports appended wildcards 'gun*', and not complex stuff like '*gun*'
 
                 if ClientSearch.IsComplexWildcard( half_complete_subtag ):
@@ -3847,7 +4908,7 @@ class DB( HydrusDB.HydrusDB ):
         return tag_ids
 
 
-    def _GetAutocompletePredicates( self, tag_service_key = CC.COMBINED_TAG_SERVICE_KEY, file_service_key = CC.COMBINED_FILE_SERVICE_KEY, search_text = '', exact_match = False, inclusive = True, include_current = True, include_pending = True, add_namespaceless = False, collapse_siblings = False, job_key = None ):
+    def _GetAutocompletePredicates( self, tag_service_key = CC.COMBINED_TAG_SERVICE_KEY, file_service_key = CC.COMBINED_FILE_SERVICE_KEY, search_text = '', exact_match = False, inclusive = True, include_current = True, include_pending = True, add_namespaceless = False, collapse_siblings = False, job_key = None, max_results = None ):
 
         tag_ids = self._GetAutocompleteTagIds( tag_service_key, search_text, exact_match, job_key = job_key )
 
@@ -3868,14 +4929,39 @@ class DB( HydrusDB.HydrusDB ):
             search_tag_service_ids = [ tag_service_id ]
 
 
-        all_predicates = []
+        # tag -> ( min_current_count, max_current_count, min_pending_count, max_pending_count ). counts are merged raw, so only the tags that make the cut become predicates
+
+        tags_to_counts = {}
 
         tag_censorship_manager = self._controller.tag_censorship_manager
 
         siblings_manager = HG.client_controller.tag_siblings_manager
+
+        # a merged count can outrank every one of its parts, so the ac cache can only do the ranking when nothing below merges counts: one service, no sibling collapse, no namespaceless sums
+
+        if max_results is not None and len( search_tag_service_ids ) == 1 and not collapse_siblings and not add_namespaceless:
+
+            cache_limit = max_results
+
+        else:
+
+            cache_limit = None
+
+
         for search_tag_service_id in search_tag_service_ids:
 
-            for group_of_tag_ids in HydrusData.SplitIteratorIntoChunks( tag_ids, 1000 ):
+            if cache_limit is None:
+
+                groups_of_tag_ids = HydrusData.SplitIteratorIntoChunks( tag_ids, 1000 )
+
+            else:
+
+                # the ac cache does the ranking in one go, so we only see its top rows
+
+                groups_of_tag_ids = [ tag_ids ]
+
+
+            for group_of_tag_ids in groups_of_tag_ids:
 
                 if job_key is not None and job_key.IsCancelled():
 
@@ -3884,129 +4970,209 @@ class DB( HydrusDB.HydrusDB ):
 
                 search_tag_service_key = self._GetService( search_tag_service_id ).GetServiceKey()
 
-                ids_to_count = self._GetAutocompleteCounts( search_tag_service_id, file_service_id, group_of_tag_ids, include_current, include_pending )
+                ids_to_count = self._GetAutocompleteCounts( search_tag_service_id, file_service_id, group_of_tag_ids, include_current, include_pending, limit = cache_limit )
 
                 #
 
-                self._PopulateTagIdsToTagsCache( list( ids_to_count.keys() ) )
-
-                tags_and_counts_generator = ( ( self._tag_ids_to_tags_cache[ id ], ids_to_count[ id ] ) for id in ids_to_count.keys() )
+                tag_ids_to_tags = self._PopulateTagIdsToTagsCache( list( ids_to_count.keys() ) )
 
-                predicates = [ ClientSearch.Predicate( HC.PREDICATE_TYPE_TAG, tag, inclusive, min_current_count = min_current_count, min_pending_count = min_pending_count, max_current_count = max_current_count, max_pending_count = max_pending_count ) for ( tag, ( min_current_count, max_current_count, min_pending_count, max_pending_count ) ) in tags_and_counts_generator ]
+                group_tags_to_counts = { tag_ids_to_tags[ id ] : counts for ( id, counts ) in ids_to_count.items() }
 
                 if collapse_siblings:
 
-                    predicates = siblings_manager.CollapsePredicates( search_tag_service_key, predicates )
+                    group_tags_to_counts = siblings_manager.CollapseTagsToAllCounts( search_tag_service_key, group_tags_to_counts )
 
 
-                predicates = tag_censorship_manager.FilterPredicates( search_tag_service_key, predicates )
+                allowed_tags = tag_censorship_manager.FilterTags( search_tag_service_key, group_tags_to_counts.keys() )
 
-                all_predicates.extend( predicates )
+                for tag in allowed_tags:
 
+                    counts = group_tags_to_counts[ tag ]
 
+                    if tag in tags_to_counts:
 
-        if job_key is not None and job_key.IsCancelled():
+                        tags_to_counts[ tag ] = ClientData.MergeAllCounts( tags_to_counts[ tag ], counts )
 
-            return []
+                    else:
 
+                        tags_to_counts[ tag ] = counts
 
-        predicates = ClientData.MergePredicates( all_predicates, add_namespaceless = add_namespaceless )
 
-        return predicates
 
 
-    def _GetBigTableNamesToAnalyze( self, force_reanalyze = False ):
-        return []
 
+        if job_key is not None and job_key.IsCancelled():
 
-    def _GetBonedStats( self ):
+            return []
 
-        self._c.execute( 'SELECT COUNT( hash_id ), SUM( size ) FROM files_info NATURAL JOIN current_files WHERE service_id = %s;', ( self._local_file_service_id, ) ); ( num_total, size_total ) = self._c.fetchone()
-        self._c.execute( 'SELECT COUNT( hash_id ), SUM( size ) FROM files_info NATURAL JOIN current_files NATURAL JOIN file_inbox WHERE service_id = %s;', ( self._local_file_service_id, ) ); ( num_inbox, size_inbox ) = self._c.fetchone()
 
-        if size_total is None:
+        if add_namespaceless:
 
-            size_total = 0
+            tags_to_counts = ClientData.MergeTagsToCountsNamespaceless( tags_to_counts )
 
 
-        if size_inbox is None:
+        tags_and_counts = tags_to_counts.items()
 
-            size_inbox = 0
+        if max_results is not None:
 
+            # the limit is only applied once every count is merged
 
-        num_archive = num_total - num_inbox
-        size_archive = size_total - size_inbox
+            tags_and_counts = heapq.nlargest( max_results, tags_and_counts, key = lambda tag_and_counts: tag_and_counts[1][0] + tag_and_counts[1][2] )
 
-        self._c.execute( 'SELECT SUM( media_views ), SUM( media_viewtime ), SUM( preview_views ), SUM( preview_viewtime ) FROM file_viewing_stats;' ); total_viewtime = self._c.fetchone()
 
-        if total_viewtime is None:
+        predicates = [ ClientSearch.Predicate( HC.PREDICATE_TYPE_TAG, tag, inclusive, min_current_count = min_current_count, min_pending_count = min_pending_count, max_current_count = max_current_count, max_pending_count = max_pending_count ) for ( tag, ( min_current_count, max_current_count, min_pending_count, max_pending_count ) ) in tags_and_counts ]
 
-            total_viewtime = ( 0, 0, 0, 0 )
+        return predicates
 
-        else:
 
-            ( media_views, media_viewtime, preview_views, preview_viewtime ) = total_viewtime
+    def _GetAutocompleteSubtags( self ):
 
-            if media_views is None:
+        self._c.execute( 'SELECT subtag_id, subtag FROM subtags;' )
 
-                total_viewtime = ( 0, 0, 0, 0 )
+        return self._c.fetchall()
 
 
+    def _GetBigTableNamesToAnalyze( self, force_reanalyze = False ):
 
-        return ( num_inbox, num_archive, size_inbox, size_archive, total_viewtime )
+        table_names_to_num_rows = self._GetTableNamesToEstimatedNumRows()
 
+        if force_reanalyze:
 
-    def _GetClientFilesLocations( self ):
+            names_to_analyze = list( table_names_to_num_rows.keys() )
 
-        self._c.execute('SELECT prefix, location FROM client_files_locations;')
-        result = { prefix : HydrusPaths.ConvertPortablePathToAbsPath( location ) for ( prefix, location ) in self._c.fetchall()  }
+        else:
 
-        return result
+            # the planner's statistics go bad as a table grows or shrinks, not as time passes, so a table is due once its row count has drifted from when it was last analyzed
+            # sync can make a table huge long before any time-based cycle would come round
 
+            self._c.execute( 'SELECT name, num_rows, timestamp FROM analyze_timestamps;' )
 
-    def _GetDownloads( self ):
-        self._c.execute('SELECT hash FROM file_transfers NATURAL JOIN hashes WHERE service_id = %s;', (self._combined_local_file_service_id,))
+            existing_names_to_info = { name : ( num_rows, timestamp ) for ( name, num_rows, timestamp ) in self._c.fetchall() }
 
-        return {  binascii.a2b_hex(hash) for ( hash, ) in self._c.fetchall()  }
+            currently_idle = self._controller.CurrentlyIdle()
 
+            names_to_analyze = []
 
-    def _GetFileHashes( self, given_hashes, given_hash_type, desired_hash_type ):
+            for ( name, num_rows ) in table_names_to_num_rows.items():
 
-        if given_hash_type == 'sha256':
+                if name in existing_names_to_info:
 
-            hash_ids = self._GetHashIds( given_hashes )
+                    ( last_num_rows, timestamp ) = existing_names_to_info[ name ]
 
-        else:
+                    drift = abs( num_rows - ( last_num_rows or 0 ) )
 
-            hash_ids = []
+                    drifted = drift >= ANALYZE_MIN_ROW_DRIFT and drift * 100 >= ( last_num_rows or 0 ) * HC.ANALYZE_ROW_DRIFT_PERCENT
 
-            for given_hash in given_hashes:
+                    if not drifted and not HydrusData.TimeHasPassed( timestamp + ANALYZE_MAX_PERIOD ):
 
-                if given_hash is None:
+                        continue
 
-                    continue
 
 
-                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE ' + given_hash_type + ' = %s;', ( binascii.b2a_hex(given_hash) , ) ); result = self._c.fetchone()
+                if num_rows > MAINTENANCE_BIG_TABLE_ROWS and not currently_idle:
 
-                if result is not None:
+                    continue
 
-                    ( hash_id, ) = result
 
-                    hash_ids.append( hash_id )
+                names_to_analyze.append( name )
 
 
 
+        # smallest first, so a short maintenance window still gets through most tables
 
-        if desired_hash_type == 'sha256':
+        names_to_analyze.sort( key = lambda name: table_names_to_num_rows[ name ] )
 
-            desired_hashes = self._GetHashes( hash_ids )
+        return names_to_analyze
+
+
+    def _GetBonedStats( self ):
+
+        self._c.execute( 'SELECT COUNT( hash_id ), SUM( size ) FROM files_info NATURAL JOIN current_files WHERE service_id = %s;', ( self._local_file_service_id, ) ); ( num_total, size_total ) = self._c.fetchone()
+        self._c.execute( 'SELECT COUNT( hash_id ), SUM( size ) FROM files_info NATURAL JOIN current_files NATURAL JOIN file_inbox WHERE service_id = %s;', ( self._local_file_service_id, ) ); ( num_inbox, size_inbox ) = self._c.fetchone()
+
+        if size_total is None:
+
+            size_total = 0
+
+
+        if size_inbox is None:
+
+            size_inbox = 0
+
+
+        num_archive = num_total - num_inbox
+        size_archive = size_total - size_inbox
+
+        self._c.execute( 'SELECT SUM( media_views ), SUM( media_viewtime ), SUM( preview_views ), SUM( preview_viewtime ) FROM file_viewing_stats;' ); total_viewtime = self._c.fetchone()
+
+        if total_viewtime is None:
+
+            total_viewtime = ( 0, 0, 0, 0 )
+
+        else:
+
+            ( media_views, media_viewtime, preview_views, preview_viewtime ) = total_viewtime
+
+            if media_views is None:
+
+                total_viewtime = ( 0, 0, 0, 0 )
+
+
+
+        return ( num_inbox, num_archive, size_inbox, size_archive, total_viewtime )
+
+
+    def _GetClientFilesLocations( self ):
+
+        self._c.execute('SELECT prefix, location FROM client_files_locations;')
+        result = { prefix : HydrusPaths.ConvertPortablePathToAbsPath( location ) for ( prefix, location ) in self._c.fetchall()  }
+
+        return result
+
+
+    def _GetDownloads( self ):
+        self._c.execute('SELECT hash FROM file_transfers NATURAL JOIN hashes WHERE service_id = %s;', (self._combined_local_file_service_id,))
+
+        return { bytes( hash ) for ( hash, ) in self._c.fetchall() }
+
+
+    def _GetFileHashes( self, given_hashes, given_hash_type, desired_hash_type ):
+
+        if given_hash_type == 'sha256':
+
+            hash_ids = self._GetHashIds( given_hashes )
+
+        else:
+
+            hash_ids = []
+
+            for given_hash in given_hashes:
+
+                if given_hash is None:
+
+                    continue
+
+
+                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE ' + given_hash_type + ' = %s;', ( given_hash, ) ); result = self._c.fetchone()
+
+                if result is not None:
+
+                    ( hash_id, ) = result
+
+                    hash_ids.append( hash_id )
+
+
+
+
+        if desired_hash_type == 'sha256':
+
+            desired_hashes = self._GetHashes( hash_ids )
 
         else:
             self._c.execute(
                 'SELECT ' + desired_hash_type + ' FROM local_hashes WHERE hash_id IN ' + HydrusData.SplayListForDB(
                     hash_ids) + ';')
-            desired_hashes = [ binascii.a2b_hex(desired_hash) for ( desired_hash, ) in  self._c.fetchall()]
+            desired_hashes = [ bytes( desired_hash ) for ( desired_hash, ) in self._c.fetchall() ]
 
 
         return desired_hashes
@@ -4030,6 +5196,127 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+    def _GetFileSearchResultDependencies( self, search_context ):
+
+        # the changes a search's result depends on, so a change only drops the cached searches it can affect. None means the search should not be cached
+
+        system_predicates = search_context.GetSystemPredicates()
+
+        simple_preds = system_predicates.GetSimpleInfo()
+
+        if 'min_timestamp' in simple_preds or 'max_timestamp' in simple_preds:
+
+            # these are relative to now, so the result goes stale on its own
+
+            return None
+
+
+        tag_service_key = search_context.GetTagServiceKey()
+
+        file_service_id = self._GetServiceId( search_context.GetFileServiceKey() )
+        tag_service_id = self._GetServiceId( tag_service_key )
+
+        dependencies = { ( 'file_service', file_service_id ) }
+
+        if file_service_id == self._combined_file_service_id:
+
+            # 'all known files' is every file with a tag
+
+            dependencies.add( ( 'all_tags', tag_service_id ) )
+
+
+        siblings_manager = self._controller.tag_siblings_manager
+
+        for tag in itertools.chain( search_context.GetTagsToInclude(), search_context.GetTagsToExclude() ):
+
+            for sibling in siblings_manager.GetAllSiblings( tag_service_key, tag ):
+
+                ( namespace, subtag ) = HydrusTags.SplitTag( sibling )
+
+                if namespace == '':
+
+                    dependencies.add( ( 'subtag', tag_service_id, subtag ) )
+
+                else:
+
+                    dependencies.add( ( 'tag', tag_service_id, sibling ) )
+
+
+
+
+        # namespace searches also pull in siblings from other namespaces, so they and wildcards just depend on every tag
+
+        there_are_broad_tag_preds = len( search_context.GetNamespacesToInclude() ) + len( search_context.GetNamespacesToExclude() ) + len( search_context.GetWildcardsToInclude() ) + len( search_context.GetWildcardsToExclude() ) > 0
+
+        if there_are_broad_tag_preds or True in ( key in simple_preds for key in ( 'min_num_tags', 'num_tags', 'max_num_tags', 'min_tag_as_number', 'max_tag_as_number' ) ):
+
+            dependencies.add( ( 'all_tags', tag_service_id ) )
+
+
+        ( file_services_to_include_current, file_services_to_include_pending, file_services_to_exclude_current, file_services_to_exclude_pending ) = system_predicates.GetFileServiceInfo()
+
+        for service_key in itertools.chain( file_services_to_include_current, file_services_to_include_pending, file_services_to_exclude_current, file_services_to_exclude_pending ):
+
+            dependencies.add( ( 'file_service', self._GetServiceId( service_key ) ) )
+
+
+        if system_predicates.MustBeLocal() or system_predicates.MustNotBeLocal():
+
+            dependencies.add( ( 'file_service', self._combined_local_file_service_id ) )
+
+
+        if system_predicates.MustBeInbox() or system_predicates.MustBeArchive():
+
+            dependencies.add( ( 'inbox', ) )
+
+
+        for ( operator, value, rating_service_key ) in system_predicates.GetRatingsPredicates():
+
+            dependencies.add( ( 'ratings', self._GetServiceId( rating_service_key ) ) )
+
+
+        if len( system_predicates.GetDuplicateRelationshipCountPredicates() ) > 0:
+
+            dependencies.add( ( 'duplicates', ) )
+
+
+        if len( system_predicates.GetFileViewingStatsPredicates() ) > 0:
+
+            dependencies.add( ( 'file_viewing_stats', ) )
+
+
+        if system_predicates.HasSimilarTo():
+
+            dependencies.add( ( 'similar_files', ) )
+
+
+        if 'known_url_rules' in simple_preds:
+
+            dependencies.add( ( 'urls', ) )
+
+
+        for or_predicate in search_context.GetORPredicates():
+
+            for or_subpredicate in or_predicate.GetValue():
+
+                or_search_context = search_context.Duplicate()
+
+                or_search_context.SetPredicates( [ or_subpredicate ] )
+
+                or_dependencies = self._GetFileSearchResultDependencies( or_search_context )
+
+                if or_dependencies is None:
+
+                    return None
+
+
+                dependencies.update( or_dependencies )
+
+
+
+        return dependencies
+
+
     def _GetFileSystemPredicates( self, service_key ):
 
         service_id = self._GetServiceId( service_key )
@@ -4143,9 +5430,24 @@ class DB( HydrusDB.HydrusDB ):
         return predicates
 
 
-    def _GetForceRefreshTagsManagers( self, hash_ids, hash_ids_to_current_file_service_ids = None ):
+    def _GetForceRefreshTagsManagers( self, hash_ids, hash_ids_to_current_file_service_ids = None, hash_ids_table_name = None ):
 
         tag_censorship_manager = self._controller.tag_censorship_manager
+
+        def select_hash_ids_and_tag_ids( mappings_table_name ):
+
+            if hash_ids_table_name is None:
+
+                return self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + mappings_table_name + ' WHERE hash_id IN {};', hash_ids )
+
+            else:
+
+                self._c.execute( 'SELECT hash_id, tag_id FROM ' + mappings_table_name + ' NATURAL JOIN ' + hash_ids_table_name + ';' )
+
+                return self._c.fetchall()
+
+
+
         #
 
         if hash_ids_to_current_file_service_ids is None:
@@ -4193,27 +5495,37 @@ class DB( HydrusDB.HydrusDB ):
 
             if common_file_service_id is None:
 
-                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_CURRENT, tag_id ) ) for ( hash_id, tag_id ) in self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + current_mappings_table_name + ' WHERE hash_id IN {};', hash_ids ) )
-                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_DELETED, tag_id ) ) for ( hash_id, tag_id ) in self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + deleted_mappings_table_name + ' WHERE hash_id IN {};', hash_ids ) )
-                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_PENDING, tag_id ) ) for ( hash_id, tag_id ) in self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + pending_mappings_table_name + ' WHERE hash_id IN {};', hash_ids ) )
+                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_CURRENT, tag_id ) ) for ( hash_id, tag_id ) in select_hash_ids_and_tag_ids( current_mappings_table_name ) )
+                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_DELETED, tag_id ) ) for ( hash_id, tag_id ) in select_hash_ids_and_tag_ids( deleted_mappings_table_name ) )
+                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_PENDING, tag_id ) ) for ( hash_id, tag_id ) in select_hash_ids_and_tag_ids( pending_mappings_table_name ) )
             else:
 
                 ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( common_file_service_id, tag_service_id )
 
-                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_CURRENT, tag_id ) ) for ( hash_id, tag_id ) in self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + cache_current_mappings_table_name + ' WHERE hash_id IN {};', hash_ids ) )
-                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_DELETED, tag_id ) ) for ( hash_id, tag_id ) in self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + cache_deleted_mappings_table_name + ' WHERE hash_id IN {};', hash_ids ) )
-                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_PENDING, tag_id ) ) for ( hash_id, tag_id ) in self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + cache_pending_mappings_table_name + ' WHERE hash_id IN {};', hash_ids ) )
+                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_CURRENT, tag_id ) ) for ( hash_id, tag_id ) in select_hash_ids_and_tag_ids( cache_current_mappings_table_name ) )
+                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_DELETED, tag_id ) ) for ( hash_id, tag_id ) in select_hash_ids_and_tag_ids( cache_deleted_mappings_table_name ) )
+                tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_PENDING, tag_id ) ) for ( hash_id, tag_id ) in select_hash_ids_and_tag_ids( cache_pending_mappings_table_name ) )
 
 
-            tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_PETITIONED, tag_id ) ) for ( hash_id, tag_id ) in self._SelectFromList( 'SELECT hash_id, tag_id FROM ' + petitioned_mappings_table_name + ' WHERE hash_id IN {};', hash_ids ) )
+            tag_data.extend( ( hash_id, ( tag_service_id, HC.CONTENT_STATUS_PETITIONED, tag_id ) ) for ( hash_id, tag_id ) in select_hash_ids_and_tag_ids( petitioned_mappings_table_name ) )
 
         seen_tag_ids = { tag_id for ( hash_id, ( tag_service_id, status, tag_id ) ) in tag_data }
 
         hash_ids_to_raw_tag_data = HydrusData.BuildKeyToListDict( tag_data )
 
-        self._PopulateTagIdsToTagsCache( seen_tag_ids )
-        self._c.execute('SELECT service_id, service_key FROM services;')
-        service_ids_to_service_keys = { service_id : binascii.a2b_hex( service_key ) for ( service_id, service_key ) in  self._c.fetchall()}
+        tag_ids_to_tags = self._PopulateTagIdsToTagsCache( seen_tag_ids )
+
+        service_ids_to_service_keys = self._GetServiceIdsToServiceKeys()
+
+        if HC.TAG_RELATIONSHIP_CACHE_SIZE > 0:
+
+            # the lazy sibling and parent managers are about to be asked about every one of these tags, so look them all up in one go
+
+            service_keys_to_tags = HydrusData.BuildKeyToSetDict( ( ( service_ids_to_service_keys[ tag_service_id ], tag_ids_to_tags[ tag_id ] ) for ( hash_id, ( tag_service_id, status, tag_id ) ) in tag_data ) )
+
+            self._controller.tag_siblings_manager.Prefetch( service_keys_to_tags )
+            self._controller.tag_parents_manager.Prefetch( service_keys_to_tags )
+
 
         hash_ids_to_tag_managers = {}
 
@@ -4223,7 +5535,7 @@ class DB( HydrusDB.HydrusDB ):
             raw_tag_data = hash_ids_to_raw_tag_data[ hash_id ]
 
             # service_id -> ( status, tag )
-            service_ids_to_tag_data = HydrusData.BuildKeyToListDict( ( ( tag_service_id, ( status, self._tag_ids_to_tags_cache[ tag_id ] ) ) for ( tag_service_id, status, tag_id ) in raw_tag_data ) )
+            service_ids_to_tag_data = HydrusData.BuildKeyToListDict( ( ( tag_service_id, ( status, tag_ids_to_tags[ tag_id ] ) ) for ( tag_service_id, status, tag_id ) in raw_tag_data ) )
 
             service_keys_to_statuses_to_tags = collections.defaultdict( HydrusData.default_dict_set )
 
@@ -4241,25 +5553,32 @@ class DB( HydrusDB.HydrusDB ):
 
     def _GetHash( self, hash_id ):
 
-        self._PopulateHashIdsToHashesCache( ( hash_id, ) )
+        hash_ids_to_hashes = self._PopulateHashIdsToHashesCache( ( hash_id, ) )
 
-        return self._hash_ids_to_hashes_cache[ hash_id ]
+        return hash_ids_to_hashes[ hash_id ]
 
 
     def _GetHashes( self, hash_ids ):
 
-        self._PopulateHashIdsToHashesCache( hash_ids )
+        hash_ids_to_hashes = self._PopulateHashIdsToHashesCache( hash_ids )
 
-        return [ self._hash_ids_to_hashes_cache[ hash_id ] for hash_id in hash_ids ]
+        return [ hash_ids_to_hashes[ hash_id ] for hash_id in hash_ids ]
 
 
     def _GetHashId( self, hash ):
 
-        self._c.execute( 'SELECT hash_id FROM hashes WHERE hash = %s;', ( binascii.b2a_hex(hash) , ) ); result = self._c.fetchone()
+        hash_id = self._hashes_to_hash_ids_cache.GetIfHasData( hash )
+
+        if hash_id is not None:
+
+            return hash_id
+
+
+        self._c.execute( 'SELECT hash_id FROM hashes WHERE hash = %s;', ( hash, ) ); result = self._c.fetchone()
 
         if result is None:
 
-            self._c.execute( 'INSERT INTO hashes ( hash ) VALUES ( %s );', ( binascii.b2a_hex(hash) , ))
+            self._c.execute( 'INSERT INTO hashes ( hash ) VALUES ( %s );', ( hash, ) )
 
             hash_id = self._c.lastrowid
 
@@ -4268,48 +5587,45 @@ class DB( HydrusDB.HydrusDB ):
             ( hash_id, ) = result
 
 
+        self._hashes_to_hash_ids_cache.AddData( hash, hash_id )
+
         return hash_id
 
 
     def _GetHashIds( self, hashes ):
 
-        hash_ids = set()
-        hashes_not_in_db = set()
-
-        for hash in hashes:
-
-            if hash is None:
-
-                continue
+        # one IN lookup per big chunk, then a multi-row insert and a single re-select for whatever was new
 
+        hashes = { hash for hash in hashes if hash is not None }
 
-            self._c.execute( 'SELECT hash_id FROM hashes WHERE hash = %s;', ( binascii.b2a_hex(hash) , ) ); result = self._c.fetchone()
-
-            if result is None:
+        ( hashes_to_hash_ids, uncached_hashes ) = self._hashes_to_hash_ids_cache.GetManyDataAndMissing( hashes )
 
-                hashes_not_in_db.add( hash )
+        select_statement = 'SELECT hash, hash_id FROM hashes WHERE hash IN {};'
 
-            else:
+        for chunk in HydrusData.SplitListIntoChunks( uncached_hashes, MASTER_BULK_CHUNK_SIZE ):
 
-                ( hash_id, ) = result
+            self._c.execute( select_statement.format( '(' + ','.join( [ '%s' ] * len( chunk ) ) + ')' ), chunk )
 
-                hash_ids.add( hash_id )
+            hashes_to_hash_ids.update( ( ( bytes( hash ), hash_id ) for ( hash, hash_id ) in self._c.fetchall() ) )
 
 
+        hashes_not_in_db = [ hash for hash in uncached_hashes if hash not in hashes_to_hash_ids ]
 
         if len( hashes_not_in_db ) > 0:
 
-            self._c.executemany( 'INSERT INTO hashes ( hash ) VALUES ( %s );', list( (  binascii.b2a_hex(hash) , ) for hash in hashes_not_in_db ) )
+            for chunk in HydrusData.SplitListIntoChunks( hashes_not_in_db, MASTER_BULK_CHUNK_SIZE ):
 
-            for hash in hashes_not_in_db:
+                self._c.execute( 'INSERT IGNORE INTO hashes ( hash ) VALUES ' + ','.join( [ '( %s )' ] * len( chunk ) ) + ';', chunk )
 
-                self._c.execute( 'SELECT hash_id FROM hashes WHERE hash = %s;', (  binascii.b2a_hex(hash) , ) ); ( hash_id, ) = self._c.fetchone()
+                self._c.execute( select_statement.format( '(' + ','.join( [ '%s' ] * len( chunk ) ) + ')' ), chunk )
 
-                hash_ids.add( hash_id )
+                hashes_to_hash_ids.update( ( ( bytes( hash ), hash_id ) for ( hash, hash_id ) in self._c.fetchall() ) )
 
 
 
-        return hash_ids
+        self._hashes_to_hash_ids_cache.AddManyData( { hash : hashes_to_hash_ids[ hash ] for hash in uncached_hashes if hash in hashes_to_hash_ids } )
+
+        return set( hashes_to_hash_ids.values() )
 
 
     def _GetHashIdsFromFileViewingStatistics( self, view_type, viewing_locations, operator, viewing_value ):
@@ -4362,7 +5678,7 @@ class DB( HydrusDB.HydrusDB ):
 
         select_statement = 'SELECT hash_id FROM file_viewing_stats WHERE ' + test_phrase + ';'
 
-        hash_ids = self._STS( self._c.execute( select_statement ) )
+        hash_ids = self._STS( self._StreamSelect( select_statement ) )
 
         return hash_ids
 
@@ -4497,10 +5813,62 @@ class DB( HydrusDB.HydrusDB ):
 
 
     def _GetHashIdsFromQuery( self, search_context, job_key = None, query_hash_ids = None, apply_implicit_limit = True ):
+
         if job_key is None:
 
             job_key = ClientThreading.JobKey( cancellable = True )
 
+
+        dependencies = None
+
+        # OR sub-searches come in restricted to the current results, so only whole searches are cached
+
+        if query_hash_ids is None:
+
+            dependencies = self._GetFileSearchResultDependencies( search_context )
+
+
+        if dependencies is None:
+
+            query_hash_ids = self._GetHashIdsFromQueryUncached( search_context, job_key, query_hash_ids )
+
+        else:
+
+            search_key = search_context.DumpToString()
+
+            cached_hash_ids = self._file_search_result_cache.GetResult( search_key )
+
+            if cached_hash_ids is None:
+
+                generation = self._file_search_result_cache.GetGeneration()
+
+                query_hash_ids = self._GetHashIdsFromQueryUncached( search_context, job_key, query_hash_ids )
+
+                if not job_key.IsCancelled():
+
+                    self._file_search_result_cache.AddResult( search_key, generation, query_hash_ids, dependencies )
+
+
+            else:
+
+                query_hash_ids = cached_hash_ids
+
+
+
+        query_hash_ids = list( query_hash_ids )
+
+        limit = search_context.GetSystemPredicates().GetLimit( apply_implicit_limit = apply_implicit_limit )
+
+        if limit is not None and limit <= len( query_hash_ids ):
+
+            query_hash_ids = random.sample( query_hash_ids, limit )
+
+
+        return query_hash_ids
+
+
+    def _GetHashIdsFromQueryUncached( self, search_context, job_key, query_hash_ids ):
+
         if query_hash_ids is not None:
 
             query_hash_ids = set( query_hash_ids )
@@ -4695,41 +6063,75 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-        
-        #
+        def get_num_files_estimate( service_id ):
 
-        def do_or_preds( or_predicates, query_hash_ids ):
+            self._c.execute( 'SELECT info FROM service_info WHERE service_id = %s AND info_type = %s;', ( service_id, HC.SERVICE_INFO_NUM_FILES ) ); result = self._c.fetchone()
 
-            # updating all this regular search code to do OR and AND naturally will be a big job getting right, so let's get a functional inefficient solution and then optimise later as needed
-            # -tag stuff and various other exclude situations remain a pain to do quickly assuming OR
-            # the future extension of this will be creating an OR_search_context with all the OR_pred's subpreds and have that naturally query_hash_ids.update throughout this func based on search_context search_type
-            # this func is called at one of several potential points, kicking in if query_hash_ids are needed but preferring tags or system preds to step in
+            if result is None:
 
-            or_predicates = list( or_predicates )
+                return None
 
-            # better typically to sort by fewest num of preds first, establishing query_hash_ids for longer chains
-            def or_sort_key( p ):
 
-                return len( p.GetValue() )
+            ( num_files, ) = result
 
+            return num_files
 
-            or_predicates.sort( key = or_sort_key )
 
-            for or_predicate in or_predicates:
+        def filter_qhi( query_hash_ids, table_join, predicates, num_rows_estimate = None ):
 
-                # blue eyes OR green eyes
+            # if we are keeping most of the table anyway, one scan is cheaper than copying our ids to the db, otherwise let the db join against them
 
-                or_query_hash_ids = set()
+            if num_rows_estimate is not None and len( query_hash_ids ) > num_rows_estimate // 2:
 
-                for or_subpredicate in or_predicate.GetValue():
+                query_hash_ids.intersection_update( self._STI( self._c.execute( 'SELECT hash_id FROM ' + table_join + ' WHERE ' + ' AND '.join( predicates ) + ';' ) ) )
 
-                    # blue eyes
+            else:
 
-                    or_search_context = search_context.Duplicate()
+                with HydrusDB.TemporaryIntegerTable( self._c, query_hash_ids, 'hash_id' ) as temp_table_name:
 
-                    or_search_context.SetPredicates( [ or_subpredicate ] )
-                    # I pass current query_hash_ids here to make these inefficient sub-searches (like -tag) potentially much faster
-                    or_query_hash_ids.update( self._GetHashIdsFromQuery( or_search_context, job_key, query_hash_ids = query_hash_ids ) )
+                    filtered_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM ' + temp_table_name + ' NATURAL JOIN ' + table_join + ' WHERE ' + ' AND '.join( predicates ) + ';' ) )
+
+
+                query_hash_ids.intersection_update( filtered_hash_ids )
+
+
+            return query_hash_ids
+
+
+        #
+
+        def do_or_preds( or_predicates, query_hash_ids ):
+
+            # updating all this regular search code to do OR and AND naturally will be a big job getting right, so let's get a functional inefficient solution and then optimise later as needed
+            # -tag stuff and various other exclude situations remain a pain to do quickly assuming OR
+            # the future extension of this will be creating an OR_search_context with all the OR_pred's subpreds and have that naturally query_hash_ids.update throughout this func based on search_context search_type
+            # this func is called at one of several potential points, kicking in if query_hash_ids are needed but preferring tags or system preds to step in
+
+            or_predicates = list( or_predicates )
+
+            # better typically to sort by fewest num of preds first, establishing query_hash_ids for longer chains
+            def or_sort_key( p ):
+
+                return len( p.GetValue() )
+
+
+            or_predicates.sort( key = or_sort_key )
+
+            for or_predicate in or_predicates:
+
+                # blue eyes OR green eyes
+
+                or_query_hash_ids = set()
+
+                for or_subpredicate in or_predicate.GetValue():
+
+                    # blue eyes
+
+                    or_search_context = search_context.Duplicate()
+
+                    or_search_context.SetPredicates( [ or_subpredicate ] )
+                    # I pass current query_hash_ids here to make these inefficient sub-searches (like -tag) potentially much faster
+                    or_query_hash_ids.update( self._GetHashIdsFromQuery( or_search_context, job_key, query_hash_ids = query_hash_ids ) )
 
                     if job_key.IsCancelled():
 
@@ -4875,18 +6277,16 @@ class DB( HydrusDB.HydrusDB ):
 
 
         if there_are_tags_to_search:
-            def sort_longest_first_key( s ):
-
-                return -len( s )
 
+            # the rarest tag goes first, so every later tag only has to be checked against its files
 
-            tags_to_include = list( tags_to_include )
+            tags_and_count_estimates = [ ( tag, self._GetHashIdsFromTagCountEstimate( file_service_key, tag_service_key, tag, include_current_tags, include_pending_tags ) ) for tag in tags_to_include ]
 
-            tags_to_include.sort( key = sort_longest_first_key )
+            tags_and_count_estimates.sort( key = lambda tag_and_count_estimate: tag_and_count_estimate[1] )
 
-            for tag in tags_to_include:
+            for ( tag, count_estimate ) in tags_and_count_estimates:
 
-                tag_query_hash_ids = self._GetHashIdsFromTag( file_service_key, tag_service_key, tag, include_current_tags, include_pending_tags, allowed_hash_ids = query_hash_ids )
+                tag_query_hash_ids = self._GetHashIdsFromTag( file_service_key, tag_service_key, tag, include_current_tags, include_pending_tags, allowed_hash_ids = query_hash_ids, count_estimate = count_estimate )
 
                 query_hash_ids = update_qhi( query_hash_ids, tag_query_hash_ids )
 
@@ -4935,7 +6335,7 @@ class DB( HydrusDB.HydrusDB ):
 
                 files_info_predicates.insert( 0, 'service_id = ' + str( file_service_id ) )
 
-                query_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM current_files NATURAL JOIN files_info WHERE ' + ' AND '.join( files_info_predicates ) + ';' ) )
+                query_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM current_files NATURAL JOIN files_info WHERE ' + ' AND '.join( files_info_predicates ) + ';' ) )
 
                 done_files_info_predicates = True
 
@@ -4945,16 +6345,15 @@ class DB( HydrusDB.HydrusDB ):
 
         if not done_files_info_predicates and ( need_file_domain_cross_reference or there_are_simple_files_info_preds_to_search_for ):
 
-            files_info_predicates.append( 'hash_id IN {}' )
-            
             if file_service_key == CC.COMBINED_FILE_SERVICE_KEY:
 
-                update_qhi( query_hash_ids, self._STI( self._SelectFromList( 'SELECT hash_id FROM files_info WHERE ' + ' AND '.join( files_info_predicates ) + ';', query_hash_ids ) ) )
+                filter_qhi( query_hash_ids, 'files_info', files_info_predicates )
+
             else:
 
                 files_info_predicates.insert( 0, 'service_id = ' + str( file_service_id ) )
-                
-                update_qhi( query_hash_ids, self._STI( self._SelectFromList( 'SELECT hash_id FROM current_files NATURAL JOIN files_info WHERE ' + ' AND '.join( files_info_predicates ) + ';', query_hash_ids ) ) )
+
+                filter_qhi( query_hash_ids, 'current_files NATURAL JOIN files_info', files_info_predicates, num_rows_estimate = get_num_files_estimate( file_service_id ) )
 
 
             done_files_info_predicates = True
@@ -4978,7 +6377,7 @@ class DB( HydrusDB.HydrusDB ):
 
         if file_service_key == CC.COMBINED_LOCAL_FILE_SERVICE_KEY:
 
-            repo_update_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM current_files NATURAL JOIN files_info WHERE service_id = %s;', ( self._local_update_service_id, ) ) )
+            repo_update_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM current_files NATURAL JOIN files_info WHERE service_id = %s;', ( self._local_update_service_id, ) ) )
 
             query_hash_ids.difference_update( repo_update_hash_ids )
 
@@ -5017,7 +6416,7 @@ class DB( HydrusDB.HydrusDB ):
 
             service_id = self._GetServiceId( service_key )
 
-            update_qhi( query_hash_ids, self._STI( self._c.execute( 'SELECT hash_id FROM current_files WHERE service_id = %s;', ( service_id, ) ) ) )
+            filter_qhi( query_hash_ids, 'current_files', [ 'service_id = ' + str( service_id ) ], num_rows_estimate = get_num_files_estimate( service_id ) )
 
 
         for service_key in file_services_to_include_pending:
@@ -5120,7 +6519,7 @@ class DB( HydrusDB.HydrusDB ):
 
         elif must_be_local or must_not_be_local:
 
-            local_hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM current_files WHERE service_id = %s;', ( self._combined_local_file_service_id, ) ) )
+            local_hash_ids = self._STL( self._StreamSelect( 'SELECT hash_id FROM current_files WHERE service_id = %s;', ( self._combined_local_file_service_id, ) ) )
 
             if must_be_local:
 
@@ -5134,11 +6533,11 @@ class DB( HydrusDB.HydrusDB ):
 
         if must_be_inbox:
 
-            update_qhi( query_hash_ids, self._inbox_hash_ids )
+            update_qhi( query_hash_ids, self._GetInboxHashIds( query_hash_ids ) )
 
         elif must_be_archive:
 
-            query_hash_ids.difference_update( self._inbox_hash_ids )
+            query_hash_ids.difference_update( self._GetInboxHashIds( query_hash_ids ) )
 
 
         #
@@ -5271,18 +6670,6 @@ class DB( HydrusDB.HydrusDB ):
             return set()
 
 
-        #
-
-        limit = system_predicates.GetLimit( apply_implicit_limit = apply_implicit_limit )
-        if limit is not None and limit <= len( query_hash_ids ):
-
-            query_hash_ids = random.sample( query_hash_ids, limit )
-
-        else:
-
-            query_hash_ids = list( query_hash_ids )
-
-
         return query_hash_ids
 
 
@@ -5341,7 +6728,7 @@ class DB( HydrusDB.HydrusDB ):
         return hash_ids
 
 
-    def _GetHashIdsFromTag( self, file_service_key, tag_service_key, tag, include_current_tags, include_pending_tags, allowed_hash_ids = None ):
+    def _GetHashIdsFromTag( self, file_service_key, tag_service_key, tag, include_current_tags, include_pending_tags, allowed_hash_ids = None, count_estimate = None ):
 
         siblings_manager = self._controller.tag_siblings_manager
         tags = siblings_manager.GetAllSiblings( tag_service_key, tag )
@@ -5435,8 +6822,13 @@ class DB( HydrusDB.HydrusDB ):
             selects.extend( pending_selects )
 
 
-        # 25k static value here sucks, but we'll see how it goes--it translates to 100 chunks in selectfromlist, and most tags have n < this anyway
-        if allowed_hash_ids is None or len( allowed_hash_ids ) > 25600:
+        if allowed_hash_ids is not None and count_estimate is None:
+
+            count_estimate = self._GetHashIdsFromTagCountEstimate( file_service_key, tag_service_key, tag, include_current_tags, include_pending_tags )
+
+
+        # if the tag is rarer than the allowed ids, fetching all its files and intersecting is cheapest, otherwise let the db join against the allowed ids
+        if allowed_hash_ids is None or len( allowed_hash_ids ) > count_estimate:
 
             for select in selects:
 
@@ -5450,16 +6842,66 @@ class DB( HydrusDB.HydrusDB ):
 
         else:
 
-            selects = [ select.replace( ';', ' AND hash_id IN {};' ) for select in selects ]
-            for select in selects:
+            with HydrusDB.TemporaryIntegerTable( self._c, allowed_hash_ids, 'hash_id' ) as temp_table_name:
+
+                selects = [ select.replace( 'SELECT hash_id FROM ', 'SELECT hash_id FROM ' + temp_table_name + ' NATURAL JOIN ', 1 ) for select in selects ]
+
+                for select in selects:
+
+                    hash_ids.update( self._STI( self._c.execute( select ) ) )
 
-                hash_ids.update( self._STI(  raw_data = self._SelectFromList( select, allowed_hash_ids ) ) )
 
 
 
         return hash_ids
 
 
+    def _GetHashIdsFromTagCountEstimate( self, file_service_key, tag_service_key, tag, include_current_tags, include_pending_tags ):
+
+        siblings_manager = self._controller.tag_siblings_manager
+        tags = siblings_manager.GetAllSiblings( tag_service_key, tag )
+
+        tag_ids = set()
+
+        for tag in tags:
+
+            ( namespace, subtag ) = HydrusTags.SplitTag( tag )
+
+            if namespace != '':
+
+                if self._TagExists( tag ):
+
+                    tag_ids.add( self._GetTagId( tag ) )
+
+
+            else:
+
+                if self._SubtagExists( subtag ):
+
+                    # an unnamespaced search matches the subtag in every namespace
+
+                    subtag_id = self._GetSubtagId( subtag )
+
+                    tag_ids.update( self._STI( self._c.execute( 'SELECT tag_id FROM tags WHERE subtag_id = %s;', ( subtag_id, ) ) ) )
+
+
+
+
+        if len( tag_ids ) == 0:
+
+            return 0
+
+
+        file_service_id = self._GetServiceId( file_service_key )
+        tag_service_id = self._GetServiceId( tag_service_key )
+
+        ids_to_count = self._GetAutocompleteCounts( tag_service_id, file_service_id, tag_ids, include_current_tags, include_pending_tags )
+
+        # the ac counts are per tag, so a file with several siblings counts more than once. as an upper bound, that is fine for ordering
+
+        return sum( ( current_min + pending_min for ( current_min, current_max, pending_min, pending_max ) in ids_to_count.values() ) )
+
+
     def _GetHashIdsFromURLRule( self, rule_type, rule, hash_ids = None ):
 
         if hash_ids is None:
@@ -5678,9 +7120,7 @@ class DB( HydrusDB.HydrusDB ):
 
         if hash_ids is not None:
 
-            self._PopulateHashIdsToHashesCache( hash_ids, exception_on_error = True )
-
-            hash_ids_to_hashes = { hash_id : self._hash_ids_to_hashes_cache[ hash_id ] for hash_id in hash_ids }
+            hash_ids_to_hashes = self._PopulateHashIdsToHashesCache( hash_ids, exception_on_error = True )
 
         elif hashes is not None:
 
@@ -5782,15 +7222,15 @@ class DB( HydrusDB.HydrusDB ):
 
             if hash_type == 'md5':
 
-                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE md5 = %s;', ( binascii.b2a_hex(hash) , ) ); result = self._c.fetchone()
+                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE md5 = %s;', ( hash, ) ); result = self._c.fetchone()
 
             elif hash_type == 'sha1':
 
-                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE sha1 = %s;', ( binascii.b2a_hex(hash) , ) ); result = self._c.fetchone()
+                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE sha1 = %s;', ( hash, ) ); result = self._c.fetchone()
 
             elif hash_type == 'sha512':
 
-                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE sha512 = %s;', ( binascii.b2a_hex(hash) , ) ); result = self._c.fetchone()
+                self._c.execute( 'SELECT hash_id FROM local_hashes WHERE sha512 = %s;', ( hash, ) ); result = self._c.fetchone()
 
 
             if result is None:
@@ -5833,6 +7273,86 @@ class DB( HydrusDB.HydrusDB ):
         return ( locations_to_ideal_weights, abs_ideal_thumbnail_override_location )
 
 
+    def _GetMappingsTableNamesToSchemas( self ):
+
+        tag_service_ids = self._GetServiceIds( HC.TAG_SERVICES )
+        file_service_ids = self._GetServiceIds( HC.AUTOCOMPLETE_CACHE_SPECIFIC_FILE_SERVICES )
+
+        table_names_to_schemas = {}
+
+        for tag_service_id in tag_service_ids:
+
+            ( current_mappings_table_name, deleted_mappings_table_name, pending_mappings_table_name, petitioned_mappings_table_name ) = GenerateMappingsTableNames( tag_service_id )
+
+            for table_name in ( current_mappings_table_name, deleted_mappings_table_name, pending_mappings_table_name ):
+
+                table_names_to_schemas[ table_name ] = ( [ 'tag_id', 'hash_id' ], False )
+
+
+            table_names_to_schemas[ petitioned_mappings_table_name ] = ( [ 'tag_id', 'hash_id' ], True )
+
+
+        for ( file_service_id, tag_service_id ) in itertools.product( file_service_ids, tag_service_ids ):
+
+            ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( file_service_id, tag_service_id )
+
+            for table_name in ( cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name ):
+
+                table_names_to_schemas[ table_name ] = ( [ 'hash_id', 'tag_id' ], False )
+
+
+
+        return table_names_to_schemas
+
+
+    def _GetMappingsTableNamesToMigrate( self ):
+
+        # a table is on the current schema if its keys are exactly the clustering key and the reverse unique index, and it has the configured partitions
+        # older tables also carry single column indexes that those two already cover
+
+        table_names_to_schemas = self._GetMappingsTableNamesToSchemas()
+
+        self._c.execute( 'SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;', ( HC.MYSQL_DB, ) )
+
+        table_and_index_names_to_columns = HydrusData.BuildKeyToListDict( ( ( table_name, index_name, non_unique ), column_name ) for ( table_name, index_name, non_unique, column_name ) in self._c.fetchall() if table_name in table_names_to_schemas )
+
+        table_names_to_keys = collections.defaultdict( set )
+
+        for ( ( table_name, index_name, non_unique ), column_names ) in table_and_index_names_to_columns.items():
+
+            table_names_to_keys[ table_name ].add( ( index_name == 'PRIMARY', not non_unique, tuple( column_names ) ) )
+
+
+        self._c.execute( 'SELECT TABLE_NAME, COUNT( PARTITION_NAME ) FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = %s GROUP BY TABLE_NAME;', ( HC.MYSQL_DB, ) )
+
+        table_names_to_num_partitions = dict( self._c.fetchall() )
+
+        # a table in the middle of a bulk load has its indexes dropped on purpose
+
+        self._c.execute( 'SELECT table_name FROM deferred_indexes;' )
+
+        deferred_table_names = self._STS()
+
+        table_names_to_migrate = {}
+
+        for ( table_name, ( primary_key_columns, has_reason_id ) ) in table_names_to_schemas.items():
+
+            if table_name not in table_names_to_num_partitions or table_name in deferred_table_names:
+
+                continue
+
+
+            ideal_keys = { ( True, True, tuple( primary_key_columns ) ), ( False, True, tuple( reversed( primary_key_columns ) ) ) }
+
+            if table_names_to_keys[ table_name ] != ideal_keys or table_names_to_num_partitions[ table_name ] != HC.MAPPINGS_PARTITIONS:
+
+                table_names_to_migrate[ table_name ] = ( primary_key_columns, has_reason_id )
+
+
+
+        return table_names_to_migrate
+
+
     def _GetMaintenanceDue( self, stop_time ):
 
         jobs_to_do = []
@@ -5842,9 +7362,44 @@ class DB( HydrusDB.HydrusDB ):
         if similar_files_due:
             jobs_to_do.append('similar files work')
 
+        names_to_vacuum = self._GetTableNamesToVacuum()
+
+        if len( names_to_vacuum ) > 0:
+
+            jobs_to_do.append( 'optimize ' + HydrusData.ToHumanInt( len( names_to_vacuum ) ) + ' tables' )
+
+
+        names_to_analyze = self._GetBigTableNamesToAnalyze()
+
+        if len( names_to_analyze ) > 0:
+
+            jobs_to_do.append( 'analyze ' + HydrusData.ToHumanInt( len( names_to_analyze ) ) + ' tables' )
+
+
         return jobs_to_do
 
 
+    def _GetInboxHashIds( self, hash_ids, hash_ids_table_name = None ):
+
+        # the writer keeps the inbox in memory and changes it as it goes, so a pooled reader asks the db instead
+
+        if self._IsReadThread():
+
+            if hash_ids_table_name is not None:
+
+                return self._STS( self._c.execute( 'SELECT hash_id FROM file_inbox NATURAL JOIN ' + hash_ids_table_name + ';' ) )
+
+            else:
+
+                return self._STS( raw_data = self._SelectFromList( 'SELECT hash_id FROM file_inbox WHERE hash_id IN {};', list( hash_ids ) ) )
+
+
+        else:
+
+            return self._inbox_hash_ids.intersection( hash_ids )
+
+
+
     def _GetJSONDump( self, dump_type ):
 
         self._c.execute( 'SELECT version, dump FROM json_dumps WHERE dump_type = %s;', ( dump_type, ) ); result = self._c.fetchone()
@@ -5899,6 +7454,8 @@ class DB( HydrusDB.HydrusDB ):
 
                     self._c.execute( 'DELETE FROM json_dumps_named WHERE dump_type = %s AND dump_name = %s AND timestamp = %s;', ( dump_type, dump_name, timestamp ) )
 
+                    self._json_dump_store.DeleteRows( ( 'json_dumps_named', dump_type, dump_name, timestamp ) )
+
                     raise
 
             return objs
@@ -5927,6 +7484,8 @@ class DB( HydrusDB.HydrusDB ):
 
                 self._c.execute( 'DELETE FROM json_dumps_named WHERE dump_type = %s AND dump_name = %s AND timestamp = %s;', ( dump_type, dump_name, timestamp ) )
 
+                self._json_dump_store.DeleteRows( ( 'json_dumps_named', dump_type, dump_name, timestamp ) )
+
                 raise
 
 
@@ -5995,105 +7554,18 @@ class DB( HydrusDB.HydrusDB ):
         return last_shutdown_work_time
 
 
-    def _GetMediaResults( self, hash_ids ):
-
-        ( cached_media_results, missing_hash_ids ) = self._weakref_media_result_cache.GetMediaResultsAndMissing( hash_ids )
-
-        if len( missing_hash_ids ) > 0:
-
-            hash_ids = missing_hash_ids
-
-            # get first detailed results
-
-            self._PopulateHashIdsToHashesCache( hash_ids )
-
-            hash_ids_to_info = { hash_id : ClientMedia.FileInfoManager( hash_id, self._hash_ids_to_hashes_cache[ hash_id ], size, mime, width, height, duration, num_frames, num_words ) for ( hash_id, size, mime, width, height, duration, num_frames, num_words ) in self._SelectFromList( 'SELECT * FROM files_info WHERE hash_id IN {};', hash_ids ) }
-
-            hash_ids_to_current_file_service_ids_and_timestamps = HydrusData.BuildKeyToListDict( ( ( hash_id, ( service_id, timestamp ) ) for ( hash_id, service_id, timestamp ) in self._SelectFromList( 'SELECT hash_id, service_id, timestamp FROM current_files WHERE hash_id IN {};', hash_ids ) ) )
-
-            hash_ids_to_deleted_file_service_ids = HydrusData.BuildKeyToListDict( self._SelectFromList( 'SELECT hash_id, service_id FROM deleted_files WHERE hash_id IN {};', hash_ids ) )
-
-            hash_ids_to_pending_file_service_ids = HydrusData.BuildKeyToListDict( self._SelectFromList( 'SELECT hash_id, service_id FROM file_transfers WHERE hash_id IN {};', hash_ids ) )
-
-            hash_ids_to_petitioned_file_service_ids = HydrusData.BuildKeyToListDict( self._SelectFromList( 'SELECT hash_id, service_id FROM file_petitions WHERE hash_id IN {};', hash_ids ) )
-
-            hash_ids_to_urls = HydrusData.BuildKeyToSetDict( self._SelectFromList( 'SELECT hash_id, url FROM url_map NATURAL JOIN urls WHERE hash_id IN {};', hash_ids ) )
-
-            hash_ids_to_service_ids_and_filenames = HydrusData.BuildKeyToListDict( ( ( hash_id, ( service_id, filename ) ) for ( hash_id, service_id, filename ) in self._SelectFromList( 'SELECT hash_id, service_id, filename FROM service_filenames WHERE hash_id IN {};', hash_ids ) ) )
-
-            hash_ids_to_local_ratings = HydrusData.BuildKeyToListDict( ( ( hash_id, ( service_id, rating ) ) for ( service_id, hash_id, rating ) in self._SelectFromList( 'SELECT service_id, hash_id, rating FROM local_ratings WHERE hash_id IN {};', hash_ids ) ) )
-
-            hash_ids_to_file_viewing_stats_managers = { hash_id : ClientMedia.FileViewingStatsManager( preview_views, preview_viewtime, media_views, media_viewtime ) for ( hash_id, preview_views, preview_viewtime, media_views, media_viewtime ) in self._SelectFromList( 'SELECT hash_id, preview_views, preview_viewtime, media_views, media_viewtime FROM file_viewing_stats WHERE hash_id IN {};', hash_ids ) }
-            #
-
-            hash_ids_to_current_file_service_ids = { hash_id : [ file_service_id for ( file_service_id, timestamp ) in file_service_ids_and_timestamps ] for ( hash_id, file_service_ids_and_timestamps ) in list(hash_ids_to_current_file_service_ids_and_timestamps.items()) }
-
-            hash_ids_to_tags_managers = self._GetForceRefreshTagsManagers( hash_ids, hash_ids_to_current_file_service_ids = hash_ids_to_current_file_service_ids )
-
-            # build it
-            self._c.execute('SELECT service_id, service_key FROM services;')
-            service_ids_to_service_keys = { service_id : binascii.a2b_hex(service_key) for ( service_id, service_key ) in self._c.fetchall()}
-
-            missing_media_results = []
-
-            for hash_id in hash_ids:
-
-                tags_manager = hash_ids_to_tags_managers[ hash_id ]
-
-                #
-
-                current_file_service_keys = { service_ids_to_service_keys[ service_id ] for ( service_id, timestamp ) in hash_ids_to_current_file_service_ids_and_timestamps[ hash_id ] }
-
-                deleted_file_service_keys = { service_ids_to_service_keys[ service_id ] for service_id in hash_ids_to_deleted_file_service_ids[ hash_id ] }
-
-                pending_file_service_keys = { service_ids_to_service_keys[ service_id ] for service_id in hash_ids_to_pending_file_service_ids[ hash_id ] }
-
-                petitioned_file_service_keys = { service_ids_to_service_keys[ service_id ] for service_id in hash_ids_to_petitioned_file_service_ids[ hash_id ] }
-
-                inbox = hash_id in self._inbox_hash_ids
-
-                urls = hash_ids_to_urls[ hash_id ]
-
-                service_ids_to_filenames = HydrusData.BuildKeyToListDict( hash_ids_to_service_ids_and_filenames[ hash_id ] )
-
-                service_keys_to_filenames = { service_ids_to_service_keys[ service_id ] : filenames for ( service_id, filenames ) in list(service_ids_to_filenames.items()) }
-
-                current_file_service_keys_to_timestamps = { service_ids_to_service_keys[ service_id ] : timestamp for ( service_id, timestamp ) in hash_ids_to_current_file_service_ids_and_timestamps[ hash_id ] }
-
-                locations_manager = ClientMedia.LocationsManager( current_file_service_keys, deleted_file_service_keys, pending_file_service_keys, petitioned_file_service_keys, inbox, urls, service_keys_to_filenames, current_to_timestamps = current_file_service_keys_to_timestamps )
-
-                #
-
-                local_ratings = { service_ids_to_service_keys[ service_id ] : rating for ( service_id, rating ) in hash_ids_to_local_ratings[ hash_id ] }
-
-                ratings_manager = ClientRatings.RatingsManager( local_ratings )
-
-                #
-
-                if hash_id in hash_ids_to_file_viewing_stats_managers:
-
-                    file_viewing_stats_manager = hash_ids_to_file_viewing_stats_managers[ hash_id ]
-
-                else:
-
-                    file_viewing_stats_manager = ClientMedia.FileViewingStatsManager.STATICGenerateEmptyManager()
-
-
-                #
-
-                if hash_id in hash_ids_to_info:
-
-                    file_info_manager = hash_ids_to_info[ hash_id ]
+    def _GetMasterIdCaches( self ):
 
-                else:
+        return [ self._hash_ids_to_hashes_cache, self._hashes_to_hash_ids_cache, self._tag_ids_to_tags_cache, self._tags_to_tag_ids_cache, self._namespaces_to_namespace_ids_cache, self._subtags_to_subtag_ids_cache ]
 
-                    hash = self._hash_ids_to_hashes_cache[ hash_id ]
 
-                    file_info_manager = ClientMedia.FileInfoManager( hash_id, hash )
+    def _GetMediaResults( self, hash_ids ):
 
+        ( cached_media_results, missing_hash_ids ) = self._weakref_media_result_cache.GetMediaResultsAndMissing( hash_ids )
 
-                missing_media_results.append( ClientMedia.MediaResult( file_info_manager, tags_manager, locations_manager, ratings_manager, file_viewing_stats_manager ) )
+        for page_of_hash_ids in HydrusData.SplitListIntoChunks( missing_hash_ids, MEDIA_RESULTS_PAGE_SIZE ):
 
+            missing_media_results = self._GenerateMediaResults( page_of_hash_ids )
 
             self._weakref_media_result_cache.AddMediaResults( missing_media_results )
 
@@ -6141,6 +7613,13 @@ class DB( HydrusDB.HydrusDB ):
             return self._null_namespace_id
 
 
+        namespace_id = self._namespaces_to_namespace_ids_cache.GetIfHasData( namespace )
+
+        if namespace_id is not None:
+
+            return namespace_id
+
+
         self._c.execute( 'SELECT namespace_id FROM namespaces WHERE namespace = %s;', ( namespace, ) ); result = self._c.fetchone()
 
         if result is None:
@@ -6154,9 +7633,16 @@ class DB( HydrusDB.HydrusDB ):
             ( namespace_id, ) = result
 
 
+        self._namespaces_to_namespace_ids_cache.AddData( namespace, namespace_id )
+
         return namespace_id
 
 
+    def _GetNumReadConnections( self ):
+
+        return HC.MYSQL_READ_CONNECTIONS
+
+
     def _GetNumsPending( self ):
 
         services = self._GetServices( ( HC.TAG_REPOSITORY, HC.FILE_REPOSITORY, HC.IPFS ) )
@@ -6383,83 +7869,101 @@ class DB( HydrusDB.HydrusDB ):
         return None
 
 
-    def _GetRecentTags( self, service_key ):
+    def _GetPossibleSubtagIdsFromAutocompleteIndex( self, half_complete_subtag ):
 
-        service_id = self._GetServiceId( service_key )
+        # None means the index is not loaded yet, so the caller should ask the fulltext index
 
-        # we could be clever and do LIMIT and ORDER BY in the delete, but not all compilations of SQLite have that turned on, so let's KISS
-        self._c.execute('SELECT tag_id, timestamp FROM recent_tags WHERE service_id = %s;', (service_id,))
-        tag_ids_to_timestamp = { tag_id : timestamp for ( tag_id, timestamp ) in self._c.fetchall() }
+        if ClientSearch.IsComplexWildcard( half_complete_subtag ):
 
-        def sort_key( key ):
+            candidate_subtag_ids = self._subtag_autocomplete_index.GetSubtagIdCandidatesFromWildcard( half_complete_subtag )
 
-            return tag_ids_to_timestamp[ key ]
+            if candidate_subtag_ids is None:
 
+                return None
 
-        newest_first = list(tag_ids_to_timestamp.keys())
 
-        newest_first.sort( key = sort_key, reverse = True )
+            if len( candidate_subtag_ids ) == 0:
 
-        num_we_want = HG.client_controller.new_options.GetNoneableInteger( 'num_recent_tags' )
+                return []
 
-        if num_we_want == None:
 
-            num_we_want = 20
+            # the trigrams only narrow it down, so LIKE still has the final say
 
+            like_param = ConvertWildcardToSQLiteLikeParameter( half_complete_subtag )
 
-        decayed = newest_first[ num_we_want : ]
+            with HydrusDB.TemporaryIntegerTable( self._c, candidate_subtag_ids, 'subtag_id' ) as temp_table_name:
 
-        if len( decayed ) > 0:
+                return self._STL( self._c.execute( 'SELECT subtag_id FROM ' + temp_table_name + ' NATURAL JOIN subtags WHERE subtag LIKE %s;', ( like_param, ) ) )
 
-            self._c.executemany( 'DELETE FROM recent_tags WHERE service_id = %s AND tag_id = %s;', list( ( service_id, tag_id ) for tag_id in decayed ) )
 
+        elif half_complete_subtag.endswith( '*' ):
 
-        sorted_recent_tag_ids = newest_first[ : num_we_want ]
+            return self._subtag_autocomplete_index.GetSubtagIdsFromPrefix( half_complete_subtag[:-1] )
 
-        self._PopulateTagIdsToTagsCache( sorted_recent_tag_ids )
+        else:
 
-        sorted_recent_tags = [ self._tag_ids_to_tags_cache[ tag_id ] for tag_id in sorted_recent_tag_ids ]
-
-        return sorted_recent_tags
+            return self._subtag_autocomplete_index.GetSubtagIdsFromPrefix( half_complete_subtag, whole_word = True )
 
 
-    def _GetRelatedTags( self, service_key, skip_hash, search_tags, max_results, max_time_to_take ):
 
-        siblings_manager = HG.client_controller.tag_siblings_manager
-        stop_time_for_finding_files = HydrusData.GetNowPrecise() + ( max_time_to_take / 2 )
-        stop_time_for_finding_tags = HydrusData.GetNowPrecise() + ( max_time_to_take / 2 )
+    def _GetRecentTags( self, service_key ):
 
-        search_tags = siblings_manager.CollapseTags( service_key, search_tags, service_strict = True )
         service_id = self._GetServiceId( service_key )
 
-        skip_hash_id = self._GetHashId( skip_hash )
+        # we could be clever and do LIMIT and ORDER BY in the delete, but not all compilations of SQLite have that turned on, so let's KISS
+        self._c.execute('SELECT tag_id, timestamp FROM recent_tags WHERE service_id = %s;', (service_id,))
+        tag_ids_to_timestamp = { tag_id : timestamp for ( tag_id, timestamp ) in self._c.fetchall() }
 
-        ( current_mappings_table_name, deleted_mappings_table_name, pending_mappings_table_name, petitioned_mappings_table_name ) = GenerateMappingsTableNames( service_id )
+        def sort_key( key ):
 
-        tag_ids = [ self._GetTagId( tag ) for tag in search_tags ]
+            return tag_ids_to_timestamp[ key ]
 
-        random.shuffle( tag_ids )
 
-        hash_ids_counter = collections.Counter()
+        newest_first = list(tag_ids_to_timestamp.keys())
 
-        query = self._c.execute( 'SELECT hash_id FROM ' + current_mappings_table_name + ' WHERE tag_id IN ' + HydrusData.SplayListForDB( tag_ids ) + ';' )
+        newest_first.sort( key = sort_key, reverse = True )
 
-        results = self._STL( rawdata=query.fetchmany( 100 ) )
+        num_we_want = HG.client_controller.new_options.GetNoneableInteger( 'num_recent_tags' )
 
-        while len( results ) > 0:
+        if num_we_want == None:
 
-            for hash_id in results:
+            num_we_want = 20
 
-                hash_ids_counter[ hash_id ] += 1
 
+        decayed = newest_first[ num_we_want : ]
 
-            if HydrusData.TimeHasPassedPrecise( stop_time_for_finding_files ):
+        if len( decayed ) > 0:
+
+            self._c.executemany( 'DELETE FROM recent_tags WHERE service_id = %s AND tag_id = %s;', list( ( service_id, tag_id ) for tag_id in decayed ) )
+
+
+        sorted_recent_tag_ids = newest_first[ : num_we_want ]
+
+        tag_ids_to_tags = self._PopulateTagIdsToTagsCache( sorted_recent_tag_ids )
+
+        sorted_recent_tags = [ tag_ids_to_tags[ tag_id ] for tag_id in sorted_recent_tag_ids ]
+
+        return sorted_recent_tags
 
-                break
 
+    def _GetRelatedTags( self, service_key, skip_hash, search_tags, max_results, max_time_to_take ):
+
+        siblings_manager = HG.client_controller.tag_siblings_manager
+
+        search_tags = siblings_manager.CollapseTags( service_key, search_tags, service_strict = True )
+        service_id = self._GetServiceId( service_key )
+
+        skip_hash_id = self._GetHashId( skip_hash )
 
-            results = self._STL( rawdata=query.fetchmany( 100 ) )
+        ( current_mappings_table_name, deleted_mappings_table_name, pending_mappings_table_name, petitioned_mappings_table_name ) = GenerateMappingsTableNames( service_id )
+
+        tag_ids = [ self._GetTagId( tag ) for tag in search_tags ]
+
+        # the longer the user is willing to wait, the more files we look at
 
+        sample_size = max( 100, int( HC.RELATED_TAGS_SAMPLE_SIZE * max_time_to_take ) )
+
+        hash_ids_counter = self._GetRelatedTagsSampleHashIdsCounter( current_mappings_table_name, tag_ids, sample_size )
 
         if skip_hash_id in hash_ids_counter:
 
@@ -6482,21 +7986,18 @@ class DB( HydrusDB.HydrusDB ):
 
         hash_ids = [ hash_id for ( hash_id, count ) in list(hash_ids_counter.items()) if count > largest_count * 0.8 ]
 
-        counter = collections.Counter()
-
-        random.shuffle( hash_ids )
-
-        for hash_id in hash_ids:
+        if len( hash_ids ) > sample_size:
 
-            for tag_id in self._STI( self._c.execute( 'SELECT tag_id FROM ' + current_mappings_table_name + ' WHERE hash_id = %s;', ( hash_id, ) ) ):
+            hash_ids = random.sample( hash_ids, sample_size )
 
-                counter[ tag_id ] += 1
 
+        # the co-occurrence count is one grouped query over the sample, using the ( hash_id, tag_id ) index
 
-            if HydrusData.TimeHasPassedPrecise( stop_time_for_finding_tags ):
+        with HydrusDB.TemporaryIntegerTable( self._c, hash_ids, 'hash_id' ) as temp_table_name:
 
-                break
+            self._c.execute( 'SELECT tag_id, COUNT( * ) AS num_files FROM ' + temp_table_name + ' CROSS JOIN ' + current_mappings_table_name + ' USING ( hash_id ) GROUP BY tag_id ORDER BY num_files DESC LIMIT %s;', ( max_results + len( tag_ids ), ) )
 
+            counter = collections.Counter( dict( self._c.fetchall() ) )
 
 
         #
@@ -6530,6 +8031,64 @@ class DB( HydrusDB.HydrusDB ):
         return predicates
 
 
+    def _GetRelatedTagsSampleHashIdsCounter( self, current_mappings_table_name, tag_ids, sample_size ):
+
+        # a random window of the hash_id space, the same for every tag, so the files in it are a fair sample of each tag and their overlaps
+        # each tag is one short range read off the primary key, wrapping round to the start if the window runs off the end
+
+        self._c.execute( 'SELECT MAX( hash_id ) FROM ' + current_mappings_table_name + ';' ); ( max_hash_id, ) = self._c.fetchone()
+
+        if max_hash_id is None:
+
+            return collections.Counter()
+
+
+        num_positions = max_hash_id + 1
+
+        window_start = random.randint( 0, max_hash_id )
+
+        tag_ids_to_positions = {}
+
+        for tag_id in tag_ids:
+
+            hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM ' + current_mappings_table_name + ' WHERE tag_id = %s AND hash_id >= %s ORDER BY hash_id LIMIT %s;', ( tag_id, window_start, sample_size ) ) )
+
+            if len( hash_ids ) < sample_size:
+
+                hash_ids.extend( self._STL( self._c.execute( 'SELECT hash_id FROM ' + current_mappings_table_name + ' WHERE tag_id = %s AND hash_id < %s ORDER BY hash_id LIMIT %s;', ( tag_id, window_start, sample_size - len( hash_ids ) ) ) ) )
+
+
+            tag_ids_to_positions[ tag_id ] = [ ( hash_id - window_start ) % num_positions for hash_id in hash_ids ]
+
+
+        # a tag that filled its sample stopped early, so the window ends where the densest tag ran out
+
+        window_end = num_positions
+
+        for positions in tag_ids_to_positions.values():
+
+            if len( positions ) == sample_size:
+
+                window_end = min( window_end, positions[ -1 ] )
+
+
+
+        hash_ids_counter = collections.Counter()
+
+        for positions in tag_ids_to_positions.values():
+
+            for position in positions:
+
+                if position <= window_end:
+
+                    hash_ids_counter[ ( position + window_start ) % num_positions ] += 1
+
+
+
+
+        return hash_ids_counter
+
+
     def _GetRepositoryProgress( self, service_key ):
 
         service_id = self._GetServiceId( service_key )
@@ -6549,7 +8108,7 @@ class DB( HydrusDB.HydrusDB ):
 
         service_id = self._GetServiceId( service_key )
 
-        needed_hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM current_files NATURAL JOIN files_info WHERE mime IN ' + HydrusData.SplayListForDB( HC.MIMES_WITH_THUMBNAILS ) + ' and service_id = %s and not exists ( SELECT 1 FROM remote_thumbnails WHERE service_id = %s );', ( service_id, service_id ) ) )
+        needed_hash_ids = self._STL( self._StreamSelect( 'SELECT hash_id FROM current_files NATURAL JOIN files_info WHERE mime IN ' + HydrusData.SplayListForDB( HC.MIMES_WITH_THUMBNAILS ) + ' and service_id = %s and not exists ( SELECT 1 FROM remote_thumbnails WHERE service_id = %s );', ( service_id, service_id ) ) )
 
         needed_hashes = []
 
@@ -6583,9 +8142,9 @@ class DB( HydrusDB.HydrusDB ):
 
         repository_updates_table_name = GenerateRepositoryRepositoryUpdatesTableName( service_id )
 
-        desired_hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM ' + repository_updates_table_name + ' ORDER BY update_index ASC;' ) )
+        desired_hash_ids = self._STL( self._StreamSelect( 'SELECT hash_id FROM ' + repository_updates_table_name + ' ORDER BY update_index ASC;' ) )
 
-        existing_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM current_files WHERE service_id = %s;', ( self._local_update_service_id, ) ) )
+        existing_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM current_files WHERE service_id = %s;', ( self._local_update_service_id, ) ) )
 
         needed_hash_ids = [ hash_id for hash_id in desired_hash_ids if hash_id not in existing_hash_ids ]
 
@@ -6702,6 +8261,24 @@ class DB( HydrusDB.HydrusDB ):
         return self._STL( self._c.execute( 'SELECT service_id FROM services WHERE service_type IN ' + HydrusData.SplayListForDB( service_types ) + ';' ) )
 
 
+    def _GetServiceIdsToServiceKeys( self ):
+
+        # a service's key never changes, so this only needs a reload when a service is added
+
+        service_ids_to_service_keys = self._service_ids_to_service_keys_cache
+
+        if service_ids_to_service_keys is None:
+
+            self._c.execute( 'SELECT service_id, service_key FROM services;' )
+
+            service_ids_to_service_keys = { service_id : binascii.a2b_hex( service_key ) for ( service_id, service_key ) in self._c.fetchall() }
+
+            self._service_ids_to_service_keys_cache = service_ids_to_service_keys
+
+
+        return service_ids_to_service_keys
+
+
     def _GetServiceInfo( self, service_key ):
 
         service_id = self._GetServiceId( service_key )
@@ -6878,6 +8455,13 @@ class DB( HydrusDB.HydrusDB ):
 
     def _GetSubtagId( self, subtag ):
 
+        subtag_id = self._subtags_to_subtag_ids_cache.GetIfHasData( subtag )
+
+        if subtag_id is not None:
+
+            return subtag_id
+
+
         self._c.execute( 'SELECT subtag_id FROM subtags WHERE subtag = %s;', ( subtag, ) ); result = self._c.fetchone()
 
         if result is None:
@@ -6890,6 +8474,13 @@ class DB( HydrusDB.HydrusDB ):
 
             self._c.execute( 'REPLACE INTO subtags_fts4 ( docid, subtag ) VALUES ( %s, %s );', ( subtag_id, subtag_searchable ) )
 
+            if self._subtag_autocomplete_index is not None:
+
+                self._subtag_autocomplete_index.AddSubtag( subtag_id, subtag )
+
+                self._TouchCache( 'subtag_autocomplete_index' )
+
+
             try:
 
                 integer_subtag = int( subtag )
@@ -6909,14 +8500,84 @@ class DB( HydrusDB.HydrusDB ):
             ( subtag_id, ) = result
 
 
+        self._subtags_to_subtag_ids_cache.AddData( subtag, subtag_id )
+
         return subtag_id
 
 
+    def _GetTableNamesToEstimatedNumRows( self ):
+
+        # these are the engine's estimates, which are cheap, and close enough to see a table's size move
+        # the session would otherwise see stats cached for up to a day. fresh stats cost a recompute on every information_schema query, so that is only for this one
+
+        self._c.execute( 'SELECT @@SESSION.information_schema_stats_expiry;' ); ( previous_stats_expiry, ) = self._c.fetchone()
+
+        self._c.execute( 'SET SESSION information_schema_stats_expiry = 0;' )
+
+        try:
+
+            self._c.execute( 'SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = %s;', ( HC.MYSQL_DB, 'BASE TABLE' ) )
+
+            return { table_name : num_rows or 0 for ( table_name, num_rows ) in self._c.fetchall() }
+
+        finally:
+
+            self._c.execute( 'SET SESSION information_schema_stats_expiry = %s;', ( previous_stats_expiry, ) )
+
+
+
+
+    def _GetTableNamesToVacuum( self, force_vacuum = False ):
+
+        table_names_to_num_rows = self._GetTableNamesToEstimatedNumRows()
+
+        if force_vacuum:
+
+            names_to_vacuum = list( table_names_to_num_rows.keys() )
+
+        else:
+
+            maintenance_vacuum_period_days = self._controller.new_options.GetNoneableInteger( 'maintenance_vacuum_period_days' )
+
+            if maintenance_vacuum_period_days is None:
+
+                return []
+
+
+            self._c.execute( 'SELECT name, timestamp FROM vacuum_timestamps;' )
+
+            existing_names_to_timestamps = dict( self._c.fetchall() )
+
+            currently_idle = self._controller.CurrentlyIdle()
+
+            names_to_vacuum = []
+
+            for ( name, num_rows ) in table_names_to_num_rows.items():
+
+                if name in existing_names_to_timestamps and not HydrusData.TimeHasPassed( existing_names_to_timestamps[ name ] + maintenance_vacuum_period_days * 86400 ):
+
+                    continue
+
+
+                if num_rows > MAINTENANCE_BIG_TABLE_ROWS and not currently_idle:
+
+                    continue
+
+
+                names_to_vacuum.append( name )
+
+
+
+        names_to_vacuum.sort( key = lambda name: table_names_to_num_rows[ name ] )
+
+        return names_to_vacuum
+
+
     def _GetTag( self, tag_id ):
 
-        self._PopulateTagIdsToTagsCache( ( tag_id, ) )
+        tag_ids_to_tags = self._PopulateTagIdsToTagsCache( ( tag_id, ) )
 
-        return self._tag_ids_to_tags_cache[ tag_id ]
+        return tag_ids_to_tags[ tag_id ]
 
 
     def _GetTagCensorship( self, service_key = None ):
@@ -6953,6 +8614,13 @@ class DB( HydrusDB.HydrusDB ):
 
         HydrusTags.CheckTagNotEmpty( tag )
 
+        tag_id = self._tags_to_tag_ids_cache.GetIfHasData( tag )
+
+        if tag_id is not None:
+
+            return tag_id
+
+
         ( namespace, subtag ) = HydrusTags.SplitTag( tag )
 
         self._c.execute( 'SELECT tag_id FROM tags NATURAL JOIN namespaces NATURAL JOIN subtags WHERE namespace = %s AND subtag = %s;', ( namespace, subtag ) ); result = self._c.fetchone()
@@ -6971,6 +8639,8 @@ class DB( HydrusDB.HydrusDB ):
             ( tag_id, ) = result
 
 
+        self._tags_to_tag_ids_cache.AddData( tag, tag_id )
+
         return tag_id
 
 
@@ -6986,9 +8656,9 @@ class DB( HydrusDB.HydrusDB ):
                 all_tag_ids.add( parent_tag_id )
 
 
-            self._PopulateTagIdsToTagsCache( all_tag_ids )
+            tag_ids_to_tags = self._PopulateTagIdsToTagsCache( all_tag_ids )
 
-            statuses_to_pairs = HydrusData.BuildKeyToSetDict( ( ( status, ( self._tag_ids_to_tags_cache[ child_tag_id ], self._tag_ids_to_tags_cache[ parent_tag_id ] ) ) for ( status, child_tag_id, parent_tag_id ) in statuses_and_pair_ids ) )
+            statuses_to_pairs = HydrusData.BuildKeyToSetDict( ( ( status, ( tag_ids_to_tags[ child_tag_id ], tag_ids_to_tags[ parent_tag_id ] ) ) for ( status, child_tag_id, parent_tag_id ) in statuses_and_pair_ids ) )
 
             return statuses_to_pairs
 
@@ -7039,6 +8709,123 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+    def _GetTagParentsLookup( self, service_key, tags, sibling_service_key = None ):
+
+        # this gives the same answers as the parents manager's full maps, which are built from sibling-collapsed pairs, so bad siblings have no parents and every parent is an ideal
+
+        if sibling_service_key is None:
+
+            sibling_service_key = service_key
+
+
+        service_id = self._GetServiceId( service_key )
+        sibling_service_id = self._GetServiceId( sibling_service_key )
+
+        tag_parent_closure_table_name = GenerateTagParentClosureTableName( service_id )
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( sibling_service_id )
+
+        tag_ids_to_ideal_tag_ids = {}
+
+        def populate_ideals( tag_ids ):
+
+            uncached_tag_ids = [ tag_id for tag_id in tag_ids if tag_id not in tag_ids_to_ideal_tag_ids ]
+
+            tag_ids_to_ideal_tag_ids.update( { tag_id : tag_id for tag_id in uncached_tag_ids } )
+
+            tag_ids_to_ideal_tag_ids.update( self._SelectFromList( 'SELECT bad_tag_id, ideal_tag_id FROM ' + tag_sibling_closure_table_name + ' WHERE status = ' + str( HC.CONTENT_STATUS_PENDING ) + ' AND bad_tag_id IN {};', uncached_tag_ids ) )
+
+
+        tags_to_tag_ids = self._GetTagsToTagIds( tags )
+
+        populate_ideals( list( tags_to_tag_ids.values() ) )
+
+        # a parent's siblings bring their own parents, so walk the collapsed graph a round of raw closure at a time until no new ideals turn up
+
+        ideal_tag_ids_to_parent_ideal_tag_ids = {}
+
+        next_ideal_tag_ids = { tag_id for tag_id in tags_to_tag_ids.values() if tag_ids_to_ideal_tag_ids[ tag_id ] == tag_id }
+
+        while len( next_ideal_tag_ids ) > 0:
+
+            member_tag_ids = set( next_ideal_tag_ids )
+
+            for ( bad_tag_id, ideal_tag_id ) in self._SelectFromList( 'SELECT bad_tag_id, ideal_tag_id FROM ' + tag_sibling_closure_table_name + ' WHERE status = ' + str( HC.CONTENT_STATUS_PENDING ) + ' AND ideal_tag_id IN {};', list( next_ideal_tag_ids ) ):
+
+                tag_ids_to_ideal_tag_ids[ bad_tag_id ] = ideal_tag_id
+
+                member_tag_ids.add( bad_tag_id )
+
+
+            for ideal_tag_id in next_ideal_tag_ids:
+
+                ideal_tag_ids_to_parent_ideal_tag_ids[ ideal_tag_id ] = set()
+
+
+            child_and_ancestor_tag_ids = self._SelectFromListFetchAll( 'SELECT child_tag_id, ancestor_tag_id FROM ' + tag_parent_closure_table_name + ' WHERE status = ' + str( HC.CONTENT_STATUS_PENDING ) + ' AND child_tag_id IN {};', list( member_tag_ids ) )
+
+            populate_ideals( { ancestor_tag_id for ( child_tag_id, ancestor_tag_id ) in child_and_ancestor_tag_ids } )
+
+            for ( child_tag_id, ancestor_tag_id ) in child_and_ancestor_tag_ids:
+
+                child_ideal_tag_id = tag_ids_to_ideal_tag_ids[ child_tag_id ]
+                ancestor_ideal_tag_id = tag_ids_to_ideal_tag_ids[ ancestor_tag_id ]
+
+                if child_ideal_tag_id != ancestor_ideal_tag_id:
+
+                    ideal_tag_ids_to_parent_ideal_tag_ids[ child_ideal_tag_id ].add( ancestor_ideal_tag_id )
+
+
+
+            next_ideal_tag_ids = { parent_ideal_tag_id for parent_ideal_tag_ids in ideal_tag_ids_to_parent_ideal_tag_ids.values() for parent_ideal_tag_id in parent_ideal_tag_ids if parent_ideal_tag_id not in ideal_tag_ids_to_parent_ideal_tag_ids }
+
+
+        tag_ids_to_ancestor_tag_ids = {}
+
+        for ( tag, tag_id ) in tags_to_tag_ids.items():
+
+            if tag_id not in ideal_tag_ids_to_parent_ideal_tag_ids:
+
+                continue
+
+
+            ancestor_tag_ids = set()
+
+            search_tag_ids = set( ideal_tag_ids_to_parent_ideal_tag_ids[ tag_id ] )
+
+            while len( search_tag_ids ) > 0:
+
+                ancestor_tag_ids.update( search_tag_ids )
+
+                search_tag_ids = { parent_tag_id for search_tag_id in search_tag_ids for parent_tag_id in ideal_tag_ids_to_parent_ideal_tag_ids[ search_tag_id ] if parent_tag_id not in ancestor_tag_ids }
+
+
+            ancestor_tag_ids.discard( tag_id )
+
+            tag_ids_to_ancestor_tag_ids[ tag_id ] = ancestor_tag_ids
+
+
+        tag_ids_to_tags = self._PopulateTagIdsToTagsCache( { ancestor_tag_id for ancestor_tag_ids in tag_ids_to_ancestor_tag_ids.values() for ancestor_tag_id in ancestor_tag_ids } )
+
+        tag_censorship_manager = self._controller.tag_censorship_manager
+
+        tags_to_parents = {}
+
+        for ( tag, tag_id ) in tags_to_tag_ids.items():
+
+            if tag_id in tag_ids_to_ancestor_tag_ids:
+
+                parents = tag_censorship_manager.FilterTags( service_key, { tag_ids_to_tags[ ancestor_tag_id ] for ancestor_tag_id in tag_ids_to_ancestor_tag_ids[ tag_id ] } )
+
+                if len( parents ) > 0:
+
+                    tags_to_parents[ tag ] = list( parents )
+
+
+
+
+        return tags_to_parents
+
+
     def _GetTagSiblings( self, service_key = None ):
 
         def convert_statuses_and_pair_ids_to_statuses_to_pairs( statuses_and_pair_ids ):
@@ -7051,9 +8838,9 @@ class DB( HydrusDB.HydrusDB ):
                 all_tag_ids.add( good_tag_id )
 
 
-            self._PopulateTagIdsToTagsCache( all_tag_ids )
+            tag_ids_to_tags = self._PopulateTagIdsToTagsCache( all_tag_ids )
 
-            statuses_to_pairs = HydrusData.BuildKeyToSetDict( ( ( status, ( self._tag_ids_to_tags_cache[ bad_tag_id ], self._tag_ids_to_tags_cache[ good_tag_id ] ) ) for ( status, bad_tag_id, good_tag_id ) in statuses_and_pair_ids ) )
+            statuses_to_pairs = HydrusData.BuildKeyToSetDict( ( ( status, ( tag_ids_to_tags[ bad_tag_id ], tag_ids_to_tags[ good_tag_id ] ) ) for ( status, bad_tag_id, good_tag_id ) in statuses_and_pair_ids ) )
 
             return statuses_to_pairs
 
@@ -7104,102 +8891,165 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-    def _GetTagSiblingIds( self, service_key, tag_ids ):
+    def _GetTagSiblingsLookup( self, service_key, tags ):
 
-        search_tag_ids = set( tag_ids )
-        searched_tag_ids = set()
-        sibling_tag_ids = set()
+        service_id = self._GetServiceId( service_key )
 
-        if service_key == CC.COMBINED_TAG_SERVICE_KEY:
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( service_id )
 
-            service_predicate = ''
+        tags_to_tag_ids = self._GetTagsToTagIds( tags )
 
-        else:
+        tag_ids_to_ideal_tag_ids = dict( self._SelectFromList( 'SELECT bad_tag_id, ideal_tag_id FROM ' + tag_sibling_closure_table_name + ' WHERE status = ' + str( HC.CONTENT_STATUS_PENDING ) + ' AND bad_tag_id IN {};', list( tags_to_tag_ids.values() ) ) )
 
-            service_id = self._GetServiceId( service_key )
+        tag_ids_to_tags = self._PopulateTagIdsToTagsCache( set( tag_ids_to_ideal_tag_ids.values() ) )
 
-            service_predicate = ' AND service_id = ' + str( service_id )
+        tags_to_ideals = { tag : tag_ids_to_tags[ tag_ids_to_ideal_tag_ids[ tag_id ] ] for ( tag, tag_id ) in tags_to_tag_ids.items() if tag_id in tag_ids_to_ideal_tag_ids }
 
+        tag_censorship_manager = self._controller.tag_censorship_manager
 
-        good_select = 'SELECT good_tag_id FROM tag_siblings WHERE bad_tag_id IN {}' + service_predicate + ';'
-        bad_select = 'SELECT bad_tag_id FROM tag_siblings WHERE good_tag_id IN {}' + service_predicate + ';'
-        while len( search_tag_ids ) > 0:
+        allowed_tags = tag_censorship_manager.FilterTags( service_key, set( tags_to_ideals.keys() ).union( tags_to_ideals.values() ) )
 
-            goods = self._STS( raw_data = self._SelectFromList( good_select, search_tag_ids ) )
-            bads = self._STS( raw_data = self._SelectFromList( bad_select, search_tag_ids ) )
+        return { tag : ideal for ( tag, ideal ) in tags_to_ideals.items() if tag in allowed_tags and ideal in allowed_tags }
 
-            searched_tag_ids.update( search_tag_ids )
 
-            # ids are new if we have not seen them before
-            new_sibling_tag_ids = goods.union( bads ).difference( searched_tag_ids )
+    def _GetTagSiblingsReverseLookup( self, service_key, ideals ):
 
-            search_tag_ids = new_sibling_tag_ids
+        service_id = self._GetServiceId( service_key )
 
-            sibling_tag_ids.update( new_sibling_tag_ids )
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( service_id )
 
+        ideals_to_tag_ids = self._GetTagsToTagIds( ideals )
 
-        return sibling_tag_ids
+        ideal_tag_ids_to_bad_tag_ids = HydrusData.BuildKeyToListDict( self._SelectFromList( 'SELECT ideal_tag_id, bad_tag_id FROM ' + tag_sibling_closure_table_name + ' WHERE status = ' + str( HC.CONTENT_STATUS_PENDING ) + ' AND ideal_tag_id IN {};', list( ideals_to_tag_ids.values() ) ) )
 
+        tag_ids_to_tags = self._PopulateTagIdsToTagsCache( { bad_tag_id for bad_tag_ids in ideal_tag_ids_to_bad_tag_ids.values() for bad_tag_id in bad_tag_ids } )
 
-    def _GetText( self, text_id ):
+        tag_censorship_manager = self._controller.tag_censorship_manager
 
-        self._c.execute( 'SELECT text FROM texts WHERE text_id = %s;', ( text_id, ) ); result = self._c.fetchone()
+        ideals_to_bads = {}
 
-        if result is None:
+        for ( ideal, ideal_tag_id ) in ideals_to_tag_ids.items():
 
-            raise HydrusExceptions.DataMissing( 'Text lookup error in database' )
+            if ideal_tag_id in ideal_tag_ids_to_bad_tag_ids and len( tag_censorship_manager.FilterTags( service_key, ( ideal, ) ) ) > 0:
 
+                bads = tag_censorship_manager.FilterTags( service_key, { tag_ids_to_tags[ bad_tag_id ] for bad_tag_id in ideal_tag_ids_to_bad_tag_ids[ ideal_tag_id ] } )
 
-        ( text, ) = result
+                if len( bads ) > 0:
 
-        return text
+                    ideals_to_bads[ ideal ] = list( bads )
 
 
-    def _GetTextId( self, text ):
 
-        self._c.execute( 'SELECT text_id FROM texts WHERE text = %s;', ( text, ) ); result = self._c.fetchone()
 
-        if result is None:
+        return ideals_to_bads
 
-            self._c.execute( 'INSERT INTO texts ( text ) VALUES ( %s );', ( text, ) )
 
-            text_id = self._c.lastrowid
+    def _GetTagSiblingIds( self, service_key, tag_ids ):
 
-        else:
+        service_id = self._GetServiceId( service_key )
 
-            ( text_id, ) = result
+        tag_sibling_closure_table_name = GenerateTagSiblingClosureTableName( service_id )
 
+        # a sibling group is everything that shares an ideal, so find the ideals and then everything that points to them
 
-        return text_id
+        with HydrusDB.TemporaryIntegerTable( self._c, tag_ids, 'tag_id' ) as temp_tag_ids_table_name:
 
+            ideal_tag_ids = self._STS( self._c.execute( 'SELECT ideal_tag_id FROM ' + temp_tag_ids_table_name + ' CROSS JOIN ' + tag_sibling_closure_table_name + ' ON ( bad_tag_id = tag_id ) WHERE status = %s;', ( HC.CONTENT_STATUS_PENDING, ) ) )
 
-    def _GetTrashHashes( self, limit = None, minimum_age = None ):
+            ideal_tag_ids.update( self._STS( self._c.execute( 'SELECT DISTINCT ideal_tag_id FROM ' + temp_tag_ids_table_name + ' CROSS JOIN ' + tag_sibling_closure_table_name + ' ON ( ideal_tag_id = tag_id ) WHERE status = %s;', ( HC.CONTENT_STATUS_PENDING, ) ) ) )
 
-        if limit is None:
 
-            limit_phrase = ''
+        sibling_tag_ids = set( ideal_tag_ids )
 
-        else:
+        sibling_tag_ids.update( self._STS( raw_data = self._SelectFromList( 'SELECT bad_tag_id FROM ' + tag_sibling_closure_table_name + ' WHERE status = ' + str( HC.CONTENT_STATUS_PENDING ) + ' AND ideal_tag_id IN {};', ideal_tag_ids ) ) )
 
-            limit_phrase = ' LIMIT ' + str( limit )
+        return sibling_tag_ids.difference( tag_ids )
 
 
-        if minimum_age is None:
+    def _GetTagsToTagIds( self, tags ):
 
-            age_phrase = ' ORDER BY timestamp ASC' # when deleting until trash is small enough, let's delete oldest first
+        # unlike _GetTagId, this does not create anything, so tags the db has never seen are left out
 
-        else:
+        ( tags_to_tag_ids, uncached_tags ) = self._tags_to_tag_ids_cache.GetManyDataAndMissing( tags )
 
-            timestamp_cutoff = HydrusData.GetNow() - minimum_age
+        if len( uncached_tags ) > 0:
 
-            age_phrase = ' AND timestamp < ' + str( timestamp_cutoff )
+            namespaces_and_subtags = { HydrusTags.SplitTag( tag ) for tag in uncached_tags }
 
+            subtags = list( { subtag for ( namespace, subtag ) in namespaces_and_subtags } )
 
-        hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM current_files WHERE service_id = %s' + age_phrase + limit_phrase + ';', ( self._trash_service_id, ) ) )
+            select_statement = 'SELECT tag_id, namespace, subtag FROM subtags NATURAL JOIN tags NATURAL JOIN namespaces WHERE subtag IN {};'
 
-        if HG.db_report_mode:
+            uncached_tags_to_tag_ids = { HydrusTags.CombineTag( namespace, subtag ) : tag_id for ( tag_id, namespace, subtag ) in self._SelectFromList( select_statement, subtags ) if ( namespace, subtag ) in namespaces_and_subtags }
 
-            message = 'When asked for '
+            self._tags_to_tag_ids_cache.AddManyData( uncached_tags_to_tag_ids )
+            self._tag_ids_to_tags_cache.AddManyData( { tag_id : tag for ( tag, tag_id ) in uncached_tags_to_tag_ids.items() } )
+
+            tags_to_tag_ids.update( uncached_tags_to_tag_ids )
+
+
+        return tags_to_tag_ids
+
+
+    def _GetText( self, text_id ):
+
+        self._c.execute( 'SELECT text FROM texts WHERE text_id = %s;', ( text_id, ) ); result = self._c.fetchone()
+
+        if result is None:
+
+            raise HydrusExceptions.DataMissing( 'Text lookup error in database' )
+
+
+        ( text, ) = result
+
+        return text
+
+
+    def _GetTextId( self, text ):
+
+        self._c.execute( 'SELECT text_id FROM texts WHERE text = %s;', ( text, ) ); result = self._c.fetchone()
+
+        if result is None:
+
+            self._c.execute( 'INSERT INTO texts ( text ) VALUES ( %s );', ( text, ) )
+
+            text_id = self._c.lastrowid
+
+        else:
+
+            ( text_id, ) = result
+
+
+        return text_id
+
+
+    def _GetTrashHashes( self, limit = None, minimum_age = None ):
+
+        if limit is None:
+
+            limit_phrase = ''
+
+        else:
+
+            limit_phrase = ' LIMIT ' + str( limit )
+
+
+        if minimum_age is None:
+
+            age_phrase = ' ORDER BY timestamp ASC' # when deleting until trash is small enough, let's delete oldest first
+
+        else:
+
+            timestamp_cutoff = HydrusData.GetNow() - minimum_age
+
+            age_phrase = ' AND timestamp < ' + str( timestamp_cutoff )
+
+
+        hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM current_files WHERE service_id = %s' + age_phrase + limit_phrase + ';', ( self._trash_service_id, ) ) )
+
+        if HG.db_report_mode:
+
+            message = 'When asked for '
 
             if limit is None:
 
@@ -7329,7 +9179,7 @@ class DB( HydrusDB.HydrusDB ):
 
     def _HashExists( self, hash ):
 
-        self._c.execute( 'SELECT 1 FROM hashes WHERE hash = %s;', ( binascii.b2a_hex(hash) , ) ); result = self._c.fetchone()
+        self._c.execute( 'SELECT 1 FROM hashes WHERE hash = %s;', ( hash, ) ); result = self._c.fetchone()
 
         if result is None:
 
@@ -7372,7 +9222,7 @@ class DB( HydrusDB.HydrusDB ):
 
             ( md5, sha1, sha512 ) = file_import_job.GetExtraHashes()
 
-            self._c.execute( 'INSERT IGNORE INTO local_hashes ( hash_id, md5, sha1, sha512 ) VALUES ( %s, %s, %s, %s );', ( hash_id, binascii.b2a_hex(md5) , binascii.b2a_hex(sha1) , binascii.b2a_hex(sha512)  ) )
+            self._c.execute( 'INSERT IGNORE INTO local_hashes ( hash_id, md5, sha1, sha512 ) VALUES ( %s, %s, %s, %s );', ( hash_id, md5, sha1, sha512 ) )
 
             file_import_options = file_import_job.GetFileImportOptions()
 
@@ -7467,6 +9317,10 @@ class DB( HydrusDB.HydrusDB ):
 
             self._inbox_hash_ids.update( hash_ids )
 
+            self._TouchCache( 'inbox' )
+
+            self._InvalidateFileSearchResults( [ ( 'inbox', ) ] )
+
 
 
     def _InitCaches( self ):
@@ -7485,16 +9339,32 @@ class DB( HydrusDB.HydrusDB ):
 
         self._subscriptions_cache = {}
         self._service_cache = {}
+        self._service_ids_to_service_keys_cache = None
 
-        self._weakref_media_result_cache = ClientCaches.MediaResultCache()
-        self._hash_ids_to_hashes_cache = {}
-        self._tag_ids_to_tags_cache = {}
+        self._weakref_media_result_cache = ClientCaches.MediaResultCache( strong_cache_size = HC.MEDIA_RESULT_CACHE_SIZE, snapshot_path = os.path.join( self._db_dir, ClientCaches.MEDIA_RESULT_SNAPSHOT_FILENAME ) )
+
+        self._InitMasterIdCaches()
 
         self._c.execute( 'SELECT namespace_id FROM namespaces WHERE namespace = %s;', ( '', ) ); ( self._null_namespace_id, ) = self._c.fetchone()
 
         HG.client_controller.pub( 'splash_set_status_subtext', 'inbox' )
 
-        self._inbox_hash_ids = self._STS( self._c.execute( 'SELECT hash_id FROM file_inbox;' ) )
+        self._inbox_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM file_inbox;' ) )
+
+        HG.client_controller.pub( 'splash_set_status_subtext', 'json dumps' )
+
+        self._LoadJSONDumpStoreIndex()
+
+        HG.client_controller.pub( 'splash_set_status_subtext', 'similar files index' )
+
+        self._PHashesLoadIndex()
+
+        if self._subtag_autocomplete_index is not None:
+
+            # this is a big read, so it fills in the background and autocomplete uses the fulltext index until it is done
+
+            self._subtag_autocomplete_index.StartLoad()
+
 
 
     def _InitDiskCache( self ):
@@ -7520,6 +9390,16 @@ class DB( HydrusDB.HydrusDB ):
         self._db_filenames[ 'external_master' ] = 'client.master.db'
 
 
+    def _InitMasterIdCaches( self ):
+
+        self._hash_ids_to_hashes_cache = ClientCaches.LRUCache( MASTER_ID_CACHE_SIZE, 'hash_ids_to_hashes' )
+        self._hashes_to_hash_ids_cache = ClientCaches.LRUCache( MASTER_ID_CACHE_SIZE, 'hashes_to_hash_ids' )
+        self._tag_ids_to_tags_cache = ClientCaches.LRUCache( MASTER_ID_CACHE_SIZE, 'tag_ids_to_tags' )
+        self._tags_to_tag_ids_cache = ClientCaches.LRUCache( MASTER_ID_CACHE_SIZE, 'tags_to_tag_ids' )
+        self._namespaces_to_namespace_ids_cache = ClientCaches.LRUCache( MASTER_ID_CACHE_SIZE, 'namespaces_to_namespace_ids' )
+        self._subtags_to_subtag_ids_cache = ClientCaches.LRUCache( MASTER_ID_CACHE_SIZE, 'subtags_to_subtag_ids' )
+
+
     def _InInbox( self, hash_param ):
 
         if isinstance( hash_param, bytes ):
@@ -7528,29 +9408,69 @@ class DB( HydrusDB.HydrusDB ):
 
             hash_id = self._GetHashId( hash )
 
-            return hash_id in self._inbox_hash_ids
+            return len( self._GetInboxHashIds( ( hash_id, ) ) ) > 0
 
         elif isinstance( hash_param, ( list, tuple, set ) ):
 
             hashes = hash_param
 
-            inbox_hashes = []
+            hashes_to_hash_ids = { hash : self._GetHashId( hash ) for hash in hashes }
 
-            for hash in hashes:
+            inbox_hash_ids = self._GetInboxHashIds( list( hashes_to_hash_ids.values() ) )
 
-                hash_id = self._GetHashId( hash )
+            inbox_hashes = [ hash for hash in hashes if hashes_to_hash_ids[ hash ] in inbox_hash_ids ]
+
+            return inbox_hashes
 
-                if hash_id in self._inbox_hash_ids:
+        else:
 
-                    inbox_hashes.append( hash )
+            raise NotImplementedError( 'Did not understand hashes parameter!' )
 
 
 
-            return inbox_hashes
+    def _InvalidateFileSearchResults( self, dependencies ):
 
-        else:
+        self._file_search_result_cache.Invalidate( dependencies )
 
-            raise NotImplementedError( 'Did not understand hashes parameter!' )
+
+    def _InvalidateFileSearchResultsForFileService( self, service_id ):
+
+        dependencies = [ ( 'file_service', service_id ), ( 'file_service', self._combined_file_service_id ) ]
+
+        if self._GetService( service_id ).GetServiceType() in HC.LOCAL_FILE_SERVICES:
+
+            dependencies.append( ( 'file_service', self._combined_local_file_service_id ) )
+
+
+        self._InvalidateFileSearchResults( dependencies )
+
+
+    def _InvalidateFileSearchResultsForMappings( self, tag_service_id, tag_ids ):
+
+        tag_service_ids = ( tag_service_id, self._combined_tag_service_id )
+
+        # this also stops new results being cached until we commit, so it is safe to skip the tag lookup if nothing is cached now
+
+        self._InvalidateFileSearchResults( [ ( 'all_tags', search_tag_service_id ) for search_tag_service_id in tag_service_ids ] )
+
+        if len( self._file_search_result_cache ) > 0:
+
+            dependencies = []
+
+            tag_ids_to_tags = self._PopulateTagIdsToTagsCache( tag_ids )
+
+            for tag in tag_ids_to_tags.values():
+
+                ( namespace, subtag ) = HydrusTags.SplitTag( tag )
+
+                for search_tag_service_id in tag_service_ids:
+
+                    dependencies.append( ( 'tag', search_tag_service_id, tag ) )
+                    dependencies.append( ( 'subtag', search_tag_service_id, subtag ) )
+
+
+
+            self._InvalidateFileSearchResults( dependencies )
 
 
 
@@ -7602,6 +9522,41 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+    def _MigrateMappingsSchema( self ):
+
+        if self._mappings_schema_migration_in_progress:
+
+            HydrusData.ShowText( 'The mappings tables are already being migrated.' )
+
+            return
+
+
+        table_names_to_schemas = self._GetMappingsTableNamesToMigrate()
+
+        if len( table_names_to_schemas ) == 0:
+
+            HydrusData.ShowText( 'All the mappings tables already have the current schema.' )
+
+            return
+
+
+        job_key = ClientThreading.JobKey( cancellable = True )
+
+        job_key.SetVariable( 'popup_title', 'migrating mappings tables' )
+
+        self._controller.pub( 'modal_message', job_key )
+
+        # smallest first, so the quick ones are done before the giant ones tie things up
+
+        table_names_to_num_rows = self._GetTableNamesToEstimatedNumRows()
+
+        table_names = sorted( table_names_to_schemas.keys(), key = lambda table_name: table_names_to_num_rows.get( table_name, 0 ) )
+
+        self._mappings_schema_migration_in_progress = True
+
+        self._controller.CallToThreadLongRunning( self.THREADMigrateMappingsSchema, job_key, table_names, table_names_to_schemas )
+
+
     def _ManageDBError( self, job, e ):
 
         if isinstance( e, MemoryError ):
@@ -7688,7 +9643,7 @@ class DB( HydrusDB.HydrusDB ):
 
                 self._c.execute( 'SELECT phash, radius, inner_id, inner_population, outer_id, outer_population FROM shape_perceptual_hashes NATURAL JOIN shape_vptree WHERE phash_id = %s;', ( ancestor_id, ) ); ( ancestor_phash, ancestor_radius, ancestor_inner_id, ancestor_inner_population, ancestor_outer_id, ancestor_outer_population ) = self._c.fetchone()
 
-                distance_to_ancestor = HydrusData.Get64BitHammingDistance( phash, binascii.a2b_hex(ancestor_phash) )
+                distance_to_ancestor = HydrusData.Get64BitHammingDistance( phash, bytes( ancestor_phash ) )
 
                 if ancestor_radius is None or distance_to_ancestor <= ancestor_radius:
 
@@ -7748,6 +9703,8 @@ class DB( HydrusDB.HydrusDB ):
 
     def _PHashesAssociatePHashes( self, hash_id, phashes ):
 
+        self._InvalidateFileSearchResults( [ ( 'similar_files', ) ] )
+
         phash_ids = set()
 
         for phash in phashes:
@@ -7779,6 +9736,8 @@ class DB( HydrusDB.HydrusDB ):
 
     def _PHashesDisassociatePHashes( self, hash_id, phash_ids ):
 
+        self._InvalidateFileSearchResults( [ ( 'similar_files', ) ] )
+
         self._c.executemany( 'DELETE FROM shape_perceptual_hash_map WHERE phash_id = %s AND hash_id = %s;', ( ( phash_id, hash_id ) for phash_id in phash_ids ) )
         self._c.execute('SELECT phash_id FROM shape_perceptual_hash_map WHERE phash_id IN ' + HydrusData.SplayListForDB(phash_ids) + ';')
         useful_phash_ids = { phash for ( phash, ) in self._c.fetchall() }
@@ -7787,6 +9746,10 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.executemany( 'INSERT IGNORE INTO shape_maintenance_branch_regen ( phash_id ) VALUES ( %s );', ( ( phash_id, ) for phash_id in useless_phash_ids ) )
 
+        self._phash_index.DeletePHashIds( useless_phash_ids )
+
+        self._TouchCache( 'phash_index' )
+
 
     def _PHashesGenerateBranch( self, job_key, parent_id, phash_id, phash, children ):
 
@@ -7889,11 +9852,11 @@ class DB( HydrusDB.HydrusDB ):
 
     def _PHashesGetPHashId( self, phash ):
 
-        self._c.execute( 'SELECT phash_id FROM shape_perceptual_hashes WHERE phash = %s;', ( binascii.b2a_hex(phash), ) ); result = self._c.fetchone()
+        self._c.execute( 'SELECT phash_id FROM shape_perceptual_hashes WHERE phash = %s;', ( phash, ) ); result = self._c.fetchone()
 
         if result is None:
 
-            self._c.execute( 'INSERT INTO shape_perceptual_hashes ( phash ) VALUES ( %s );', ( binascii.b2a_hex(phash), ) )
+            self._c.execute( 'INSERT INTO shape_perceptual_hashes ( phash ) VALUES ( %s );', ( phash, ) )
 
             phash_id = self._c.lastrowid
 
@@ -7904,9 +9867,22 @@ class DB( HydrusDB.HydrusDB ):
             ( phash_id, ) = result
 
 
+        # an orphaned phash may come back before branch maintenance clears it out, so always make sure it is searchable
+
+        self._phash_index.AddPHashes( [ ( phash_id, phash ) ] )
+
+        self._TouchCache( 'phash_index' )
+
         return phash_id
 
 
+    def _PHashesLoadIndex( self ):
+
+        self._c.execute( 'SELECT phash_id, phash FROM shape_perceptual_hashes;' )
+
+        self._phash_index = ClientCaches.PHashIndex( ( phash_id, bytes( phash ) ) for ( phash_id, phash ) in self._c.fetchall() )
+
+
     def _PHashesMaintainFiles( self, job_key = None, stop_time = None ):
 
         time_started = HydrusData.GetNow()
@@ -7924,7 +9900,7 @@ class DB( HydrusDB.HydrusDB ):
 
             self._c.execute( 'SELECT COUNT( * ) FROM shape_search_cache;' ); ( total_num_hash_ids_in_cache, ) = self._c.fetchone()
 
-            hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM shape_maintenance_phash_regen;' ) )
+            hash_ids = self._STL( self._StreamSelect( 'SELECT hash_id FROM shape_maintenance_phash_regen;' ) )
 
             client_files_manager = self._controller.client_files_manager
 
@@ -8051,7 +10027,7 @@ class DB( HydrusDB.HydrusDB ):
 
             job_key.SetVariable( 'popup_title', 'similar files metadata maintenance' )
 
-            rebalance_phash_ids = self._STL( self._c.execute( 'SELECT phash_id FROM shape_maintenance_branch_regen;' ) )
+            rebalance_phash_ids = self._STL( self._StreamSelect( 'SELECT phash_id FROM shape_maintenance_branch_regen;' ) )
 
             num_to_do = len( rebalance_phash_ids )
 
@@ -8090,7 +10066,7 @@ class DB( HydrusDB.HydrusDB ):
 
                 self._PHashesRegenerateBranch( job_key, biggest_phash_id )
 
-                rebalance_phash_ids = self._STL( self._c.execute( 'SELECT phash_id FROM shape_maintenance_branch_regen;' ) )
+                rebalance_phash_ids = self._STL( self._StreamSelect( 'SELECT phash_id FROM shape_maintenance_branch_regen;' ) )
 
 
         finally:
@@ -8235,7 +10211,7 @@ class DB( HydrusDB.HydrusDB ):
 
         with_clause = 'WITH RECURSIVE ' + cte_table_name + ' AS ( ' + initial_select + ' UNION ALL ' +  recursive_select +  ')'
         self._c.execute(with_clause + ' SELECT branch_phash_id, phash FROM branch, shape_perceptual_hashes ON phash_id = branch_phash_id;', (phash_id,))
-        unbalanced_nodes = [(x[0], binascii.a2b_hex(x[1])) for x in self._c.fetchall()]
+        unbalanced_nodes = [ ( branch_phash_id, bytes( phash ) ) for ( branch_phash_id, phash ) in self._c.fetchall() ]
 
         # removal of old branch, maintenance schedule, and orphan phashes
 
@@ -8255,6 +10231,10 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.executemany( 'DELETE FROM shape_perceptual_hashes WHERE phash_id = %s;', ( ( p_id, ) for p_id in orphan_phash_ids ) )
 
+        self._phash_index.DeletePHashIds( orphan_phash_ids )
+
+        self._TouchCache( 'phash_index' )
+
         useful_nodes = [ row for row in unbalanced_nodes if row[0] in useful_phash_ids ]
 
         useful_population = len( useful_nodes )
@@ -8311,13 +10291,15 @@ class DB( HydrusDB.HydrusDB ):
             self._c.execute( 'DELETE FROM shape_vptree;' )
 
             self._c.execute( 'SELECT phash_id, phash FROM shape_perceptual_hashes;' )
-            all_nodes = [ (x[0], binascii.a2b_hex(x[1])) for x in self._c.fetchall() ]
+            all_nodes = [ ( phash_id, bytes( phash ) ) for ( phash_id, phash ) in self._c.fetchall() ]
             job_key.SetVariable( 'popup_text_1', HydrusData.ToHumanInt( len( all_nodes ) ) + ' leaves found, now regenerating' )
 
             ( root_id, root_phash ) = self._PHashesPopBestRootNode( all_nodes ) #HydrusData.RandomPop( all_nodes )
 
             self._PHashesGenerateBranch( job_key, None, root_id, root_phash, all_nodes )
 
+            self._PHashesLoadIndex()
+
         finally:
 
             job_key.SetVariable( 'popup_text_1', 'done!' )
@@ -8363,11 +10345,24 @@ class DB( HydrusDB.HydrusDB ):
 
             self._c.execute( 'SELECT COUNT( * ) FROM shape_search_cache;' ); ( total_num_hash_ids_in_cache, ) = self._c.fetchone()
 
-            hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM shape_search_cache WHERE searched_distance IS NULL or searched_distance < %s;', ( search_distance, ) ) )
+            hash_ids = self._STL( self._StreamSelect( 'SELECT hash_id FROM shape_search_cache WHERE searched_distance IS NULL or searched_distance < %s;', ( search_distance, ) ) )
 
             total_done_previously = total_num_hash_ids_in_cache - len( hash_ids )
 
-            for ( i, hash_id ) in enumerate( hash_ids ):
+            if len( hash_ids ) == 0:
+
+                return
+
+
+            # rather than one index search per file, we do a block of files against the whole index in one go
+
+            ( index_phash_ids, index_phashes ) = self._phash_index.GetSnapshot()
+
+            phash_ids_to_indices = { phash_id : index for ( index, phash_id ) in enumerate( index_phash_ids.tolist() ) }
+
+            num_done = 0
+
+            for block_of_hash_ids in HydrusData.SplitListIntoChunks( hash_ids, PHASH_SEARCH_BLOCK_SIZE ):
 
                 job_key.SetVariable( 'popup_title', 'similar files duplicate pair discovery' )
 
@@ -8387,147 +10382,104 @@ class DB( HydrusDB.HydrusDB ):
                     return
 
 
-                if i % 25 == 0:
-
-                    text = 'searched ' + HydrusData.ConvertValueRangeToPrettyString( total_done_previously + i, total_num_hash_ids_in_cache ) + ' files'
-
-                    job_key.SetVariable( 'popup_text_1', text )
-                    job_key.SetVariable( 'popup_gauge_1', ( total_done_previously + i, total_num_hash_ids_in_cache ) )
-
-                    HG.client_controller.pub( 'splash_set_status_subtext', text )
-
-
-                potential_duplicate_hash_ids = [ duplicate_hash_id for duplicate_hash_id in self._PHashesSearch( hash_id, search_distance ) if duplicate_hash_id != hash_id ]
-
-                self._DuplicatesAddPotentialDuplicates( hash_id, potential_duplicate_hash_ids )
-
-                self._c.execute( 'UPDATE shape_search_cache SET searched_distance = %s WHERE hash_id = %s;', ( search_distance, hash_id ) )
-
-
-        finally:
-
-            job_key.SetVariable( 'popup_text_1', 'done!' )
-            job_key.DeleteVariable( 'popup_gauge_1' )
-
-            job_key.Finish()
-
-            job_key.Delete( 5 )
-
-
-
-    def _PHashesSchedulePHashRegeneration( self, hash_ids = None ):
-
-        if hash_ids is None:
-
-            hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM files_info NATURAL JOIN current_files WHERE service_id = %s AND mime IN ' + HydrusData.SplayListForDB( HC.MIMES_WE_CAN_PHASH ) + ';', ( self._combined_local_file_service_id, ) ) )
+                text = 'searched ' + HydrusData.ConvertValueRangeToPrettyString( total_done_previously + num_done, total_num_hash_ids_in_cache ) + ' files'
 
+                job_key.SetVariable( 'popup_text_1', text )
+                job_key.SetVariable( 'popup_gauge_1', ( total_done_previously + num_done, total_num_hash_ids_in_cache ) )
 
-        self._c.executemany( 'INSERT IGNORE INTO shape_maintenance_phash_regen ( hash_id ) VALUES ( %s );', ( ( hash_id, ) for hash_id in hash_ids ) )
+                HG.client_controller.pub( 'splash_set_status_subtext', text )
 
+                hash_ids_to_phash_ids = HydrusData.BuildKeyToSetDict( self._SelectFromList( 'SELECT hash_id, phash_id FROM shape_perceptual_hash_map WHERE hash_id IN {};', block_of_hash_ids ) )
 
-    def _PHashesSearch( self, hash_id, max_hamming_distance ):
+                query_phash_ids = [ phash_id for phash_id in set( itertools.chain.from_iterable( hash_ids_to_phash_ids.values() ) ) if phash_id in phash_ids_to_indices ]
 
-        if max_hamming_distance == 0:
+                query_phashes = index_phashes[ [ phash_ids_to_indices[ phash_id ] for phash_id in query_phash_ids ] ]
 
-            similar_hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM shape_perceptual_hash_map WHERE phash_id IN ( SELECT phash_id FROM shape_perceptual_hash_map WHERE hash_id = %s );', ( hash_id, ) ) )
+                ( query_indices, match_indices ) = ClientCaches.GetPHashPairsWithinDistance( query_phashes, index_phashes, search_distance, num_threads = HC.SIMILAR_FILES_SEARCH_THREADS )
 
-        else:
+                query_phash_ids_to_similar_phash_ids = HydrusData.BuildKeyToSetDict( zip( [ query_phash_ids[ query_index ] for query_index in query_indices.tolist() ], index_phash_ids[ match_indices ].tolist() ) )
 
-            search_radius = max_hamming_distance
+                similar_phash_ids = set( index_phash_ids[ match_indices ].tolist() )
 
-            self._c.execute( 'SELECT phash_id FROM shape_vptree WHERE parent_id IS NULL;' ); top_node_result = self._c.fetchone()
+                similar_phash_ids_to_hash_ids = HydrusData.BuildKeyToSetDict( self._SelectFromList( 'SELECT phash_id, hash_id FROM shape_perceptual_hash_map WHERE phash_id IN {};', similar_phash_ids ) )
 
-            if top_node_result is None:
+                pairs = set()
 
-                return []
+                for ( hash_id, phash_ids ) in hash_ids_to_phash_ids.items():
 
+                    for phash_id in phash_ids:
 
-            ( root_node_phash_id, ) = top_node_result
-            self._c.execute('SELECT phash FROM shape_perceptual_hashes NATURAL JOIN shape_perceptual_hash_map WHERE hash_id = %s;',(hash_id,))
-            search_phashes = [ binascii.a2b_hex(x) for ( x, ) in self._c.fetchall() ]
+                        for similar_phash_id in query_phash_ids_to_similar_phash_ids[ phash_id ]:
 
-            if len( search_phashes ) == 0:
+                            for similar_hash_id in similar_phash_ids_to_hash_ids[ similar_phash_id ]:
 
-                return []
+                                if similar_hash_id != hash_id:
 
+                                    pairs.add( ( min( hash_id, similar_hash_id ), max( hash_id, similar_hash_id ) ) )
 
-            similar_phash_ids = set()
 
-            num_cycles = 0
 
-            for search_phash in search_phashes:
 
-                next_potentials = [ root_node_phash_id ]
 
-                while len( next_potentials ) > 0:
 
-                    current_potentials = next_potentials
-                    next_potentials = []
 
-                    num_cycles += 1
+                self._DuplicatesAddPotentialDuplicatePairs( pairs )
 
-                    for group_of_current_potentials in HydrusData.SplitListIntoChunks( current_potentials, 1024 ):
+                self._c.execute( 'UPDATE shape_search_cache SET searched_distance = %s WHERE hash_id IN ' + HydrusData.SplayListForDB( block_of_hash_ids ) + ';', ( search_distance, ) )
 
-                        # this is split into fixed lists of results of subgroups because as an iterable it was causing crashes on linux!!
-                        # after investigation, it seemed to be SQLite having a problem with part of Get64BitHammingDistance touching phashes it presumably was still hanging on to
-                        # the crash was in sqlite code, again presumably on subsequent fetch
-                        # adding a delay in seemed to fix it as well. guess it was some memory maintenance buffer/bytes thing
-                        # anyway, we now just get the whole lot of results first and then work on the whole lot
+                num_done += len( block_of_hash_ids )
 
-                        select_statement = 'SELECT phash_id, phash, radius, inner_id, outer_id FROM shape_perceptual_hashes NATURAL JOIN shape_vptree WHERE phash_id IN {};'
 
-                        results = list( self._SelectFromList( select_statement, group_of_current_potentials ) )
 
-                        for ( node_phash_id, node_phash, node_radius, inner_phash_id, outer_phash_id ) in results:
+        finally:
 
-                            # first check the node itself--is it similar?
+            job_key.SetVariable( 'popup_text_1', 'done!' )
+            job_key.DeleteVariable( 'popup_gauge_1' )
 
-                            node_hamming_distance = HydrusData.Get64BitHammingDistance( search_phash, binascii.a2b_hex(node_phash) )
+            job_key.Finish()
 
-                            if node_hamming_distance <= search_radius:
+            job_key.Delete( 5 )
 
-                                similar_phash_ids.add( node_phash_id )
 
 
-                            # now how about its children?
+    def _PHashesSchedulePHashRegeneration( self, hash_ids = None ):
 
-                            if node_radius is not None:
+        if hash_ids is None:
 
-                                # we have two spheres--node and search--their centers separated by node_hamming_distance
-                                # we want to search inside/outside the node_sphere if the search_sphere intersects with those spaces
-                                # there are four possibles:
-                                # (----N----)-(--S--)    intersects with outer only - distance between N and S > their radii
-                                # (----N---(-)-S--)      intersects with both
-                                # (----N-(--S-)-)        intersects with both
-                                # (---(-N-S--)-)         intersects with inner only - distance between N and S + radius_S does not exceed radius_N
+            hash_ids = self._STL( self._StreamSelect( 'SELECT hash_id FROM files_info NATURAL JOIN current_files WHERE service_id = %s AND mime IN ' + HydrusData.SplayListForDB( HC.MIMES_WE_CAN_PHASH ) + ';', ( self._combined_local_file_service_id, ) ) )
 
-                                if inner_phash_id is not None:
 
-                                    spheres_disjoint = node_hamming_distance > ( node_radius + search_radius )
+        self._c.executemany( 'INSERT IGNORE INTO shape_maintenance_phash_regen ( hash_id ) VALUES ( %s );', ( ( hash_id, ) for hash_id in hash_ids ) )
 
-                                    if not spheres_disjoint: # i.e. they intersect at some point
 
-                                        next_potentials.append( inner_phash_id )
+    def _PHashesSearch( self, hash_id, max_hamming_distance ):
 
+        if max_hamming_distance == 0:
 
+            similar_hash_ids = self._STL( self._c.execute( 'SELECT hash_id FROM shape_perceptual_hash_map WHERE phash_id IN ( SELECT phash_id FROM shape_perceptual_hash_map WHERE hash_id = %s );', ( hash_id, ) ) )
 
-                                if outer_phash_id is not None:
+        else:
 
-                                    search_sphere_subset_of_node_sphere = ( node_hamming_distance + search_radius ) <= node_radius
+            self._c.execute( 'SELECT phash FROM shape_perceptual_hashes NATURAL JOIN shape_perceptual_hash_map WHERE hash_id = %s;', ( hash_id, ) )
+            search_phashes = [ bytes( phash ) for ( phash, ) in self._c.fetchall() ]
 
-                                    if not search_sphere_subset_of_node_sphere: # i.e. search sphere intersects with non-node sphere space at some point
+            if len( search_phashes ) == 0:
 
-                                        next_potentials.append( outer_phash_id )
+                return []
 
 
+            # the vptree walk took a db round trip per level, so radius queries now go to the in-memory index instead
 
+            similar_phash_ids = set()
 
+            for search_phash in search_phashes:
 
+                similar_phash_ids.update( self._phash_index.Search( search_phash, max_hamming_distance ) )
 
 
             if HG.db_report_mode:
 
-                HydrusData.ShowText( 'Similar file search completed in ' + HydrusData.ToHumanInt( num_cycles ) + ' cycles.' )
+                HydrusData.ShowText( 'Similar file search found ' + HydrusData.ToHumanInt( len( similar_phash_ids ) ) + ' phashes out of ' + HydrusData.ToHumanInt( len( self._phash_index ) ) + '.' )
 
 
             select_statement = 'SELECT hash_id FROM shape_perceptual_hash_map WHERE phash_id IN {};'
@@ -8540,12 +10492,7 @@ class DB( HydrusDB.HydrusDB ):
     
     def _PopulateHashIdsToHashesCache( self, hash_ids, exception_on_error = False ):
 
-        if len( self._hash_ids_to_hashes_cache ) > 25000:
-
-            self._hash_ids_to_hashes_cache = {}
-
-
-        uncached_hash_ids = [ hash_id for hash_id in hash_ids if hash_id not in self._hash_ids_to_hashes_cache ]
+        ( hash_ids_to_hashes, uncached_hash_ids ) = self._hash_ids_to_hashes_cache.GetManyDataAndMissing( hash_ids )
 
         if len( uncached_hash_ids ) > 0:
 
@@ -8553,7 +10500,10 @@ class DB( HydrusDB.HydrusDB ):
 
             select_statement = 'SELECT hash_id, hash FROM hashes WHERE hash_id IN {};'
 
-            uncached_hash_ids_to_hashes = { k: binascii.a2b_hex(v) for k, v in self._SelectFromList( select_statement, uncached_hash_ids ) }
+            uncached_hash_ids_to_hashes = { hash_id : bytes( hash ) for ( hash_id, hash ) in self._SelectFromList( select_statement, uncached_hash_ids ) }
+
+            self._hashes_to_hash_ids_cache.AddManyData( { hash : hash_id for ( hash_id, hash ) in uncached_hash_ids_to_hashes.items() } )
+
             if len( uncached_hash_ids_to_hashes ) < len( uncached_hash_ids ):
 
                 for hash_id in uncached_hash_ids:
@@ -8581,27 +10531,29 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-            self._hash_ids_to_hashes_cache.update( uncached_hash_ids_to_hashes )
-
+            self._hash_ids_to_hashes_cache.AddManyData( uncached_hash_ids_to_hashes )
 
+            hash_ids_to_hashes.update( uncached_hash_ids_to_hashes )
 
-    def _PopulateTagIdsToTagsCache( self, tag_ids ):
 
-        if len( self._tag_ids_to_tags_cache ) > 25000:
+        return hash_ids_to_hashes
 
-            self._tag_ids_to_tags_cache = {}
 
+    def _PopulateTagIdsToTagsCache( self, tag_ids ):
 
-        uncached_tag_ids = [ tag_id for tag_id in tag_ids if tag_id not in self._tag_ids_to_tags_cache ]
+        ( tag_ids_to_tags, uncached_tag_ids ) = self._tag_ids_to_tags_cache.GetManyDataAndMissing( tag_ids )
 
         if len( uncached_tag_ids ) > 0:
             select_statement = 'SELECT tag_id, tag FROM local_tags_cache WHERE tag_id IN {};'
 
             local_uncached_tag_ids_to_tags = { tag_id : tag for ( tag_id, tag ) in self._SelectFromList( select_statement, uncached_tag_ids ) }
 
-            self._tag_ids_to_tags_cache.update( local_uncached_tag_ids_to_tags )
+            self._tag_ids_to_tags_cache.AddManyData( local_uncached_tag_ids_to_tags )
+            self._tags_to_tag_ids_cache.AddManyData( { tag : tag_id for ( tag_id, tag ) in local_uncached_tag_ids_to_tags.items() } )
+
+            tag_ids_to_tags.update( local_uncached_tag_ids_to_tags )
 
-            uncached_tag_ids = [ tag_id for tag_id in tag_ids if tag_id not in self._tag_ids_to_tags_cache ]
+            uncached_tag_ids = [ tag_id for tag_id in uncached_tag_ids if tag_id not in local_uncached_tag_ids_to_tags ]
 
 
         if len( uncached_tag_ids ) > 0:
@@ -8629,8 +10581,13 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-            self._tag_ids_to_tags_cache.update( uncached_tag_ids_to_tags )
+            self._tag_ids_to_tags_cache.AddManyData( uncached_tag_ids_to_tags )
+            self._tags_to_tag_ids_cache.AddManyData( { tag : tag_id for ( tag_id, tag ) in uncached_tag_ids_to_tags.items() } )
+
+            tag_ids_to_tags.update( uncached_tag_ids_to_tags )
+
 
+        return tag_ids_to_tags
 
 
     def _ProcessContentUpdates( self, service_keys_to_content_updates, do_pubsubs = True ):
@@ -8727,6 +10684,8 @@ class DB( HydrusDB.HydrusDB ):
 
                             self._c.executemany( 'INSERT IGNORE INTO file_transfers ( service_id, hash_id ) VALUES ( %s, %s );', list( ( service_id, hash_id ) for hash_id in hash_ids ) )
 
+                            self._InvalidateFileSearchResults( [ ( 'file_service', service_id ) ] )
+
                             if service_key == CC.COMBINED_LOCAL_FILE_SERVICE_KEY: notify_new_downloads = True
                             else: notify_new_pending = True
 
@@ -8753,6 +10712,8 @@ class DB( HydrusDB.HydrusDB ):
 
                             self._c.execute( 'DELETE FROM file_transfers WHERE service_id = %s AND hash_id IN ' + HydrusData.SplayListForDB( hash_ids ) + ';', ( service_id, ) )
 
+                            self._InvalidateFileSearchResults( [ ( 'file_service', service_id ) ] )
+
                             notify_new_pending = True
 
                         elif action == HC.CONTENT_UPDATE_RESCIND_PETITION:
@@ -8824,6 +10785,8 @@ class DB( HydrusDB.HydrusDB ):
 
                     elif data_type == HC.CONTENT_TYPE_URLS:
 
+                        self._InvalidateFileSearchResults( [ ( 'urls', ) ] )
+
                         if action == HC.CONTENT_UPDATE_ADD:
 
                             ( urls, hashes ) = row
@@ -8845,6 +10808,8 @@ class DB( HydrusDB.HydrusDB ):
 
                     elif data_type == HC.CONTENT_TYPE_FILE_VIEWING_STATS:
 
+                        self._InvalidateFileSearchResults( [ ( 'file_viewing_stats', ) ] )
+
                         if action == HC.CONTENT_UPDATE_ADVANCED:
 
                             action = row
@@ -9129,6 +11094,8 @@ class DB( HydrusDB.HydrusDB ):
 
                             self._c.execute( 'INSERT IGNORE INTO tag_parent_petitions ( service_id, child_tag_id, parent_tag_id, reason_id, status ) VALUES ( %s, %s, %s, %s, %s );', ( service_id, child_tag_id, parent_tag_id, reason_id, new_status ) )
 
+                            self._CacheTagParentsClosureUpdate( service_id, ( child_tag_id, ) )
+
                             notify_new_pending = True
 
                         elif action in ( HC.CONTENT_UPDATE_RESCIND_PEND, HC.CONTENT_UPDATE_RESCIND_PETITION ):
@@ -9157,6 +11124,8 @@ class DB( HydrusDB.HydrusDB ):
 
                             self._c.execute( 'DELETE FROM tag_parent_petitions WHERE service_id = %s AND child_tag_id = %s AND parent_tag_id = %s AND status = %s;', ( service_id, child_tag_id, parent_tag_id, deletee_status ) )
 
+                            self._CacheTagParentsClosureUpdate( service_id, ( child_tag_id, ) )
+
                             notify_new_pending = True
 
 
@@ -9220,6 +11189,8 @@ class DB( HydrusDB.HydrusDB ):
 
                             self._c.execute( 'INSERT IGNORE INTO tag_sibling_petitions ( service_id, bad_tag_id, good_tag_id, reason_id, status ) VALUES ( %s, %s, %s, %s, %s );', ( service_id, bad_tag_id, good_tag_id, reason_id, new_status ) )
 
+                            self._CacheTagSiblingsClosureUpdate( service_id, ( bad_tag_id, good_tag_id ) )
+
                             notify_new_pending = True
 
                         elif action in ( HC.CONTENT_UPDATE_RESCIND_PEND, HC.CONTENT_UPDATE_RESCIND_PETITION ):
@@ -9239,6 +11210,8 @@ class DB( HydrusDB.HydrusDB ):
 
                                 bad_tag_id = self._GetTagId( bad_tag )
 
+                                good_tag_id = self._GetTagId( good_tag )
+
                             except HydrusExceptions.SizeException:
 
                                 continue
@@ -9246,6 +11219,8 @@ class DB( HydrusDB.HydrusDB ):
 
                             self._c.execute( 'DELETE FROM tag_sibling_petitions WHERE service_id = %s AND bad_tag_id = %s AND status = %s;', ( service_id, bad_tag_id, deletee_status ) )
 
+                            self._CacheTagSiblingsClosureUpdate( service_id, ( bad_tag_id, good_tag_id ) )
+
                             notify_new_pending = True
 
 
@@ -9254,6 +11229,8 @@ class DB( HydrusDB.HydrusDB ):
 
                 elif service_type in HC.RATINGS_SERVICES:
 
+                    self._InvalidateFileSearchResults( [ ( 'ratings', service_id ) ] )
+
                     if action == HC.CONTENT_UPDATE_ADD:
 
                         ( rating, hashes ) = row
@@ -9335,6 +11312,13 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+        if notify_new_siblings or notify_new_force_refresh_tags:
+
+            # sibling changes and advanced mappings operations can change any tag search
+
+            self._file_search_result_cache.Clear()
+
+
         if do_pubsubs:
 
             if notify_new_downloads:
@@ -9363,288 +11347,180 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-    def _ProcessRepositoryContentUpdate( self, job_key, service_id, content_update ):
+    def _ProcessRepositoryContentUpdate( self, job_key, service_id, content_update, hash_id = None, num_rows_already_processed = 0 ):
 
         FILES_CHUNK_SIZE = 200
         MAPPINGS_CHUNK_SIZE = 50000
         NEW_TAG_PARENTS_CHUNK_SIZE = 10
 
+        repository_updates_table_name = GenerateRepositoryRepositoryUpdatesTableName( service_id )
+
         total_rows = content_update.GetNumRows()
 
         rows_processed = 0
 
-        for chunk in HydrusData.SplitListIntoChunks( content_update.GetNewFiles(), FILES_CHUNK_SIZE ):
+        # the chunks always come out the same way, so a checkpoint from an interrupted run tells us which ones are already in
 
+        def skip_chunk( num_rows ):
 
+            nonlocal rows_processed
 
-            precise_timestamp = HydrusData.GetNowPrecise()
+            if rows_processed + num_rows <= num_rows_already_processed:
 
-            files_info_rows = []
-            files_rows = []
+                rows_processed += num_rows
 
-            for ( service_hash_id, size, mime, timestamp, width, height, duration, num_frames, num_words ) in chunk:
+                return True
 
-                hash_id = self._CacheRepositoryNormaliseServiceHashId( service_id, service_hash_id )
 
-                files_info_rows.append( ( hash_id, size, mime, width, height, duration, num_frames, num_words ) )
+            return False
 
-                files_rows.append( ( hash_id, timestamp ) )
 
+        def save_progress():
 
-            self._AddFilesInfo( files_info_rows )
+            if hash_id is None:
 
-            self._AddFiles( service_id, files_rows )
+                return
 
-            num_rows = len( files_rows )
 
-            rows_processed += num_rows
+            self._c.execute( 'UPDATE ' + repository_updates_table_name + ' SET processed_rows = %s WHERE hash_id = %s;', ( rows_processed, hash_id ) )
 
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'new files' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
+            # big updates can take a long time, so we commit between chunks too, and a crash only loses the last few
 
+            if HydrusData.TimeHasPassed( self._transaction_started + 60 ):
 
+                self._Commit()
 
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
+                self._BeginImmediate()
 
-            if should_quit:
 
-                return False
 
-#
+        def split_whole_block( rows ):
 
-        for chunk in HydrusData.SplitListIntoChunks( content_update.GetDeletedFiles(), FILES_CHUNK_SIZE ):
-            
-            precise_timestamp = HydrusData.GetNowPrecise()
+            rows = list( rows )
 
-            service_hash_ids = chunk
+            if len( rows ) > 0:
 
-            hash_ids = self._CacheRepositoryNormaliseServiceHashIds( service_id, service_hash_ids )
+                yield rows
 
-            self._DeleteFiles( service_id, hash_ids )
 
-            num_rows = len( hash_ids )
 
-            rows_processed += num_rows
+        def count_rows( chunk ):
 
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'deleted files' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
+            return len( chunk )
 
 
+        def count_mappings( chunk ):
 
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
+            return sum( ( len( service_hash_ids ) for ( service_tag_id, service_hash_ids ) in chunk ) )
 
-            if should_quit:
 
-                return False
+        def add_files( chunk ):
 
-#
+            files_info_rows = []
+            files_rows = []
 
-        for chunk in HydrusData.SplitMappingListIntoChunks( content_update.GetNewMappings(), MAPPINGS_CHUNK_SIZE ):
-            
-            precise_timestamp = HydrusData.GetNowPrecise()
-
-            mappings_ids = []
-
-            num_rows = 0
-
-            for ( service_tag_id, service_hash_ids ) in chunk:
-
-                tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_tag_id )
-                hash_ids = self._CacheRepositoryNormaliseServiceHashIds( service_id, service_hash_ids )
-
-                mappings_ids.append( ( tag_id, hash_ids ) )
-
-                num_rows += len( service_hash_ids )
+            for ( service_hash_id, size, mime, timestamp, width, height, duration, num_frames, num_words ) in chunk:
 
+                hash_id = self._CacheRepositoryNormaliseServiceHashId( service_id, service_hash_id )
 
-            self._UpdateMappings( service_id, mappings_ids = mappings_ids )
+                files_info_rows.append( ( hash_id, size, mime, width, height, duration, num_frames, num_words ) )
 
-            rows_processed += num_rows
+                files_rows.append( ( hash_id, timestamp ) )
 
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'new mappings' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
 
+            self._AddFilesInfo( files_info_rows )
 
+            self._AddFiles( service_id, files_rows )
 
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
 
-            if should_quit:
+        def delete_files( chunk ):
 
-                return False
+            hash_ids = self._CacheRepositoryNormaliseServiceHashIds( service_id, chunk )
 
-#
+            self._DeleteFiles( service_id, hash_ids )
 
-        for chunk in HydrusData.SplitMappingListIntoChunks( content_update.GetDeletedMappings(), MAPPINGS_CHUNK_SIZE ):
-            
-            precise_timestamp = HydrusData.GetNowPrecise()
 
-            deleted_mappings_ids = []
+        def normalise_mappings( chunk ):
 
-            num_rows = 0
+            mappings_ids = []
 
             for ( service_tag_id, service_hash_ids ) in chunk:
 
                 tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_tag_id )
                 hash_ids = self._CacheRepositoryNormaliseServiceHashIds( service_id, service_hash_ids )
 
-                deleted_mappings_ids.append( ( tag_id, hash_ids ) )
-
-                num_rows += len( service_hash_ids )
-
-
-            self._UpdateMappings( service_id, deleted_mappings_ids = deleted_mappings_ids )
-
-            rows_processed += num_rows
-
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'deleted mappings' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
-
-
-
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
-
-            if should_quit:
-
-                return False
-
-#
-
-        for chunk in HydrusData.SplitListIntoChunks( content_update.GetNewTagParents(), NEW_TAG_PARENTS_CHUNK_SIZE ):
-            
-            precise_timestamp = HydrusData.GetNowPrecise()
-
-            parent_ids = []
-
-            for ( service_child_tag_id, service_parent_tag_id ) in chunk:
-
-                child_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_child_tag_id )
-                parent_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_parent_tag_id )
-
-                parent_ids.append( ( child_tag_id, parent_tag_id ) )
-
-
-            self._AddTagParents( service_id, parent_ids )
-
-            num_rows = len( chunk )
-
-            rows_processed += num_rows
-
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'new tag parents' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
-
-
-
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
-
-            if should_quit:
-
-                return False
-
-#
-
-        deleted_parents = content_update.GetDeletedTagParents()
-
-        if len( deleted_parents ) > 0:
-            
-            precise_timestamp = HydrusData.GetNowPrecise()
-
-            parent_ids = []
-
-            for ( service_child_tag_id, service_parent_tag_id ) in deleted_parents:
-
-                child_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_child_tag_id )
-                parent_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_parent_tag_id )
-
-                parent_ids.append( ( child_tag_id, parent_tag_id ) )
-
-
-            self._DeleteTagParents( service_id, parent_ids )
-
-            num_rows = len( deleted_parents )
-
-            rows_processed += num_rows
-
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'deleted tag parents' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
-
-
+                mappings_ids.append( ( tag_id, hash_ids ) )
 
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
 
-            if should_quit:
+            return mappings_ids
 
-                return False
 
-#
+        def add_mappings( chunk ):
 
-        new_siblings = content_update.GetNewTagSiblings()
+            self._UpdateMappingsStaged( service_id, mappings_ids = normalise_mappings( chunk ) )
 
-        if len( new_siblings ) > 0:
-            
-            precise_timestamp = HydrusData.GetNowPrecise()
 
-            sibling_ids = []
+        def delete_mappings( chunk ):
 
-            for ( service_bad_tag_id, service_good_tag_id ) in new_siblings:
+            self._UpdateMappingsStaged( service_id, deleted_mappings_ids = normalise_mappings( chunk ) )
 
-                bad_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_bad_tag_id )
-                good_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_good_tag_id )
 
-                sibling_ids.append( ( bad_tag_id, good_tag_id ) )
+        def normalise_pairs( chunk ):
 
+            return [ ( self._CacheRepositoryNormaliseServiceTagId( service_id, service_tag_id_a ), self._CacheRepositoryNormaliseServiceTagId( service_id, service_tag_id_b ) ) for ( service_tag_id_a, service_tag_id_b ) in chunk ]
 
-            self._AddTagSiblings( service_id, sibling_ids )
 
-            num_rows = len( new_siblings )
+        # each kind of row goes to its consumer as its block comes out of the update, so the update is only decoded once
 
-            rows_processed += num_rows
+        content_types_and_actions_to_consumers = {}
 
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'new tag siblings' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_FILES, HC.CONTENT_UPDATE_ADD ) ] = ( lambda rows: HydrusData.SplitIteratorIntoChunks( rows, FILES_CHUNK_SIZE ), count_rows, add_files, 'new files' )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_FILES, HC.CONTENT_UPDATE_DELETE ) ] = ( lambda rows: HydrusData.SplitIteratorIntoChunks( rows, FILES_CHUNK_SIZE ), count_rows, delete_files, 'deleted files' )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD ) ] = ( lambda rows: HydrusData.SplitMappingListIntoChunks( rows, MAPPINGS_CHUNK_SIZE ), count_mappings, add_mappings, 'new mappings' )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_DELETE ) ] = ( lambda rows: HydrusData.SplitMappingListIntoChunks( rows, MAPPINGS_CHUNK_SIZE ), count_mappings, delete_mappings, 'deleted mappings' )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_TAG_PARENTS, HC.CONTENT_UPDATE_ADD ) ] = ( lambda rows: HydrusData.SplitIteratorIntoChunks( rows, NEW_TAG_PARENTS_CHUNK_SIZE ), count_rows, lambda chunk: self._AddTagParents( service_id, normalise_pairs( chunk ) ), 'new tag parents' )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_TAG_PARENTS, HC.CONTENT_UPDATE_DELETE ) ] = ( split_whole_block, count_rows, lambda chunk: self._DeleteTagParents( service_id, normalise_pairs( chunk ) ), 'deleted tag parents' )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_TAG_SIBLINGS, HC.CONTENT_UPDATE_ADD ) ] = ( split_whole_block, count_rows, lambda chunk: self._AddTagSiblings( service_id, normalise_pairs( chunk ) ), 'new tag siblings' )
+        content_types_and_actions_to_consumers[ ( HC.CONTENT_TYPE_TAG_SIBLINGS, HC.CONTENT_UPDATE_DELETE ) ] = ( split_whole_block, count_rows, lambda chunk: self._DeleteTagSiblings( service_id, normalise_pairs( chunk ) ), 'deleted tag siblings' )
 
+        for ( content_type, action, rows ) in content_update.IterateContent():
 
+            if ( content_type, action ) not in content_types_and_actions_to_consumers:
 
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
+                continue
 
-            if should_quit:
 
-                return False
+            ( split_into_chunks, count_chunk, consume_chunk, description ) = content_types_and_actions_to_consumers[ ( content_type, action ) ]
 
-#
+            for chunk in split_into_chunks( rows ):
 
-        deleted_siblings = content_update.GetDeletedTagSiblings()
+                num_rows = count_chunk( chunk )
 
-        if len( deleted_siblings ) > 0:
-            
-            precise_timestamp = HydrusData.GetNowPrecise()
+                if skip_chunk( num_rows ):
 
-            sibling_ids = []
+                    continue
 
-            for ( service_bad_tag_id, service_good_tag_id ) in deleted_siblings:
 
-                bad_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_bad_tag_id )
-                good_tag_id = self._CacheRepositoryNormaliseServiceTagId( service_id, service_good_tag_id )
+                precise_timestamp = HydrusData.GetNowPrecise()
 
-                sibling_ids.append( ( bad_tag_id, good_tag_id ) )
+                consume_chunk( chunk )
 
+                rows_processed += num_rows
 
-            self._DeleteTagSiblings( service_id, sibling_ids )
+                report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, description )
+                job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
 
-            num_rows = len( deleted_siblings )
+                save_progress()
 
-            rows_processed += num_rows
+                ( i_paused, should_quit ) = job_key.WaitIfNeeded()
 
-            report_content_speed_to_job_key( job_key, rows_processed, total_rows, precise_timestamp, num_rows, 'deleted tag siblings' )
-            job_key.SetVariable( 'popup_gauge_2', ( rows_processed, total_rows ) )
+                if should_quit:
 
-            ( i_paused, should_quit ) = job_key.WaitIfNeeded()
+                    return False
 
-            if should_quit:
 
-                return False
 
 
-        
         return True
 
 
@@ -9677,7 +11553,7 @@ class DB( HydrusDB.HydrusDB ):
 
         service_id = self._GetServiceId( service_key )
 
-        self._c.execute( 'SELECT name FROM services WHERE service_id = %s;', ( service_id, ) ); ( name, ) = self._c.fetchone()
+        self._c.execute( 'SELECT name, service_type FROM services WHERE service_id = %s;', ( service_id, ) ); ( name, service_type ) = self._c.fetchone()
 
         repository_updates_table_name = GenerateRepositoryRepositoryUpdatesTableName( service_id )
 
@@ -9756,26 +11632,15 @@ class DB( HydrusDB.HydrusDB ):
 
                     try:
 
-                        for hash_id in definition_hash_ids:
-
+                        update_paths = [ client_files_manager.LocklessGetFilePath( update_hash, HC.APPLICATION_HYDRUS_UPDATE_DEFINITIONS ) for update_hash in self._GetHashes( definition_hash_ids ) ]
 
+                        for ( hash_id, definition_update ) in zip( definition_hash_ids, LoadRepositoryUpdates( update_paths, HC.REPOSITORY_UPDATE_LOAD_THREADS ) ):
 
                             status = 'processing ' + HydrusData.ConvertValueRangeToPrettyString( num_updates_done + 1, num_updates_to_do )
 
                             job_key.SetVariable( 'popup_text_1', status )
                             job_key.SetVariable( 'popup_gauge_1', ( num_updates_done, num_updates_to_do ) )
 
-                            update_hash = self._GetHash( hash_id )
-
-                            update_path = client_files_manager.LocklessGetFilePath( update_hash, HC.APPLICATION_HYDRUS_UPDATE_DEFINITIONS )
-
-                            with open( update_path, 'rb' ) as f:
-
-                                update_network_bytes = f.read()
-
-
-                            definition_update = HydrusSerialisable.CreateFromNetworkBytes( update_network_bytes )
-
                             precise_timestamp = HydrusData.GetNowPrecise()
 
                             self._ProcessRepositoryDefinitionUpdate( service_id, definition_update )
@@ -9841,29 +11706,66 @@ class DB( HydrusDB.HydrusDB ):
                     total_content_rows = 0
                     transaction_rows = 0
 
-                    try:
+                    # a first sync into empty mappings tables builds their secondary indexes once at the end rather than keeping them up row by row
+                    # they stay off across pauses and restarts until every update is processed, so a paused sync does not pay for a full rebuild
 
-                        for hash_id in content_hash_ids:
+                    deferred_index_table_names = []
 
+                    if service_type == HC.TAG_REPOSITORY:
 
+                        mappings_table_names = GenerateMappingsTableNames( service_id )
 
-                            status = 'processing ' + HydrusData.ConvertValueRangeToPrettyString( num_updates_done + 1, num_updates_to_do )
+                        already_deferred_table_names = self._STS( self._c.execute( 'SELECT table_name FROM deferred_indexes;' ) )
+
+                        if len( already_deferred_table_names.intersection( mappings_table_names ) ) > 0:
+
+                            deferred_index_table_names = mappings_table_names
+
+                        elif this_is_first_sync:
+
+                            tables_are_empty = True
+
+                            for table_name in mappings_table_names:
+
+                                self._c.execute( 'SELECT 1 FROM ' + table_name + ' LIMIT 1;' ); result = self._c.fetchone()
+
+                                if result is not None:
+
+                                    tables_are_empty = False
+
+                                    break
 
-                            job_key.SetVariable( 'popup_text_1', status )
-                            job_key.SetVariable( 'popup_gauge_1', ( num_updates_done, num_updates_to_do ) )
 
-                            update_hash = self._GetHash( hash_id )
 
-                            update_path = client_files_manager.LocklessGetFilePath( update_hash, HC.APPLICATION_HYDRUS_UPDATE_DEFINITIONS )
+                            if tables_are_empty:
 
-                            with open( update_path, 'rb' ) as f:
+                                job_key.SetVariable( 'popup_text_1', 'dropping indexes for the first sync' )
 
-                                update_network_bytes = f.read()
+                                self._DeferSecondaryIndexes( mappings_table_names )
 
+                                deferred_index_table_names = mappings_table_names
 
-                            content_update = HydrusSerialisable.CreateFromNetworkBytes( update_network_bytes )
 
-                            did_whole_update = self._ProcessRepositoryContentUpdate( job_key, service_id, content_update )
+
+
+                    try:
+
+                        self._c.execute( 'SELECT hash_id, processed_rows FROM ' + repository_updates_table_name + ' WHERE processed = %s AND processed_rows > 0;', ( False, ) )
+
+                        hash_ids_to_num_rows_already_processed = dict( self._c.fetchall() )
+
+                        update_paths = [ client_files_manager.LocklessGetFilePath( update_hash, HC.APPLICATION_HYDRUS_UPDATE_DEFINITIONS ) for update_hash in self._GetHashes( content_hash_ids ) ]
+
+                        for ( hash_id, content_update ) in zip( content_hash_ids, LoadRepositoryUpdates( update_paths, HC.REPOSITORY_UPDATE_LOAD_THREADS, streamed = True ) ):
+
+                            status = 'processing ' + HydrusData.ConvertValueRangeToPrettyString( num_updates_done + 1, num_updates_to_do )
+
+                            job_key.SetVariable( 'popup_text_1', status )
+                            job_key.SetVariable( 'popup_gauge_1', ( num_updates_done, num_updates_to_do ) )
+
+                            num_rows_already_processed = hash_ids_to_num_rows_already_processed.get( hash_id, 0 )
+
+                            did_whole_update = self._ProcessRepositoryContentUpdate( job_key, service_id, content_update, hash_id = hash_id, num_rows_already_processed = num_rows_already_processed )
 
                             ( i_paused, should_quit ) = job_key.WaitIfNeeded()
 
@@ -9876,7 +11778,7 @@ class DB( HydrusDB.HydrusDB ):
 
                             num_updates_done += 1
 
-                            num_rows = content_update.GetNumRows()
+                            num_rows = content_update.GetNumRows() - num_rows_already_processed
 
                             total_content_rows += num_rows
                             transaction_rows += num_rows
@@ -9904,17 +11806,30 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+                        if len( deferred_index_table_names ) > 0:
+
+                            self._c.execute( 'SELECT 1 FROM ' + repository_updates_table_name + ' WHERE processed = %s LIMIT 1;', ( False, ) ); result = self._c.fetchone()
+
+                            if result is None:
+
+                                job_key.SetVariable( 'popup_text_1', 'rebuilding indexes' )
+
+                                self._RestoreDeferredIndexes( deferred_index_table_names )
+
+
+
                     finally:
 
                         report_speed_to_log( precise_timestamp, total_content_rows, 'content rows' )
 
 
 
+
             finally:
 
                 HG.client_controller.pub( 'splash_set_status_text', 'committing' )
 
-                self._AnalyzeStaleBigTables()
+                # tables this sync grew are analyzed by the idle maintenance cycle, which notices the drift
 
                 job_key.SetVariable( 'popup_text_1', 'finished' )
                 job_key.DeleteVariable( 'popup_gauge_1' )
@@ -9955,6 +11870,7 @@ class DB( HydrusDB.HydrusDB ):
     def _Read( self, action, *args, **kwargs ):
 
         if action == 'autocomplete_predicates': result = self._GetAutocompletePredicates( *args, **kwargs )
+        elif action == 'autocomplete_subtags': result = self._GetAutocompleteSubtags( *args, **kwargs )
         elif action == 'boned_stats': result = self._GetBonedStats( *args, **kwargs )
         elif action == 'client_files_locations': result = self._GetClientFilesLocations( *args, **kwargs )
         elif action == 'downloads': result = self._GetDownloads( *args, **kwargs )
@@ -10007,7 +11923,10 @@ class DB( HydrusDB.HydrusDB ):
         elif action == 'related_tags': result = self._GetRelatedTags( *args, **kwargs )
         elif action == 'tag_censorship': result = self._GetTagCensorship( *args, **kwargs )
         elif action == 'tag_parents': result = self._GetTagParents( *args, **kwargs )
+        elif action == 'tag_parents_lookup': result = self._GetTagParentsLookup( *args, **kwargs )
         elif action == 'tag_siblings': result = self._GetTagSiblings( *args, **kwargs )
+        elif action == 'tag_siblings_lookup': result = self._GetTagSiblingsLookup( *args, **kwargs )
+        elif action == 'tag_siblings_reverse_lookup': result = self._GetTagSiblingsReverseLookup( *args, **kwargs )
         elif action == 'potential_duplicates_count': result = self._DuplicatesGetPotentialDuplicatesCount( *args, **kwargs )
         elif action == 'url_statuses': result = self._GetURLStatuses( *args, **kwargs )
         else: raise Exception( 'db received an unknown read command: ' + action )
@@ -10015,8 +11934,44 @@ class DB( HydrusDB.HydrusDB ):
         return result
 
 
+    def _RefreshCachesAfterRollback( self, caches_touched ):
+
+        # a rolled back batch may have touched these before it was undone. the small ones are just dropped, the big ones are only reloaded if the batch changed them
+
+        self._service_cache = {}
+        self._service_ids_to_service_keys_cache = None
+
+        for cache in self._GetMasterIdCaches():
+
+            cache.Clear()
+
+
+        self._file_search_result_cache.Clear()
+
+        if 'subtag_autocomplete_index' in caches_touched and self._subtag_autocomplete_index is not None:
+
+            self._subtag_autocomplete_index.Reset()
+
+
+        if 'inbox' in caches_touched:
+
+            self._inbox_hash_ids = self._STS( self._StreamSelect( 'SELECT hash_id FROM file_inbox;' ) )
+
+
+        if self._json_dump_store.RowsChangedSinceCommit():
+
+            self._LoadJSONDumpStoreIndex()
+
+
+        if 'phash_index' in caches_touched:
+
+            self._PHashesLoadIndex()
+
+
     def _RegenerateACCache( self ):
 
+        self._file_search_result_cache.Clear()
+
         job_key = ClientThreading.JobKey( cancellable = True )
 
         try:
@@ -10138,10 +12093,11 @@ class DB( HydrusDB.HydrusDB ):
 
         self._subscriptions_cache = {}
         self._service_cache = {}
+        self._service_ids_to_service_keys_cache = None
 
         self._weakref_media_result_cache = ClientCaches.MediaResultCache()
-        self._hash_ids_to_hashes_cache = {}
-        self._tag_ids_to_tags_cache = {}
+
+        self._InitMasterIdCaches()
 
         self._c.execute( 'SELECT namespace_id FROM namespaces WHERE namespace = %s;', ( '', ) ); ( self._null_namespace_id, ) = self._c.fetchone()
 
@@ -10186,11 +12142,97 @@ class DB( HydrusDB.HydrusDB ):
 
             self._controller.CallBlockingToWX( self._controller, wx.MessageBox, message )
 
-            self._c.execute( 'CREATE TABLE local_hashes ( hash_id INTEGER PRIMARY KEY, md5 varchar(255), sha1 varchar(255), sha512 varchar(255) );' )
+            self._c.execute( 'CREATE TABLE local_hashes ( hash_id INTEGER PRIMARY KEY, md5 BINARY(16), sha1 BINARY(20), sha512 BINARY(64) );' )
             self._CreateIndex( 'local_hashes', [ 'md5' ] )
             self._CreateIndex( 'local_hashes', [ 'sha1' ] )
             self._CreateIndex( 'local_hashes', [ 'sha512' ] )
 
+        # older dbs stored hashes as hex text, so convert them in place
+
+        binary_hash_columns = []
+
+        binary_hash_columns.append( ( 'hashes', 'hash', 32 ) )
+        binary_hash_columns.append( ( 'local_hashes', 'md5', 16 ) )
+        binary_hash_columns.append( ( 'local_hashes', 'sha1', 20 ) )
+        binary_hash_columns.append( ( 'local_hashes', 'sha512', 64 ) )
+        binary_hash_columns.append( ( 'shape_perceptual_hashes', 'phash', 8 ) )
+
+        for ( table_name, column_name, num_bytes ) in binary_hash_columns:
+
+            self._c.execute( 'SELECT DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s;', ( HC.MYSQL_DB, table_name, column_name ) ); result = self._c.fetchone()
+
+            if result is not None and result[0] in ( 'varchar', 'text' ):
+
+                message = 'converting ' + table_name + '.' + column_name + ' to binary'
+
+                self._controller.pub( 'splash_set_status_text', message )
+                HydrusData.Print( message )
+
+                # the hex digits survive the switch to varbinary as plain bytes, which UNHEX can then collapse
+
+                self._c.execute( 'ALTER TABLE ' + table_name + ' MODIFY ' + column_name + ' VARBINARY(255);' )
+                self._c.execute( 'UPDATE ' + table_name + ' SET ' + column_name + ' = UNHEX( ' + column_name + ' );' )
+                self._c.execute( 'ALTER TABLE ' + table_name + ' MODIFY ' + column_name + ' BINARY(' + str( num_bytes ) + ');' )
+
+
+
+        # content update progress is now saved per chunk, which older repository tables have no column for
+
+        for service_id in repository_service_ids:
+
+            repository_updates_table_name = GenerateRepositoryRepositoryUpdatesTableName( service_id )
+
+            self._c.execute( 'SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s;', ( HC.MYSQL_DB, repository_updates_table_name, 'processed_rows' ) ); result = self._c.fetchone()
+
+            if result is None:
+
+                self._c.execute( 'ALTER TABLE ' + repository_updates_table_name + ' ADD COLUMN processed_rows INTEGER DEFAULT 0;' )
+
+
+
+        # indexes dropped for a bulk load that was stopped before it could put them back
+
+        existing_tables = self._STS( self._c.execute( 'SHOW TABLES;' ) )
+
+        if 'deferred_indexes' not in existing_tables:
+
+            self._c.execute( 'CREATE TABLE deferred_indexes ( table_name VARCHAR(255), index_name VARCHAR(255), columns TEXT, is_unique BOOL, PRIMARY KEY ( table_name, index_name ) );' )
+
+
+        # a first sync that is still going keeps its mappings indexes off, and _ProcessRepositoryUpdates puts them back when it is done
+
+        mid_sync_table_names = set()
+
+        for service_id in repository_service_ids:
+
+            repository_updates_table_name = GenerateRepositoryRepositoryUpdatesTableName( service_id )
+
+            self._c.execute( 'SELECT 1 FROM ' + repository_updates_table_name + ' WHERE processed = %s LIMIT 1;', ( False, ) ); result = self._c.fetchone()
+
+            if result is not None:
+
+                mid_sync_table_names.update( GenerateMappingsTableNames( service_id ) )
+
+
+
+        deferred_table_names = self._STS( self._c.execute( 'SELECT table_name FROM deferred_indexes;' ) )
+
+        self._RestoreDeferredIndexes( deferred_table_names.difference( mid_sync_table_names ) )
+
+        # a mappings schema migration stopped part way is dropped, and starting it again copies those tables from the start
+
+        for table_name in existing_tables:
+
+            if table_name.endswith( MAPPINGS_SCHEMA_MIGRATION_SUFFIX ):
+
+                self._DropMappingsSchemaMigrationTable( table_name[ : - len( MAPPINGS_SCHEMA_MIGRATION_SUFFIX ) ] )
+
+            elif table_name.endswith( MAPPINGS_SCHEMA_MIGRATION_OLD_SUFFIX ):
+
+                self._c.execute( 'DROP TABLE ' + table_name + ';' )
+
+
+
         # mappings
 
         existing_mapping_tables = self._STS( self._c.execute( 'show tables in hydrus;' ) )
@@ -10291,9 +12333,64 @@ class DB( HydrusDB.HydrusDB ):
 
             self._controller.CallBlockingToWX( self._controller, wx.MessageBox, message )
             self._RegenerateACCache()
+
+
+        # sibling and parent closures are new, so older dbs build them here. they are just derived from the pairs
+
+        for table_name in ( 'tag_siblings', 'tag_sibling_petitions' ):
+
+            self._c.execute( 'SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s;', ( HC.MYSQL_DB, table_name, 'good_tag_id' ) ); result = self._c.fetchone()
+
+            if result is None:
+
+                self._CreateIndex( table_name, [ 'good_tag_id' ] )
+
+
+
+        existing_cache_tables = self._STS( self._c.execute( 'show tables in hydrus;' ) )
+
+        for service_id in tag_service_ids + [ self._combined_tag_service_id ]:
+
+            if GenerateTagSiblingClosureTableName( service_id ) not in existing_cache_tables or GenerateTagParentClosureTableName( service_id ) not in existing_cache_tables:
+
+                message = 'generating tag sibling and parent closures'
+
+                self._controller.pub( 'splash_set_status_text', message )
+                HydrusData.Print( message )
+
+                self._CacheTagClosuresDrop( service_id )
+
+                self._CacheTagClosuresGenerate( service_id )
+
+                self._CacheTagSiblingsClosureRegenerate( service_id )
+                self._CacheTagParentsClosureRegenerate( service_id )
+
+
             
         
 
+    def _ReportCacheStats( self ):
+
+        for cache in self._GetMasterIdCaches():
+
+            ( num_cached, max_size, num_hits, num_misses ) = cache.GetStats()
+
+            num_lookups = num_hits + num_misses
+
+            hit_rate = num_hits / num_lookups if num_lookups > 0 else 0.0
+
+            HydrusData.Print( cache.GetName() + ' cache: ' + HydrusData.ConvertValueRangeToPrettyString( num_cached, max_size ) + ' cached, ' + HydrusData.ConvertFloatToPercentage( hit_rate ) + ' hit rate over ' + HydrusData.ToHumanInt( num_lookups ) + ' lookups' )
+
+
+        ( num_searches, num_ids, max_num_ids, num_hits, num_misses ) = self._file_search_result_cache.GetStats()
+
+        num_lookups = num_hits + num_misses
+
+        hit_rate = num_hits / num_lookups if num_lookups > 0 else 0.0
+
+        HydrusData.Print( 'file search result cache: ' + HydrusData.ToHumanInt( num_searches ) + ' searches holding ' + HydrusData.ConvertValueRangeToPrettyString( num_ids, max_num_ids ) + ' file ids, ' + HydrusData.ConvertFloatToPercentage( hit_rate ) + ' hit rate over ' + HydrusData.ToHumanInt( num_lookups ) + ' searches' )
+
+
     def _ReportOverupdatedDB( self, version ):
 
         def wx_code():
@@ -10320,6 +12417,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._BeginImmediate()
 
+        self._file_search_result_cache.Clear()
+
         ( service_key, service_type, name, dictionary ) = service.ToTuple()
 
         service_id = self._GetServiceId( service_key )
@@ -10357,72 +12456,198 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
-    def _SaveDirtyServices( self, dirty_services ):
+    def _RestoreDeferredIndexes( self, table_names = None ):
 
-        # if allowed to save objects
+        self._c.execute( 'SELECT table_name, index_name, columns, is_unique FROM deferred_indexes;' )
 
-        self._SaveServices( dirty_services )
+        table_names_to_indexes = HydrusData.BuildKeyToListDict( ( table_name, ( index_name, columns, is_unique ) ) for ( table_name, index_name, columns, is_unique ) in self._c.fetchall() )
 
+        if table_names is not None:
 
-    def _SaveServices( self, services ):
+            table_names_to_indexes = { table_name : indexes for ( table_name, indexes ) in table_names_to_indexes.items() if table_name in table_names }
 
-        for service in services:
 
-            ( service_key, service_type, name, dictionary ) = service.ToTuple()
+        if len( table_names_to_indexes ) == 0:
 
-            dictionary_string = dictionary.DumpToString()
-            dictionary_string = self._SaveNamedDump(dictionary_string, json_dump=False)
+            return
 
-            self._c.execute( 'UPDATE services SET dictionary_string = %s WHERE service_key = %s;', ( dictionary_string, binascii.b2a_hex(service_key)  ) )
 
-            service.SetClean()
+        self._Commit()
 
+        try:
 
+            existing_table_names = self._STS( self._c.execute( 'SHOW TABLES;' ) )
 
-    def _SaveOptions( self, options ):
-        options = dict(options)
+            for ( table_name, indexes ) in table_names_to_indexes.items():
 
-        self._c.execute( 'UPDATE options SET options = %s;', ( yaml.safe_dump(options), ) )
+                # a table deleted in the meantime, say with its service, needs nothing put back
 
-        self.pub_after_job( 'clear_all_thumbnails' )
-        self.pub_after_job( 'notify_new_options' )
+                if table_name in existing_table_names:
 
+                    message = 'rebuilding indexes on ' + table_name
 
-    def _SetIdealClientFilesLocations( self, locations_to_ideal_weights, ideal_thumbnail_override_location ):
+                    self._controller.pub( 'splash_set_status_text', message )
+                    HydrusData.Print( message )
 
-        if len( locations_to_ideal_weights ) == 0:
+                    clauses = [ ( 'ADD UNIQUE INDEX ' if is_unique else 'ADD INDEX ' ) + index_name + ' ( ' + columns + ' )' for ( index_name, columns, is_unique ) in indexes ]
 
-            raise Exception( 'No locations passed in ideal locations list!' )
+                    # one ALTER, so the table is read once for all its indexes
 
+                    self._c.execute( 'ALTER TABLE ' + table_name + ' ' + ', '.join( clauses ) + ';' )
 
-        self._c.execute( 'DELETE FROM ideal_client_files_locations;' )
 
-        for ( abs_location, weight ) in locations_to_ideal_weights.items():
+                self._c.execute( 'DELETE FROM deferred_indexes WHERE table_name = %s;', ( table_name, ) )
 
-            portable_location = HydrusPaths.ConvertAbsPathToPortablePath( abs_location )
+                self._Commit()
 
-            self._c.execute( 'INSERT INTO ideal_client_files_locations ( location, weight ) VALUES ( %s, %s );', ( portable_location, weight ) )
 
+        finally:
 
-        self._c.execute( 'DELETE FROM ideal_thumbnail_override_location;' )
+            self._BeginImmediate()
 
-        if ideal_thumbnail_override_location is not None:
 
-            portable_ideal_thumbnail_override_location = HydrusPaths.ConvertAbsPathToPortablePath( ideal_thumbnail_override_location )
 
-            self._c.execute( 'INSERT INTO ideal_thumbnail_override_location ( location ) VALUES ( %s );', ( portable_ideal_thumbnail_override_location, ) )
+    def _RunTableMaintenance( self, statement_phrase, description, table_names, maintenance_mode, stop_time ):
 
+        job_key = ClientThreading.JobKey( cancellable = True, maintenance_mode = maintenance_mode, stop_time = stop_time )
 
+        job_key.SetVariable( 'popup_title', 'database maintenance - ' + description )
 
-    def _SetJSONDump( self, obj ):
+        self._controller.pub( 'modal_message', job_key )
 
-        if isinstance( obj, HydrusSerialisable.SerialisableBaseNamed ):
+        def should_stop():
 
-            ( dump_type, dump_name, version, serialisable_info ) = obj.GetSerialisableTuple()
+            return self._controller.ShouldStopThisWork( maintenance_mode, stop_time = stop_time ) or job_key.IsCancelled()
 
-            try:
 
-                dump = self._SaveNamedDump( serialisable_info )
+        def text_update_hook( text ):
+
+            self._controller.pub( 'splash_set_status_text', text, print_to_log = False )
+
+            job_key.SetVariable( 'popup_text_1', text )
+
+
+        # the other connections would wait on any locks an open batch holds on their tables, while this thread waits on them
+
+        self._Commit()
+
+        try:
+
+            done_table_names = HydrusDB.RunTableMaintenanceInParallel( statement_phrase, table_names, HC.MAINTENANCE_CONNECTIONS, should_stop, text_update_hook = text_update_hook )
+
+            job_key.SetVariable( 'popup_text_1', description + ' done: ' + HydrusData.ConvertValueRangeToPrettyString( len( done_table_names ), len( table_names ) ) + ' tables' )
+
+            HydrusData.Print( job_key.ToString() )
+
+        finally:
+
+            self._BeginImmediate()
+
+            job_key.Finish()
+
+            job_key.Delete( 10 )
+
+
+        return done_table_names
+
+
+    def _SaveDirtyServices( self, dirty_services ):
+
+        # if allowed to save objects
+
+        self._SaveServices( dirty_services )
+
+
+    def _SaveServices( self, services ):
+
+        for service in services:
+
+            ( service_key, service_type, name, dictionary ) = service.ToTuple()
+
+            dictionary_string = dictionary.DumpToString()
+            dictionary_string = self._SaveNamedDump(dictionary_string, json_dump=False)
+
+            self._c.execute( 'UPDATE services SET dictionary_string = %s WHERE service_key = %s;', ( dictionary_string, binascii.b2a_hex(service_key)  ) )
+
+            self._json_dump_store.SetRow( ( 'services', self._GetServiceId( service_key ) ), dictionary_string )
+
+            service.SetClean()
+
+
+
+    def _SaveOptions( self, options ):
+        options = dict(options)
+
+        self._c.execute( 'UPDATE options SET options = %s;', ( yaml.safe_dump(options), ) )
+
+        self.pub_after_job( 'clear_all_thumbnails' )
+        self.pub_after_job( 'notify_new_options' )
+
+
+    def _SaveTableMaintenanceTimestamps( self, timestamps_table_name, table_names ):
+
+        if len( table_names ) == 0:
+
+            return
+
+
+        now = HydrusData.GetNow()
+
+        self._c.executemany( 'DELETE FROM ' + timestamps_table_name + ' WHERE name = %s;', [ ( name, ) for name in table_names ] )
+
+        if timestamps_table_name == 'analyze_timestamps':
+
+            # recorded against the row count as it is now, so the next drift check starts from here
+
+            table_names_to_num_rows = self._GetTableNamesToEstimatedNumRows()
+
+            self._c.executemany( 'INSERT INTO analyze_timestamps ( name, num_rows, timestamp ) VALUES ( %s, %s, %s );', [ ( name, table_names_to_num_rows.get( name, 0 ), now ) for name in table_names ] )
+
+        else:
+
+            self._c.executemany( 'INSERT INTO ' + timestamps_table_name + ' ( name, timestamp ) VALUES ( %s, %s );', [ ( name, now ) for name in table_names ] )
+
+
+
+    def _SetIdealClientFilesLocations( self, locations_to_ideal_weights, ideal_thumbnail_override_location ):
+
+        if len( locations_to_ideal_weights ) == 0:
+
+            raise Exception( 'No locations passed in ideal locations list!' )
+
+
+        self._c.execute( 'DELETE FROM ideal_client_files_locations;' )
+
+        for ( abs_location, weight ) in locations_to_ideal_weights.items():
+
+            portable_location = HydrusPaths.ConvertAbsPathToPortablePath( abs_location )
+
+            self._c.execute( 'INSERT INTO ideal_client_files_locations ( location, weight ) VALUES ( %s, %s );', ( portable_location, weight ) )
+
+
+        self._c.execute( 'DELETE FROM ideal_thumbnail_override_location;' )
+
+        if ideal_thumbnail_override_location is not None:
+
+            portable_ideal_thumbnail_override_location = HydrusPaths.ConvertAbsPathToPortablePath( ideal_thumbnail_override_location )
+
+            self._c.execute( 'INSERT INTO ideal_thumbnail_override_location ( location ) VALUES ( %s );', ( portable_ideal_thumbnail_override_location, ) )
+
+
+
+    def _SetJSONDump( self, obj ):
+
+        if isinstance( obj, HydrusSerialisable.SerialisableBaseNamed ):
+
+            ( dump_type, dump_name, version, serialisable_info ) = obj.GetSerialisableTuple()
+
+            # a session's pages are stored one blob each, so a save only writes the pages that changed
+
+            split = dump_type == HydrusSerialisable.SERIALISABLE_TYPE_GUI_SESSION
+
+            try:
+
+                dump = self._SaveNamedDump( serialisable_info, split = split )
 
             except Exception as e:
 
@@ -10453,13 +12678,24 @@ class DB( HydrusDB.HydrusDB ):
 
                     self._c.executemany( 'DELETE FROM json_dumps_named WHERE dump_type = %s AND dump_name = %s AND timestamp = %s;', [ ( dump_type, dump_name, timestamp ) for timestamp in deletee_timestamps ] )
 
+                    for timestamp in deletee_timestamps:
+
+                        self._json_dump_store.DeleteRows( ( 'json_dumps_named', dump_type, dump_name, timestamp ) )
+
+
 
             else:
 
                 self._c.execute( 'DELETE FROM json_dumps_named WHERE dump_type = %s AND dump_name = %s;', ( dump_type, dump_name ) )
 
+                self._json_dump_store.DeleteRows( ( 'json_dumps_named', dump_type, dump_name ) )
+
+
+            timestamp = HydrusData.GetNow()
+
+            self._c.execute( 'INSERT INTO json_dumps_named ( dump_type, dump_name, version, timestamp, dump ) VALUES ( %s, %s, %s, %s, %s );', ( dump_type, dump_name, version, timestamp,  dump))
 
-            self._c.execute( 'INSERT INTO json_dumps_named ( dump_type, dump_name, version, timestamp, dump ) VALUES ( %s, %s, %s, %s, %s );', ( dump_type, dump_name, version, HydrusData.GetNow(),  dump))
+            self._json_dump_store.SetRow( ( 'json_dumps_named', dump_type, dump_name, timestamp ), dump )
 
         else:
 
@@ -10482,6 +12718,8 @@ class DB( HydrusDB.HydrusDB ):
 
             self._c.execute( 'INSERT INTO json_dumps ( dump_type, version, dump ) VALUES ( %s, %s, %s );', ( dump_type, version, dump ))
 
+            self._json_dump_store.SetRow( ( 'json_dumps', dump_type ), dump )
+
 
 
     def _SetJSONSimple( self, name, value ):
@@ -10634,6 +12872,50 @@ class DB( HydrusDB.HydrusDB ):
 
 
 
+    def _StartMappingsSchemaMigrationTable( self, table_name, primary_key_columns, has_reason_id ):
+
+        # the new table gets every write to the old one through triggers, so the copy can run beside the writer and still end up complete
+
+        migration_table_name = table_name + MAPPINGS_SCHEMA_MIGRATION_SUFFIX
+
+        column_names = [ 'tag_id', 'hash_id' ]
+
+        if has_reason_id:
+
+            column_names.append( 'reason_id' )
+
+
+        columns_phrase = ', '.join( column_names )
+        new_values_phrase = ', '.join( 'NEW.' + column_name for column_name in column_names )
+        old_key_phrase = 'tag_id = OLD.tag_id AND hash_id = OLD.hash_id'
+
+        self._Commit()
+
+        try:
+
+            existing_table_names = self._STS( self._c.execute( 'SHOW TABLES;' ) )
+
+            if table_name not in existing_table_names:
+
+                return None
+
+
+            self._DropMappingsSchemaMigrationTable( table_name )
+
+            self._c.execute( GenerateMappingsTableCreateStatement( table_name, primary_key_columns, has_reason_id = has_reason_id, create_as = migration_table_name ) )
+
+            self._c.execute( 'CREATE TRIGGER ' + table_name + '_migration_insert AFTER INSERT ON ' + table_name + ' FOR EACH ROW REPLACE INTO ' + migration_table_name + ' ( ' + columns_phrase + ' ) VALUES ( ' + new_values_phrase + ' );' )
+            self._c.execute( 'CREATE TRIGGER ' + table_name + '_migration_update AFTER UPDATE ON ' + table_name + ' FOR EACH ROW BEGIN DELETE FROM ' + migration_table_name + ' WHERE ' + old_key_phrase + '; REPLACE INTO ' + migration_table_name + ' ( ' + columns_phrase + ' ) VALUES ( ' + new_values_phrase + ' ); END;' )
+            self._c.execute( 'CREATE TRIGGER ' + table_name + '_migration_delete AFTER DELETE ON ' + table_name + ' FOR EACH ROW DELETE FROM ' + migration_table_name + ' WHERE ' + old_key_phrase + ';' )
+
+        finally:
+
+            self._BeginImmediate()
+
+
+        return column_names
+
+
     def _SyncHashesToTagArchive( self, hashes, hta_path, tag_service_key, adding, namespaces ):
 
         hta = HydrusTagArchive.HydrusTagArchive( hta_path )
@@ -10656,7 +12938,7 @@ class DB( HydrusDB.HydrusDB ):
                 try: self._c.execute( 'SELECT ' + h + ' FROM local_hashes WHERE hash_id = %s;', ( hash_id, ) ); ( archive_hash, ) = self._c.fetchone()
                 except: return
 
-            archive_hash = binascii.a2b_hex(archive_hash)
+            archive_hash = bytes( archive_hash )
             tags = HydrusTags.CleanTags( hta.GetTags( archive_hash ) )
 
             desired_tags = HydrusTags.FilterNamespaces( tags, namespaces )
@@ -11017,7 +13299,7 @@ class DB( HydrusDB.HydrusDB ):
 
                     ( cache_files_table_name, cache_current_mappings_table_name, cache_deleted_mappings_table_name, cache_pending_mappings_table_name, ac_cache_table_name ) = GenerateSpecificMappingsCacheTableNames( combined_local_file_service_id, tag_service_id )
 
-                    service_tag_ids = self._STL( self._c.execute( 'SELECT tag_id FROM ' + ac_cache_table_name + ' WHERE current_count > 0;' ) )
+                    service_tag_ids = self._STL( self._StreamSelect( 'SELECT tag_id FROM ' + ac_cache_table_name + ' WHERE current_count > 0;' ) )
 
                     tag_ids.update( service_tag_ids )
 
@@ -11026,15 +13308,16 @@ class DB( HydrusDB.HydrusDB ):
 
                 i = 0
 
-                self._tag_ids_to_tags_cache = {}
+                self._tag_ids_to_tags_cache.Clear()
+                self._tags_to_tag_ids_cache.Clear()
 
                 for block_of_tag_ids in HydrusData.SplitListIntoChunks( tag_ids, 1000 ):
 
                     self._controller.pub( 'splash_set_status_subtext', 'generating new local tag cache: {}'.format( HydrusData.ConvertValueRangeToPrettyString( i, num_to_do ) ) )
 
-                    self._PopulateTagIdsToTagsCache( block_of_tag_ids )
+                    tag_ids_to_tags = self._PopulateTagIdsToTagsCache( block_of_tag_ids )
 
-                    self._c.executemany( 'INSERT IGNORE INTO local_tags_cache ( tag_id, tag ) VALUES ( %s,%s );', ( ( tag_id, self._tag_ids_to_tags_cache[ tag_id ] ) for tag_id in block_of_tag_ids ) )
+                    self._c.executemany( 'INSERT IGNORE INTO local_tags_cache ( tag_id, tag ) VALUES ( %s,%s );', ( ( tag_id, tag_ids_to_tags[ tag_id ] ) for tag_id in block_of_tag_ids ) )
 
                     i += 1000
 
@@ -11198,6 +13481,11 @@ class DB( HydrusDB.HydrusDB ):
         tag_ids_to_search_for = tag_ids_being_added.union( tag_ids_being_removed )
         hash_ids_to_search_for = hash_ids_being_added.union( hash_ids_being_removed )
 
+        if len( tag_ids_to_search_for ) > 0:
+
+            self._InvalidateFileSearchResultsForMappings( tag_service_id, tag_ids_to_search_for )
+
+
         random_uuid = str(uuid.uuid4()).replace('-','_')
         temp_tag_ids_name = "temp_tag_ids_" + random_uuid
         temp_hash_ids_name = "temp_hash_ids_" + random_uuid
@@ -11380,6 +13668,158 @@ class DB( HydrusDB.HydrusDB ):
         if len( service_info_updates ) > 0: self._c.executemany( 'UPDATE service_info SET info = info + %s WHERE service_id = %s AND info_type = %s;', service_info_updates )
 
 
+    def _UpdateMappingsStaged( self, tag_service_id, mappings_ids = None, deleted_mappings_ids = None ):
+
+        # repository processing's version of _UpdateMappings. each side of the chunk goes into one staged table and moves with set-based statements, rather than several executemanys per tag
+
+        ( current_mappings_table_name, deleted_mappings_table_name, pending_mappings_table_name, petitioned_mappings_table_name ) = GenerateMappingsTableNames( tag_service_id )
+
+        if mappings_ids is None: mappings_ids = []
+        if deleted_mappings_ids is None: deleted_mappings_ids = []
+
+        file_service_ids = self._GetServiceIds( HC.AUTOCOMPLETE_CACHE_SPECIFIC_FILE_SERVICES )
+
+        change_in_num_mappings = 0
+        change_in_num_deleted_mappings = 0
+        change_in_num_pending_mappings = 0
+        change_in_num_petitioned_mappings = 0
+        change_in_num_tags = 0
+        change_in_num_files = 0
+
+        tag_ids_to_search_for = { tag_id for ( tag_id, hash_ids ) in itertools.chain( mappings_ids, deleted_mappings_ids ) }
+
+        if len( tag_ids_to_search_for ) > 0:
+
+            self._InvalidateFileSearchResultsForMappings( tag_service_id, tag_ids_to_search_for )
+
+
+        combined_files_current_counter = collections.Counter()
+        combined_files_pending_counter = collections.Counter()
+
+        if len( mappings_ids ) > 0:
+
+            staged_mappings = ( ( tag_id, hash_id ) for ( tag_id, hash_ids ) in mappings_ids for hash_id in hash_ids )
+
+            with HydrusDB.TemporaryIntegerPairTable( self._c, staged_mappings, ( 'tag_id', 'hash_id' ) ) as staged_mappings_table_name:
+
+                self._c.execute( 'SELECT COUNT( * ) FROM ( SELECT DISTINCT tag_id FROM ' + staged_mappings_table_name + ' ) AS staged WHERE NOT EXISTS ( SELECT 1 FROM ' + current_mappings_table_name + ' WHERE tag_id = staged.tag_id );' )
+
+                ( num_tags_added, ) = self._c.fetchone()
+
+                self._c.execute( 'SELECT COUNT( * ) FROM ( SELECT DISTINCT hash_id FROM ' + staged_mappings_table_name + ' ) AS staged WHERE NOT EXISTS ( SELECT 1 FROM ' + current_mappings_table_name + ' WHERE hash_id = staged.hash_id );' )
+
+                ( num_files_added, ) = self._c.fetchone()
+
+                change_in_num_tags += num_tags_added
+                change_in_num_files += num_files_added
+
+                self._c.execute( 'SELECT tag_id, COUNT( * ) FROM ' + staged_mappings_table_name + ' NATURAL JOIN ' + pending_mappings_table_name + ' GROUP BY tag_id;' )
+
+                for ( tag_id, num_pending_deleted ) in self._c.fetchall():
+
+                    combined_files_pending_counter[ tag_id ] -= num_pending_deleted
+
+
+                self._c.execute( 'SELECT tag_id, COUNT( * ) FROM ' + staged_mappings_table_name + ' AS staged WHERE NOT EXISTS ( SELECT 1 FROM ' + current_mappings_table_name + ' AS mappings WHERE mappings.tag_id = staged.tag_id AND mappings.hash_id = staged.hash_id ) GROUP BY tag_id;' )
+
+                for ( tag_id, num_current_inserted ) in self._c.fetchall():
+
+                    combined_files_current_counter[ tag_id ] += num_current_inserted
+
+
+                self._c.execute( 'DELETE mappings FROM ' + deleted_mappings_table_name + ' AS mappings NATURAL JOIN ' + staged_mappings_table_name + ';' )
+
+                change_in_num_deleted_mappings -= self._GetRowCount()
+
+                self._c.execute( 'DELETE mappings FROM ' + pending_mappings_table_name + ' AS mappings NATURAL JOIN ' + staged_mappings_table_name + ';' )
+
+                change_in_num_pending_mappings -= self._GetRowCount()
+
+                self._c.execute( 'INSERT IGNORE INTO ' + current_mappings_table_name + ' ( tag_id, hash_id ) SELECT tag_id, hash_id FROM ' + staged_mappings_table_name + ';' )
+
+                change_in_num_mappings += self._GetRowCount()
+
+                for file_service_id in file_service_ids:
+
+                    self._CacheSpecificMappingsAddMappingsStaged( file_service_id, tag_service_id, staged_mappings_table_name )
+
+
+
+
+        if len( deleted_mappings_ids ) > 0:
+
+            staged_mappings = ( ( tag_id, hash_id ) for ( tag_id, hash_ids ) in deleted_mappings_ids for hash_id in hash_ids )
+
+            with HydrusDB.TemporaryIntegerPairTable( self._c, staged_mappings, ( 'tag_id', 'hash_id' ) ) as staged_mappings_table_name:
+
+                self._c.execute( 'SELECT tag_id, COUNT( * ) FROM ' + staged_mappings_table_name + ' NATURAL JOIN ' + current_mappings_table_name + ' GROUP BY tag_id;' )
+
+                tag_ids_to_num_current_deleted = dict( self._c.fetchall() )
+
+                for ( tag_id, num_current_deleted ) in tag_ids_to_num_current_deleted.items():
+
+                    combined_files_current_counter[ tag_id ] -= num_current_deleted
+
+
+                hash_ids_losing_mappings = self._STS( self._c.execute( 'SELECT DISTINCT hash_id FROM ' + staged_mappings_table_name + ' NATURAL JOIN ' + current_mappings_table_name + ';' ) )
+
+                self._c.execute( 'DELETE mappings FROM ' + current_mappings_table_name + ' AS mappings NATURAL JOIN ' + staged_mappings_table_name + ';' )
+
+                change_in_num_mappings -= self._GetRowCount()
+
+                self._c.execute( 'DELETE mappings FROM ' + petitioned_mappings_table_name + ' AS mappings NATURAL JOIN ' + staged_mappings_table_name + ';' )
+
+                change_in_num_petitioned_mappings -= self._GetRowCount()
+
+                self._c.execute( 'INSERT IGNORE INTO ' + deleted_mappings_table_name + ' ( tag_id, hash_id ) SELECT tag_id, hash_id FROM ' + staged_mappings_table_name + ';' )
+
+                change_in_num_deleted_mappings += self._GetRowCount()
+
+                for file_service_id in file_service_ids:
+
+                    self._CacheSpecificMappingsDeleteMappingsStaged( file_service_id, tag_service_id, staged_mappings_table_name )
+
+
+
+            # a tag or file only leaves the service if it lost its last mapping here
+
+            with HydrusDB.TemporaryIntegerTable( self._c, tag_ids_to_num_current_deleted.keys(), 'tag_id' ) as temp_tag_ids_table_name:
+
+                self._c.execute( 'SELECT COUNT( * ) FROM ' + temp_tag_ids_table_name + ' AS losing WHERE NOT EXISTS ( SELECT 1 FROM ' + current_mappings_table_name + ' WHERE tag_id = losing.tag_id );' )
+
+                ( num_tags_removed, ) = self._c.fetchone()
+
+
+            with HydrusDB.TemporaryIntegerTable( self._c, hash_ids_losing_mappings, 'hash_id' ) as temp_hash_ids_table_name:
+
+                self._c.execute( 'SELECT COUNT( * ) FROM ' + temp_hash_ids_table_name + ' AS losing WHERE NOT EXISTS ( SELECT 1 FROM ' + current_mappings_table_name + ' WHERE hash_id = losing.hash_id );' )
+
+                ( num_files_removed, ) = self._c.fetchone()
+
+
+            change_in_num_tags -= num_tags_removed
+            change_in_num_files -= num_files_removed
+
+
+        combined_files_seen_ids = set( ( key for ( key, value ) in list(combined_files_current_counter.items()) if value != 0 ) )
+        combined_files_seen_ids.update( ( key for ( key, value ) in list(combined_files_pending_counter.items()) if value != 0 ) )
+
+        combined_files_counts = [ ( tag_id, combined_files_current_counter[ tag_id ], combined_files_pending_counter[ tag_id ] ) for tag_id in combined_files_seen_ids ]
+
+        self._CacheCombinedFilesMappingsUpdate( tag_service_id, combined_files_counts )
+
+        service_info_updates = []
+
+        if change_in_num_mappings != 0: service_info_updates.append( ( change_in_num_mappings, tag_service_id, HC.SERVICE_INFO_NUM_MAPPINGS ) )
+        if change_in_num_deleted_mappings != 0: service_info_updates.append( ( change_in_num_deleted_mappings, tag_service_id, HC.SERVICE_INFO_NUM_DELETED_MAPPINGS ) )
+        if change_in_num_pending_mappings != 0: service_info_updates.append( ( change_in_num_pending_mappings, tag_service_id, HC.SERVICE_INFO_NUM_PENDING_MAPPINGS ) )
+        if change_in_num_petitioned_mappings != 0: service_info_updates.append( ( change_in_num_petitioned_mappings, tag_service_id, HC.SERVICE_INFO_NUM_PETITIONED_MAPPINGS ) )
+        if change_in_num_tags != 0: service_info_updates.append( ( change_in_num_tags, tag_service_id, HC.SERVICE_INFO_NUM_TAGS ) )
+        if change_in_num_files != 0: service_info_updates.append( ( change_in_num_files, tag_service_id, HC.SERVICE_INFO_NUM_FILES ) )
+
+        if len( service_info_updates ) > 0: self._c.executemany( 'UPDATE service_info SET info = info + %s WHERE service_id = %s AND info_type = %s;', service_info_updates )
+
+
     def _UpdateServerServices( self, admin_service_key, serverside_services, service_keys_to_access_keys, deletee_service_keys ):
 
         admin_service_id = self._GetServiceId( admin_service_key )
@@ -11533,6 +13973,8 @@ class DB( HydrusDB.HydrusDB ):
 
         self._c.execute( 'UPDATE services SET name = %s, dictionary_string = %s WHERE service_id = %s;', ( name, dictionary_string, service_id ) )
 
+        self._json_dump_store.SetRow( ( 'services', service_id ), dictionary_string )
+
         if service_id in self._service_cache:
 
             del self._service_cache[ service_id ]
@@ -11585,14 +14027,26 @@ class DB( HydrusDB.HydrusDB ):
         self._InitDBCursor(started=True)
 
 
-    def _Vacuum( self, stop_time = None, force_vacuum = False ):
-        pass
+    def _Vacuum( self, maintenance_mode = HC.MAINTENANCE_FORCED, stop_time = None, force_vacuum = False ):
+
+        # there is no whole-database vacuum here. OPTIMIZE rebuilds one table at a time, and tables are independent, so several go at once
+
+        names_to_vacuum = self._GetTableNamesToVacuum( force_vacuum = force_vacuum )
+
+        if len( names_to_vacuum ) > 0:
+
+            done_names = self._RunTableMaintenance( 'OPTIMIZE TABLE', 'optimizing', names_to_vacuum, maintenance_mode, stop_time )
+
+            self._SaveTableMaintenanceTimestamps( 'vacuum_timestamps', done_names )
+
+
 
     def _Write( self, action, *args, **kwargs ):
 
         result = None
 
-        if action == 'analyze': self._AnalyzeStaleBigTables( *args, **kwargs )
+        if action == 'abandon_mappings_schema_migration_table': self._AbandonMappingsSchemaMigrationTable( *args, **kwargs )
+        elif action == 'analyze': self._AnalyzeStaleBigTables( *args, **kwargs )
         elif action == 'associate_repository_update_hashes': self._AssociateRepositoryUpdateHashes( *args, **kwargs )
         elif action == 'backup': self._Backup( *args, **kwargs )
         elif action == 'clear_orphan_file_records': self._ClearOrphanFileRecords( *args, **kwargs )
@@ -11613,6 +14067,7 @@ class DB( HydrusDB.HydrusDB ):
         elif action == 'file_integrity': self._CheckFileIntegrity( *args, **kwargs )
         elif action == 'file_maintenance_add_jobs': self._FileMaintenanceAddJobs( *args, **kwargs )
         elif action == 'file_maintenance_clear_jobs': self._FileMaintenanceClearJobs( *args, **kwargs )
+        elif action == 'finish_mappings_schema_migration_table': self._FinishMappingsSchemaMigrationTable( *args, **kwargs )
         elif action == 'imageboard': self._SetYAMLDump( YAML_DUMP_ID_IMAGEBOARD, *args, **kwargs )
         elif action == 'ideal_client_files_locations': self._SetIdealClientFilesLocations( *args, **kwargs )
         elif action == 'import_file': result = self._ImportFile( *args, **kwargs )
@@ -11622,6 +14077,7 @@ class DB( HydrusDB.HydrusDB ):
         elif action == 'maintain_similar_files_search_for_potential_duplicates': self._PHashesSearchForPotentialDuplicates( *args, **kwargs )
         elif action == 'maintain_similar_files_phashes': self._PHashesMaintainFiles( *args, **kwargs )
         elif action == 'maintain_similar_files_tree': self._PHashesMaintainTree( *args, **kwargs )
+        elif action == 'migrate_mappings_schema': self._MigrateMappingsSchema( *args, **kwargs )
         elif action == 'process_repository': result = self._ProcessRepositoryUpdates( *args, **kwargs )
         elif action == 'push_recent_tags': self._PushRecentTags( *args, **kwargs )
         elif action == 'regenerate_ac_cache': self._RegenerateACCache( *args, **kwargs )
@@ -11635,6 +14091,7 @@ class DB( HydrusDB.HydrusDB ):
         elif action == 'serialisable': self._SetJSONDump( *args, **kwargs )
         elif action == 'serialisables_overwrite': self._OverwriteJSONDumps( *args, **kwargs )
         elif action == 'set_password': self._SetPassword( *args, **kwargs )
+        elif action == 'start_mappings_schema_migration_table': result = self._StartMappingsSchemaMigrationTable( *args, **kwargs )
         elif action == 'sync_hashes_to_tag_archive': self._SyncHashesToTagArchive( *args, **kwargs )
         elif action == 'tag_censorship': self._SetTagCensorship( *args, **kwargs )
         elif action == 'update_server_services': self._UpdateServerServices( *args, **kwargs )
@@ -11673,4 +14130,369 @@ class DB( HydrusDB.HydrusDB ):
 
 
     def RestoreBackup( self, path ):
-        pass
+
+        # the db loop has finished, so nothing else is talking to the db
+
+        with open( os.path.join( path, 'db', 'manifest.json' ), 'r', encoding = 'utf-8' ) as f:
+
+            manifest = json.load( f )
+
+
+        # the last session's media results describe the db being replaced
+
+        ClientCaches.MediaResultSnapshot.STATICDelete( os.path.join( self._db_dir, ClientCaches.MEDIA_RESULT_SNAPSHOT_FILENAME ) )
+
+        HG.client_controller.pub( 'splash_set_status_text', 'restoring db tables' )
+
+        connection = HydrusDB.GetStandaloneConnection( database = None )
+
+        try:
+
+            cursor = connection.cursor()
+
+            cursor.execute( 'DROP DATABASE IF EXISTS ' + HC.MYSQL_DB + ';' )
+            cursor.execute( 'CREATE DATABASE ' + HC.MYSQL_DB + ';' )
+            cursor.execute( 'USE ' + HC.MYSQL_DB + ';' )
+
+            for table in manifest[ 'tables' ]:
+
+                cursor.execute( table[ 'create_statement' ] )
+
+
+        finally:
+
+            connection.close()
+
+
+        connections = queue.Queue()
+
+        for i in range( HC.BACKUP_CONNECTIONS ):
+
+            connection = HydrusDB.GetStandaloneConnection( allow_local_infile = True )
+
+            connection.autocommit = True
+
+            connection.cursor().execute( 'SET SESSION unique_checks = 0, foreign_key_checks = 0;' )
+
+            connections.put( connection )
+
+
+        def load_table( table ):
+
+            connection = connections.get()
+
+            try:
+
+                cursor = connection.cursor()
+
+                for ( filename, num_rows ) in table[ 'chunks' ]:
+
+                    HydrusDB.LoadChunkIntoTable( cursor, table[ 'name' ], os.path.join( path, 'db', filename ) )
+
+
+
+            finally:
+
+                connections.put( connection )
+
+
+
+        try:
+
+            with concurrent.futures.ThreadPoolExecutor( max_workers = HC.BACKUP_CONNECTIONS ) as executor:
+
+                for future in [ executor.submit( load_table, table ) for table in manifest[ 'tables' ] ]:
+
+                    future.result()
+
+
+
+
+        finally:
+
+            while not connections.empty():
+
+                connections.get().close()
+
+
+
+        HG.client_controller.pub( 'splash_set_status_text', 'restoring json dumps' )
+
+        json_source = os.path.join( path, 'json' )
+
+        if os.path.exists( json_source ):
+
+            HydrusPaths.MakeSureDirectoryExists( HC.JSON_PATH )
+
+            existing_names = set( os.listdir( HC.JSON_PATH ) )
+
+            for name in os.listdir( json_source ):
+
+                if name not in existing_names:
+
+                    shutil.copy2( os.path.join( json_source, name ), os.path.join( HC.JSON_PATH, name ) )
+
+
+
+
+        connection = HydrusDB.GetStandaloneConnection()
+
+        try:
+
+            cursor = connection.cursor()
+
+            cursor.execute( 'SELECT prefix, location FROM client_files_locations;' )
+
+            prefixes_to_locations = { prefix : HydrusPaths.ConvertPortablePathToAbsPath( location ) for ( prefix, location ) in cursor.fetchall() }
+
+        finally:
+
+            connection.close()
+
+
+        def text_update_hook( text ):
+
+            HG.client_controller.pub( 'splash_set_status_text', text )
+
+
+        RestoreClientFiles( path, prefixes_to_locations, text_update_hook = text_update_hook )
+
+
+    def THREADBackup( self, job_key, path, connections, table_names, table_names_to_create_statements, live_json_names, prefixes_to_locations ):
+
+        def is_cancelled_hook():
+
+            return job_key.IsCancelled() or self._controller.ModelIsShutdown()
+
+
+        def text_update_hook( text ):
+
+            job_key.SetVariable( 'popup_text_1', text )
+
+
+        # each connection holds its snapshot for the whole dump, and each table is read in full by whichever connection is free next
+
+        available_connections = queue.Queue()
+
+        for connection in connections:
+
+            available_connections.put( connection )
+
+
+        db_in_progress_dir = os.path.join( path, 'db_in_progress' )
+
+        tables = []
+        num_tables_done = 0
+        lock = threading.Lock()
+
+        def dump_table( table_name ):
+
+            nonlocal num_tables_done
+
+            connection = available_connections.get()
+
+            try:
+
+                chunks = HydrusDB.DumpTableToChunks( connection, table_name, db_in_progress_dir, is_cancelled_hook = is_cancelled_hook )
+
+            finally:
+
+                available_connections.put( connection )
+
+
+            with lock:
+
+                tables.append( { 'name' : table_name, 'create_statement' : table_names_to_create_statements[ table_name ], 'chunks' : chunks } )
+
+                num_tables_done += 1
+
+                text_update_hook( 'dumping tables: ' + HydrusData.ConvertValueRangeToPrettyString( num_tables_done, len( table_names ) ) )
+
+
+
+        try:
+
+            HydrusPaths.DeletePath( db_in_progress_dir )
+
+            HydrusPaths.MakeSureDirectoryExists( db_in_progress_dir )
+
+            with concurrent.futures.ThreadPoolExecutor( max_workers = len( connections ) ) as executor:
+
+                futures = [ executor.submit( dump_table, table_name ) for table_name in table_names ]
+
+                try:
+
+                    for future in futures:
+
+                        future.result()
+
+
+                except:
+
+                    for future in futures:
+
+                        future.cancel()
+
+
+                    raise
+
+
+
+
+            tables.sort( key = lambda table: table[ 'name' ] )
+
+            with open( os.path.join( db_in_progress_dir, 'manifest.json' ), 'w', encoding = 'utf-8' ) as f:
+
+                json.dump( { 'timestamp' : HydrusData.GetNow(), 'tables' : tables }, f )
+
+
+            # the old dump is only replaced once the new one is whole
+
+            db_dir = os.path.join( path, 'db' )
+            old_db_dir = os.path.join( path, 'db_old' )
+
+            if os.path.exists( db_dir ):
+
+                os.replace( db_dir, old_db_dir )
+
+
+            os.replace( db_in_progress_dir, db_dir )
+
+            HydrusPaths.DeletePath( old_db_dir )
+
+            # now nothing points at blobs the old dump needed
+
+            ClientCaches.JSONDumpStore.PruneMirroredBlobs( os.path.join( path, 'json' ), live_json_names )
+
+            for connection in connections:
+
+                connection.close()
+
+
+            connections = []
+
+            ( num_copied, num_deleted ) = BackupClientFiles( prefixes_to_locations, path, is_cancelled_hook = is_cancelled_hook, text_update_hook = text_update_hook )
+
+            if is_cancelled_hook():
+
+                text_update_hook( 'client files backup cancelled, it will carry on from here next time' )
+
+            else:
+
+                text_update_hook( 'done! ' + HydrusData.ToHumanInt( num_copied ) + ' new client files copied, ' + HydrusData.ToHumanInt( num_deleted ) + ' removed' )
+
+
+        except HydrusExceptions.CancelledException:
+
+            HydrusPaths.DeletePath( db_in_progress_dir )
+
+            text_update_hook( 'cancelled, the previous backup was left as it was' )
+
+        except Exception as e:
+
+            HydrusData.ShowException( e )
+
+            text_update_hook( 'the backup failed! the error has been written to the log' )
+
+        finally:
+
+            for connection in connections:
+
+                connection.close()
+
+
+            self._backup_in_progress = False
+
+            job_key.Finish()
+
+            job_key.Delete( 5 )
+
+
+
+    def THREADMigrateMappingsSchema( self, job_key, table_names, table_names_to_schemas ):
+
+        # each table is copied while the client keeps running, and only the swap at the end waits on the writer
+
+        def is_cancelled_hook():
+
+            return job_key.IsCancelled() or self._controller.ModelIsShutdown()
+
+
+        num_done = 0
+
+        connection = HydrusDB.GetStandaloneConnection()
+
+        try:
+
+            for table_name in table_names:
+
+                if is_cancelled_hook():
+
+                    break
+
+
+                ( primary_key_columns, has_reason_id ) = table_names_to_schemas[ table_name ]
+
+                prefix = 'table ' + HydrusData.ConvertValueRangeToPrettyString( num_done + 1, len( table_names ) ) + ', ' + table_name + ': '
+
+                job_key.SetVariable( 'popup_text_1', prefix + 'setting up' )
+
+                column_names = self._controller.WriteSynchronous( 'start_mappings_schema_migration_table', table_name, primary_key_columns, has_reason_id )
+
+                if column_names is None:
+
+                    continue
+
+
+                def progress_hook( value, range ):
+
+                    job_key.SetVariable( 'popup_text_1', prefix + 'copying' )
+                    job_key.SetVariable( 'popup_gauge_1', ( value, range ) )
+
+
+                try:
+
+                    finished = HydrusDB.CopyTableInHashIdRanges( connection, table_name, table_name + MAPPINGS_SCHEMA_MIGRATION_SUFFIX, column_names, MAPPINGS_SCHEMA_MIGRATION_CHUNK_ROWS, is_cancelled_hook = is_cancelled_hook, progress_hook = progress_hook )
+
+                except:
+
+                    self._controller.WriteSynchronous( 'abandon_mappings_schema_migration_table', table_name )
+
+                    raise
+
+
+                if not finished:
+
+                    self._controller.WriteSynchronous( 'abandon_mappings_schema_migration_table', table_name )
+
+                    break
+
+
+                job_key.SetVariable( 'popup_text_1', prefix + 'swapping in' )
+
+                self._controller.WriteSynchronous( 'finish_mappings_schema_migration_table', table_name )
+
+                num_done += 1
+
+
+            job_key.DeleteVariable( 'popup_gauge_1' )
+
+            job_key.SetVariable( 'popup_text_1', 'done ' + HydrusData.ConvertValueRangeToPrettyString( num_done, len( table_names ) ) + ' tables' )
+
+        except Exception as e:
+
+            HydrusData.ShowException( e )
+
+            job_key.SetVariable( 'popup_text_1', 'the migration failed! the table it was on was left as it was, and the error has been written to the log' )
+
+        finally:
+
+            connection.close()
+
+            self._mappings_schema_migration_in_progress = False
+
+            job_key.Finish()
+
+            job_key.Delete( 5 )
+
+
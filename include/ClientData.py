@@ -301,6 +301,18 @@ def GetSortTypeChoices():
     
     return sort_choices
     
+def MergeAllCounts( counts_a, counts_b ):
+    
+    # ( min_current_count, max_current_count, min_pending_count, max_pending_count ), merged the way a predicate's AddCounts does
+    
+    ( min_current_a, max_current_a, min_pending_a, max_pending_a ) = counts_a
+    ( min_current_b, max_current_b, min_pending_b, max_pending_b ) = counts_b
+    
+    ( min_current, max_current ) = MergeCounts( min_current_a, max_current_a, min_current_b, max_current_b )
+    ( min_pending, max_pending ) = MergeCounts( min_pending_a, max_pending_a, min_pending_b, max_pending_b )
+    
+    return ( min_current, max_current, min_pending, max_pending )
+    
 def MergeCounts( min_a, max_a, min_b, max_b ):
     
     # 100-None and 100-None returns 100-200
@@ -391,6 +403,46 @@ def MergePredicates( predicates, add_namespaceless = False ):
     
     return list(master_predicate_dict.values())
     
+def MergeTagsToCountsNamespaceless( tags_to_counts ):
+    
+    # MergePredicates' add_namespaceless, for raw counts, so only the tags that make the cut need predicates
+    
+    subtags_to_counts = {}
+    subtag_nonzero_instance_counter = collections.Counter()
+    
+    for ( tag, counts ) in tags_to_counts.items():
+        
+        ( min_current_count, max_current_count, min_pending_count, max_pending_count ) = counts
+        
+        if min_current_count > 0 or min_pending_count > 0:
+            
+            ( namespace, subtag ) = HydrusTags.SplitTag( tag )
+            
+            subtag_nonzero_instance_counter[ subtag ] += 1
+            
+            if subtag in subtags_to_counts:
+                
+                subtags_to_counts[ subtag ] = MergeAllCounts( subtags_to_counts[ subtag ], counts )
+                
+            else:
+                
+                subtags_to_counts[ subtag ] = counts
+                
+            
+        
+    
+    tags_to_counts = dict( tags_to_counts )
+    
+    for ( subtag, count ) in subtag_nonzero_instance_counter.items():
+        
+        if count > 1:
+            
+            tags_to_counts[ subtag ] = subtags_to_counts[ subtag ]
+            
+        
+    
+    return tags_to_counts
+    
 def OrdIsSensibleASCII( o ):
     
     return 32 <= o and o <= 127
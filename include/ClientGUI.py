@@ -709,9 +709,9 @@ class FrameGUI( ClientGUITopLevelWindows.FrameThatResizes ):
             HydrusPaths.MakeSureDirectoryExists( path )
             
         
-        client_db_path = os.path.join( path, 'client.db' )
+        client_db_manifest_path = os.path.join( path, 'db', 'manifest.json' )
         
-        if os.path.exists( client_db_path ):
+        if os.path.exists( client_db_manifest_path ):
             
             action = 'Update the existing'
             
@@ -722,7 +722,7 @@ class FrameGUI( ClientGUITopLevelWindows.FrameThatResizes ):
         
         text = action + ' backup at "' + path + '"?'
         text += os.linesep * 2
-        text += 'The database will be locked while the backup occurs, which may lock up your gui as well.'
+        text += 'The database is only locked while the backup takes its snapshot. You can keep using the client while the tables and files are copied.'
         
         with ClientGUIDialogs.DialogYesNo( self, text ) as dlg_yn:
             
@@ -1904,6 +1904,7 @@ class FrameGUI( ClientGUITopLevelWindows.FrameThatResizes ):
             if self._controller.new_options.GetBoolean( 'advanced_mode' ):
                 
                 ClientGUIMenus.AppendMenuItem( self, submenu, 'clear orphan tables', 'Clear out surplus db tables that have not been deleted correctly.', self._ClearOrphanTables )
+                ClientGUIMenus.AppendMenuItem( self, submenu, 'migrate mappings tables to the current schema', 'Rebuild older mappings tables with the current indices and partitioning while the client keeps running.', self._MigrateMappingsSchema )
                 
             
             ClientGUIMenus.AppendMenu( menu, submenu, 'maintain' )
@@ -3395,6 +3396,21 @@ class FrameGUI( ClientGUITopLevelWindows.FrameThatResizes ):
         self._menu_updater.Update()
         
     
+    def _MigrateMappingsSchema( self ):
+        
+        text = 'This will copy any mappings tables that do not have the current schema--a unique index on hash_id and tag_id, and the number of partitions set in config.yaml--into new tables, and swap them in.'
+        text += os.linesep * 2
+        text += 'The client keeps working while the tables are copied, but it will be slower, and the database needs enough free disk space for a second copy of the biggest table. A popup message will show its status, and you can cancel it between tables or part way through one.'
+        
+        with ClientGUIDialogs.DialogYesNo( self, text, yes_label = 'do it', no_label = 'forget it' ) as dlg:
+            
+            if dlg.ShowModal() == wx.ID_YES:
+                
+                self._controller.Write( 'migrate_mappings_schema' )
+                
+            
+        
+    
     def _ModifyAccount( self, service_key ):
         
         wx.MessageBox( 'this does not work yet!' )
@@ -4220,9 +4236,9 @@ The password is cleartext here but obscured in the entry dialog. Enter a blank p
     
     def _VacuumDatabase( self ):
         
-        text = 'This will rebuild the database, rewriting all indices and tables to be contiguous and optimising most operations. It typically happens automatically every few days, but you can force it here. If you have a large database, it will take a few minutes, during which your gui may hang. A popup message will show its status.'
+        text = 'This will run OPTIMIZE TABLE on the database\'s tables, rewriting their indices and rows to be contiguous and optimising most operations. Several tables are done at once. It typically happens automatically every few days, but you can force it here. If you have a large database, it will take a while. A popup message will show its status.'
         text += os.linesep * 2
-        text += 'A \'soft\' vacuum will only reanalyze those databases that are due for a check in the normal db maintenance cycle. If nothing is due, it will return immediately.'
+        text += 'A \'soft\' vacuum will only optimize those tables that are due in the normal db maintenance cycle. If nothing is due, it will return immediately.'
         text += os.linesep * 2
         text += 'A \'full\' vacuum will immediately force a vacuum for the entire database. This can take substantially longer.'
         
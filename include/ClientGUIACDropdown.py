@@ -127,9 +127,16 @@ def ReadFetch( win, job_key, results_callable, parsed_search_text, wx_media_call
                     
                     if cache_invalid_for_this_search:
                         
-                        new_search_text_for_current_cache = cache_text
+                        search_text_for_current_cache = cache_text
                         
-                        cached_results = HG.client_controller.Read( 'autocomplete_predicates', file_service_key = file_service_key, tag_service_key = tag_service_key, search_text = search_text, inclusive = inclusive, include_current = include_current, include_pending = include_pending, add_namespaceless = add_namespaceless, job_key = job_key, collapse_siblings = True )
+                        cached_results = HG.client_controller.Read( 'autocomplete_predicates', file_service_key = file_service_key, tag_service_key = tag_service_key, search_text = search_text, inclusive = inclusive, include_current = include_current, include_pending = include_pending, add_namespaceless = add_namespaceless, job_key = job_key, collapse_siblings = True, max_results = HC.AUTOCOMPLETE_MAX_RESULTS )
+                        
+                        if HC.AUTOCOMPLETE_MAX_RESULTS is not None:
+                            
+                            # the top tags for 'ab' need not hold the top tags for 'abc', so the next search goes back to the db
+                            
+                            search_text_for_current_cache = None
+                            
                         
                     
                     predicates = cached_results
@@ -307,7 +314,14 @@ def WriteFetch( win, job_key, results_callable, parsed_search_text, file_service
                 
                 search_text_for_current_cache = cache_text
                 
-                cached_results = HG.client_controller.Read( 'autocomplete_predicates', file_service_key = file_service_key, tag_service_key = tag_service_key, search_text = search_text, add_namespaceless = False, job_key = job_key, collapse_siblings = False )
+                cached_results = HG.client_controller.Read( 'autocomplete_predicates', file_service_key = file_service_key, tag_service_key = tag_service_key, search_text = search_text, add_namespaceless = False, job_key = job_key, collapse_siblings = False, max_results = HC.AUTOCOMPLETE_MAX_RESULTS )
+                
+                if HC.AUTOCOMPLETE_MAX_RESULTS is not None:
+                    
+                    # the top tags for 'ab' need not hold the top tags for 'abc', so the next search goes back to the db
+                    
+                    search_text_for_current_cache = None
+                    
                 
             
             predicates = cached_results
@@ -0,0 +1,536 @@
+from . import ClientCaches
+from . import HydrusConstants as HC
+from . import HydrusData
+from . import HydrusDB
+from . import HydrusSerialisable
+import binascii
+import concurrent.futures
+import json
+import os
+import sqlite3
+
+# the four files of a sqlite client, biggest first, so the long tables start early
+SQLITE_DB_FILENAMES = ( 'client.mappings.db', 'client.caches.db', 'client.master.db', 'client.db' )
+
+MIGRATION_PROGRESS_FILENAME = 'client.mysql_migration.json'
+
+# rows staged in memory for each LOAD DATA
+MIGRATION_CHUNK_ROWS = 200000
+
+SQLITE_TYPES_TO_MYSQL_TYPES = {}
+
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'INTEGER' ] = 'INTEGER'
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'INTEGER_BOOLEAN' ] = 'BOOL'
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'REAL' ] = 'REAL'
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'TEXT' ] = 'TEXT'
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'TEXT_YAML' ] = 'LONGTEXT'
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'BLOB_JSON' ] = 'LONGTEXT'
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'BLOB_BYTES' ] = 'VARBINARY(255)'
+SQLITE_TYPES_TO_MYSQL_TYPES[ 'BLOB' ] = 'LONGBLOB'
+
+# mysql cannot index a TEXT column without a prefix length
+INDEXED_TEXT_TYPE = 'VARCHAR(255)'
+
+# where the mysql port's own schema differs from a straight type swap
+COLUMN_TYPE_OVERRIDES = {}
+
+COLUMN_TYPE_OVERRIDES[ ( 'hashes', 'hash' ) ] = 'BINARY(32)'
+COLUMN_TYPE_OVERRIDES[ ( 'local_hashes', 'md5' ) ] = 'BINARY(16)'
+COLUMN_TYPE_OVERRIDES[ ( 'local_hashes', 'sha1' ) ] = 'BINARY(20)'
+COLUMN_TYPE_OVERRIDES[ ( 'local_hashes', 'sha512' ) ] = 'BINARY(64)'
+COLUMN_TYPE_OVERRIDES[ ( 'shape_perceptual_hashes', 'phash' ) ] = 'BINARY(8)'
+COLUMN_TYPE_OVERRIDES[ ( 'services', 'service_key' ) ] = 'VARCHAR(255)'
+COLUMN_TYPE_OVERRIDES[ ( 'services', 'dictionary_string' ) ] = 'LONGTEXT'
+COLUMN_TYPE_OVERRIDES[ ( 'json_dumps', 'dump' ) ] = 'LONGTEXT'
+COLUMN_TYPE_OVERRIDES[ ( 'json_dumps_named', 'dump' ) ] = 'LONGTEXT'
+COLUMN_TYPE_OVERRIDES[ ( 'files_info', 'size' ) ] = 'BIGINT'
+COLUMN_TYPE_OVERRIDES[ ( 'service_info', 'info' ) ] = 'BIGINT'
+COLUMN_TYPE_OVERRIDES[ ( 'service_directories', 'total_size' ) ] = 'BIGINT'
+COLUMN_TYPE_OVERRIDES[ ( 'subtags', 'subtag' ) ] = 'VARCHAR(512)'
+COLUMN_TYPE_OVERRIDES[ ( 'urls', 'url' ) ] = 'VARCHAR(2083) CHARACTER SET ascii'
+COLUMN_TYPE_OVERRIDES[ ( 'subtags_fts4_content', 'c0subtag' ) ] = 'TEXT'
+
+# sqlite's fts4 keeps its text in a shadow table, which becomes the port's FULLTEXT table
+TABLE_RENAMES = { 'subtags_fts4_content' : 'subtags_fts4' }
+COLUMN_RENAMES = { ( 'subtags_fts4_content', 'c0subtag' ) : 'subtag' }
+EXTRA_INDEXES = { 'subtags_fts4' : [ ( 'FULLTEXT', [ 'subtag' ] ) ] }
+
+JSON_DUMP_STORE = None
+
+def ConvertBinaryHash( value, num_bytes ):
+
+    # some older clients kept hashes as hex text
+
+    if isinstance( value, ( bytes, bytearray ) ) and len( value ) == num_bytes * 2:
+
+        try:
+
+            return bytes.fromhex( str( value, 'ascii' ) )
+
+        except ValueError:
+
+            pass
+
+
+
+    return value
+
+def ConvertJSONDump( dump, dump_type ):
+
+    # the port keeps dumps in the json dump store, and the row only holds the blob name
+
+    if isinstance( dump, ( bytes, bytearray ) ):
+
+        dump = str( dump, 'utf-8' )
+
+
+    split = dump_type == HydrusSerialisable.SERIALISABLE_TYPE_GUI_SESSION
+
+    return GetJSONDumpStore().Write( json.loads( dump ), split = split )
+
+def ConvertServiceDictionaryString( dictionary_string ):
+
+    if isinstance( dictionary_string, ( bytes, bytearray ) ):
+
+        dictionary_string = str( dictionary_string, 'utf-8' )
+
+
+    return GetJSONDumpStore().Write( dictionary_string, json_dump = False )
+
+def GetColumnConverters( table_spec ):
+
+    source_name = table_spec[ 'source_name' ]
+    source_column_names = [ source_column_name for ( source_column_name, dest_column_name, mysql_type ) in table_spec[ 'columns' ] ]
+
+    converters = {}
+
+    for ( i, ( source_column_name, dest_column_name, mysql_type ) ) in enumerate( table_spec[ 'columns' ] ):
+
+        key = ( source_name, source_column_name )
+
+        if mysql_type.startswith( 'BINARY(' ):
+
+            num_bytes = int( mysql_type[ 7 : -1 ] )
+
+            converters[ i ] = lambda row, i = i, num_bytes = num_bytes: ConvertBinaryHash( row[ i ], num_bytes )
+
+        elif key == ( 'services', 'service_key' ):
+
+            converters[ i ] = lambda row, i = i: str( binascii.b2a_hex( row[ i ] ), 'ascii' )
+
+        elif key == ( 'services', 'dictionary_string' ):
+
+            converters[ i ] = lambda row, i = i: ConvertServiceDictionaryString( row[ i ] )
+
+        elif key in ( ( 'json_dumps', 'dump' ), ( 'json_dumps_named', 'dump' ) ):
+
+            dump_type_index = source_column_names.index( 'dump_type' )
+
+            converters[ i ] = lambda row, i = i, dump_type_index = dump_type_index: ConvertJSONDump( row[ i ], row[ dump_type_index ] )
+
+
+
+    return converters
+
+def GetJSONDumpStore():
+
+    global JSON_DUMP_STORE
+
+    if JSON_DUMP_STORE is None:
+
+        JSON_DUMP_STORE = ClientCaches.JSONDumpStore( HC.JSON_PATH )
+
+
+    return JSON_DUMP_STORE
+
+def GenerateCreateTableStatement( table_spec, engine = None ):
+
+    column_definitions = [ dest_column_name + ' ' + mysql_type for ( source_column_name, dest_column_name, mysql_type ) in table_spec[ 'columns' ] ]
+
+    if table_spec[ 'auto_increment' ]:
+
+        column_definitions[ 0 ] += ' AUTO_INCREMENT'
+
+
+    if len( table_spec[ 'primary_key' ] ) > 0:
+
+        column_definitions.append( 'PRIMARY KEY ( ' + ', '.join( table_spec[ 'primary_key' ] ) + ' )' )
+
+
+    statement = 'CREATE TABLE ' + table_spec[ 'dest_name' ] + ' ( ' + ', '.join( column_definitions ) + ' )'
+
+    if engine is not None:
+
+        statement += ' ENGINE=' + engine
+
+
+    return statement + ';'
+
+def GenerateCreateIndexesStatement( table_spec ):
+
+    # one ALTER for all of a table's indexes, so it is rebuilt once
+
+    clauses = []
+
+    for ( index_type, column_names ) in table_spec[ 'indexes' ]:
+
+        if index_type == 'UNIQUE':
+
+            clause = 'ADD UNIQUE INDEX'
+
+        elif index_type == 'FULLTEXT':
+
+            clause = 'ADD FULLTEXT INDEX'
+
+        else:
+
+            clause = 'ADD INDEX'
+
+
+        index_name = table_spec[ 'dest_name' ] + '_' + '_'.join( column_names ) + '_index'
+
+        clauses.append( clause + ' ' + index_name + ' ( ' + ', '.join( column_names ) + ' )' )
+
+
+    if len( clauses ) == 0:
+
+        return None
+
+
+    return 'ALTER TABLE ' + table_spec[ 'dest_name' ] + ' ' + ', '.join( clauses ) + ';'
+
+def GetSQLiteConnection( db_dir, db_filename ):
+
+    path = os.path.join( db_dir, db_filename )
+
+    db = sqlite3.connect( 'file:' + path + '?mode=ro', uri = True )
+
+    # text comes out as the raw bytes, which LOAD DATA takes as they are, so a badly encoded string cannot stop the migration
+    db.text_factory = bytes
+
+    return db
+
+def GetTableSpecs( db_dir ):
+
+    table_specs = []
+
+    for db_filename in SQLITE_DB_FILENAMES:
+
+        db = GetSQLiteConnection( db_dir, db_filename )
+
+        try:
+
+            c = db.cursor()
+
+            table_names = [ str( name, 'utf-8' ) for ( name, sql ) in c.execute( 'SELECT name, sql FROM sqlite_master WHERE type = ?;', ( 'table', ) ) if not sql.startswith( b'CREATE VIRTUAL' ) ]
+
+            for table_name in table_names:
+
+                if table_name.startswith( 'sqlite_' ) or ( '_fts4' in table_name and table_name not in TABLE_RENAMES ):
+
+                    continue
+
+
+                table_specs.append( GetTableSpec( c, db_filename, table_name ) )
+
+
+        finally:
+
+            db.close()
+
+
+
+    return table_specs
+
+def GetTableSpec( c, db_filename, table_name ):
+
+    columns_info = [ ( str( name, 'utf-8' ), str( declared_type, 'utf-8' ).upper(), pk ) for ( cid, name, declared_type, notnull, default, pk ) in c.execute( 'PRAGMA table_info( "' + table_name + '" );' ) ]
+
+    indexes = []
+    indexed_column_names = set()
+
+    for ( seq, index_name, unique, origin, partial ) in list( c.execute( 'PRAGMA index_list( "' + table_name + '" );' ) ):
+
+        if origin == b'pk':
+
+            continue
+
+
+        index_name = str( index_name, 'utf-8' )
+
+        index_column_names = [ str( name, 'utf-8' ) for ( seqno, cid, name ) in c.execute( 'PRAGMA index_info( "' + index_name + '" );' ) ]
+
+        indexes.append( ( 'UNIQUE' if unique else 'INDEX', index_column_names ) )
+
+        indexed_column_names.update( index_column_names )
+
+
+    primary_key = [ name for ( name, declared_type, pk ) in sorted( columns_info, key = lambda column_info: column_info[2] ) if pk > 0 ]
+
+    indexed_column_names.update( primary_key )
+
+    columns = []
+
+    for ( name, declared_type, pk ) in columns_info:
+
+        key = ( table_name, name )
+
+        if key in COLUMN_TYPE_OVERRIDES:
+
+            mysql_type = COLUMN_TYPE_OVERRIDES[ key ]
+
+        else:
+
+            mysql_type = SQLITE_TYPES_TO_MYSQL_TYPES.get( declared_type, 'LONGTEXT' )
+
+            if mysql_type in ( 'TEXT', 'LONGTEXT' ) and name in indexed_column_names:
+
+                mysql_type = INDEXED_TEXT_TYPE
+
+
+
+        columns.append( ( name, COLUMN_RENAMES.get( key, name ), mysql_type ) )
+
+
+    dest_name = TABLE_RENAMES.get( table_name, table_name )
+
+    source_names_to_dest_names = { source_name : dest_name for ( source_name, dest_name, mysql_type ) in columns }
+
+    indexes = [ ( index_type, [ source_names_to_dest_names[ name ] for name in index_column_names ] ) for ( index_type, index_column_names ) in indexes ]
+
+    indexes.extend( EXTRA_INDEXES.get( dest_name, [] ) )
+
+    # an INTEGER PRIMARY KEY is sqlite's rowid, which the port fills with AUTO_INCREMENT
+    auto_increment = len( primary_key ) == 1 and columns[ 0 ][0] == primary_key[0] and columns_info[ 0 ][1] == 'INTEGER'
+
+    table_spec = {}
+
+    table_spec[ 'db_filename' ] = db_filename
+    table_spec[ 'source_name' ] = table_name
+    table_spec[ 'dest_name' ] = dest_name
+    table_spec[ 'columns' ] = columns
+    table_spec[ 'primary_key' ] = [ source_names_to_dest_names[ name ] for name in primary_key ]
+    table_spec[ 'auto_increment' ] = auto_increment
+    table_spec[ 'indexes' ] = indexes
+
+    return table_spec
+
+def GetMySQLConnection():
+
+    connection = HydrusDB.GetStandaloneConnection( allow_local_infile = True )
+
+    connection.autocommit = True
+
+    cursor = connection.cursor()
+
+    # an id of 0 is a real id here, not a request for the next one
+    cursor.execute( 'SET SESSION sql_mode = CONCAT_WS( \',\', NULLIF( @@SESSION.sql_mode, \'\' ), \'NO_AUTO_VALUE_ON_ZERO\' ), unique_checks = 0, foreign_key_checks = 0;' )
+
+    cursor.close()
+
+    return connection
+
+def IndexTable( table_spec ):
+
+    statement = GenerateCreateIndexesStatement( table_spec )
+
+    if statement is None:
+
+        return
+
+
+    connection = GetMySQLConnection()
+
+    try:
+
+        connection.cursor().execute( statement )
+
+    finally:
+
+        connection.close()
+
+
+def LoadProgress( db_dir ):
+
+    path = os.path.join( db_dir, MIGRATION_PROGRESS_FILENAME )
+
+    if os.path.exists( path ):
+
+        with open( path, 'r', encoding = 'utf-8' ) as f:
+
+            return json.load( f )
+
+
+
+    return { 'loaded' : [], 'indexed' : [] }
+
+def MigrateTable( db_dir, table_spec, engine = None ):
+
+    # runs in its own process. a table that was half done when a migration stopped is dropped and loaded again from the start
+
+    db = GetSQLiteConnection( db_dir, table_spec[ 'db_filename' ] )
+    connection = GetMySQLConnection()
+
+    try:
+
+        cursor = connection.cursor()
+
+        cursor.execute( 'DROP TABLE IF EXISTS ' + table_spec[ 'dest_name' ] + ';' )
+        cursor.execute( GenerateCreateTableStatement( table_spec, engine = engine ) )
+
+        source_column_names = [ '"' + source_column_name + '"' for ( source_column_name, dest_column_name, mysql_type ) in table_spec[ 'columns' ] ]
+        dest_column_names = [ dest_column_name for ( source_column_name, dest_column_name, mysql_type ) in table_spec[ 'columns' ] ]
+
+        converters = GetColumnConverters( table_spec )
+
+        c = db.cursor()
+
+        c.execute( 'SELECT ' + ', '.join( source_column_names ) + ' FROM "' + table_spec[ 'source_name' ] + '";' )
+
+        num_rows = 0
+
+        while True:
+
+            rows = c.fetchmany( MIGRATION_CHUNK_ROWS )
+
+            if len( rows ) == 0:
+
+                break
+
+
+            if len( converters ) > 0:
+
+                rows = [ [ converters[ i ]( row ) if i in converters else value for ( i, value ) in enumerate( row ) ] for row in rows ]
+
+
+            HydrusDB.LoadLinesIntoTable( cursor, table_spec[ 'dest_name' ], dest_column_names, ( HydrusDB.ConvertRowToLoadDataLine( row ) for row in rows ) )
+
+            num_rows += len( rows )
+
+
+        return num_rows
+
+    finally:
+
+        db.close()
+        connection.close()
+
+
+def MigrateSQLiteDB( db_dir, num_processes = None, engine = None, text_update_hook = None ):
+
+    def report( text ):
+
+        HydrusData.Print( text )
+
+        if text_update_hook is not None:
+
+            text_update_hook( text )
+
+
+
+    for db_filename in SQLITE_DB_FILENAMES:
+
+        if not os.path.exists( os.path.join( db_dir, db_filename ) ):
+
+            raise Exception( 'Could not find ' + db_filename + ' in ' + db_dir + '!' )
+
+
+
+    if num_processes is None:
+
+        num_processes = os.cpu_count() or 1
+
+
+    connection = HydrusDB.GetStandaloneConnection( database = None )
+
+    try:
+
+        connection.cursor().execute( 'CREATE DATABASE IF NOT EXISTS ' + HC.MYSQL_DB + ';' )
+
+    finally:
+
+        connection.close()
+
+
+    # a media result snapshot left by the sqlite client would be served as if it came from the new db
+
+    ClientCaches.MediaResultSnapshot.STATICDelete( os.path.join( db_dir, ClientCaches.MEDIA_RESULT_SNAPSHOT_FILENAME ) )
+
+    table_specs = GetTableSpecs( db_dir )
+
+    progress = LoadProgress( db_dir )
+
+    # each table is loaded into a bare table by a process of its own, and its indexes are only built once every table is in
+
+    stages = []
+
+    stages.append( ( 'loaded', 'loading', lambda executor, table_spec: executor.submit( MigrateTable, db_dir, table_spec, engine = engine ) ) )
+    stages.append( ( 'indexed', 'indexing', lambda executor, table_spec: executor.submit( IndexTable, table_spec ) ) )
+
+    for ( stage, stage_description, submit ) in stages:
+
+        todo_table_specs = [ table_spec for table_spec in table_specs if table_spec[ 'dest_name' ] not in progress[ stage ] ]
+
+        if len( todo_table_specs ) == 0:
+
+            continue
+
+
+        errors = []
+
+        with concurrent.futures.ProcessPoolExecutor( max_workers = num_processes ) as executor:
+
+            futures_to_table_specs = { submit( executor, table_spec ) : table_spec for table_spec in todo_table_specs }
+
+            for future in concurrent.futures.as_completed( futures_to_table_specs ):
+
+                table_spec = futures_to_table_specs[ future ]
+
+                try:
+
+                    result = future.result()
+
+                except Exception as e:
+
+                    report( stage_description + ' ' + table_spec[ 'dest_name' ] + ' failed: ' + str( e ) )
+
+                    errors.append( table_spec[ 'dest_name' ] )
+
+                    continue
+
+
+                progress[ stage ].append( table_spec[ 'dest_name' ] )
+
+                SaveProgress( db_dir, progress )
+
+                text = stage_description + ' tables: ' + HydrusData.ConvertValueRangeToPrettyString( len( progress[ stage ] ), len( table_specs ) ) + ', done ' + table_spec[ 'dest_name' ]
+
+                if stage == 'loaded':
+
+                    text += ' (' + HydrusData.ToHumanInt( result ) + ' rows)'
+
+
+                report( text )
+
+
+
+        if len( errors ) > 0:
+
+            raise Exception( 'Migration stopped because these tables failed: ' + ', '.join( sorted( errors ) ) + '. Run it again to retry them, the tables already done will be skipped.' )
+
+
+
+    report( 'migration done! the sqlite files were not changed' )
+
+def SaveProgress( db_dir, progress ):
+
+    path = os.path.join( db_dir, MIGRATION_PROGRESS_FILENAME )
+    temp_path = path + '.tmp'
+
+    with open( temp_path, 'w', encoding = 'utf-8' ) as f:
+
+        json.dump( progress, f )
+
+
+    os.replace( temp_path, path )
+
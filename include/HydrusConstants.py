@@ -751,4 +751,20 @@ MYSQL_HOST = config['mysql_db']['host']
 MYSQL_USER = config['mysql_db']['user']
 MYSQL_PASSWORD = config['mysql_db']['password']
 MYSQL_DB = config['mysql_db']['database']
+MYSQL_READ_CONNECTIONS = config['mysql_db'].get( 'read_connections', 4 )
+MYSQL_GROUP_COMMIT_TIME = config['mysql_db'].get( 'group_commit_time', 2 )
+MYSQL_GROUP_COMMIT_ROWS = config['mysql_db'].get( 'group_commit_rows', 100000 )
 JSON_PATH = config['json_path']
+SIMILAR_FILES_SEARCH_THREADS = config.get( 'similar_files_search_threads', 0 ) or os.cpu_count() or 1
+MEDIA_RESULT_CACHE_SIZE = config.get( 'media_result_cache_size', 0 )
+FILE_SEARCH_RESULT_CACHE_SIZE = config.get( 'file_search_result_cache_size', 0 )
+TAG_AUTOCOMPLETE_INDEX = config.get( 'tag_autocomplete_index', False )
+AUTOCOMPLETE_MAX_RESULTS = config.get( 'autocomplete_max_results', 0 ) or None
+REPOSITORY_UPDATE_LOAD_THREADS = config.get( 'repository_update_load_threads', 0 ) or 2
+REPOSITORY_UPDATE_PREFETCH_BYTES = ( config.get( 'repository_update_prefetch_mb', 0 ) or 256 ) * 1048576
+TAG_RELATIONSHIP_CACHE_SIZE = config.get( 'tag_relationship_cache_size', 0 )
+RELATED_TAGS_SAMPLE_SIZE = config.get( 'related_tags_sample_size', 0 ) or 5000
+BACKUP_CONNECTIONS = config.get( 'backup_connections', 0 ) or 4
+MAINTENANCE_CONNECTIONS = config.get( 'maintenance_connections', 0 ) or 4
+ANALYZE_ROW_DRIFT_PERCENT = config.get( 'analyze_row_drift_percent', 0 ) or 10
+MAPPINGS_PARTITIONS = config.get( 'mappings_partitions', 0 )
@@ -1,4 +1,6 @@
+import collections
 import distutils.version
+import gzip
 from . import HydrusConstants as HC
 from . import HydrusData
 from . import HydrusExceptions
@@ -7,47 +9,449 @@ from . import HydrusPaths
 from . import HydrusText
 import os
 import queue
+import shutil
 import mysql.connector
 from mysql.connector.constants import CharacterSet
+from mysql.connector.cursor_cext import CMySQLCursorBuffered
+import threading
 import traceback
 import time
+import weakref
 
 CONNECTION_REFRESH_TIME = 60 * 30
 
+# the most rows put in one multi-row INSERT when staging ids, well inside the default max_allowed_packet
+STAGED_ID_INSERT_CHUNK_SIZE = 10000
+
+# _SelectFromList stages longer lists than this and runs one query against them, rather than many chunks of IN ( %s, ... )
+STAGED_ID_SELECT_THRESHOLD = 1024
+
+STAGED_ID_TABLE_POOLS = weakref.WeakKeyDictionary()
+STAGED_ID_TABLE_POOLS_LOCK = threading.Lock()
+
+# rows handed over at a time when _STL and _STS read a result
+FETCH_MANY_SIZE = 4096
+
+# prepared statements _SelectFromList keeps open on each connection, one per statement and chunk size
+PREPARED_STATEMENT_CACHE_SIZE = 64
+
+# _SelectFromList chunks start here for each statement, then double while a chunk costs less than ten round trips and halve when one takes more than a second
+SELECT_FROM_LIST_DEFAULT_CHUNK_SIZE = 256
+SELECT_FROM_LIST_MIN_CHUNK_SIZE = 64
+SELECT_FROM_LIST_MAX_CHUNK_SIZE = 32768 # the biggest power of two under mysql's 65,535 placeholder limit
+SELECT_FROM_LIST_ROUND_TRIPS_PER_CHUNK = 10
+SELECT_FROM_LIST_SLOW_CHUNK_TIME = 1.0
+
+# rows written to each compressed chunk file of a logical dump
+LOGICAL_DUMP_CHUNK_ROWS = 250000
+
+# innodb undoes the whole transaction for these, not just the failing statement
+TRANSACTION_ROLLED_BACK_ERRNOS = ( 1213, ) # deadlock
+
+# a background copy just tries its chunk again after these, as the writer will have moved on
+LOCK_CONFLICT_ERRNOS = ( 1205, 1213 ) # lock wait timeout, deadlock
+
+# CopyTableInHashIdRanges starts its ranges this wide and never goes wider, whatever the counts say, so no one chunk can lock a whole table
+COPY_HASH_ID_RANGE_DEFAULT_WIDTH = 256
+COPY_HASH_ID_RANGE_MAX_WIDTH = 65536
+
 def CanVacuum( db_path, stop_time = None ):
     return False
 
 
+def ConvertRowToLoadDataLine( row ):
+
+    # mysql's default LOAD DATA format: tab separated, newline terminated, backslash escaped, \N for NULL
+
+    fields = []
+
+    for value in row:
+
+        if value is None:
+
+            fields.append( b'\\N' )
+
+            continue
+
+
+        if isinstance( value, ( bytes, bytearray ) ):
+
+            data = bytes( value )
+
+        else:
+
+            data = str( value ).encode( 'utf-8' )
+
+
+        fields.append( data.replace( b'\\', b'\\\\' ).replace( b'\t', b'\\t' ).replace( b'\n', b'\\n' ).replace( b'\x00', b'\\0' ) )
+
+
+    return b'\t'.join( fields ) + b'\n'
+
+
+def CopyTableInHashIdRanges( connection, source_table_name, dest_table_name, column_names, num_rows_per_chunk, is_cancelled_hook = None, progress_hook = None ):
+
+    # each range is read with FOR UPDATE, so a writer deleting one of its rows waits for the chunk to commit and cannot have the delete undone by it
+    # rows written to the source meanwhile are expected to reach dest some other way, such as triggers
+
+    cursor = connection.cursor()
+
+    cursor.execute( 'SELECT MAX( hash_id ) FROM ' + source_table_name + ';' ); ( max_hash_id, ) = cursor.fetchone()
+
+    if max_hash_id is None:
+
+        return True
+
+
+    # table stats are often missing or stale for a freshly loaded table, so each range is counted, unlocked, before it is copied
+    # the width is halved while a range holds more than a chunk, and grown towards a chunk's worth from what the last count found
+
+    columns_phrase = ', '.join( column_names )
+
+    count_statement = 'SELECT COUNT( * ) FROM ' + source_table_name + ' WHERE hash_id >= %s AND hash_id < %s;'
+    insert_statement = 'INSERT IGNORE INTO ' + dest_table_name + ' ( ' + columns_phrase + ' ) SELECT ' + columns_phrase + ' FROM ' + source_table_name + ' WHERE hash_id >= %s AND hash_id < %s FOR UPDATE;'
+
+    hash_ids_per_chunk = COPY_HASH_ID_RANGE_DEFAULT_WIDTH
+
+    start = 0
+
+    while start <= max_hash_id:
+
+        if is_cancelled_hook is not None and is_cancelled_hook():
+
+            return False
+
+
+        cursor.execute( count_statement, ( start, start + hash_ids_per_chunk ) ); ( num_rows_in_range, ) = cursor.fetchone()
+
+        if num_rows_in_range > num_rows_per_chunk and hash_ids_per_chunk > 1:
+
+            hash_ids_per_chunk = max( 1, hash_ids_per_chunk // 2 )
+
+            continue
+
+
+        try:
+
+            cursor.execute( insert_statement, ( start, start + hash_ids_per_chunk ) )
+
+            connection.commit()
+
+        except mysql.connector.Error as e:
+
+            connection.rollback()
+
+            if e.errno in LOCK_CONFLICT_ERRNOS:
+
+                time.sleep( 1 )
+
+                continue
+
+
+            raise
+
+
+        start += hash_ids_per_chunk
+
+        if num_rows_in_range == 0:
+
+            hash_ids_per_chunk = min( hash_ids_per_chunk * 2, COPY_HASH_ID_RANGE_MAX_WIDTH )
+
+        else:
+
+            hash_ids_per_chunk = max( 1, min( ( hash_ids_per_chunk * num_rows_per_chunk ) // num_rows_in_range, hash_ids_per_chunk * 2, COPY_HASH_ID_RANGE_MAX_WIDTH ) )
+
+
+        if progress_hook is not None:
+
+            progress_hook( min( start, max_hash_id + 1 ), max_hash_id + 1 )
+
+
+
+    return True
+
+
+def DumpTableToChunks( connection, table_name, dest_dir, is_cancelled_hook = None ):
+
+    # streams the table off an unbuffered cursor, so only FETCH_MANY_SIZE rows are in memory at once
+
+    chunks = []
+
+    cursor = connection.cursor( buffered = False )
+
+    f = None
+
+    try:
+
+        cursor.execute( 'SELECT * FROM ' + table_name + ';' )
+
+        while True:
+
+            rows = cursor.fetchmany( FETCH_MANY_SIZE )
+
+            if len( rows ) == 0:
+
+                break
+
+
+            if is_cancelled_hook is not None and is_cancelled_hook():
+
+                raise HydrusExceptions.CancelledException( 'Dump of ' + table_name + ' was cancelled!' )
+
+
+            if f is None or chunks[ -1 ][1] >= LOGICAL_DUMP_CHUNK_ROWS:
+
+                if f is not None:
+
+                    f.close()
+
+
+                filename = '{}.{:05}.tsv.gz'.format( table_name, len( chunks ) )
+
+                f = gzip.open( os.path.join( dest_dir, filename ), 'wb', compresslevel = 1 )
+
+                chunks.append( [ filename, 0 ] )
+
+
+            f.write( b''.join( ( ConvertRowToLoadDataLine( row ) for row in rows ) ) )
+
+            chunks[ -1 ][1] += len( rows )
+
+
+    finally:
+
+        if f is not None:
+
+            f.close()
+
+
+        cursor.close()
+
+
+    return [ tuple( chunk ) for chunk in chunks ]
+
+
+def GenerateIndexName( table_name, columns ):
+
+    index_name = table_name + '_' + '_'.join( columns ) + '_index'
+
+    if len( index_name ) > 64:
+
+        index_name = '_'.join( x[:4] for x in index_name.split( '_' ) )
+
+
+    return index_name
+
+
+def GetStagedIdTablePool( cursor ):
+
+    # temporary tables belong to the connection, and every connection here has the one cursor, so the pool hangs off that
+
+    with STAGED_ID_TABLE_POOLS_LOCK:
+
+        if cursor not in STAGED_ID_TABLE_POOLS:
+
+            STAGED_ID_TABLE_POOLS[ cursor ] = StagedIdTablePool( cursor )
+
+
+        return STAGED_ID_TABLE_POOLS[ cursor ]
+
+
+def GetStandaloneConnection( database = HC.MYSQL_DB, **kwargs ):
+
+    # a connection outside the pool, for long jobs that should not hold a pooled connection or share its session state
+
+    charset = CharacterSet.get_charset_info( 'utf8mb4', 'utf8mb4_0900_ai_ci' )
+
+    connection_kwargs = dict( host = HC.MYSQL_HOST, user = HC.MYSQL_USER, password = HC.MYSQL_PASSWORD, charset = charset[0], use_pure = False )
+
+    if database is not None:
+
+        connection_kwargs[ 'database' ] = database
+
+
+    connection_kwargs.update( kwargs )
+
+    return mysql.connector.connect( **connection_kwargs )
+
+
+def LoadChunkIntoTable( cursor, table_name, chunk_path ):
+
+    # the connector can only LOAD DATA LOCAL from a real file, so the chunk is decompressed to a temp file first
+    # CHARACTER SET binary loads the bytes as they were dumped, which is utf-8 for text and raw for binary columns
+
+    ( os_file_handle, temp_path ) = HydrusPaths.GetTempPath( suffix = '.tsv' )
+
+    try:
+
+        with gzip.open( chunk_path, 'rb' ) as source:
+
+            with open( temp_path, 'wb' ) as dest:
+
+                shutil.copyfileobj( source, dest )
+
+
+
+        cursor.execute( 'LOAD DATA LOCAL INFILE %s INTO TABLE ' + table_name + ' CHARACTER SET binary;', ( temp_path, ) )
+
+    finally:
+
+        HydrusPaths.CleanUpTempPath( os_file_handle, temp_path )
+
+
+
+def LoadLinesIntoTable( cursor, table_name, column_names, lines ):
+
+    # lines are in ConvertRowToLoadDataLine's format, and go through a temp file for the same reason as LoadChunkIntoTable
+
+    ( os_file_handle, temp_path ) = HydrusPaths.GetTempPath( suffix = '.tsv' )
+
+    try:
+
+        with open( temp_path, 'wb' ) as f:
+
+            f.writelines( lines )
+
+
+        cursor.execute( 'LOAD DATA LOCAL INFILE %s INTO TABLE ' + table_name + ' CHARACTER SET binary ( ' + ', '.join( column_names ) + ' );', ( temp_path, ) )
+
+    finally:
+
+        HydrusPaths.CleanUpTempPath( os_file_handle, temp_path )
+
+
+
 def ReadLargeIdQueryInSeparateChunks( cursor, select_statement, chunk_size ):
 
-    table_name = 'tempbigread' + os.urandom( 10 ).hex()
+    staged_id_table_pool = GetStagedIdTablePool( cursor )
+
+    # a btree key, as the chunks are read off in ranges
+    table_name = staged_id_table_pool.AcquireTable( 'bigread', 'job_id INTEGER AUTO_INCREMENT, temp_id INTEGER, PRIMARY KEY USING BTREE ( job_id )' )
+
+    try:
+
+        cursor.execute( 'INSERT INTO ' + table_name + ' ( temp_id ) ' + select_statement ) # given statement should end in semicolon, so we are good
+
+        # a reused table keeps counting up its job_ids, so page on the last one seen rather than from zero
+
+        last_job_id = 0
+
+        while True:
+
+            cursor.execute( 'SELECT job_id, temp_id FROM ' + table_name + ' WHERE job_id > %s ORDER BY job_id LIMIT %s;', ( last_job_id, chunk_size ) )
+
+            rows = cursor.fetchall()
+
+            if len( rows ) == 0:
+
+                break
+
+
+            last_job_id = rows[-1][0]
+
+            chunk = [ temp_id for ( job_id, temp_id ) in rows ]
+
+            yield chunk
+
+
+    finally:
+
+        staged_id_table_pool.ReleaseTable( table_name )
+
+
+def RunTableMaintenanceInParallel( statement_phrase, table_names, num_connections, should_stop_hook, text_update_hook = None ):
+
+    # ANALYZE and OPTIMIZE only hold the table they work on, so different tables can go at once on connections of their own
+    # a statement already started is not interrupted, so should_stop_hook is checked before each table
+
+    table_names_queue = queue.Queue()
+
+    for table_name in table_names:
+
+        table_names_queue.put( table_name )
+
+
+    done_table_names = []
+    lock = threading.Lock()
+
+    def work():
+
+        connection = GetStandaloneConnection()
+
+        try:
+
+            cursor = connection.cursor()
+
+            while not should_stop_hook():
+
+                try:
+
+                    table_name = table_names_queue.get_nowait()
+
+                except queue.Empty:
+
+                    break
+
+
+                if text_update_hook is not None:
+
+                    text_update_hook( statement_phrase.lower() + ' ' + table_name )
+
+
+                started = HydrusData.GetNowPrecise()
+
+                try:
+
+                    cursor.execute( statement_phrase + ' ' + table_name + ';' )
+
+                    # problems come back as result rows, not exceptions
+                    errors = [ msg_text for ( table, op, msg_type, msg_text ) in cursor.fetchall() if msg_type == 'error' ]
+
+                except mysql.connector.Error as e:
+
+                    errors = [ str( e ) ]
 
-    cursor.execute( 'CREATE TEMPORARY TABLE ' + table_name + ' ( job_id INTEGER PRIMARY KEY AUTO_INCREMENT, temp_id INTEGER  );' )
 
-    cursor.execute( 'INSERT INTO ' + table_name + ' ( temp_id ) ' + select_statement ) # given statement should end in semicolon, so we are good
+                if len( errors ) > 0:
 
-    num_to_do = cursor.rowcount
+                    HydrusData.Print( statement_phrase + ' ' + table_name + ' failed: ' + ', '.join( errors ) )
 
-    if num_to_do is None or num_to_do == -1:
+                    continue
 
-        num_to_do = 0
 
+                time_took = HydrusData.GetNowPrecise() - started
 
-    i = 0
+                if time_took > 1:
 
-    while i < num_to_do:
+                    HydrusData.Print( statement_phrase + ' ' + table_name + ' took ' + HydrusData.TimeDeltaToPrettyTimeDelta( time_took ) )
 
-        cursor.execute('SELECT temp_id FROM ' + table_name + ' WHERE job_id BETWEEN %s AND %s;',
-                       (i, i + chunk_size - 1))
 
-        chunk = [ temp_id for ( temp_id, ) in cursor.fetchall()  ]
+                with lock:
 
-        yield chunk
+                    done_table_names.append( table_name )
 
-        i += chunk_size
 
 
-    cursor.execute( 'DROP TABLE ' + table_name + ';' )
+
+        finally:
+
+            connection.close()
+
+
+
+    threads = [ threading.Thread( target = work, name = 'table maintenance' ) for i in range( min( num_connections, len( table_names ) ) ) ]
+
+    for thread in threads:
+
+        thread.start()
+
+
+    for thread in threads:
+
+        thread.join()
+
+
+    return done_table_names
 
 def VacuumDB( db_path ):
     pass
@@ -56,18 +460,26 @@ def VacuumDB( db_path ):
 class HydrusDB( object ):
 
     READ_WRITE_ACTIONS = []
+    SERIAL_READ_ACTIONS = []
     UPDATE_WAIT = 2
 
     TRANSACTION_COMMIT_TIME = 120
 
     def __init__( self, controller, db_dir, db_name ):
 
+        # every thread that talks to the db (the writer and each pooled reader) gets its own connection and cursor
+        self._thread_local = threading.local()
+
         self._controller = controller
         self._db_dir = db_dir
         self._db_name = db_name
 
         self._transaction_started = 0
         self._transaction_contains_writes = False
+        self._group_commit_paused = False
+
+        # the in-memory caches the open transaction has changed, so a rollback only has to reload those
+        self._caches_touched_in_transaction = set()
 
         self._connection_timestamp = 0
 
@@ -89,7 +501,16 @@ class HydrusDB( object ):
         self._could_not_initialise = False
 
         self._jobs = queue.Queue()
-        self._pubsubs = []
+
+        self._num_read_connections = self._GetNumReadConnections()
+        self._read_jobs = queue.Queue()
+        self._read_loops_lock = threading.Lock()
+        self._num_read_loops_running = 0
+
+        # writes that are queued or waiting on a group commit, by the thread that issued them. while a thread has any, its reads go to the writer behind them, so it never misses its own earlier write
+        self._unfinished_write_jobs_to_thread_idents = {}
+        self._thread_idents_to_num_unfinished_write_jobs = collections.Counter()
+        self._unfinished_write_jobs_lock = threading.Lock()
 
         self._current_status = ''
         self._current_job_name = ''
@@ -163,6 +584,8 @@ class HydrusDB( object ):
 
         self._CloseDBCursor()
 
+        self._CloseDBConnection() # the writer thread will make its own
+
         self._controller.CallToThreadLongRunning( self.MainLoop )
 
         while not self._ready_to_serve_requests:
@@ -181,19 +604,145 @@ class HydrusDB( object ):
 
 
     def _BeginImmediate( self ):
-        pass
+
+        if not self._db.in_transaction:
+
+            self._db.start_transaction()
+
+            self._transaction_started = HydrusData.GetNowFloat()
+            self._transaction_contains_writes = False
+
+            self._c.ResetRowsWritten()
+
+
 
     def _CleanUpCaches( self ):
 
         pass
 
 
+    @property
+    def _c( self ):
+
+        return getattr( self._thread_local, 'c', None )
+
+
+    @_c.setter
+    def _c( self, c ):
+
+        self._thread_local.c = c
+
+
+    @property
+    def _db( self ):
+
+        return getattr( self._thread_local, 'db', None )
+
+
+    @_db.setter
+    def _db( self, db ):
+
+        self._thread_local.db = db
+
+
+    @property
+    def _jobs_awaiting_commit( self ):
+
+        if not hasattr( self._thread_local, 'jobs_awaiting_commit' ):
+
+            self._thread_local.jobs_awaiting_commit = []
+
+
+        return self._thread_local.jobs_awaiting_commit
+
+
+    @_jobs_awaiting_commit.setter
+    def _jobs_awaiting_commit( self, jobs_awaiting_commit ):
+
+        self._thread_local.jobs_awaiting_commit = jobs_awaiting_commit
+
+
+    @property
+    def _prepared_cursors( self ):
+
+        if not hasattr( self._thread_local, 'prepared_cursors' ):
+
+            self._thread_local.prepared_cursors = collections.OrderedDict()
+
+
+        return self._thread_local.prepared_cursors
+
+
+    @property
+    def _pubsubs( self ):
+
+        if not hasattr( self._thread_local, 'pubsubs' ):
+
+            self._thread_local.pubsubs = []
+
+
+        return self._thread_local.pubsubs
+
+
+    @_pubsubs.setter
+    def _pubsubs( self, pubsubs ):
+
+        self._thread_local.pubsubs = pubsubs
+
+
+    @property
+    def _select_from_list_chunk_sizes( self ):
+
+        if not hasattr( self._thread_local, 'select_from_list_chunk_sizes' ):
+
+            self._thread_local.select_from_list_chunk_sizes = {}
+
+
+        return self._thread_local.select_from_list_chunk_sizes
+
+
+    def _CloseDBConnection( self ):
+
+        if self._db is not None:
+
+            self._db.close()
+
+            self._db = None
+
+
+
     def _CloseDBCursor( self ):
+
+        for prepared_cursor in self._prepared_cursors.values():
+
+            prepared_cursor.close()
+
+
+        self._prepared_cursors.clear()
+
+        # the next connection may be to somewhere nearer or further
+        self._thread_local.connection_limits = None
+        self._select_from_list_chunk_sizes.clear()
+
         self._c.close()
 
+        # a closed cursor left here would make this thread look like it can still run db jobs itself
+        self._c = None
+
 
     def _Commit( self ):
-        pass
+
+        if self._db.in_transaction:
+
+            self._db.commit()
+
+
+        self._transaction_contains_writes = False
+
+        self._caches_touched_in_transaction = set()
+
+        self._FlushJobsAwaitingCommit()
+
 
 
 
@@ -212,9 +761,7 @@ class HydrusDB( object ):
 
             table_name_simple = table_name
 
-        index_name = table_name + '_' + '_'.join( columns ) + '_index'
-        if len(index_name) > 64:
-            index_name = "_".join(x[:4] for x in index_name.split("_"))
+        index_name = GenerateIndexName( table_name, columns )
 
         if unique:
 
@@ -231,6 +778,21 @@ class HydrusDB( object ):
         self._c.execute( create_statement )
 
 
+    def _DeliverJobResult( self, job, result, pubsubs ):
+
+        self._FinishWriteJob( job )
+
+        for ( topic, args, kwargs ) in pubsubs:
+
+            self._controller.pub( topic, *args, **kwargs )
+
+
+        if job.IsSynchronous():
+
+            job.PutResult( result )
+
+
+
     def _DisplayCatastrophicError( self, text ):
 
         message = 'The db encountered a serious error! This is going to be written to the log as well, but here it is for a screenshot:'
@@ -240,6 +802,98 @@ class HydrusDB( object ):
         HydrusData.DebugPrint( message )
 
 
+    def _FinishWriteJob( self, job ):
+
+        with self._unfinished_write_jobs_lock:
+
+            if job in self._unfinished_write_jobs_to_thread_idents:
+
+                thread_ident = self._unfinished_write_jobs_to_thread_idents.pop( job )
+
+                self._thread_idents_to_num_unfinished_write_jobs[ thread_ident ] -= 1
+
+                if self._thread_idents_to_num_unfinished_write_jobs[ thread_ident ] == 0:
+
+                    del self._thread_idents_to_num_unfinished_write_jobs[ thread_ident ]
+
+
+
+
+
+    def _FlushJobsAwaitingCommit( self ):
+
+        jobs_awaiting_commit = self._jobs_awaiting_commit
+
+        self._jobs_awaiting_commit = []
+
+        for ( job, result, pubsubs ) in jobs_awaiting_commit:
+
+            self._DeliverJobResult( job, result, pubsubs )
+
+
+
+    def _GetConnectionLimits( self ):
+
+        if getattr( self._thread_local, 'connection_limits', None ) is None:
+
+            round_trip_times = []
+
+            for i in range( 3 ):
+
+                started = time.perf_counter()
+
+                self._c.execute( 'SELECT @@max_allowed_packet;' )
+
+                ( max_allowed_packet, ) = self._c.fetchone()
+
+                round_trip_times.append( time.perf_counter() - started )
+
+
+            self._thread_local.connection_limits = ( min( round_trip_times ), max_allowed_packet )
+
+
+        return self._thread_local.connection_limits
+
+
+    def _GetConnectionPoolSize( self ):
+
+        # the writer, the boot connection and a little headroom, capped at what mysql connector allows for a pool
+
+        return min( max( 10, self._num_read_connections + 2 ), 32 )
+
+
+    def _GetNumReadConnections( self ):
+
+        return 0
+
+
+    def _GetPreparedCursor( self, statement ):
+
+        prepared_cursors = self._prepared_cursors
+
+        if statement in prepared_cursors:
+
+            prepared_cursors.move_to_end( statement )
+
+            return prepared_cursors[ statement ]
+
+
+        # a prepared cursor keeps its one statement prepared on the server for as long as it is given the same sql, so there is a cursor per statement
+        # the connection buffers by default, which the connector does not offer for prepared cursors, but everything here is fetched straight away anyway
+        prepared_cursor = self._db.cursor( buffered = False, prepared = True )
+
+        prepared_cursors[ statement ] = prepared_cursor
+
+        while len( prepared_cursors ) > PREPARED_STATEMENT_CACHE_SIZE:
+
+            ( old_statement, old_prepared_cursor ) = prepared_cursors.popitem( last = False )
+
+            old_prepared_cursor.close()
+
+
+        return prepared_cursor
+
+
     def _GetRowCount( self ):
 
         row_count = self._c.rowcount
@@ -248,6 +902,36 @@ class HydrusDB( object ):
         else: return row_count
 
 
+    def _GroupCommitIsDue( self ):
+
+        # consecutive writes share one transaction, which is committed as soon as the writer runs out of queued work or the batch hits its time or row budget
+
+        if self._group_commit_paused or self._jobs.empty():
+
+            return True
+
+
+        if HydrusData.TimeHasPassedFloat( self._transaction_started + HC.MYSQL_GROUP_COMMIT_TIME ):
+
+            return True
+
+
+        if HC.MYSQL_GROUP_COMMIT_ROWS > 0 and self._c.GetRowsWritten() > HC.MYSQL_GROUP_COMMIT_ROWS:
+
+            return True
+
+
+        return False
+
+
+    def _HasUnfinishedWriteJobs( self, thread_ident ):
+
+        with self._unfinished_write_jobs_lock:
+
+            return thread_ident in self._thread_idents_to_num_unfinished_write_jobs
+
+
+
     def _InitCaches( self ):
 
         pass
@@ -291,7 +975,7 @@ class HydrusDB( object ):
                 password=HC.MYSQL_PASSWORD,
                 buffered=True,
                 pool_name="hydrus",
-                pool_size=10,
+                pool_size=self._GetConnectionPoolSize(),
                 charset=charset[0],
                 use_pure=False
             )
@@ -303,7 +987,7 @@ class HydrusDB( object ):
                 database=HC.MYSQL_DB,
                 buffered=True,
                 pool_name="hydrus",
-                pool_size=10,
+                pool_size=self._GetConnectionPoolSize(),
                 charset=charset[0],
                 use_pure=False
             )
@@ -311,15 +995,30 @@ class HydrusDB( object ):
         self._db.autocommit = True
         self._connection_timestamp = HydrusData.GetNow()
 
-        self._c = self._db.cursor()
-        try:
+        self._c = self._db.cursor( cursor_class = RowCountingCursor )
 
-            self._BeginImmediate()
+        # writes are batched into long transactions, so each statement should see the latest committed rows rather than a snapshot from the start of the batch
+        self._c.execute( 'SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED;' )
 
-        except Exception as e:
 
-            raise HydrusExceptions.DBAccessException( str( e ) )
 
+    def _IsDBThread( self ):
+
+        # the writer or a pooled reader, each with a live connection of its own
+
+        return self._c is not None and ( self._IsWriterThread() or self._IsReadThread() )
+
+
+    def _IsWriterThread( self ):
+
+        return getattr( self._thread_local, 'is_writer_thread', False )
+
+
+    def _IsReadThread( self ):
+
+        # a pooled reader, which must not touch caches the writer changes as it goes
+
+        return getattr( self._thread_local, 'is_read_thread', False )
 
 
     def _InitDiskCache( self ):
@@ -349,6 +1048,10 @@ class HydrusDB( object ):
 
                 self._current_status = 'db writing'
 
+                self._BeginImmediate()
+
+                self._transaction_contains_writes = True
+
             else:
 
                 self._current_status = 'db reading'
@@ -365,33 +1068,82 @@ class HydrusDB( object ):
                 result = self._Write( action, *args, **kwargs )
 
 
-            for ( topic, args, kwargs ) in self._pubsubs:
+            if self._db.in_transaction:
+
+                # the work is not durable yet, so the result and pubsubs wait for the group commit
+
+                self._jobs_awaiting_commit.append( ( job, result, self._pubsubs ) )
+
+                if self._GroupCommitIsDue():
 
-                self._controller.pub( topic, *args, **kwargs )
+                    self._Commit()
 
 
-            if job.IsSynchronous():
+            else:
+
+                # a plain read, or a job that committed on its own (mysql commits implicitly on ddl)
 
-                job.PutResult( result )
+                self._FlushJobsAwaitingCommit()
+
+                self._DeliverJobResult( job, result, self._pubsubs )
 
 
         except Exception as e:
 
+            self._FinishWriteJob( job )
+
             self._ManageDBError( job, e )
 
-            try:
+            if self._TransactionWasLost( e ):
+
+                jobs_to_replay = [ batched_job for ( batched_job, result, pubsubs ) in self._jobs_awaiting_commit ]
+
+                self._jobs_awaiting_commit = []
+
+                try:
+
+                    self._Rollback()
+
+                except Exception as rollback_e:
+
+                    HydrusData.Print( 'When the transaction failed, attempting to rollback the database failed. Please restart the client as soon as is convenient.' )
 
-                self._Rollback()
+                    self._CloseDBCursor()
 
-            except Exception as rollback_e:
+                    self._InitDBCursor(started=True)
 
-                HydrusData.Print( 'When the transaction failed, attempting to rollback the database failed. Please restart the client as soon as is convenient.' )
+                    HydrusData.PrintException( rollback_e )
 
-                self._CloseDBCursor()
 
-                self._InitDBCursor(started=True)
+                caches_touched = self._caches_touched_in_transaction
+
+                self._caches_touched_in_transaction = set()
+
+                self._RefreshCachesAfterRollback( caches_touched )
+
+            else:
+
+                # anything batched before this job was committed along with its ddl, so it stands
+
+                jobs_to_replay = []
+
+                self._FlushJobsAwaitingCommit()
+
+
+            # the rest of the batch did nothing wrong, so redo each of those jobs in its own transaction
+
+            for batched_job in jobs_to_replay:
+
+                self._group_commit_paused = True
+
+                try:
+
+                    self._ProcessJob( batched_job )
+
+                finally:
+
+                    self._group_commit_paused = False
 
-                HydrusData.PrintException( rollback_e )
 
 
         finally:
@@ -409,11 +1161,21 @@ class HydrusDB( object ):
         raise NotImplementedError()
 
 
+    def _RefreshCachesAfterRollback( self, caches_touched ):
+
+        pass
+
+
     def _RepairDB( self ):
 
         pass
 
 
+    def _ReportCacheStats( self ):
+
+        pass
+
+
     def _ReportOverupdatedDB( self, version ):
 
         pass
@@ -426,59 +1188,149 @@ class HydrusDB( object ):
 
     def _ReportStatus( self, text ):
 
-        HydrusData.Print( text )
+        HydrusData.Print( text )
+
+
+    def _Rollback( self ):
+
+        if self._db.in_transaction:
+
+            self._db.rollback()
+
+        else:
+
+            HydrusData.Print( 'Received a call to rollback, but was not in a transaction!' )
+
+
+
+    def _RunJob( self, job ):
+
+        if HG.db_report_mode:
+
+            summary = 'Running ' + job.ToString()
+
+            HydrusData.ShowText( summary )
+
+
+        if HG.db_profile_mode:
+
+            summary = 'Profiling ' + job.ToString()
+
+            HydrusData.ShowText( summary )
+
+            HydrusData.Profile( summary, 'self._ProcessJob( job )', globals(), locals() )
+
+        else:
+
+            self._ProcessJob( job )
+
+
+        if HG.db_report_mode:
+
+            self._ReportCacheStats()
+
+
+
+    def _Save( self ):
+        pass
+
+    def _SelectFromList( self, select_statement, xs ):
+
+        # issue here is that doing a simple blah_id = ? is real quick and cacheable but doing a lot of fetchone()s is slow
+        # blah_id IN ( 1, 2, 3 ) is fast to execute but not cacheable and doing the str() list splay takes time so there is initial lag
+        # doing the temporaryintegertable trick works well for gigantic lists you refer to frequently but it is super laggy when you sometimes are only selecting four things
+        # blah_id IN ( ?, ?, ? ) as a server-side prepared statement is fast and cacheable, so lets do that in chunks, sized to the connection
+
+        # this will take a select statement with {} like so:
+        # SELECT blah_id, blah FROM blahs WHERE blah_id IN {};
+
+        if len( xs ) == 0:
+
+            return
+
+
+        # past a point, though, it is cheaper to stage the ids in a pooled table and make one query of it
+        if len( xs ) > STAGED_ID_SELECT_THRESHOLD and all( isinstance( x, int ) for x in xs ):
+
+            with TemporaryIntegerTable( self._c, xs, 'temp_id' ) as temp_table_name:
+
+                self._c.execute( select_statement.format( '( SELECT temp_id FROM ' + temp_table_name + ' )' ) )
+
+                rows = self._c.fetchall()
+
+
+            for row in rows:
+
+                yield row
+
+
+            return
+
+
+        if not isinstance( xs, list ):
+
+            xs = list( xs )
+
+
+        ( round_trip_time, max_allowed_packet ) = self._GetConnectionLimits()
+
+        # leave plenty of the packet for the rest of the statement and the protocol
+        biggest_param_size = max( ( len( x ) if isinstance( x, ( str, bytes ) ) else 8 for x in xs ) )
+
+        max_chunk_size = min( SELECT_FROM_LIST_MAX_CHUNK_SIZE, max( 1, ( max_allowed_packet // 2 ) // ( biggest_param_size + 16 ) ) )
+
+        max_chunk_size = 1 << ( max_chunk_size.bit_length() - 1 )
+
+        chunk_size = min( self._select_from_list_chunk_sizes.get( select_statement, SELECT_FROM_LIST_DEFAULT_CHUNK_SIZE ), max_chunk_size )
+
+        i = 0
+
+        while i < len( xs ):
+
+            chunk = list( xs[ i : i + chunk_size ] )
+
+            i += len( chunk )
 
+            # statements are only ever prepared for power of two chunks, and a short chunk is made up with repeats of its last id, which IN does not mind
+            num_params = 1 << ( len( chunk ) - 1 ).bit_length()
 
-    def _Rollback( self ):
+            if num_params > len( chunk ):
 
-        if self._db.in_transaction:
+                chunk.extend( [ chunk[-1] ] * ( num_params - len( chunk ) ) )
 
-            self._db.rollback()
 
-        else:
+            chunk_statement = select_statement.format( '({})'.format( ','.join( [ '%s' ] * num_params ) ) )
 
-            HydrusData.Print( 'Received a call to rollback, but was not in a transaction!' )
+            prepared_cursor = self._GetPreparedCursor( chunk_statement )
 
+            started = time.perf_counter()
 
+            prepared_cursor.execute( chunk_statement, chunk )
 
-    def _Save( self ):
-        pass
+            rows = prepared_cursor.fetchall()
 
-    def _SelectFromList( self, select_statement, xs ):
+            time_took = time.perf_counter() - started
 
-        # issue here is that doing a simple blah_id = ? is real quick and cacheable but doing a lot of fetchone()s is slow
-        # blah_id IN ( 1, 2, 3 ) is fast to execute but not cacheable and doing the str() list splay takes time so there is initial lag
-        # doing the temporaryintegertable trick works well for gigantic lists you refer to frequently but it is super laggy when you sometimes are only selecting four things
-        # blah_id IN ( ?, ?, ? ) is fast and cacheable but there's a small limit (1024 is too many) to the number of params sql can handle
-        # so lets do the latter but break it into 256-strong chunks to get a good medium
+            if num_params == chunk_size:
 
-        # this will take a select statement with {} like so:
-        # SELECT blah_id, blah FROM blahs WHERE blah_id IN {};
-        MAX_CHUNK_SIZE = 256
+                if time_took < round_trip_time * SELECT_FROM_LIST_ROUND_TRIPS_PER_CHUNK and chunk_size * 2 <= max_chunk_size:
 
-        # do this just so we aren't always reproducing this long string for gigantic lists
-        # and also so we aren't overmaking it when this gets spammed with a lot of len() == 1 calls
-        if len( xs ) >= MAX_CHUNK_SIZE:
+                    chunk_size *= 2
 
-            max_statement = select_statement.format( '({})'.format( ','.join( ['%s'] * MAX_CHUNK_SIZE ) ) )
+                elif time_took > SELECT_FROM_LIST_SLOW_CHUNK_TIME and chunk_size // 2 >= SELECT_FROM_LIST_MIN_CHUNK_SIZE:
 
-        for chunk in HydrusData.SplitListIntoChunks( xs, MAX_CHUNK_SIZE ):
+                    chunk_size //= 2
 
-            if len( chunk ) == MAX_CHUNK_SIZE:
 
-                chunk_statement = max_statement
+                self._select_from_list_chunk_sizes[ select_statement ] = chunk_size
 
-            else:
 
-                chunk_statement = select_statement.format( '({})'.format( ','.join( ['%s'] * len( chunk ) ) ) )
+            for row in rows:
 
-            self._c.execute(chunk_statement, chunk)
-            for row in self._c.fetchall():
                 yield row
 
 
 
-
     def _SelectFromListFetchAll( self, select_statement, xs ):
 
         return list(self._SelectFromList( select_statement, xs ))
@@ -487,6 +1339,18 @@ class HydrusDB( object ):
     def _ShrinkMemory( self ):
         pass
 
+    def _StartWriteJob( self, job ):
+
+        thread_ident = threading.get_ident()
+
+        with self._unfinished_write_jobs_lock:
+
+            self._unfinished_write_jobs_to_thread_idents[ job ] = thread_ident
+
+            self._thread_idents_to_num_unfinished_write_jobs[ thread_ident ] += 1
+
+
+
     def _STI( self, raw_data = None ):
 
 
@@ -503,10 +1367,7 @@ class HydrusDB( object ):
 
         if not raw_data:
             # strip singleton tuples to a list
-            try:
-                return [ item for ( item, ) in self._c.fetchall() ]
-            except mysql.connector.errors.InterfaceError:
-                return []
+            return [ item for ( item, ) in self._StreamFetchedRows() ]
 
         else:
             return [ item for ( item, ) in raw_data ]
@@ -517,15 +1378,80 @@ class HydrusDB( object ):
         if not raw_data:
 
             # strip singleton tuples to a set
-            try:
-                return { item for ( item, ) in self._c.fetchall()  }
-            except mysql.connector.errors.InterfaceError:
-                return {}
+            return { item for ( item, ) in self._StreamFetchedRows() }
 
         else:
             return {item for (item,) in raw_data}
 
 
+    def _StreamFetchedRows( self ):
+
+        # the writer's cursor is buffered, so the whole result is already in client memory, but fetchmany at least does not copy it into a second giant list on its way to the caller
+        # results that can be huge should come from _StreamSelect instead
+
+        try:
+
+            rows = self._c.fetchmany( FETCH_MANY_SIZE )
+
+        except mysql.connector.errors.InterfaceError:
+
+            return
+
+
+        while len( rows ) > 0:
+
+            for row in rows:
+
+                yield row
+
+
+            rows = self._c.fetchmany( FETCH_MANY_SIZE )
+
+
+    def _StreamSelect( self, query, args = None ):
+
+        # an unbuffered cursor hands the rows over as the server sends them, so only FETCH_MANY_SIZE of them are in client memory at once
+        # nothing else may run on the connection until the result is read to the end, so this is for _STL and _STS to drain straight away
+
+        cursor = self._db.cursor( buffered = False )
+
+        try:
+
+            cursor.execute( query, args )
+
+            rows = cursor.fetchmany( FETCH_MANY_SIZE )
+
+            while len( rows ) > 0:
+
+                for row in rows:
+
+                    yield row
+
+
+                rows = cursor.fetchmany( FETCH_MANY_SIZE )
+
+
+        finally:
+
+            cursor.close()
+
+
+
+    def _TouchCache( self, cache_name ):
+
+        self._caches_touched_in_transaction.add( cache_name )
+
+
+    def _TransactionWasLost( self, e ):
+
+        if self._db.in_transaction:
+
+            return True
+
+
+        return isinstance( e, mysql.connector.Error ) and e.errno in TRANSACTION_ROLLED_BACK_ERRNOS
+
+
     def _UpdateDB( self, version ):
 
         raise NotImplementedError()
@@ -595,11 +1521,13 @@ class HydrusDB( object ):
 
     def JobsQueueEmpty( self ):
 
-        return self._jobs.empty()
+        return self._jobs.empty() and self._read_jobs.empty()
 
 
     def MainLoop( self ):
 
+        self._thread_local.is_writer_thread = True
+
         try:
 
             self._InitDBCursor(started=True) # have to reinitialise because the thread id has changed
@@ -617,6 +1545,13 @@ class HydrusDB( object ):
             return
 
 
+        # readers only start once the caches they share with the writer exist
+
+        for i in range( self._num_read_connections ):
+
+            self._controller.CallToThreadLongRunning( self.ReadLoop )
+
+
         self._ready_to_serve_requests = True
 
         error_count = 0
@@ -633,25 +1568,7 @@ class HydrusDB( object ):
 
                 try:
 
-                    if HG.db_report_mode:
-
-                        summary = 'Running ' + job.ToString()
-
-                        HydrusData.ShowText( summary )
-
-
-                    if HG.db_profile_mode:
-
-                        summary = 'Profiling ' + job.ToString()
-
-                        HydrusData.ShowText( summary )
-
-                        HydrusData.Profile( summary, 'self._ProcessJob( job )', globals(), locals() )
-
-                    else:
-
-                        self._ProcessJob( job )
-
+                    self._RunJob( job )
 
                     error_count = 0
 
@@ -677,6 +1594,13 @@ class HydrusDB( object ):
 
 
 
+        self._Commit()
+
+        while self._num_read_loops_running > 0:
+
+            time.sleep( 0.1 )
+
+
         self._CleanUpCaches()
 
         self._CloseDBCursor()
@@ -695,6 +1619,13 @@ class HydrusDB( object ):
             job_type = 'read'
 
 
+        if job_type == 'read' and self._IsDBThread():
+
+            # a db thread asking for a read (a lazy sibling lookup in the middle of a search, say) would otherwise wait on a queue it is meant to be serving
+
+            return self._Read( action, *args, **kwargs )
+
+
         synchronous = True
 
         job = HydrusData.JobDatabase( job_type, synchronous, action, *args, **kwargs )
@@ -704,11 +1635,106 @@ class HydrusDB( object ):
             raise HydrusExceptions.ShutdownException( 'Application has shut down!' )
 
 
-        self._jobs.put( job )
+        if job_type == 'read_write':
+
+            self._StartWriteJob( job )
+
+
+        # a pooled reader only sees committed rows, so a thread that has a write still in flight reads behind it on the writer's queue. everyone else keeps the pool
+
+        if job_type == 'read' and action not in self.SERIAL_READ_ACTIONS and self._num_read_loops_running > 0 and not self._HasUnfinishedWriteJobs( threading.get_ident() ):
+
+            self._read_jobs.put( job )
+
+        else:
+
+            self._jobs.put( job )
+
 
         return job.GetResult()
 
 
+    def ReadLoop( self ):
+
+        self._thread_local.is_read_thread = True
+
+        try:
+
+            self._InitDBCursor(started=True)
+
+        except Exception as e:
+
+            HydrusData.Print( 'A db read connection could not be initialised! Reads will share the other connections.' )
+
+            HydrusData.PrintException( e )
+
+            return
+
+
+        with self._read_loops_lock:
+
+            self._num_read_loops_running += 1
+
+
+        try:
+
+            error_count = 0
+
+            while not ( ( self._local_shutdown or self._controller.ModelIsShutdown() ) and self._read_jobs.empty() ):
+
+                try:
+
+                    job = self._read_jobs.get( timeout = 1 )
+
+                except queue.Empty:
+
+                    continue
+
+
+                try:
+
+                    self._RunJob( job )
+
+                    error_count = 0
+
+                except:
+
+                    error_count += 1
+
+                    if error_count > 5:
+
+                        raise
+
+
+                    self._read_jobs.put( job )
+
+                    time.sleep( 5 )
+
+
+
+        finally:
+
+            with self._read_loops_lock:
+
+                self._num_read_loops_running -= 1
+
+                if self._num_read_loops_running == 0:
+
+                    # nothing is left to drain the read queue, so hand anything still waiting to the writer
+
+                    while not self._read_jobs.empty():
+
+                        self._jobs.put( self._read_jobs.get() )
+
+
+
+
+            self._CloseDBCursor()
+
+            self._CloseDBConnection()
+
+
+
     def ReadyToServeRequests( self ):
 
         return self._ready_to_serve_requests
@@ -730,11 +1756,158 @@ class HydrusDB( object ):
             raise HydrusExceptions.ShutdownException( 'Application has shut down!' )
 
 
+        self._StartWriteJob( job )
+
         self._jobs.put( job )
 
         if synchronous: return job.GetResult()
 
 
+class RowCountingCursor( CMySQLCursorBuffered ):
+
+    # adds up the rows its statements change, so the writer can size a group commit without asking the server after every job
+
+    def __init__( self, *args, **kwargs ):
+
+        CMySQLCursorBuffered.__init__( self, *args, **kwargs )
+
+        self._rows_written = 0
+        self._in_executemany = False
+
+
+    def _CountRows( self ):
+
+        if not self.with_rows and self.rowcount > 0:
+
+            self._rows_written += self.rowcount
+
+
+
+    def execute( self, *args, **kwargs ):
+
+        result = CMySQLCursorBuffered.execute( self, *args, **kwargs )
+
+        # executemany may run each row through here, and counts the total itself
+
+        if not self._in_executemany:
+
+            self._CountRows()
+
+
+        return result
+
+
+    def executemany( self, *args, **kwargs ):
+
+        self._in_executemany = True
+
+        try:
+
+            result = CMySQLCursorBuffered.executemany( self, *args, **kwargs )
+
+        finally:
+
+            self._in_executemany = False
+
+
+        self._CountRows()
+
+        return result
+
+
+    def GetRowsWritten( self ):
+
+        return self._rows_written
+
+
+    def ResetRowsWritten( self ):
+
+        self._rows_written = 0
+
+
+class StagedIdTablePool( object ):
+
+    def __init__( self, cursor ):
+
+        self._cursor = cursor
+
+        self._definitions_to_free_table_names = collections.defaultdict( list )
+        self._definitions_to_num_tables = collections.Counter()
+        self._table_names_to_definitions = {}
+
+
+    def AcquireTable( self, name, columns_definition ):
+
+        definition = ( name, columns_definition )
+
+        free_table_names = self._definitions_to_free_table_names[ definition ]
+
+        if len( free_table_names ) > 0:
+
+            return free_table_names.pop()
+
+
+        # nested uses want their own tables, so there can be a few of each shape
+
+        self._definitions_to_num_tables[ definition ] += 1
+
+        table_name = 'mem.staged_' + name + '_' + str( self._definitions_to_num_tables[ definition ] )
+
+        # a pooled connection can hand back a session that still has it
+        self._cursor.execute( 'CREATE TEMPORARY TABLE IF NOT EXISTS ' + table_name + ' ( ' + columns_definition + ' ) ENGINE=MEMORY;' )
+
+        self._cursor.execute( 'DELETE FROM ' + table_name + ';' )
+
+        self._table_names_to_definitions[ table_name ] = definition
+
+        return table_name
+
+
+    def ReleaseTable( self, table_name ):
+
+        # DELETE with no WHERE empties a MEMORY table in one go and, unlike TRUNCATE, does not end a group commit transaction
+
+        self._cursor.execute( 'DELETE FROM ' + table_name + ';' )
+
+        definition = self._table_names_to_definitions[ table_name ]
+
+        self._definitions_to_free_table_names[ definition ].append( table_name )
+
+
+class TemporaryIntegerPairTable( object ):
+
+    def __init__( self, cursor, integer_pair_iterable, column_names ):
+
+        self._cursor = cursor
+        self._integer_pair_iterable = integer_pair_iterable
+        self._column_names = column_names
+
+        self._table_name = None
+
+
+    def __enter__( self ):
+
+        ( first_column_name, second_column_name ) = self._column_names
+
+        staged_id_table_pool = GetStagedIdTablePool( self._cursor )
+
+        self._table_name = staged_id_table_pool.AcquireTable( 'intpair_' + first_column_name + '_' + second_column_name, first_column_name + ' INTEGER, ' + second_column_name + ' INTEGER, PRIMARY KEY ( ' + first_column_name + ', ' + second_column_name + ' )' )
+
+        for chunk in HydrusData.SplitIteratorIntoChunks( self._integer_pair_iterable, STAGED_ID_INSERT_CHUNK_SIZE ):
+
+            self._cursor.execute( 'INSERT IGNORE INTO ' + self._table_name + ' ( ' + first_column_name + ', ' + second_column_name + ' ) VALUES ' + ','.join( '(%d,%d)' % pair for pair in chunk ) + ';' )
+
+
+        return self._table_name
+
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+
+        GetStagedIdTablePool( self._cursor ).ReleaseTable( self._table_name )
+
+        return False
+
+
 class TemporaryIntegerTable( object ):
 
     def __init__( self, cursor, integer_iterable, column_name ):
@@ -743,20 +1916,27 @@ class TemporaryIntegerTable( object ):
         self._integer_iterable = integer_iterable
         self._column_name = column_name
 
-        self._table_name = 'mem.tempint' + os.urandom( 32 ).hex()
+        self._table_name = None
 
 
     def __enter__( self ):
 
-        self._cursor.execute( 'CREATE TEMPORARY TABLE ' + self._table_name + ' ( ' + self._column_name + ' INTEGER PRIMARY KEY ) ENGINE=MEMORY;' )
+        staged_id_table_pool = GetStagedIdTablePool( self._cursor )
+
+        self._table_name = staged_id_table_pool.AcquireTable( 'int_' + self._column_name, self._column_name + ' INTEGER PRIMARY KEY' )
+
+        # the ids are written straight into multi-row VALUES, so there is no per-parameter escaping and only a round trip per chunk
+
+        for chunk in HydrusData.SplitIteratorIntoChunks( self._integer_iterable, STAGED_ID_INSERT_CHUNK_SIZE ):
+
+            self._cursor.execute( 'INSERT IGNORE INTO ' + self._table_name + ' ( ' + self._column_name + ' ) VALUES ' + ','.join( '(%d)' % i for i in chunk ) + ';' )
 
-        self._cursor.executemany( 'INSERT INTO ' + self._table_name + ' ( ' + self._column_name + ' ) VALUES ( %s );', ( ( i, ) for i in self._integer_iterable ) )
 
         return self._table_name
 
 
     def __exit__( self, exc_type, exc_val, exc_tb ):
 
-        self._cursor.execute( 'DROP TABLE ' + self._table_name + ';' )
+        GetStagedIdTablePool( self._cursor ).ReleaseTable( self._table_name )
 
         return False
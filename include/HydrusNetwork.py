@@ -8,6 +8,7 @@ from . import HydrusSerialisable
 from . import HydrusLocking
 import threading
 import urllib
+import zlib
 
 INT_PARAMS = { 'expires', 'num', 'since', 'content_type', 'action', 'status' }
 BYTE_PARAMS = { 'access_key', 'account_type_key', 'subject_account_key', 'hash', 'registration_key', 'subject_hash', 'update_hash' }
@@ -15,6 +16,38 @@ STRING_PARAMS = { 'subject_tag' }
 JSON_PARAMS = set()
 JSON_BYTE_LIST_PARAMS = set()
 
+def CreateStreamedContentUpdate( network_bytes ):
+    
+    # a big content update parses out to many times its compressed size, so we keep the bytes and let each getter decode its rows as they are asked for
+    
+    try:
+        
+        reader = HydrusSerialisable.StreamedJSONReader( network_bytes )
+        
+        reader.EnterArray()
+        
+        reader.NextItem()
+        
+        serialisable_type = reader.ReadValue()
+        
+        reader.NextItem()
+        
+        version = reader.ReadValue()
+        
+    except zlib.error:
+        
+        # old lz4 updates
+        
+        return HydrusSerialisable.CreateFromNetworkBytes( network_bytes )
+        
+    
+    if serialisable_type != HydrusSerialisable.SERIALISABLE_TYPE_CONTENT_UPDATE or version != ContentUpdate.SERIALISABLE_VERSION:
+        
+        return HydrusSerialisable.CreateFromNetworkBytes( network_bytes )
+        
+    
+    return ContentUpdate( network_bytes = network_bytes )
+    
 def GenerateDefaultServiceDictionary( service_type ):
     
     dictionary = HydrusSerialisable.SerialisableDictionary()
@@ -1233,28 +1266,55 @@ class ContentUpdate( HydrusSerialisable.SerialisableBase ):
     SERIALISABLE_NAME = 'Content Update'
     SERIALISABLE_VERSION = 1
     
-    def __init__( self ):
+    def __init__( self, network_bytes = None ):
         
         HydrusSerialisable.SerialisableBase.__init__( self )
         
         self._content_data = {}
         
+        # if we were made from network bytes, the rows stay compressed and are only decoded as they are iterated
+        
+        self._network_bytes = network_bytes
+        self._num_rows = None
+        
     
     def _GetContent( self, content_type, action ):
         
-        if content_type in self._content_data:
+        if self._network_bytes is not None:
+            
+            for ( row_content_type, row_action, reader ) in self._IterateStreamedContent():
+                
+                if row_content_type == content_type and row_action == action:
+                    
+                    reader.EnterArray()
+                    
+                    while reader.NextItem():
+                        
+                        yield reader.ReadValue()
+                        
+                    
+                else:
+                    
+                    reader.SkipValue()
+                    
+                
+            
+        elif content_type in self._content_data:
             
             if action in self._content_data[ content_type ]:
                 
-                return self._content_data[ content_type ][ action ]
+                yield from self._content_data[ content_type ][ action ]
                 
             
         
-        return []
-        
     
     def _GetSerialisableInfo( self ):
         
+        if self._network_bytes is not None:
+            
+            return HydrusSerialisable.CreateFromNetworkBytes( self._network_bytes ).GetSerialisableTuple()[2]
+            
+        
         serialisable_info = []
         
         for ( content_type, actions_to_datas ) in list(self._content_data.items()):
@@ -1277,6 +1337,69 @@ class ContentUpdate( HydrusSerialisable.SerialisableBase ):
             
         
     
+    def _IterateStreamedContent( self ):
+        
+        # yields ( content_type, action, reader ) for each block of rows, with the reader sat at the start of the rows. the caller must read or skip them before the next block
+        
+        reader = HydrusSerialisable.StreamedJSONReader( self._network_bytes )
+        
+        # ( serialisable_type, version, serialisable_info )
+        
+        reader.EnterArray()
+        
+        reader.NextItem()
+        reader.SkipValue()
+        
+        reader.NextItem()
+        reader.SkipValue()
+        
+        reader.NextItem()
+        reader.EnterArray()
+        
+        while reader.NextItem():
+            
+            # ( content_type, serialisable_actions_to_datas )
+            
+            reader.EnterArray()
+            
+            reader.NextItem()
+            
+            content_type = reader.ReadValue()
+            
+            reader.NextItem()
+            reader.EnterArray()
+            
+            while reader.NextItem():
+                
+                # ( action, data )
+                
+                reader.EnterArray()
+                
+                reader.NextItem()
+                
+                action = reader.ReadValue()
+                
+                reader.NextItem()
+                
+                yield ( content_type, action, reader )
+                
+                reader.NextItem()
+                
+            
+            reader.NextItem()
+            
+        
+    
+    def _IterateStreamedRows( self, reader ):
+        
+        reader.EnterArray()
+        
+        while reader.NextItem():
+            
+            yield reader.ReadValue()
+            
+        
+    
     def AddRow( self, row ):
         
         ( content_type, action, data ) = row
@@ -1334,8 +1457,69 @@ class ContentUpdate( HydrusSerialisable.SerialisableBase ):
         return self._GetContent( HC.CONTENT_TYPE_TAG_SIBLINGS, HC.CONTENT_UPDATE_ADD )
         
     
+    def IterateContent( self ):
+        
+        # yields ( content_type, action, rows ) for each block of rows in the order they are stored, so a consumer that wants everything decodes the update once rather than once per getter
+        # rows should be used up before the next block is asked for. anything left over is read past here
+        
+        if self._network_bytes is not None:
+            
+            for ( content_type, action, reader ) in self._IterateStreamedContent():
+                
+                rows = self._IterateStreamedRows( reader )
+                
+                yield ( content_type, action, rows )
+                
+                collections.deque( rows, maxlen = 0 )
+                
+            
+        else:
+            
+            for ( content_type, actions_to_datas ) in list( self._content_data.items() ):
+                
+                for ( action, data ) in list( actions_to_datas.items() ):
+                    
+                    yield ( content_type, action, iter( data ) )
+                    
+                
+            
+        
+    
     def GetNumRows( self ):
         
+        if self._network_bytes is not None:
+            
+            if self._num_rows is None:
+                
+                num = 0
+                
+                for ( content_type, action, reader ) in self._IterateStreamedContent():
+                    
+                    reader.EnterArray()
+                    
+                    while reader.NextItem():
+                        
+                        if content_type == HC.CONTENT_TYPE_MAPPINGS:
+                            
+                            ( tag_id, hash_ids ) = reader.ReadValue()
+                            
+                            num += len( hash_ids )
+                            
+                        else:
+                            
+                            reader.SkipValue()
+                            
+                            num += 1
+                            
+                        
+                    
+                
+                self._num_rows = num
+                
+            
+            return self._num_rows
+            
+        
         num = 0
         
         for content_type in self._content_data:
@@ -1,4 +1,6 @@
+import codecs
 import json
+import re
 import zlib
 
 LZ4_OK = False
@@ -457,3 +459,228 @@ class SerialisableList( SerialisableBase, list ):
         
     
 SERIALISABLE_TYPES_TO_OBJECT_TYPES[ SERIALISABLE_TYPE_LIST ] = SerialisableList
+
+class StreamedJSONReader( object ):
+    
+    # walks a zlib compressed json dump front to back, decompressing a block at a time, so a big array can be read or skipped an item at a time without the whole thing ever being in memory
+    
+    COMPRESSED_BLOCK_SIZE = 65536
+    
+    ARRAY_SKIP_RE = re.compile( r'[\[\]"]' )
+    
+    def __init__( self, network_bytes ):
+        
+        self._network_bytes = memoryview( network_bytes )
+        
+        self._decompressor = zlib.decompressobj()
+        self._text_decoder = codecs.getincrementaldecoder( 'utf-8' )()
+        self._json_decoder = json.JSONDecoder()
+        
+        self._compressed_position = 0
+        self._done = False
+        
+        self._text = ''
+        self._position = 0
+        
+        self._array_starts = []
+        
+        # this raises zlib.error straight away if these are not zlib bytes
+        
+        self._Fill()
+        
+    
+    def _Expect( self, c ):
+        
+        if self._Peek() != c:
+            
+            raise ValueError( 'Serialised data was malformed! Expected "' + c + '".' )
+            
+        
+        self._position += 1
+        
+    
+    def _Fill( self ):
+        
+        if self._done:
+            
+            return False
+            
+        
+        # we drop what has been read and at least double what is left, so a single huge item is not re-parsed once per block
+        
+        leftover_text = self._text[ self._position : ]
+        
+        pieces = [ leftover_text ]
+        
+        num_chars = 0
+        target_num_chars = max( len( leftover_text ), 1 )
+        
+        while num_chars < target_num_chars and not self._done:
+            
+            compressed_block = self._network_bytes[ self._compressed_position : self._compressed_position + self.COMPRESSED_BLOCK_SIZE ]
+            
+            self._compressed_position += len( compressed_block )
+            
+            obj_bytes = self._decompressor.decompress( compressed_block )
+            
+            if self._compressed_position >= len( self._network_bytes ):
+                
+                obj_bytes += self._decompressor.flush()
+                
+                self._done = True
+                
+            
+            piece = self._text_decoder.decode( obj_bytes, final = self._done )
+            
+            pieces.append( piece )
+            
+            num_chars += len( piece )
+            
+        
+        self._text = ''.join( pieces )
+        self._position = 0
+        
+        return True
+        
+    
+    def _Peek( self ):
+        
+        while True:
+            
+            while self._position < len( self._text ):
+                
+                c = self._text[ self._position ]
+                
+                if c not in ' \t\n\r':
+                    
+                    return c
+                    
+                
+                self._position += 1
+                
+            
+            if not self._Fill():
+                
+                raise ValueError( 'Serialised data was truncated!' )
+                
+            
+        
+    
+    def EnterArray( self ):
+        
+        self._Expect( '[' )
+        
+        self._array_starts.append( True )
+        
+    
+    def NextItem( self ):
+        
+        # True if the current array has another item, with the reader sat at its start. False if the array just closed
+        
+        c = self._Peek()
+        
+        if c == ']':
+            
+            self._position += 1
+            
+            self._array_starts.pop()
+            
+            return False
+            
+        
+        if self._array_starts[ -1 ]:
+            
+            self._array_starts[ -1 ] = False
+            
+        else:
+            
+            self._Expect( ',' )
+            
+        
+        return True
+        
+    
+    def ReadValue( self ):
+        
+        self._Peek()
+        
+        while True:
+            
+            try:
+                
+                ( value, end ) = self._json_decoder.raw_decode( self._text, self._position )
+                
+                # a number that runs to the end of what we have decompressed so far may not be finished
+                
+                if end < len( self._text ) or self._done:
+                    
+                    self._position = end
+                    
+                    return value
+                    
+                
+            except ValueError:
+                
+                if self._done:
+                    
+                    raise
+                    
+                
+            
+            self._Fill()
+            
+        
+    
+    def SkipValue( self ):
+        
+        if self._Peek() != '[':
+            
+            self.ReadValue()
+            
+            return
+            
+        
+        # counting brackets is much faster than building the objects, as long as there are no strings that might hide some
+        
+        depth = 0
+        scan_offset = 0
+        
+        while True:
+            
+            for match in self.ARRAY_SKIP_RE.finditer( self._text, self._position + scan_offset ):
+                
+                c = match.group()
+                
+                if c == '"':
+                    
+                    self.ReadValue()
+                    
+                    return
+                    
+                
+                if c == '[':
+                    
+                    depth += 1
+                    
+                else:
+                    
+                    depth -= 1
+                    
+                    if depth == 0:
+                        
+                        self._position = match.end()
+                        
+                        return
+                        
+                    
+                
+            
+            scan_offset = len( self._text ) - self._position
+            
+            if not self._Fill():
+                
+                raise ValueError( 'Serialised data was truncated!' )
+                
+            
+        
+    
@@ -2,16 +2,337 @@ from . import ClientConstants as CC
 from . import ClientGUIManagement
 from . import ClientNetworking
 from . import ClientCaches
+from . import ClientMedia
+from . import ClientRatings
 from . import ClientServices
 import collections
 from . import HydrusConstants as HC
+import numpy
 import os
+import random
+import shutil
+import tempfile
 import unittest
 from . import HydrusData
 from . import HydrusGlobals as HG
 
 class TestManagers( unittest.TestCase ):
     
+    def test_file_search_result_cache( self ):
+        
+        cache = ClientCaches.FileSearchResultCache( 5 )
+        
+        generation = cache.GetGeneration()
+        
+        cache.AddResult( 'blue eyes', generation, { 3, 1, 2 }, { ( 'tag', 1, 'eyes:blue' ) } )
+        cache.AddResult( 'inbox', generation, { 4 }, { ( 'inbox', ) } )
+        
+        self.assertEqual( list( cache.GetResult( 'blue eyes' ) ), [ 1, 2, 3 ] )
+        self.assertEqual( cache.GetResult( 'green eyes' ), None )
+        
+        # only the search that depends on the change is dropped
+        
+        cache.Invalidate( [ ( 'tag', 1, 'eyes:blue' ) ] )
+        
+        self.assertEqual( cache.GetResult( 'blue eyes' ), None )
+        self.assertEqual( list( cache.GetResult( 'inbox' ) ), [ 4 ] )
+        
+        # a search that ran before the change, or before the change is committed, is not stored
+        
+        cache.AddResult( 'blue eyes', generation, { 1, 2 }, { ( 'tag', 1, 'eyes:blue' ) } )
+        cache.AddResult( 'blue eyes', cache.GetGeneration(), { 1, 2 }, { ( 'tag', 1, 'eyes:blue' ) } )
+        
+        self.assertEqual( cache.GetResult( 'blue eyes' ), None )
+        
+        cache.NotifyCommitted()
+        
+        cache.AddResult( 'blue eyes', cache.GetGeneration(), { 1, 2 }, { ( 'tag', 1, 'eyes:blue' ) } )
+        
+        self.assertEqual( list( cache.GetResult( 'blue eyes' ) ), [ 1, 2 ] )
+        
+        # 'inbox' is the oldest, so it goes when the id budget is exceeded
+        
+        cache.AddResult( 'archive', cache.GetGeneration(), { 5, 6, 7 }, { ( 'inbox', ) } )
+        
+        self.assertEqual( cache.GetResult( 'inbox' ), None )
+        self.assertEqual( len( cache ), 2 )
+        
+        self.assertEqual( cache.GetStats(), ( 2, 5, 5, 3, 4 ) )
+        
+    
+    def test_json_dump_store( self ):
+        
+        path = tempfile.mkdtemp()
+        
+        try:
+            
+            store = ClientCaches.JSONDumpStore( path )
+            
+            store.LoadIndex( [] )
+            
+            pages = [ [ 'page', i ] for i in range( 50 ) ]
+            
+            session_name = store.Write( pages, split = True )
+            
+            store.SetRow( ( 'json_dumps_named', 1, 'last session', 100 ), session_name )
+            
+            self.assertEqual( store.Read( session_name ), pages )
+            
+            self.assertEqual( len( os.listdir( path ) ), 51 )
+            
+            # an unchanged object is not written again, and a changed session only writes the changed page and the manifest
+            
+            self.assertEqual( store.Write( pages, split = True ), session_name )
+            
+            pages[ 3 ] = [ 'page', 'changed' ]
+            
+            new_session_name = store.Write( pages, split = True )
+            
+            self.assertEqual( len( os.listdir( path ) ), 53 )
+            
+            store.SetRow( ( 'json_dumps_named', 1, 'last session', 100 ), new_session_name )
+            
+            self.assertEqual( store.Read( new_session_name ), pages )
+            
+            # the old manifest and page are only collected once committed and past the grace period
+            
+            self.assertEqual( store.CollectGarbage(), 0 )
+            
+            store.NotifyCommitted()
+            
+            self.assertEqual( store.GetNumOrphans(), 2 )
+            
+            store.GRACE_PERIOD = -1
+            
+            self.assertEqual( store.CollectGarbage(), 2 )
+            
+            self.assertEqual( len( os.listdir( path ) ), 51 )
+            
+            self.assertEqual( store.Read( new_session_name ), pages )
+            
+            # a blob left over from before is found when the index loads
+            
+            with open( os.path.join( path, 'legacy.json' ), 'w' ) as f:
+                
+                f.write( '"hello"' )
+                
+            
+            store = ClientCaches.JSONDumpStore( path )
+            
+            store.GRACE_PERIOD = -1
+            
+            store.LoadIndex( [ ( ( 'json_dumps_named', 1, 'last session', 100 ), new_session_name ) ] )
+            
+            self.assertEqual( store.Read( 'legacy.json' ), 'hello' )
+            
+            self.assertEqual( store.CollectGarbage(), 1 )
+            
+            store.DeleteRows( ( 'json_dumps_named', 1 ) )
+            
+            store.NotifyCommitted()
+            
+            self.assertEqual( store.CollectGarbage( max_num_to_delete = 100 ), 51 )
+            
+            self.assertEqual( os.listdir( path ), [] )
+            
+        finally:
+            
+            shutil.rmtree( path )
+            
+        
+    
+    def test_lru_cache( self ):
+        
+        cache = ClientCaches.LRUCache( 3 )
+        
+        cache.AddManyData( { 1 : 'a', 2 : 'b', 3 : 'c' } )
+        
+        self.assertEqual( cache.GetIfHasData( 1 ), 'a' )
+        
+        cache.AddData( 4, 'd' )
+        
+        # 2 was the least recently used, so it goes first
+        
+        self.assertEqual( len( cache ), 3 )
+        self.assertNotIn( 2, cache )
+        self.assertIn( 1, cache )
+        
+        ( keys_to_values, missing_keys ) = cache.GetManyDataAndMissing( [ 1, 2, 3, 4 ] )
+        
+        self.assertEqual( keys_to_values, { 1 : 'a', 3 : 'c', 4 : 'd' } )
+        self.assertEqual( missing_keys, [ 2 ] )
+        
+        self.assertEqual( cache.GetIfHasData( 2 ), None )
+        
+        self.assertEqual( cache.GetStats(), ( 3, 3, 4, 2 ) )
+        
+        cache.Clear()
+        
+        self.assertEqual( len( cache ), 0 )
+        
+    
+    def test_media_result_snapshot( self ):
+        
+        def make_media_result( hash_id, hash ):
+            
+            file_info_manager = ClientMedia.FileInfoManager( hash_id, hash, size = 1024, mime = HC.IMAGE_JPEG, width = 640, height = 480 )
+            
+            tags_manager = ClientMedia.TagsManager( { CC.LOCAL_TAG_SERVICE_KEY : { HC.CONTENT_STATUS_CURRENT : { 'blue eyes' } } } )
+            
+            locations_manager = ClientMedia.LocationsManager( set(), set(), set(), set() )
+            ratings_manager = ClientRatings.RatingsManager( {} )
+            file_viewing_stats_manager = ClientMedia.FileViewingStatsManager( 0, 0, 0, 0 )
+            
+            return ClientMedia.MediaResult( file_info_manager, tags_manager, locations_manager, ratings_manager, file_viewing_stats_manager )
+            
+        
+        hash_ids_to_hashes = { hash_id : HydrusData.GenerateKey() for hash_id in ( 1, 2, 3 ) }
+        
+        path = tempfile.mkdtemp()
+        
+        try:
+            
+            snapshot_path = os.path.join( path, ClientCaches.MEDIA_RESULT_SNAPSHOT_FILENAME )
+            
+            # one session fills the strong cache and saves it on shutdown
+            
+            cache = ClientCaches.MediaResultCache( strong_cache_size = 10, snapshot_path = snapshot_path )
+            
+            cache.AddMediaResults( [ make_media_result( hash_id, hash ) for ( hash_id, hash ) in hash_ids_to_hashes.items() ] )
+            
+            cache.SaveSnapshot()
+            
+            self.assertTrue( os.path.exists( snapshot_path ) )
+            
+            # the next one loads it, and the file goes as soon as it is read
+            
+            cache = ClientCaches.MediaResultCache( strong_cache_size = 10, snapshot_path = snapshot_path )
+            
+            self.assertFalse( os.path.exists( snapshot_path ) )
+            
+            # a change to 2 before anything asks for it means its saved row is stale
+            
+            content_update = HydrusData.ContentUpdate( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD, ( 'red eyes', ( hash_ids_to_hashes[ 2 ], ) ) )
+            
+            cache.ProcessContentUpdates( { CC.LOCAL_TAG_SERVICE_KEY : [ content_update ] } )
+            
+            ( media_results, missing_hash_ids ) = cache.GetMediaResultsAndMissing( [ 1, 2, 3, 4 ] )
+            
+            self.assertEqual( sorted( media_result.GetHashId() for media_result in media_results ), [ 1, 3 ] )
+            self.assertEqual( missing_hash_ids, [ 2, 4 ] )
+            
+            for media_result in media_results:
+                
+                self.assertEqual( media_result.GetHash(), hash_ids_to_hashes[ media_result.GetHashId() ] )
+                self.assertEqual( media_result.GetTagsManager().GetCurrent( CC.LOCAL_TAG_SERVICE_KEY ), { 'blue eyes' } )
+                
+            
+            # each row is handed out once, and after that the live object is what comes back
+            
+            ( second_media_results, missing_hash_ids ) = cache.GetMediaResultsAndMissing( [ 1, 3 ] )
+            
+            self.assertEqual( missing_hash_ids, [] )
+            
+            self.assertEqual( { id( media_result ) for media_result in second_media_results }, { id( media_result ) for media_result in media_results } )
+            
+            ClientCaches.MediaResultSnapshot.STATICWrite( snapshot_path, media_results )
+            
+            snapshot = ClientCaches.MediaResultSnapshot( snapshot_path )
+            
+            self.assertEqual( len( snapshot.PopMediaResults( [ 1, 3 ] ) ), 2 )
+            self.assertEqual( snapshot.PopMediaResults( [ 1, 3 ] ), [] )
+            
+        finally:
+            
+            shutil.rmtree( path )
+            
+        
+    
+    def test_phash_index( self ):
+        
+        phash = bytes.fromhex( '0000000000000000' )
+        one_bit_away = bytes.fromhex( '0100000000000000' )
+        four_bits_away = bytes.fromhex( '0f00000000000000' )
+        far_away = bytes.fromhex( 'ffffffffffffffff' )
+        
+        phash_index = ClientCaches.PHashIndex( [ ( 1, phash ), ( 2, one_bit_away ), ( 3, four_bits_away ) ] )
+        
+        phash_index.AddPHashes( [ ( 4, far_away ), ( 1, phash ) ] )
+        
+        self.assertEqual( len( phash_index ), 4 )
+        
+        self.assertEqual( set( phash_index.Search( phash, 0 ) ), { 1 } )
+        self.assertEqual( set( phash_index.Search( phash, 1 ) ), { 1, 2 } )
+        self.assertEqual( set( phash_index.Search( phash, 4 ) ), { 1, 2, 3 } )
+        self.assertEqual( set( phash_index.Search( far_away, 60 ) ), { 3, 4 } )
+        
+        phash_index.DeletePHashIds( { 1, 5 } )
+        
+        self.assertEqual( len( phash_index ), 3 )
+        
+        self.assertEqual( set( phash_index.Search( phash, 4 ) ), { 2, 3 } )
+        
+    
+    def test_phash_pairs_within_distance( self ):
+        
+        rng = random.Random( 42 )
+        
+        # clusters of near duplicates, so there are matches at every distance up to the limit as well as plenty of strangers
+        
+        phash_values = []
+        
+        for i in range( 20 ):
+            
+            base_value = rng.getrandbits( 64 )
+            
+            phash_values.append( base_value )
+            
+            for j in range( 9 ):
+                
+                value = base_value
+                
+                for bit in rng.sample( range( 64 ), rng.randint( 1, 12 ) ):
+                    
+                    value ^= 1 << bit
+                    
+                
+                phash_values.append( value )
+                
+            
+        
+        rng.shuffle( phash_values )
+        
+        phashes = numpy.array( phash_values, dtype = numpy.uint64 )
+        
+        query_phashes = phashes[ rng.sample( range( len( phashes ) ), 25 ) ]
+        
+        max_hamming_distance = 8
+        
+        expected_pairs = { ( query_index, phash_index ) for ( query_index, query_value ) in enumerate( query_phashes.tolist() ) for ( phash_index, value ) in enumerate( phash_values ) if bin( query_value ^ value ).count( '1' ) <= max_hamming_distance }
+        
+        old_max_matrix_cells = ClientCaches.PHASH_SEARCH_MAX_MATRIX_CELLS
+        
+        try:
+            
+            # 25 queries get tiles of 7, so the 200 phashes here cross many tile boundaries and the last tile is short
+            
+            ClientCaches.PHASH_SEARCH_MAX_MATRIX_CELLS = 175
+            
+            for num_threads in ( 1, 3 ):
+                
+                ( query_indices, phash_indices ) = ClientCaches.GetPHashPairsWithinDistance( query_phashes, phashes, max_hamming_distance, num_threads = num_threads )
+                
+                self.assertEqual( len( query_indices ), len( expected_pairs ) )
+                
+                self.assertEqual( set( zip( query_indices.tolist(), phash_indices.tolist() ) ), expected_pairs )
+                
+            
+        finally:
+            
+            ClientCaches.PHASH_SEARCH_MAX_MATRIX_CELLS = old_max_matrix_cells
+            
+        
+    
     def test_services( self ):
         
         def test_service( service, key, service_type, name ):
@@ -69,6 +390,43 @@ class TestManagers( unittest.TestCase ):
         self.assertRaises( Exception, services_manager.GetService, other_key )
         
     
+    def test_subtag_autocomplete_index( self ):
+        
+        HG.test_controller.SetRead( 'autocomplete_subtags', [ ( 1, 'samus aran' ), ( 2, 'gun' ), ( 3, 'big gun' ) ] )
+        
+        subtag_autocomplete_index = ClientCaches.SubtagAutocompleteIndex()
+        
+        # added while the load is reading, and newer than anything it read
+        subtag_autocomplete_index.AddSubtag( 4, 'gundam' )
+        
+        subtag_autocomplete_index.THREADLoad( 0 )
+        
+        self.assertTrue( subtag_autocomplete_index.IsReady() )
+        
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdsFromPrefix( 'sam' ), { 1 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdsFromPrefix( 'ar' ), { 1 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdsFromPrefix( 'gun' ), { 2, 3, 4 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdsFromPrefix( 'gun', whole_word = True ), { 2, 3 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdsFromPrefix( 'x' ), set() )
+        
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdCandidatesFromWildcard( '*gun*' ), { 2, 3, 4 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdCandidatesFromWildcard( '*us*ar*' ), None )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdCandidatesFromWildcard( '*mus*ara*' ), { 1 } )
+        
+        # case and accents are ignored, the same as the subtag column's collation
+        
+        subtag_autocomplete_index.AddSubtag( 5, 'Pokémon' )
+        
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdsFromPrefix( 'poke' ), { 5 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdsFromPrefix( 'POKÉ' ), { 5 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdCandidatesFromWildcard( '*kemo*' ), { 5 } )
+        self.assertEqual( subtag_autocomplete_index.GetSubtagIdCandidatesFromWildcard( '*SAMUS*' ), { 1 } )
+        
+        subtag_autocomplete_index.Reset()
+        
+        self.assertFalse( subtag_autocomplete_index.IsReady() )
+        
+    
     def test_undo( self ):
         
         hash_1 = HydrusData.GenerateKey()
@@ -152,6 +152,16 @@ class TestClientDB( unittest.TestCase ):
         
         self.assertEqual( set( result ), preds )
         
+        # cars, but only the top one
+        
+        result = self._read( 'autocomplete_predicates', tag_service_key = CC.LOCAL_TAG_SERVICE_KEY, search_text = 'c*', add_namespaceless = False, max_results = 1 )
+        
+        ( read_pred, ) = result
+        
+        self.assertEqual( read_pred.GetCount( HC.CONTENT_STATUS_CURRENT ), 1 )
+        
+        self.assertIn( read_pred, preds )
+        
         #
         
         result = self._read( 'autocomplete_predicates', tag_service_key = CC.LOCAL_TAG_SERVICE_KEY, search_text = 'ser*' )
@@ -193,6 +203,41 @@ class TestClientDB( unittest.TestCase ):
         self.assertEqual( result, [] )
         
     
+    def test_autocomplete_limit_after_merge( self ):
+        
+        TestClientDB._clear_db()
+        
+        ( hash_1, hash_2, hash_3 ) = [ HydrusData.GenerateKey() for i in range( 3 ) ]
+        
+        content_updates = []
+        
+        content_updates.append( HydrusData.ContentUpdate( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD, ( 'cat', ( hash_1, hash_2, hash_3 ) ) ) )
+        content_updates.append( HydrusData.ContentUpdate( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD, ( 'cars', ( hash_1, hash_2 ) ) ) )
+        content_updates.append( HydrusData.ContentUpdate( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD, ( 'series:cars', ( hash_1, hash_2 ) ) ) )
+        
+        self._write( 'content_updates', { CC.LOCAL_TAG_SERVICE_KEY : content_updates } )
+        
+        # 'cat' outranks both parts of 'cars', but not their namespaceless sum
+        
+        result = self._read( 'autocomplete_predicates', tag_service_key = CC.LOCAL_TAG_SERVICE_KEY, search_text = 'ca*', add_namespaceless = True, max_results = 1 )
+        
+        ( read_pred, ) = result
+        
+        self.assertEqual( read_pred, ClientSearch.Predicate( HC.PREDICATE_TYPE_TAG, 'cars' ) )
+        
+        self.assertEqual( read_pred.GetCount( HC.CONTENT_STATUS_CURRENT ), 4 )
+        
+        # with nothing to merge, each part is ranked on its own
+        
+        result = self._read( 'autocomplete_predicates', tag_service_key = CC.LOCAL_TAG_SERVICE_KEY, search_text = 'ca*', add_namespaceless = False, max_results = 1 )
+        
+        ( read_pred, ) = result
+        
+        self.assertEqual( read_pred, ClientSearch.Predicate( HC.PREDICATE_TYPE_TAG, 'cat' ) )
+        
+        self.assertEqual( read_pred.GetCount( HC.CONTENT_STATUS_CURRENT ), 3 )
+        
+    
     def test_export_folders( self ):
         
         file_search_context = ClientSearch.FileSearchContext(file_service_key = HydrusData.GenerateKey(), tag_service_key = HydrusData.GenerateKey(), predicates = [ ClientSearch.Predicate( HC.PREDICATE_TYPE_TAG, 'test' ) ] )
@@ -1057,6 +1102,69 @@ class TestClientDB( unittest.TestCase ):
         self.assertEqual( result, ( False, [ ':', 'series:' ] ) )
         
     
+    def test_tag_siblings_and_parents( self ):
+        
+        TestClientDB._clear_db()
+        
+        hash = b'\xadm5\x99\xa6\xc4\x89\xa5u\xeb\x19\xc0&\xfa\xce\x97\xa9\xcdey\xe7G(\xb0\xce\x94\xa6\x01\xd22\xf3\xc3'
+        
+        path = os.path.join( HC.STATIC_DIR, 'hydrus.png' )
+        
+        file_import_job = ClientImportFileSeeds.FileImportJob( path )
+        
+        file_import_job.GenerateHashAndStatus()
+        
+        file_import_job.GenerateInfo()
+        
+        self._write( 'import_file', file_import_job )
+        
+        #
+        
+        content_updates = []
+        
+        content_updates.append( HydrusData.ContentUpdate( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD, ( 'samus aran', ( hash, ) ) ) )
+        content_updates.append( HydrusData.ContentUpdate( HC.CONTENT_TYPE_TAG_SIBLINGS, HC.CONTENT_UPDATE_ADD, ( 'samus', 'samus aran' ) ) )
+        content_updates.append( HydrusData.ContentUpdate( HC.CONTENT_TYPE_TAG_PARENTS, HC.CONTENT_UPDATE_ADD, ( 'samus', 'metroid' ) ) )
+        
+        self._write( 'content_updates', { CC.LOCAL_TAG_SERVICE_KEY : content_updates } )
+        
+        # the parent of the worse sibling is filled in for the better one
+        
+        result = self._read( 'autocomplete_predicates', tag_service_key = CC.LOCAL_TAG_SERVICE_KEY, search_text = 'metroid', exact_match = True )
+        
+        ( read_pred, ) = result
+        
+        self.assertEqual( read_pred.GetCount( HC.CONTENT_STATUS_CURRENT ), 1 )
+        
+        self.assertEqual( read_pred, ClientSearch.Predicate( HC.PREDICATE_TYPE_TAG, 'metroid', min_current_count = 1 ) )
+        
+        # searching for the worse sibling finds the better one
+        
+        result = self._read( 'autocomplete_predicates', tag_service_key = CC.LOCAL_TAG_SERVICE_KEY, search_text = 'samus', exact_match = True )
+        
+        ( read_pred, ) = result
+        
+        self.assertEqual( read_pred, ClientSearch.Predicate( HC.PREDICATE_TYPE_TAG, 'samus aran', min_current_count = 1 ) )
+        
+        # the lazy managers' lookups, where parents hang off the better sibling
+        
+        self.assertEqual( self._read( 'tag_siblings_lookup', CC.LOCAL_TAG_SERVICE_KEY, [ 'samus', 'samus aran', 'not a tag' ] ), { 'samus' : 'samus aran' } )
+        self.assertEqual( self._read( 'tag_siblings_reverse_lookup', CC.LOCAL_TAG_SERVICE_KEY, [ 'samus aran', 'metroid' ] ), { 'samus aran' : [ 'samus' ] } )
+        self.assertEqual( self._read( 'tag_parents_lookup', CC.LOCAL_TAG_SERVICE_KEY, [ 'samus', 'samus aran', 'metroid' ] ), { 'samus aran' : [ 'metroid' ] } )
+        
+        #
+        
+        content_updates = []
+        
+        content_updates.append( HydrusData.ContentUpdate( HC.CONTENT_TYPE_TAG_SIBLINGS, HC.CONTENT_UPDATE_DELETE, ( 'samus', 'samus aran' ) ) )
+        
+        self._write( 'content_updates', { CC.LOCAL_TAG_SERVICE_KEY : content_updates } )
+        
+        result = self._read( 'autocomplete_predicates', tag_service_key = CC.LOCAL_TAG_SERVICE_KEY, search_text = 'samus', exact_match = True )
+        
+        self.assertEqual( result, [] )
+        
+    
     def test_nums_pending( self ):
         
         result = self._read( 'nums_pending' )
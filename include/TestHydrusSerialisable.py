@@ -18,6 +18,7 @@ from . import HydrusData
 from . import HydrusNetwork
 from . import HydrusSerialisable
 from . import TestController as TC
+import json
 import os
 import unittest
 import wx
@@ -152,6 +153,74 @@ class TestSerialisables( unittest.TestCase ):
             
         
     
+    def test_SERIALISABLE_TYPE_CONTENT_UPDATE( self ):
+        
+        getter_names = [ 'GetNewFiles', 'GetDeletedFiles', 'GetNewMappings', 'GetDeletedMappings', 'GetNewTagParents', 'GetDeletedTagParents', 'GetNewTagSiblings', 'GetDeletedTagSiblings' ]
+        
+        def normalise( rows ):
+            
+            return json.loads( json.dumps( list( rows ) ) )
+            
+        
+        def test( obj, dupe_obj ):
+            
+            self.assertEqual( obj.GetNumRows(), dupe_obj.GetNumRows() )
+            
+            for getter_name in getter_names:
+                
+                self.assertEqual( normalise( getattr( obj, getter_name )() ), normalise( getattr( dupe_obj, getter_name )() ) )
+                
+            
+        
+        content_update = HydrusNetwork.ContentUpdate()
+        
+        for i in range( 100 ):
+            
+            content_update.AddRow( ( HC.CONTENT_TYPE_FILES, HC.CONTENT_UPDATE_ADD, ( i, 1024, HC.IMAGE_JPEG, 5, 640, 480, None, None, None ) ) )
+            
+        
+        content_update.AddRow( ( HC.CONTENT_TYPE_FILES, HC.CONTENT_UPDATE_DELETE, 200 ) )
+        
+        # big enough to run over several decompression blocks
+        
+        content_update.AddRow( ( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD, ( 1, list( range( 0, 5000000, 7 ) ) ) ) )
+        content_update.AddRow( ( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_ADD, ( 2, [ 3, 5 ] ) ) )
+        content_update.AddRow( ( HC.CONTENT_TYPE_MAPPINGS, HC.CONTENT_UPDATE_DELETE, ( 3, [ 7 ] ) ) )
+        content_update.AddRow( ( HC.CONTENT_TYPE_TAG_SIBLINGS, HC.CONTENT_UPDATE_ADD, ( 4, 5 ) ) )
+        
+        self._dump_and_load_and_test( content_update, test )
+        
+        streamed_content_update = HydrusNetwork.CreateStreamedContentUpdate( content_update.DumpToNetworkBytes() )
+        
+        test( content_update, streamed_content_update )
+        
+        self.assertEqual( streamed_content_update.GetNumRows(), 100 + 1 + len( range( 0, 5000000, 7 ) ) + 2 + 1 + 1 )
+        
+        self.assertEqual( list( streamed_content_update.GetNewTagParents() ), [] )
+        
+        def iterate_content( obj ):
+            
+            return { ( content_type, action ) : normalise( rows ) for ( content_type, action, rows ) in obj.IterateContent() }
+            
+        
+        self.assertEqual( iterate_content( content_update ), iterate_content( streamed_content_update ) )
+        
+        # a block that is only partly read is skipped past before the next one
+        
+        blocks_seen = []
+        
+        for ( content_type, action, rows ) in streamed_content_update.IterateContent():
+            
+            next( rows )
+            
+            blocks_seen.append( ( content_type, action ) )
+            
+        
+        self.assertEqual( blocks_seen, list( iterate_content( content_update ).keys() ) )
+        
+        test( content_update, HydrusSerialisable.CreateFromString( streamed_content_update.DumpToString() ) )
+        
+    
     def test_SERIALISABLE_TYPE_DUPLICATE_ACTION_OPTIONS( self ):
         
         def test( obj, dupe_obj ):
@@ -935,3 +935,65 @@ class TestTagSiblings( unittest.TestCase ):
         self.assertEqual( self._tag_siblings_manager.CollapseTagsToCount( self._first_key, { 'tree_1' : 10, 'tree_2' : 3, 'tree_3' : 5, 'tree_4' : 2, 'tree_5' : 20, 'tree_6' : 30 } ), { 'tree_6' : 70 } )
         
     
+class TestTagSiblingsLazy( unittest.TestCase ):
+    
+    @classmethod
+    def setUpClass( cls ):
+        
+        cls._first_key = HydrusData.GenerateKey()
+        
+        cls._old_cache_size = HC.TAG_RELATIONSHIP_CACHE_SIZE
+        
+        HC.TAG_RELATIONSHIP_CACHE_SIZE = 2
+        
+        HG.test_controller.SetRead( 'tag_siblings_lookup', { 'chain_a' : 'chain_c', 'chain_b' : 'chain_c' } )
+        HG.test_controller.SetRead( 'tag_siblings_reverse_lookup', { 'chain_c' : [ 'chain_a', 'chain_b' ] } )
+        
+        cls._tag_siblings_manager = ClientCaches.TagSiblingsManager( HG.client_controller )
+        
+    
+    @classmethod
+    def tearDownClass( cls ):
+        
+        HC.TAG_RELATIONSHIP_CACHE_SIZE = cls._old_cache_size
+        
+    
+    def test_cache( self ):
+        
+        tag_siblings_manager = ClientCaches.TagSiblingsManager( HG.client_controller )
+        
+        tag_siblings_manager.Prefetch( { self._first_key : { 'chain_a', 'chain_b' } } )
+        
+        HG.test_controller.SetRead( 'tag_siblings_lookup', {} )
+        
+        try:
+            
+            # what was looked up stays cached, up to the cache size
+            
+            self.assertEqual( tag_siblings_manager.CollapseTag( self._first_key, 'chain_a' ), 'chain_c' )
+            self.assertEqual( tag_siblings_manager.CollapseTag( self._first_key, 'chain_b' ), 'chain_c' )
+            
+            self.assertEqual( tag_siblings_manager.CollapseTag( self._first_key, 'chain_c' ), 'chain_c' )
+            
+            self.assertEqual( tag_siblings_manager.CollapseTag( self._first_key, 'chain_a' ), 'chain_a' )
+            
+        finally:
+            
+            HG.test_controller.SetRead( 'tag_siblings_lookup', { 'chain_a' : 'chain_c', 'chain_b' : 'chain_c' } )
+            
+        
+    
+    def test_chain( self ):
+        
+        self.assertEqual( self._tag_siblings_manager.GetSibling( self._first_key, 'chain_a' ), 'chain_c' )
+        self.assertEqual( self._tag_siblings_manager.GetSibling( self._first_key, 'chain_c' ), None )
+        
+        self.assertEqual( set( self._tag_siblings_manager.GetAllSiblings( self._first_key, 'chain_a' ) ), set( [ 'chain_a', 'chain_b', 'chain_c' ] ) )
+        self.assertEqual( set( self._tag_siblings_manager.GetAllSiblings( self._first_key, 'chain_c' ) ), set( [ 'chain_a', 'chain_b', 'chain_c' ] ) )
+        self.assertEqual( set( self._tag_siblings_manager.GetAllSiblings( self._first_key, 'not_exist' ) ), set( [ 'not_exist' ] ) )
+        
+        self.assertEqual( set( self._tag_siblings_manager.CollapseTags( self._first_key, [ 'chain_a', 'chain_b', 'chain_c', 'not_exist' ] ) ), set( [ 'chain_c', 'not_exist' ] ) )
+        
+        self.assertEqual( self._tag_siblings_manager.CollapseTagsToCount( self._first_key, { 'chain_a' : 10, 'chain_b' : 5, 'chain_c' : 20 } ), { 'chain_c' : 35 } )
+        
+    
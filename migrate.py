@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+# copies a sqlite hydrus client's database into the mysql database set in config.yaml
+# run it again after a failure and it picks up from the tables it had not finished
+
+import argparse
+
+from include import ClientMigration
+
+if __name__ == '__main__':
+    
+    argparser = argparse.ArgumentParser( description = 'hydrus sqlite to mysql migration' )
+    
+    argparser.add_argument( 'db_dir', help = 'the directory holding client.db, client.caches.db, client.mappings.db and client.master.db' )
+    argparser.add_argument( '-p', '--processes', type = int, help = 'how many tables to load at once (default: one per cpu)' )
+    argparser.add_argument( '-e', '--engine', help = 'storage engine for the new tables (default: the server\'s default)' )
+    
+    result = argparser.parse_args()
+    
+    ClientMigration.MigrateSQLiteDB( result.db_dir, num_processes = result.processes, engine = result.engine )
+    
@@ -0,0 +1,156 @@
+# times fetching one file's tags from a mappings table, on the old layout and on the current one with different partition counts
+# run it from the install dir, with config.yaml set up: python scripts/benchmark_mappings_schema.py --files 10000000 --tags-per-file 100
+# the defaults build a 1-billion-mapping table, about the size of the public tag repository. it needs a lot of disk and a few hours to load
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from include import ClientDB
+from include import HydrusDB
+
+LOAD_CHUNK_ROWS = 1000000
+
+# what _GenerateMappingsTables made for current_mappings_N before: the clustering key, a unique ( hash_id, tag_id ) covering index, and the two single column indexes
+LEGACY_CREATE_STATEMENTS = [
+    'CREATE TABLE {} ( tag_id INTEGER, hash_id INTEGER, PRIMARY KEY ( tag_id, hash_id ) ) ENGINE=RocksDB;',
+    'CREATE UNIQUE INDEX {}_hash_id_tag_id_index ON {} ( hash_id, tag_id );',
+    'CREATE INDEX {}_tag_id_index ON {} ( tag_id );',
+    'CREATE INDEX {}_hash_id_index ON {} ( hash_id );'
+]
+
+
+def generate_rows(num_files, tags_per_file, num_tags, seed):
+    # tag popularity is heavily skewed, a few tags are on most files and most tags are on a few
+    rng = random.Random(seed)
+
+    for hash_id in range(1, num_files + 1):
+        tag_ids = {int(num_tags * rng.random() ** 3) + 1 for i in range(tags_per_file)}
+
+        for tag_id in tag_ids:
+            yield (tag_id, hash_id)
+
+
+def load_table(cursor, table_name, rows):
+    chunk = []
+    num_rows = 0
+
+    for row in rows:
+        chunk.append(row)
+
+        if len(chunk) == LOAD_CHUNK_ROWS:
+            HydrusDB.LoadLinesIntoTable(cursor, table_name, ['tag_id', 'hash_id'], (HydrusDB.ConvertRowToLoadDataLine(r) for r in chunk))
+            num_rows += len(chunk)
+            chunk = []
+            print('  loaded {:,} rows'.format(num_rows), end='\r')
+
+    if len(chunk) > 0:
+        HydrusDB.LoadLinesIntoTable(cursor, table_name, ['tag_id', 'hash_id'], (HydrusDB.ConvertRowToLoadDataLine(r) for r in chunk))
+        num_rows += len(chunk)
+
+    print('  loaded {:,} rows'.format(num_rows))
+
+
+def time_queries(cursor, statement, params_list):
+    timings = []
+
+    for params in params_list:
+        started = time.perf_counter()
+        cursor.execute(statement, params)
+        cursor.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    timings.sort()
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+    return (statistics.mean(timings), percentile(0.5), percentile(0.95), percentile(0.99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='per-file tag fetch latency on mappings table layouts')
+    parser.add_argument('--database', default='hydrus_mappings_benchmark', help='scratch database, created and dropped by the benchmark')
+    parser.add_argument('--files', type=int, default=10000000)
+    parser.add_argument('--tags-per-file', type=int, default=100)
+    parser.add_argument('--tags', type=int, default=2000000, help='number of distinct tags')
+    parser.add_argument('--partitions', type=int, nargs='+', default=[0, 16, 64], help='partition counts to try for the current layout')
+    parser.add_argument('--samples', type=int, default=2000, help='files fetched per layout')
+    parser.add_argument('--batch', type=int, default=256, help='files per query for the batched fetch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='do not drop the scratch database at the end')
+    args = parser.parse_args()
+
+    connection = HydrusDB.GetStandaloneConnection(database=None, allow_local_infile=True)
+    connection.autocommit = True
+    cursor = connection.cursor()
+
+    cursor.execute('DROP DATABASE IF EXISTS ' + args.database + ';')
+    cursor.execute('CREATE DATABASE ' + args.database + ';')
+    cursor.execute('USE ' + args.database + ';')
+
+    # the server side copies are far more rows than one myrocks transaction may lock
+    cursor.execute('SET SESSION rocksdb_commit_in_the_middle = 1;')
+
+    try:
+        layouts = [('mappings_legacy', [statement.format('mappings_legacy', 'mappings_legacy') for statement in LEGACY_CREATE_STATEMENTS])]
+
+        for num_partitions in args.partitions:
+            table_name = 'mappings_current_{}'.format(num_partitions)
+
+            layouts.append((table_name, [ClientDB.GenerateMappingsTableCreateStatement(table_name, ['tag_id', 'hash_id'], num_partitions=num_partitions)]))
+
+        # the first table is loaded from the generator, the rest are filled from it server side
+        source_table_name = None
+
+        for (table_name, create_statements) in layouts:
+            print('building ' + table_name)
+
+            for create_statement in create_statements:
+                cursor.execute(create_statement)
+
+            started = time.perf_counter()
+
+            if source_table_name is None:
+                load_table(cursor, table_name, generate_rows(args.files, args.tags_per_file, args.tags, args.seed))
+                source_table_name = table_name
+            else:
+                cursor.execute('INSERT INTO ' + table_name + ' ( tag_id, hash_id ) SELECT tag_id, hash_id FROM ' + source_table_name + ';')
+
+            cursor.execute('ANALYZE TABLE ' + table_name + ';')
+            cursor.fetchall()
+
+            print('  took {:.0f}s'.format(time.perf_counter() - started))
+
+        rng = random.Random(args.seed + 1)
+
+        single_params = [(rng.randint(1, args.files),) for i in range(args.samples)]
+        batch_params = [tuple(rng.randint(1, args.files) for j in range(args.batch)) for i in range(max(1, args.samples // 10))]
+        batch_placeholders = ', '.join(['%s'] * args.batch)
+
+        print()
+        print('{:<24}{:>12}{:>10}{:>10}{:>10}{:>16}{:>10}'.format('layout', 'mean ms', 'p50', 'p95', 'p99', 'batch mean ms', 'p99'))
+
+        for (table_name, create_statements) in layouts:
+            # a warm-up pass, so every layout is timed from a similar cache state
+            time_queries(cursor, 'SELECT tag_id FROM ' + table_name + ' WHERE hash_id = %s;', single_params[:100])
+
+            single = time_queries(cursor, 'SELECT tag_id FROM ' + table_name + ' WHERE hash_id = %s;', single_params)
+            batch = time_queries(cursor, 'SELECT hash_id, tag_id FROM ' + table_name + ' WHERE hash_id IN ( ' + batch_placeholders + ' );', batch_params)
+
+            print('{:<24}{:>12.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>16.3f}{:>10.3f}'.format(table_name, single[0], single[1], single[2], single[3], batch[0], batch[3]))
+
+    finally:
+        if not args.keep:
+            cursor.execute('DROP DATABASE IF EXISTS ' + args.database + ';')
+
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()